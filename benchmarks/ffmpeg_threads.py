@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""
+Measures aggregate encoding throughput for 1, 2, and 4 concurrent ffmpeg
+encodes, with ffmpeg's default threading and with the cores partitioned
+between encoders the way ec2nommerd does it (see
+media_nommer.ec2nommerd.cpu_budget).
+
+Each encode renders the same synthetic clip, so no source media is needed.
+Run this on the instance type you're sizing for:
+
+    python benchmarks/ffmpeg_threads.py --frames 1500 --size 1280x720
+"""
+import os
+import sys
+import time
+import optparse
+import subprocess
+import multiprocessing
+
+def build_cmd(options, num_threads=None, cpus=None):
+    """
+    Assembles an ffmpeg command that encodes a synthetic clip to nowhere.
+    """
+    cmd = ['ffmpeg', '-y', '-loglevel', 'error',
+           '-f', 'lavfi',
+           '-i', 'testsrc=size=%s:rate=30' % options.size,
+           '-frames:v', str(options.frames),
+           '-c:v', options.codec]
+    if num_threads:
+        cmd += ['-threads', str(num_threads)]
+    cmd += ['-f', 'null', os.devnull]
+    if cpus:
+        cmd = ['taskset', '-c', ','.join([str(cpu) for cpu in cpus])] + cmd
+    return cmd
+
+def run_concurrent(options, num_encoders, partition):
+    """
+    Runs num_encoders encodes at once.
+
+    :returns: Aggregate frames per second.
+    """
+    num_cpus = multiprocessing.cpu_count()
+    threads_per_encoder = max(num_cpus // num_encoders, 1)
+
+    processes = []
+    start = time.time()
+    for index in range(num_encoders):
+        if partition:
+            first_cpu = (index * threads_per_encoder) % num_cpus
+            cpus = [(first_cpu + offset) % num_cpus
+                    for offset in range(threads_per_encoder)]
+            cmd = build_cmd(options, threads_per_encoder,
+                            options.pin and cpus or None)
+        else:
+            cmd = build_cmd(options)
+        processes.append(subprocess.Popen(cmd))
+
+    for process in processes:
+        if process.wait() != 0:
+            sys.exit("ffmpeg failed: %s" % ' '.join(cmd))
+    elapsed = time.time() - start
+    return (num_encoders * options.frames) / elapsed
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--frames', type='int', default=900,
+                      help="Frames per encode.")
+    parser.add_option('--size', default='1280x720',
+                      help="Frame size of the synthetic clip.")
+    parser.add_option('--codec', default='libx264',
+                      help="Video codec to encode with.")
+    parser.add_option('--no-pin', dest='pin', action='store_false',
+                      default=True,
+                      help="Partition thread counts, but don't pin to cores.")
+    parser.add_option('--concurrency', default='1,2,4',
+                      help="Comma-separated numbers of concurrent encodes.")
+    options, args = parser.parse_args()
+
+    print "%d cores, %d frames of %s per encode, %s" % (
+        multiprocessing.cpu_count(), options.frames, options.size,
+        options.codec)
+    print "%-12s %-16s %-16s" % ('encoders', 'default fps', 'partitioned fps')
+    for num_encoders in [int(num) for num in options.concurrency.split(',')]:
+        default_fps = run_concurrent(options, num_encoders, partition=False)
+        partitioned_fps = run_concurrent(options, num_encoders, partition=True)
+        print "%-12d %-16.1f %-16.1f" % (num_encoders, default_fps,
+                                         partitioned_fps)
+
+if __name__ == '__main__':
+    main()
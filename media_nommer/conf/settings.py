@@ -36,6 +36,33 @@ SQS_NEW_JOB_QUEUE_NAME = 'media_nommer'
 """Default: ``'media_nommer'``
 
 The SQS_ queue used to notify :doc:`../ec2nommerd` of new jobs."""
+JOB_PRIORITY_LANES = (
+    ('high', 6),
+    ('normal', 3),
+    ('low', 1),
+)
+"""Default: ``(('high', 6), ('normal', 3), ('low', 1))``
+
+The priority lanes that new jobs may be queued in, highest priority first.
+Each lane gets its own SQS_ queue, and has a weight. :doc:`../ec2nommerd` 
+pulls from the lanes in proportion to their weights, so lower priority
+lanes are never starved entirely. 
+
+The :py:data:`DEFAULT_JOB_PRIORITY` lane uses
+:py:data:`SQS_NEW_JOB_QUEUE_NAME` as its queue. Other lanes use
+:py:data:`SQS_NEW_JOB_QUEUE_NAME` with ``_<lane name>`` appended."""
+DEFAULT_JOB_PRIORITY = 'normal'
+"""Default: ``'normal'``
+
+The priority lane for jobs whose submission and preset don't specify one.
+This must be one of the lanes in :py:data:`JOB_PRIORITY_LANES`."""
+JOB_CACHE_AFFINITY = True
+"""Default: ``True``
+
+When ``True``, :doc:`../feederd` sends new jobs to a node that already has
+their source cached, if one has free slots. Each node has its own SQS_ queue
+for this, named after :py:data:`SQS_NEW_JOB_QUEUE_NAME` and its instance ID.
+See :py:data:`FEEDERD_AFFINITY_TIMEOUT`."""
 SQS_JOB_STATE_CHANGE_QUEUE_NAME = 'media_nommer_jstate'
 """Default: ``'media_nommer_jstate'``
 
@@ -55,6 +82,12 @@ SIMPLEDB_EC2_NOMMER_STATE_DOMAIN = 'media_nommer_ec2nommer_state'
 
 The SimpleDB_ domain for storing heartbeat information from the
 EC2_ encoder instances."""
+SIMPLEDB_FINGERPRINT_DOMAIN = 'media_nommer_fingerprints'
+"""Default: ``'media_nommer_fingerprints'``
+
+The SimpleDB_ domain that maps job fingerprints (source content, nommer, and
+options) to the job producing that output. See
+:py:data:`FEEDERD_DEDUPLICATE_JOBS`."""
 
 ########################
 # EC2 instance settings
@@ -77,28 +110,69 @@ EC2_INSTANCE_TYPE = 'm1.large'
 
 The type of instance to run on. Must be at least ``m1.large``. ``t1.micro`` 
 and ``t1.small`` instances are *NOT* supported by the default AMI."""
+EC2_UPGRADE_ON_BOOT = True
+"""Default: ``True``
+
+When ``True``, newly launched EC2_ instances upgrade media-nommer via 
+:command:`pip` before starting :doc:`../ec2nommerd`. This adds a good bit
+to boot times. If your AMI already has the version of media-nommer you want,
+set this to ``False``."""
 
 ###############################
 # Intelligent scaling settings
 ###############################
 
-MAX_ENCODING_JOBS_PER_EC2_INSTANCE = 2
-"""Default: ``2``
+MAX_ENCODING_JOBS_PER_EC2_INSTANCE = None
+"""Default: ``None``
 
 The maximum number of jobs that should ever run on a single EC2_ instance at
-the same time."""
+the same time. When ``None``, each instance works this out for itself from 
+its CPU count and memory (see :py:data:`NOMMERD_CPUS_PER_JOB` and
+:py:data:`NOMMERD_MEMORY_MB_PER_JOB`), and reports it to :doc:`../feederd`."""
+AUTOSCALE_DEFAULT_SLOTS_PER_INSTANCE = 2
+"""Default: ``2``
+
+When :py:data:`MAX_ENCODING_JOBS_PER_EC2_INSTANCE` is ``None``, 
+:doc:`../feederd` assumes instances have this many encoding slots until 
+one of them reports in."""
 MAX_NUM_EC2_INSTANCES = 3
 """Default: ``3``
 
 The maximum number of EC2 instances to run at a time."""
-JOB_OVERFLOW_THRESH = 2
-"""Default: ``2``
+AUTOSCALE_TARGET_DRAIN_TIME = 3600
+"""Default: ``3600``
+
+:doc:`../feederd` tries to run enough EC2_ instances to get through all
+queued work within this many seconds, up to :py:data:`MAX_NUM_EC2_INSTANCES`.
+Queued work is estimated in encoder-seconds from the size of each job's 
+source media and the observed throughput of its preset."""
+AUTOSCALE_INSTANCE_BOOT_TIME = 60 * 5
+"""Default: ``60 * 5``
+
+Roughly how long (in seconds) it takes for a new EC2_ instance to boot and 
+start encoding. New instances don't contribute during this time."""
+AUTOSCALE_MIN_WORK_PER_NEW_INSTANCE = 60 * 15
+"""Default: ``60 * 15``
+
+You pay for an entire hour when you start an EC2_ instance (see 
+:py:data:`NOMMERD_MAX_INACTIVITY`). An extra instance won't be spawned to 
+cover less than this many encoder-seconds of left-over work."""
+AUTOSCALE_DEFAULT_BYTES_PER_SECOND = 512 * 1024
+"""Default: ``512 * 1024``
 
-If the number of unfinished jobs exceeds our capacity 
-(:py:data:`MAX_ENCODING_JOBS_PER_EC2_INSTANCE` * 
-``<Number of Active EC2 instances>``) by this number of jobs, look at starting 
-new instances if we have not already exceeded 
-:py:data:`MAX_NUM_EC2_INSTANCES`."""
+The assumed number of source bytes an encoding slot gets through per second,
+for presets that haven't finished any jobs yet. Once jobs finish, the
+observed throughput for each preset is used instead."""
+AUTOSCALE_DEFAULT_JOB_SECONDS = 60 * 10
+"""Default: ``60 * 10``
+
+The assumed number of encoder-seconds a job takes when the size of its source
+media couldn't be determined."""
+AUTOSCALE_THROUGHPUT_SMOOTHING = 0.3
+"""Default: ``0.3``
+
+How much weight each finished job gets in its preset's moving average 
+throughput. Higher values adapt faster, lower values are steadier."""
 
 ###################
 # feederd settings
@@ -107,7 +181,157 @@ new instances if we have not already exceeded
 FEEDERD_JOB_STATE_CHANGE_CHECK_INTERVAL = 60
 """Default: ``60``
 
-How often :doc:`../feederd` will check for job state changes."""
+The longest :doc:`../feederd` will wait between checks for job state changes.
+When the state change queue is empty, the delay between checks backs off
+exponentially until it reaches this value."""
+FEEDERD_JOB_STATE_CHANGE_MIN_CHECK_INTERVAL = 5
+"""Default: ``5``
+
+The delay (in seconds) between job state change checks while state changes
+are coming in. See :py:data:`FEEDERD_JOB_STATE_CHANGE_CHECK_INTERVAL`."""
+FEEDERD_JOB_STATE_CHANGE_MAX_RECEIVERS = 4
+"""Default: ``4``
+
+While draining the state change queue, :doc:`../feederd` adds concurrent
+receivers for as long as batches keep coming back full. This is the most
+receivers that will be used at once."""
+FEEDERD_JOB_STATE_CHANGE_MAX_DRAIN = 1000
+"""Default: ``1000``
+
+The maximum number of state change messages to drain per check. This keeps
+a single check from running indefinitely under a sustained flood."""
+FEEDERD_AFFINITY_TIMEOUT = 60 * 2
+"""Default: ``60 * 2``
+
+How long (in seconds) a job routed to a node that has its source cached 
+waits for that node before it is moved to its priority lane, where any 
+node can take it. See :py:data:`JOB_CACHE_AFFINITY`."""
+FEEDERD_AFFINITY_CHECK_INTERVAL = 30
+"""Default: ``30``
+
+How often (in seconds) :doc:`../feederd` looks for routed jobs that have 
+waited longer than :py:data:`FEEDERD_AFFINITY_TIMEOUT`."""
+FEEDERD_DEDUPLICATE_JOBS = True
+"""Default: ``True``
+
+When ``True``, a job that would produce the same output as an earlier one
+(the same source content, nommer, and options) isn't encoded again. If the
+earlier job is going to the same destination, its ID is handed back. If not,
+a node copies its output over to the new destination once it's done, which
+is a server-side copy for S3_. Sources without an ETag are always encoded."""
+FEEDERD_WEB_THREADS = 10
+"""Default: ``10``
+
+The most threads :doc:`../feederd`'s JSON API uses for talking to AWS_.
+Requests past this many wait their turn, without holding up the rest of
+:doc:`../feederd`."""
+FEEDERD_MAX_BATCH_SIZE = 1000
+"""Default: ``1000``
+
+The most jobs that can be submitted in one request to
+``/job/submit_batch``. See :doc:`../jsonapi`."""
+FEEDERD_CLIENT_SUBMIT_RATE = None
+"""Default: ``None``
+
+How many jobs a second each API client may submit, on average. Clients
+that go over get a ``429`` response, with a ``Retry-After`` header. If
+``None``, clients aren't rate limited. Presets may be rate limited too, with
+``submit_rate`` and ``submit_burst`` keys. See :py:data:`PRESETS`."""
+FEEDERD_CLIENT_SUBMIT_BURST = 100
+"""Default: ``100``
+
+How many jobs each API client may submit in a burst, over and above
+:py:data:`FEEDERD_CLIENT_SUBMIT_RATE`."""
+FEEDERD_CLIENT_HEADER = None
+"""Default: ``None``
+
+The HTTP header that API clients are told apart by for rate limiting, like
+``X-Api-Client``. If ``None``, or the header is missing, the client's IP
+is used. Set this if :doc:`../feederd` is behind a load balancer."""
+FEEDERD_MAX_BACKLOG_SECONDS = None
+"""Default: ``None``
+
+Once the un-finished jobs are estimated to need this many encoder-seconds,
+new submissions get a ``429`` response until the backlog shrinks. If
+``None``, there is no limit."""
+FEEDERD_BACKLOG_RETRY_AFTER = 60
+"""Default: ``60``
+
+The ``Retry-After`` (in seconds) sent back with submissions turned away
+because of :py:data:`FEEDERD_MAX_BACKLOG_SECONDS`."""
+FEEDERD_FINISHED_JOB_CACHE_SIZE = 1000
+"""Default: ``1000``
+
+How many recently finished jobs :doc:`../feederd` keeps in memory, so that
+clients checking on them through the JSON API don't cost a trip to
+SimpleDB_."""
+FEEDERD_NOTIFY_CONCURRENCY = 10
+"""Default: ``10``
+
+The most job completion notifications (see the ``notify_url`` in 
+:doc:`../jsonapi`) that :doc:`../feederd` sends at once."""
+FEEDERD_NOTIFY_TIMEOUT = 30
+"""Default: ``30``
+
+How long (in seconds) a notification's ``notify_url`` has to respond before
+the attempt counts as failed."""
+FEEDERD_NOTIFY_RETRY_DELAY = 30
+"""Default: ``30``
+
+How long (in seconds) to wait before retrying a failed notification. This
+doubles with each failure, up to :py:data:`FEEDERD_NOTIFY_MAX_RETRY_DELAY`."""
+FEEDERD_NOTIFY_MAX_RETRY_DELAY = 60 * 60
+"""Default: ``60 * 60``
+
+The longest (in seconds) to wait between tries of a failed notification."""
+FEEDERD_NOTIFY_MAX_ATTEMPTS = 10
+"""Default: ``10``
+
+How many times a notification is tried before it's given up on."""
+FEEDERD_NOTIFY_CHECK_INTERVAL = 5
+"""Default: ``5``
+
+How often (in seconds) :doc:`../feederd` looks for failed notifications that
+are due for another try. Changes to the undelivered notifications are written
+to :py:data:`FEEDERD_NOTIFY_RETRY_FILE` this often too, so up to this much of
+them may be lost if feederd crashes."""
+FEEDERD_NOTIFY_RETRY_FILE = None
+"""Default: ``None``
+
+The file undelivered notifications are kept in, so that they survive
+restarts. If ``None``, ``feederd-notifications.json`` in the system's
+temporary directory is used. Point this somewhere that survives reboots in
+production."""
+FEEDERD_EVENTS_MAX_BUFFER = 1000
+"""Default: ``1000``
+
+How many events are held for a ``/job/events`` client that can't keep up.
+Once it falls this far behind, it's disconnected, so that one slow client
+can't eat up :doc:`../feederd`'s memory."""
+FEEDERD_EVENTS_KEEPALIVE_INTERVAL = 15
+"""Default: ``15``
+
+How often (in seconds) a comment is sent to ``/job/events`` clients, so
+that idle connections aren't closed by proxies along the way."""
+FEEDERD_SUBMISSION_LOG = True
+"""Default: ``True``
+
+If ``True``, new jobs are written to a local log and acknowledged right
+away, then saved to SimpleDB_ and queued up in SQS_ in the background. A
+slow or erroring AWS_ then doesn't hold up or lose submissions, and jobs
+left over when :doc:`../feederd` goes down are picked up when it comes back.
+If ``False``, jobs are saved and queued up before the client hears back."""
+FEEDERD_SUBMISSION_LOG_FILE = None
+"""Default: ``None``
+
+The file that :py:data:`FEEDERD_SUBMISSION_LOG` is kept in. If ``None``,
+``feederd-submissions.log`` in the system's temporary directory is used.
+Point this somewhere that survives reboots in production."""
+FEEDERD_SUBMISSION_LOG_FLUSH_INTERVAL = 1
+"""Default: ``1``
+
+How often (in seconds) jobs in the :py:data:`FEEDERD_SUBMISSION_LOG` are
+saved and queued up."""
 FEEDERD_PRUNE_JOBS_INTERVAL = 60 * 5
 """Default: ``60 * 5``
 
@@ -126,6 +350,45 @@ FEEDERD_AUTO_SCALE_INTERVAL = 60
 
 How often :doc:`../feederd` should see if it needs to spawn additional
 EC2_ instances."""
+FEEDERD_FLEET_CONTROLLER = True
+"""Default: ``True``
+
+When ``True`` (and :py:data:`FEEDERD_ALLOW_EC2_LAUNCHES` is ``True``), 
+:doc:`../feederd` pre-warms instances ahead of forecasted demand, and decides
+which idle instances retire. When ``False``, instances only spawn in reaction
+to queued work, and each instance decides on its own when to terminate."""
+FEEDERD_FLEET_WARM_SPARES = 0
+"""Default: ``0``
+
+The number of instances to keep running beyond what forecasted demand calls 
+for. Only used with :py:data:`FEEDERD_FLEET_CONTROLLER`."""
+FEEDERD_FORECAST_HISTORY_DAYS = 7
+"""Default: ``7``
+
+Demand for each hour of the day is forecast as the average of the work 
+submitted during that hour over this many past days. Only used with
+:py:data:`FEEDERD_FLEET_CONTROLLER`."""
+FEEDERD_RETIRE_BEFORE_BILLING_HOUR = 60 * 10
+"""Default: ``60 * 10``
+
+Idle instances are only retired within this many seconds of the end of their
+current billing hour, since the rest of the hour has already been paid for.
+This must be comfortably more than :py:data:`FEEDERD_AUTO_SCALE_INTERVAL`
+plus :py:data:`NOMMERD_HEARTBEAT_INTERVAL`, or the chance may be missed.
+Only used with :py:data:`FEEDERD_FLEET_CONTROLLER`."""
+FEEDERD_NODE_STALE_THRESH = 60 * 5
+"""Default: ``60 * 5``
+
+If an EC2_ instance hasn't sent a heartbeat in this many seconds, 
+:doc:`../feederd` counts it as dead capacity when deciding whether to spawn
+more instances. This should be a few multiples of 
+:py:data:`NOMMERD_HEARTBEAT_INTERVAL`."""
+FEEDERD_EC2_RECONCILE_INTERVAL = 60 * 10
+"""Default: ``60 * 10``
+
+How often (in seconds) :doc:`../feederd` asks EC2_ for the full list of 
+media-nommer instances. In between, it goes by the instances it has spawned
+and the heartbeats it has received."""
 
 ###################
 # nommerd settings
@@ -143,21 +406,182 @@ NOMMERD_MAX_INACTIVITY = 60 * 50
 """Default: ``60 * 50``
 
 How many seconds of inactivity (not working on any jobs) before an
-instance will terminate itself."""
-NOMMERD_HEARTBEAT_INTERVAL = 60
-"""Default: ``60``
-
-Used by EC2_ nodes to determine how long to wait between sending a status 
-update via SimpleDB_. The node will also check for inactivity greater than the 
+instance will terminate itself. When :py:data:`FEEDERD_FLEET_CONTROLLER` is
+in use, instances follow :doc:`../feederd`'s lead instead, and only fall back
+to this if they haven't heard from :doc:`../feederd` in this long."""
+NOMMERD_HEARTBEAT_INTERVAL = 60 * 2
+"""Default: ``60 * 2``
+
+The longest EC2_ nodes will wait between sending a status update via 
+SimpleDB_. Nodes heartbeat more often while their state is changing (see 
+:py:data:`NOMMERD_HEARTBEAT_MIN_INTERVAL`), and back off to this while it 
+isn't. The node will also check for inactivity greater than the 
 configured value in :py:data:`NOMMERD_MAX_INACTIVITY`, and terminate itself if 
 inactivity has exceeded that value, and :py:data:`NOMMERD_TERMINATE_WHEN_IDLE` 
-is ``True``.
+is ``True``. Keep this comfortably below 
+:py:data:`FEEDERD_NODE_STALE_THRESH`.
 """
+NOMMERD_HEARTBEAT_MIN_INTERVAL = 15
+"""Default: ``15``
+
+How soon (in seconds) a node sends its next status update after its state
+has changed."""
+NOMMERD_HEARTBEAT_JITTER = 0.2
+"""Default: ``0.2``
+
+Each delay between heartbeats is randomly stretched or shrunk by up to this
+fraction, so that nodes launched together don't write to SimpleDB_ in
+lockstep."""
+NOMMERD_METADATA_URL = 'http://169.254.169.254/latest/meta-data/'
+"""Default: ``'http://169.254.169.254/latest/meta-data/'``
+
+Where EC2_ nodes look up their instance ID, type, and availability zone."""
+NOMMERD_METADATA_TIMEOUT = 2
+"""Default: ``2``
+
+How long (in seconds) to wait on :py:data:`NOMMERD_METADATA_URL` before
+deciding we're not running on EC2_."""
+NOMMERD_INSTANCE_METADATA = None
+"""Default: ``None``
+
+A dict of instance metadata values that override what the metadata service
+says. Valid keys are ``instance_id``, ``instance_type``, 
+``availability_zone``, ``num_cpus``, and ``memory_mb``. Setting 
+``instance_id`` skips the metadata service entirely. These can also be set
+with upper-cased, ``NOMMERD_`` prefixed environment variables (for example,
+``NOMMERD_NUM_CPUS``), which win out over this setting."""
+NOMMERD_CPUS_PER_JOB = 2
+"""Default: ``2``
+
+When :py:data:`MAX_ENCODING_JOBS_PER_EC2_INSTANCE` is ``None``, nodes allow
+one encoding job for every this many CPUs."""
+NOMMERD_MEMORY_MB_PER_JOB = 1536
+"""Default: ``1536``
+
+When :py:data:`MAX_ENCODING_JOBS_PER_EC2_INSTANCE` is ``None``, nodes allow
+no more than one encoding job for every this many megabytes of memory. With
+:py:data:`NOMMERD_ADAPTIVE_CONCURRENCY`, this is also the assumed memory 
+use of a job until the running encoders can be measured."""
+NOMMERD_ADAPTIVE_CONCURRENCY = True
+"""Default: ``True``
+
+When ``True``, nodes watch their CPU and memory usage, and only take on new
+jobs while there is headroom. :py:data:`MAX_ENCODING_JOBS_PER_EC2_INSTANCE`
+(or the CPU count, if that's ``None``) is then a ceiling rather than a 
+target. When ``False``, nodes stick to the number of jobs they start out
+with."""
+NOMMERD_RESOURCE_CHECK_INTERVAL = 15
+"""Default: ``15``
+
+How often (in seconds) nodes take CPU and memory readings. Only used with
+:py:data:`NOMMERD_ADAPTIVE_CONCURRENCY`."""
+NOMMERD_RESOURCE_SMOOTHING = 0.5
+"""Default: ``0.5``
+
+How much weight (0 to 1) the newest CPU reading gets over the previous 
+ones. Only used with :py:data:`NOMMERD_ADAPTIVE_CONCURRENCY`."""
+NOMMERD_TARGET_CPU_UTILIZATION = 0.9
+"""Default: ``0.9``
+
+Nodes take on more jobs until this fraction of their CPU time is in use. 
+CPU time stolen by the hypervisor counts against this. Only used with
+:py:data:`NOMMERD_ADAPTIVE_CONCURRENCY`."""
+NOMMERD_MAX_LOAD_PER_CPU = 2.0
+"""Default: ``2.0``
+
+Nodes that are already encoding won't start another job while their one 
+minute load average per CPU is above this. Only used with
+:py:data:`NOMMERD_ADAPTIVE_CONCURRENCY`."""
+NOMMERD_PARTITION_CPUS = True
+"""Default: ``True``
+
+When ``True``, each encoder is told to use the node's core count divided by
+its number of encoding slots as its thread count, rather than a thread per 
+core. This keeps concurrent encoders from fighting over the same cores. 
+Presets that set a thread count of their own are left alone."""
+NOMMERD_PIN_ENCODERS = False
+"""Default: ``False``
+
+When ``True`` (and :py:data:`NOMMERD_PARTITION_CPUS` is ``True``), each 
+encoder is also pinned to its own set of cores. This needs 
+:command:`taskset` on Python 2."""
+NOMMERD_FFMPEG_PROGRESS = True
+"""Default: ``True``
+
+When ``True``, ffmpeg is run with ``-progress``, and its progress is 
+published to the job's state details while it encodes. Set this to 
+``False`` if your ffmpeg build is too old to support ``-progress``."""
+NOMMERD_PROGRESS_UPDATE_INTERVAL = 30
+"""Default: ``30``
+
+The least number of seconds between progress updates for a job. Each update
+is a SimpleDB_ write and a state change notification to :doc:`../feederd`."""
+NOMMERD_FFMPEG_STDERR_LINES = 50
+"""Default: ``50``
+
+How many of the last lines of ffmpeg's stderr to keep for error reporting."""
+NOMMERD_SOURCE_CACHE_DIR = None
+"""Default: ``None``
+
+Where nodes keep their cache of recently used source media. If ``None``, a
+``nommerd-source-cache`` directory in the system's temporary directory is
+used. This should be on the same filesystem as the temporary directory, so
+that cached sources can be hard linked rather than copied."""
+NOMMERD_SOURCE_CACHE_BYTES = 1024 * 1024 * 1024 * 20
+"""Default: ``1024 * 1024 * 1024 * 20`` (20 GB)
+
+The most disk space (in bytes) each node's source cache may use. Set this 
+to ``0`` to turn the source cache off."""
+NOMMERD_SOURCE_CACHE_SUMMARY_BITS = 4096
+"""Default: ``4096``
+
+The size (in bits) of the Bloom filter that nodes advertise their cached 
+sources with. This goes out with each heartbeat, and SimpleDB_ values are 
+limited to 1024 bytes, so this can't be much more than 6000. See
+:py:data:`JOB_CACHE_AFFINITY`."""
+NOMMERD_SOURCE_CACHE_SUMMARY_HASHES = 4
+"""Default: ``4``
+
+How many bits each cached source sets in the Bloom filter. See
+:py:data:`NOMMERD_SOURCE_CACHE_SUMMARY_BITS`."""
+NOMMERD_SEGMENT_SECONDS = 60 * 5
+"""Default: ``60 * 5``
+
+The length (in seconds) of the segments that
+:py:class:`SegmentingNommer <media_nommer.ec2nommerd.nommers.segmenting.SegmentingNommer>`
+splits sources into. Segments are cut at the first keyframe after each
+multiple of this, so actual lengths vary a little."""
+SEGMENT_SCRATCH_URI = None
+"""Default: ``None``
+
+A URI (like ``s3://AWS_ID:AWS_SECRET@bucket/segments``) under which
+:py:class:`SegmentingNommer <media_nommer.ec2nommerd.nommers.segmenting.SegmentingNommer>`
+stores segments and their encoded output. Each job gets its own directory
+under this, which isn't cleaned up afterwards, so an S3 lifecycle rule on
+this prefix is a good idea. Segmented jobs fail if this isn't set."""
 NOMMERD_NEW_JOB_CHECK_INTERVAL = 60
 """Default: ``60``
 
 An interval (in seconds) to wait between calls to AWS_ to check for new 
 jobs."""
+NOMMERD_JOB_PREFETCH_DEPTH = 1
+"""Default: ``1``
+
+How many jobs beyond the number of free encoding slots a node will pull
+from the queue and hold on to. When a slot frees up, a prefetched job
+can start right away instead of waiting for the next check for new jobs."""
+NOMMERD_JOB_VISIBILITY_TIMEOUT = 60 * 10
+"""Default: ``60 * 10``
+
+How long (in seconds) a job's queue message stays hidden from other nodes
+after being received or extended. Nodes keep extending this for as long
+as they hold on to a job, so it only comes into play when a node dies."""
+NOMMERD_JOB_VISIBILITY_HEARTBEAT_INTERVAL = 60 * 3
+"""Default: ``60 * 3``
+
+How often (in seconds) a node extends the visibility timeout of the queue
+messages for the jobs it holds. This must be comfortably below
+:py:data:`NOMMERD_JOB_VISIBILITY_TIMEOUT`."""
 
 ##################
 #General settings
@@ -215,6 +639,13 @@ to specify some default values to be passed to whatever software the
 These may be over-ridden on a per-job basis. Anything in ``options`` merely
 serves as a default value.
 
+A preset may also specify a ``priority`` key, which is used for jobs that
+don't specify a priority of their own. See :py:data:`JOB_PRIORITY_LANES`.
+
+A preset may also be rate limited with ``submit_rate`` (jobs per second) and
+``submit_burst`` keys, which work like :py:data:`FEEDERD_CLIENT_SUBMIT_RATE`
+and :py:data:`FEEDERD_CLIENT_SUBMIT_BURST`.
+
 .. note:: The contents of the ``options`` dict will vary depending on which
     :ref:`Nommer <nommers>` you use. See your nommer's documentation for
     details on what this should look like.
@@ -0,0 +1,22 @@
+"""
+Job state backend exceptions
+"""
+class JobStateException(Exception):
+    """
+    A generic job state backend-related exception. Try to be more specific
+    in your code, just use this as a parent class.
+    """
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return repr(self.message)
+
+class JobStateConflictException(JobStateException):
+    """
+    Raised by :py:meth:`EncodingJob.save <media_nommer.core.job_state_backend.EncodingJob.save>`
+    when the job has been finished by someone else since our copy was
+    loaded. Finished jobs are never un-finished, so the save is given up on.
+    Also raised if the job keeps changing out from under us.
+    """
+    pass
@@ -15,12 +15,15 @@ There are two pieces to the job state backend:
 import random
 import hashlib
 import datetime
+from xml.etree import ElementTree
 import simplejson
 import boto
+from boto.exception import SQSError
 from boto.sqs.message import Message
 from media_nommer.conf import settings
 from media_nommer.utils import logger
 from media_nommer.utils.mod_importing import import_class_from_module_string
+from media_nommer.core.exceptions import JobStateConflictException
 
 class EncodingJob(object):
     """
@@ -35,7 +38,11 @@ class EncodingJob(object):
     def __init__(self, source_path, dest_path, nommer, job_options,
                  unique_id=None, job_state='PENDING', job_state_details=None,
                  notify_url=None, creation_dtime=None,
-                 last_modified_dtime=None):
+                 last_modified_dtime=None, job_state_version=0,
+                 priority=None, preset=None, source_size=None,
+                 source_etag=None, parent_id=None, segment_index=None,
+                 num_segments=None, output_states=None, fingerprint=None,
+                 depends_on=None, dest_size=None, dest_etag=None):
         """
         :param str source_path: The URI to the source media to encode.
         :param str dest_path: The URI to upload the encoded media to.
@@ -54,6 +61,41 @@ class EncodingJob(object):
             was created.
         :keyword datetime.datetime last_modified_dtime: The time when this job
             was last modified.
+        :keyword int job_state_version: A monotonically increasing counter
+            that is bumped every time the job is saved. This lets consumers
+            of the state change queue discard out-of-order or duplicate
+            notifications.
+        :keyword str priority: The priority lane to queue this job in. See
+            the :py:data:`JOB_PRIORITY_LANES <media_nommer.conf.settings.JOB_PRIORITY_LANES>`
+            setting. Defaults to
+            :py:data:`DEFAULT_JOB_PRIORITY <media_nommer.conf.settings.DEFAULT_JOB_PRIORITY>`.
+        :keyword str preset: The name of the preset the job was submitted
+            with, if any.
+        :keyword int source_size: The size of the source media (in bytes),
+            if it could be determined at submission time.
+        :keyword str source_etag: The ETag of the source media, if it could
+            be determined at submission time.
+        :keyword str parent_id: If this job is one piece of a larger job,
+            the unique ID of that job. See
+            :py:class:`SegmentingNommer <media_nommer.ec2nommerd.nommers.segmenting.SegmentingNommer>`.
+        :keyword int segment_index: If this job encodes one segment of its
+            parent's source, which one (counting from 0).
+        :keyword int num_segments: If this job's source was split into
+            segments, how many.
+        :keyword list output_states: For jobs with more than one output, the
+            state of each output, in the same order as the outputs in
+            ``job_options``.
+        :keyword str fingerprint: The job's fingerprint, as computed by
+            :py:meth:`get_fingerprint` when it was submitted, if
+            de-duplication was on.
+        :keyword str depends_on: The unique ID of a job that has to finish
+            before this one can be queued up. Jobs copying another job's
+            output wait on it this way.
+        :keyword int dest_size: The size of the output (in bytes), as
+            uploaded to ``dest_path``. Recorded when a job with a fingerprint
+            finishes, so the output can be checked before it's re-used.
+        :keyword str dest_etag: The ETag of the output, recorded along with
+            ``dest_size``.
         """
         self.source_path = source_path
         self.dest_path = dest_path
@@ -64,6 +106,30 @@ class EncodingJob(object):
         self.job_state = job_state
         self.job_state_details = job_state_details
         self.notify_url = notify_url
+        # SimpleDB hands everything back as strings.
+        self.job_state_version = int(job_state_version or 0)
+        self.priority = priority or settings.DEFAULT_JOB_PRIORITY
+        self.preset = preset
+        self.source_size = source_size
+        if self.source_size is not None:
+            self.source_size = int(self.source_size)
+        self.source_etag = source_etag
+        self.parent_id = parent_id
+        self.segment_index = segment_index
+        if self.segment_index is not None:
+            self.segment_index = int(self.segment_index)
+        self.num_segments = num_segments
+        if self.num_segments is not None:
+            self.num_segments = int(self.num_segments)
+        self.output_states = output_states
+        if isinstance(self.output_states, basestring):
+            self.output_states = simplejson.loads(self.output_states)
+        self.fingerprint = fingerprint
+        self.depends_on = depends_on
+        self.dest_size = dest_size
+        if self.dest_size is not None:
+            self.dest_size = int(self.dest_size)
+        self.dest_etag = dest_etag
 
         self.creation_dtime = creation_dtime
         if not self.creation_dtime:
@@ -121,14 +187,97 @@ class EncodingJob(object):
                                   random_salt)
         return hashlib.sha512(combo_str).hexdigest()[:50]
 
-    def save(self):
+    def get_fingerprint(self):
+        """
+        Unlike the unique ID, the fingerprint is the same for every job that
+        would produce the same output: the same source content, encoded by
+        the same nommer with the same options. The destination plays no part
+        in it. Used by :doc:`../feederd` to avoid encoding things twice.
+
+        :rtype: str
+        :returns: A hash of the job's source ETag and size, nommer, and
+            options, or ``None`` if the source's ETag isn't known.
+        """
+        if not self.source_etag:
+            return None
+        nommer = '%s.%s' % (self.nommer.__class__.__module__,
+                            self.nommer.__class__.__name__)
+        # Sorting the keys makes equal options serialize the same way.
+        job_options = simplejson.dumps(self.job_options, sort_keys=True,
+                                       separators=(',', ':'))
+        combo_str = "%s\n%s\n%s\n%s" % (self.source_etag, self.source_size,
+                                          nommer, job_options)
+        return hashlib.sha1(combo_str).hexdigest()
+
+    def _get_item_attributes(self, now_dtime):
+        """
+        Readies the job to be written to SimpleDB_, and serializes it. Every
+        call produces a new version of the job.
+
+        :param datetime.datetime now_dtime: The time of the write.
+        :rtype: dict
+        :returns: The SimpleDB attributes for the job's item.
+        """
+        if self.job_state_details and isinstance(self.job_state_details,
+                                                 basestring):
+            # Get within AWS's limitations. We'll assume that the error message
+            # is probably near the tail end of the output (hopefully). Not
+            # a great assumption, but it'll have to do.
+            self.job_state_details = self.job_state_details[-1023:]
+
+        # Every save produces a new version of the job. Anyone reading
+        # state changes can use this to tell old news from new.
+        self.job_state_version += 1
+
+        attributes = {}
+        attributes['unique_id'] = self.unique_id
+        attributes['source_path'] = self.source_path
+        attributes['dest_path'] = self.dest_path
+        attributes['nommer'] = '%s.%s' % (self.nommer.__class__.__module__,
+                                          self.nommer.__class__.__name__)
+        attributes['job_options'] = simplejson.dumps(self.job_options)
+        attributes['job_state'] = self.job_state
+        attributes['job_state_details'] = self.job_state_details
+        attributes['notify_url'] = self.notify_url
+        attributes['last_modified_dtime'] = now_dtime
+        attributes['creation_dtime'] = self.creation_dtime
+        attributes['job_state_version'] = self.job_state_version
+        attributes['priority'] = self.priority
+        attributes['preset'] = self.preset
+        attributes['source_size'] = self.source_size
+        attributes['source_etag'] = self.source_etag
+        attributes['parent_id'] = self.parent_id
+        attributes['segment_index'] = self.segment_index
+        attributes['num_segments'] = self.num_segments
+        if self.output_states is not None:
+            attributes['output_states'] = simplejson.dumps(self.output_states)
+        attributes['fingerprint'] = self.fingerprint
+        attributes['depends_on'] = self.depends_on
+        attributes['dest_size'] = self.dest_size
+        attributes['dest_etag'] = self.dest_etag
+        return attributes
+
+    # How many times a save is retried when someone else saves the job
+    # first.
+    SAVE_RETRIES = 5
+
+    def save(self, enqueue=True):
         """
         Serializes and saves the job to SimpleDB_. In the case of a newly
         instantiated job, also handles queueing the job up into the new job
         queue.
+
+        Existing jobs are only saved over the version we loaded. If someone
+        else has saved the job since, our changes are saved on top of their
+        version instead, so no two saves share a ``job_state_version``.
         
+        :keyword bool enqueue: If ``False``, a new job is not queued up.
+            The caller is then responsible for calling
+            :py:meth:`JobStateBackend.enqueue_job`.
         :rtype: str
         :returns: The unique ID of the job.
+        :raises: :py:exc:`JobStateConflictException <media_nommer.core.exceptions.JobStateConflictException>`
+            if someone else has finished the job since we loaded it.
         """
         # Is this a new job that needs creation?
         is_new_job = not self.unique_id
@@ -136,52 +285,85 @@ class EncodingJob(object):
         # creation time to updated time.
         now_dtime = datetime.datetime.now()
 
-        if is_new_job:
-            # This serves as the "FK" equivalent.
-            self.unique_id = self._generate_unique_job_id()
-            # Create the item in the domain.
-            job = JobStateBackend._get_sdb_job_state_domain().new_item(self.unique_id)
-            # Start populating values.
-            self.creation_dtime = now_dtime
-            self.job_state = 'PENDING'
-        else:
-            # Retrieve the existing item for the job.
-            job = JobStateBackend._get_sdb_job_state_domain().get_item(self.unique_id)
-            if job is None:
-                msg = 'EncodingJob.save(): ' \
-                      'No match found in DB for ID: %s' % self.unique_id
-                raise Exception(msg)
+        if not is_new_job:
+            self._save_over_version(now_dtime)
+            return self.unique_id
 
-        if self.job_state_details and isinstance(self.job_state_details,
-                                                 basestring):
-            # Get within AWS's limitations. We'll assume that the error message
-            # is probably near the tail end of the output (hopefully). Not
-            # a great assumption, but it'll have to do.
-            self.job_state_details = self.job_state_details[-1023:]
+        # This serves as the "FK" equivalent.
+        self.unique_id = self._generate_unique_job_id()
+        # Create the item in the domain.
+        job = JobStateBackend._get_sdb_job_state_domain().new_item(self.unique_id)
+        # Start populating values.
+        self.creation_dtime = now_dtime
+        self.job_state = 'PENDING'
 
-        job['unique_id'] = self.unique_id
-        job['source_path'] = self.source_path
-        job['dest_path'] = self.dest_path
-        job['nommer'] = '%s.%s' % (self.nommer.__class__.__module__,
-                                   self.nommer.__class__.__name__)
-        job['job_options'] = simplejson.dumps(self.job_options)
-        job['job_state'] = self.job_state
-        job['job_state_details'] = self.job_state_details
-        job['notify_url'] = self.notify_url
-        job['last_modified_dtime'] = now_dtime
-        job['creation_dtime'] = self.creation_dtime
+        for key, value in self._get_item_attributes(now_dtime).items():
+            job[key] = value
 
         logger.debug("EncodingJob.save(): Item pre-save values: %s" % job)
 
         job.save()
 
-        if is_new_job:
-            logger.debug("EncodingJob.save(): Enqueueing new job: %s" % self.unique_id)
-            sqs_message = Message(body=job['unique_id'])
-            JobStateBackend._get_sqs_new_job_queue().write(sqs_message)
+        if enqueue:
+            JobStateBackend.enqueue_job(self)
 
         return job['unique_id']
 
+    def _save_over_version(self, now_dtime):
+        """
+        Saves an existing job with a conditional put, which only goes through
+        if SimpleDB_ still has the version we loaded. If it doesn't, the
+        stored version is looked up and we try again on top of it.
+
+        :param datetime.datetime now_dtime: The time of the write.
+        :raises: :py:exc:`JobStateConflictException <media_nommer.core.exceptions.JobStateConflictException>`
+            if someone else has finished the job, or it keeps changing out
+            from under us.
+        """
+        domain = JobStateBackend._get_sdb_job_state_domain()
+        for attempt in range(self.SAVE_RETRIES):
+            loaded_version = self.job_state_version
+            if loaded_version:
+                expected_value = ['job_state_version', str(loaded_version)]
+            else:
+                # Saved before jobs had versions.
+                expected_value = ['job_state_version', False]
+            attributes = self._get_item_attributes(now_dtime)
+            logger.debug("EncodingJob.save(): Item pre-save values: %s" % attributes)
+            try:
+                domain.put_attributes(self.unique_id, attributes,
+                                      expected_value=expected_value)
+                return
+            except boto.exception.SDBResponseError, e:
+                self.job_state_version = loaded_version
+                if e.error_code not in ['ConditionalCheckFailed',
+                                        'AttributeDoesNotExist']:
+                    raise
+            except:
+                self.job_state_version = loaded_version
+                raise
+
+            # Someone else saved the job since we loaded it.
+            item = domain.get_item(self.unique_id, consistent_read=True)
+            if item is None:
+                msg = 'EncodingJob.save(): ' \
+                      'No match found in DB for ID: %s' % self.unique_id
+                raise Exception(msg)
+            stored_job = JobStateBackend._get_job_object_from_item(item)
+            if stored_job.is_finished():
+                raise JobStateConflictException('EncodingJob.save(): ' \
+                        'Job %s was already %s.' % (self.unique_id,
+                                                    stored_job.job_state))
+            logger.debug("EncodingJob.save(): Job %s went from v%d to v%d " \
+                         "under us, saving on top of it." % (
+                            self.unique_id, loaded_version,
+                            stored_job.job_state_version))
+            self.job_state_version = stored_job.job_state_version
+
+        raise JobStateConflictException('EncodingJob.save(): Job %s kept ' \
+                                        'changing, gave up saving it.' % (
+                                            self.unique_id))
+
     def _send_state_change_notification(self):
         """
         Send a message to a state change SQS that lets feederd know to
@@ -219,6 +401,27 @@ class EncodingJob(object):
         # Announce a change in state, if the backend supports such a thing.
         self._send_state_change_notification()
 
+    def get_progress(self):
+        """
+        Returns the encoding progress last published by the nommer, if it
+        publishes such a thing. See
+        :py:class:`FFmpegNommer <media_nommer.ec2nommerd.nommers.ffmpeg.FFmpegNommer>`.
+
+        :rtype: dict
+        :returns: A dict with keys like ``percent``, ``fps``, ``speed``, and
+            ``eta_seconds``, or ``None`` if there's no progress to report.
+        """
+        if self.job_state not in ['ENCODING', 'WAITING'] or \
+           not self.job_state_details:
+            return None
+        try:
+            progress = simplejson.loads(self.job_state_details)
+        except ValueError:
+            return None
+        if not isinstance(progress, dict):
+            return None
+        return progress
+
     def is_finished(self):
         """
         Returns True if this job is in a finished state.
@@ -229,6 +432,29 @@ class EncodingJob(object):
         """
         return self.job_state in JobStateBackend.FINISHED_STATES
 
+    def is_newer_than(self, other_job):
+        """
+        Determines whether this copy of a job represents a more recent state
+        than ``other_job``, which should be another copy of the same job.
+        State change notifications may arrive more than once and out of
+        order, so this is used to discard regressions.
+        
+        :param EncodingJob other_job: Another copy of this same job.
+        :rtype: bool
+        :returns: ``True`` if this copy is more recent than ``other_job``,
+            ``False`` if it is the same version or older.
+        """
+        if other_job.is_finished() and not self.is_finished():
+            # Finished jobs never go back to being un-finished.
+            return False
+
+        if self.job_state_version or other_job.job_state_version:
+            return self.job_state_version > other_job.job_state_version
+
+        # Neither copy has a version (saved before versioning was added).
+        # Fall back to the modification times.
+        return self.last_modified_dtime > other_job.last_modified_dtime
+
 class JobStateBackend(object):
     """
     Abstracts storing and retrieving job state information to and from
@@ -236,18 +462,34 @@ class JobStateBackend(object):
     which are instantiated and returned as needed.
     """
     JOB_STATES = ['PENDING', 'DOWNLOADING', 'ENCODING', 'UPLOADING',
-                  'FINISHED', 'ERROR', 'ABANDONED']
-    """All possible job states as a list of strings."""
+                  'WAITING', 'FINISHED', 'ERROR', 'ABANDONED']
+    """All possible job states as a list of strings. ``WAITING`` is for jobs
+    that have been split up, and are waiting on their child jobs."""
 
     FINISHED_STATES = ['FINISHED', 'ERROR', 'ABANDONED']
     """Any jobs in the following states are considered "finished" in that we
     won't do anything else with them. This is a list of strings."""
 
+    SDB_BATCH_SIZE = 25
+    """The most items SimpleDB_ takes in one ``BatchPutAttributes`` call."""
+
+    SDB_SELECT_IN_SIZE = 20
+    """The most values SimpleDB_ takes in a ``SELECT``'s ``IN`` clause."""
+
+    SQS_BATCH_SIZE = 10
+    """The most messages SQS_ takes in one ``SendMessageBatch`` call."""
+
+    SQS_BATCH_API_VERSION = '2011-10-01'
+    """The first SQS_ API version with ``SendMessageBatch``."""
+
     # The following AWS fields are for lazy-loading.
     __aws_sdb_connection = None
     __aws_sdb_job_state_domain = None
+    __aws_sdb_fingerprint_domain = None
     __aws_sqs_connection = None
-    __aws_sqs_new_job_queue = None
+    __aws_sqs_batch_connection = None
+    # Keys are priority lane names, values are boto SQS queues.
+    __aws_sqs_new_job_queues = {}
     __aws_sqs_state_change_queue = None
 
     @classmethod
@@ -277,6 +519,103 @@ class JobStateBackend(object):
                                         settings.SIMPLEDB_JOB_STATE_DOMAIN)
         return cls.__aws_sdb_job_state_domain
 
+    @classmethod
+    def _get_sdb_fingerprint_domain(cls):
+        """
+        Lazy-loading of the SimpleDB boto domain that maps job fingerprints
+        to jobs. Refer to this instead of referencing
+        cls.__aws_sdb_fingerprint_domain directly.
+
+        :returns: A boto SimpleDB domain.
+        """
+        if not cls.__aws_sdb_fingerprint_domain:
+            cls.__aws_sdb_fingerprint_domain = cls._get_sdb_connection().create_domain(
+                                        settings.SIMPLEDB_FINGERPRINT_DOMAIN)
+        return cls.__aws_sdb_fingerprint_domain
+
+    @classmethod
+    def get_job_id_for_fingerprint(cls, fingerprint):
+        """
+        Looks up the job that was last submitted to produce the output a
+        fingerprint describes. See :py:meth:`EncodingJob.get_fingerprint`.
+
+        :param str fingerprint: A job fingerprint.
+        :rtype: str
+        :returns: The job's unique ID, or ``None`` if there isn't one.
+        """
+        item = cls._get_sdb_fingerprint_domain().get_item(fingerprint,
+                                                          consistent_read=True)
+        if item is None:
+            return None
+        return item.get('job_id')
+
+    @classmethod
+    def set_job_id_for_fingerprint(cls, fingerprint, unique_id):
+        """
+        Records a job as the one producing the output a fingerprint
+        describes, replacing whatever was there.
+
+        :param str fingerprint: A job fingerprint.
+        :param str unique_id: The job's unique ID.
+        """
+        cls._get_sdb_fingerprint_domain().put_attributes(fingerprint,
+                                                         {'job_id': unique_id})
+
+    @classmethod
+    def set_job_ids_for_fingerprints(cls, fingerprints):
+        """
+        Like :py:meth:`set_job_id_for_fingerprint`, but for many jobs at
+        once, :py:data:`SDB_BATCH_SIZE` per request.
+
+        :param dict fingerprints: Keys are job fingerprints, values are the
+            unique IDs of the jobs producing their output.
+        """
+        items = [(fingerprint, {'job_id': unique_id})
+                 for fingerprint, unique_id in fingerprints.items()]
+        for start in range(0, len(items), cls.SDB_BATCH_SIZE):
+            cls._get_sdb_fingerprint_domain().batch_put_attributes(
+                            dict(items[start:start + cls.SDB_BATCH_SIZE]))
+
+    @classmethod
+    def save_new_jobs(cls, jobs):
+        """
+        Saves a bunch of new jobs to SimpleDB_ in as few requests as it can,
+        :py:data:`SDB_BATCH_SIZE` per request. Unlike
+        :py:meth:`EncodingJob.save`, this doesn't queue them up, see
+        :py:meth:`enqueue_jobs`.
+
+        :param list jobs: The new :py:class:`EncodingJob` objects. Jobs
+            that were given a unique ID ahead of time keep it.
+        :rtype: list
+        :returns: The jobs that couldn't be saved. Unique IDs given out
+            here are ``None`` again.
+        """
+        now_dtime = datetime.datetime.now()
+        failed_jobs = []
+        for start in range(0, len(jobs), cls.SDB_BATCH_SIZE):
+            batch = jobs[start:start + cls.SDB_BATCH_SIZE]
+            items = {}
+            new_ids = set()
+            for job in batch:
+                if not job.unique_id:
+                    job.unique_id = job._generate_unique_job_id()
+                    job.creation_dtime = now_dtime
+                    new_ids.add(job.unique_id)
+                job.job_state = 'PENDING'
+                items[job.unique_id] = job._get_item_attributes(now_dtime)
+
+            try:
+                cls._get_sdb_job_state_domain().batch_put_attributes(items)
+            except:
+                logger.error(message_or_obj="JobStateBackend.save_new_jobs(): " \
+                             "Unable to save a batch of %d jobs." % len(batch))
+                logger.error()
+                for job in batch:
+                    if job.unique_id in new_ids:
+                        job.unique_id = None
+                failed_jobs += batch
+        return failed_jobs
+
     @classmethod
     def _get_sqs_connection(cls):
         """
@@ -292,17 +631,192 @@ class JobStateBackend(object):
         return cls.__aws_sqs_connection
 
     @classmethod
-    def _get_sqs_new_job_queue(cls):
+    def get_priority_lanes(cls):
         """
-        Lazy - loading of the SQS boto queue. Refer to this instead of
-        referencing cls.__aws_sqs_new_job_queue directly.
+        Returns the names of the configured priority lanes, highest priority
+        first. See the
+        :py:data:`JOB_PRIORITY_LANES <media_nommer.conf.settings.JOB_PRIORITY_LANES>`
+        setting.
+        
+        :rtype: list
+        :returns: A list of priority lane names.
+        """
+        return [lane for lane, weight in settings.JOB_PRIORITY_LANES]
+
+    @classmethod
+    def get_new_job_queue_name(cls, priority=None):
+        """
+        Determines the SQS queue name for a priority lane. The default lane
+        uses :py:data:`SQS_NEW_JOB_QUEUE_NAME <media_nommer.conf.settings.SQS_NEW_JOB_QUEUE_NAME>`
+        as-is. Other lanes have their name appended to it.
+        
+        :keyword str priority: The priority lane. Defaults to 
+            :py:data:`DEFAULT_JOB_PRIORITY <media_nommer.conf.settings.DEFAULT_JOB_PRIORITY>`.
+        :rtype: str
+        :returns: The name of the SQS queue for the lane.
+        """
+        priority = priority or settings.DEFAULT_JOB_PRIORITY
+        if priority not in cls.get_priority_lanes():
+            raise Exception('Invalid job priority: %s' % priority)
+
+        if priority == settings.DEFAULT_JOB_PRIORITY:
+            return settings.SQS_NEW_JOB_QUEUE_NAME
+        return '%s_%s' % (settings.SQS_NEW_JOB_QUEUE_NAME, priority)
+
+    @classmethod
+    def _get_sqs_new_job_queue(cls, priority=None):
+        """
+        Lazy - loading of the SQS boto queue for a priority lane. Refer to this
+        instead of referencing cls.__aws_sqs_new_job_queues directly.
 
+        :keyword str priority: The priority lane. Defaults to 
+            :py:data:`DEFAULT_JOB_PRIORITY <media_nommer.conf.settings.DEFAULT_JOB_PRIORITY>`.
         :returns: A boto SQS queue.
         """
-        if not cls.__aws_sqs_new_job_queue:
-            cls.__aws_sqs_new_job_queue = cls._get_sqs_connection().create_queue(
-                settings.SQS_NEW_JOB_QUEUE_NAME)
-        return cls.__aws_sqs_new_job_queue
+        queue_name = cls.get_new_job_queue_name(priority)
+        if not cls.__aws_sqs_new_job_queues.has_key(queue_name):
+            cls.__aws_sqs_new_job_queues[queue_name] = cls._get_sqs_connection().create_queue(
+                queue_name)
+        return cls.__aws_sqs_new_job_queues[queue_name]
+
+    @classmethod
+    def get_node_job_queue_name(cls, instance_id):
+        """
+        Determines the name of the SQS queue that jobs are routed to when
+        they're meant for a particular node. See
+        :py:data:`JOB_CACHE_AFFINITY <media_nommer.conf.settings.JOB_CACHE_AFFINITY>`.
+
+        :param str instance_id: The node's EC2 instance ID.
+        :rtype: str
+        :returns: The name of the node's SQS queue.
+        """
+        return '%s_node_%s' % (settings.SQS_NEW_JOB_QUEUE_NAME, instance_id)
+
+    @classmethod
+    def _get_sqs_node_job_queue(cls, instance_id):
+        """
+        Lazy - loading of the SQS boto queue for jobs routed to a node.
+
+        :param str instance_id: The node's EC2 instance ID.
+        :returns: A boto SQS queue.
+        """
+        queue_name = cls.get_node_job_queue_name(instance_id)
+        if not cls.__aws_sqs_new_job_queues.has_key(queue_name):
+            cls.__aws_sqs_new_job_queues[queue_name] = cls._get_sqs_connection().create_queue(
+                queue_name)
+        return cls.__aws_sqs_new_job_queues[queue_name]
+
+    @classmethod
+    def enqueue_job(cls, job, instance_id=None):
+        """
+        Queues a job up to be encoded.
+
+        :param EncodingJob job: The job to queue up. It must have been saved.
+        :keyword str instance_id: If specified, the job is routed to this
+            node's queue. Otherwise it goes into its priority lane.
+        """
+        logger.debug("JobStateBackend.enqueue_job(): Enqueueing job: %s (%s)" % (
+                        job.unique_id, instance_id or job.priority))
+        sqs_message = Message(body=job.unique_id)
+        if instance_id:
+            queue = cls._get_sqs_node_job_queue(instance_id)
+        else:
+            queue = cls._get_sqs_new_job_queue(job.priority)
+        queue.write(sqs_message)
+
+    @classmethod
+    def _get_sqs_batch_connection(cls):
+        """
+        Lazy-loading of an SQS boto connection that speaks
+        :py:data:`SQS_BATCH_API_VERSION`. Our boto predates
+        ``SendMessageBatch``, and always sends the API version it was written
+        for, so batches go out over their own connection.
+
+        :returns: A boto connection to Amazon's SQS interface.
+        """
+        if not cls.__aws_sqs_batch_connection:
+            cls.__aws_sqs_batch_connection = boto.connect_sqs(
+                settings.AWS_ACCESS_KEY_ID,
+                settings.AWS_SECRET_ACCESS_KEY)
+            cls.__aws_sqs_batch_connection.APIVersion = cls.SQS_BATCH_API_VERSION
+        return cls.__aws_sqs_batch_connection
+
+    @classmethod
+    def _send_message_batch(cls, queue, bodies):
+        """
+        Sends up to :py:data:`SQS_BATCH_SIZE` messages to a queue in a
+        single ``SendMessageBatch`` request.
+
+        :param queue: A boto SQS queue.
+        :param list bodies: The message bodies, encoded the way the queue's
+            readers expect.
+        :rtype: list
+        :returns: The indices of the messages SQS turned down.
+        """
+        params = {}
+        for index, body in enumerate(bodies):
+            prefix = 'SendMessageBatchRequestEntry.%d' % (index + 1)
+            params['%s.Id' % prefix] = str(index)
+            params['%s.MessageBody' % prefix] = body
+
+        response = cls._get_sqs_batch_connection().make_request(
+                            'SendMessageBatch', params, queue.id, verb='POST')
+        body = response.read()
+        if response.status != 200:
+            raise SQSError(response.status, response.reason, body)
+
+        failed_indices = []
+        for element in ElementTree.fromstring(body).getiterator():
+            if not element.tag.endswith('BatchResultErrorEntry'):
+                continue
+            for child in element:
+                if child.tag.endswith('Id'):
+                    failed_indices.append(int(child.text))
+        return failed_indices
+
+    @classmethod
+    def enqueue_jobs(cls, jobs, instance_id=None):
+        """
+        Like :py:meth:`enqueue_job`, but for many jobs at once. They go out
+        :py:data:`SQS_BATCH_SIZE` per request. Any that SQS turns down are
+        sent one at a time.
+
+        :param list jobs: The :py:class:`EncodingJob` objects to queue up.
+            They must have been saved.
+        :keyword str instance_id: If specified, the jobs are routed to this
+            node's queue. Otherwise they go into their priority lanes.
+        """
+        # Keys are queue names, values are (queue, jobs) tuples.
+        queues = {}
+        for job in jobs:
+            if instance_id:
+                queue_name = cls.get_node_job_queue_name(instance_id)
+            else:
+                queue_name = cls.get_new_job_queue_name(job.priority)
+            if not queues.has_key(queue_name):
+                if instance_id:
+                    queue = cls._get_sqs_node_job_queue(instance_id)
+                else:
+                    queue = cls._get_sqs_new_job_queue(job.priority)
+                queues[queue_name] = (queue, [])
+            queues[queue_name][1].append(job)
+
+        for queue_name, (queue, queue_jobs) in queues.items():
+            logger.debug("JobStateBackend.enqueue_jobs(): Enqueueing %d " \
+                         "jobs in %s" % (len(queue_jobs), queue_name))
+            for start in range(0, len(queue_jobs), cls.SQS_BATCH_SIZE):
+                batch = queue_jobs[start:start + cls.SQS_BATCH_SIZE]
+                bodies = [Message(body=job.unique_id).get_body_encoded()
+                          for job in batch]
+                try:
+                    failed_indices = cls._send_message_batch(queue, bodies)
+                except:
+                    logger.error(message_or_obj="JobStateBackend.enqueue_jobs(): " \
+                                 "Batch send to %s failed." % queue_name)
+                    logger.error()
+                    failed_indices = range(len(batch))
+                for index in failed_indices:
+                    queue.write(Message(body=batch[index].unique_id))
 
     @classmethod
     def _get_sqs_state_change_queue(cls):
@@ -322,20 +836,32 @@ class JobStateBackend(object):
         """
         Given an SDB item, instantiate and return an EncodingJob.
         """
+        # SimpleDB stores everything as strings, None included. Turn those
+        # back into real Nones.
+        kwargs = {}
+        for key, value in item.items():
+            if value == 'None':
+                value = None
+            # __init__ doesn't like unicode keyword names.
+            kwargs[str(key)] = value
         # Pass the SDB item as a dict to be used as args to constructor.
-        job = EncodingJob(**item)
+        job = EncodingJob(**kwargs)
         return job
 
     @classmethod
-    def get_job_object_from_id(cls, unique_id):
+    def get_job_object_from_id(cls, unique_id, consistent_read=False):
         """
         Given a job's unique ID, return an EncodingJob instance.
         
         TODO: Make this raise a more specific exception.
         
         :param str unique_id: An :py:class:`EncodingJob`'s unique ID.
+        :keyword bool consistent_read: If ``True``, ask SimpleDB_ for a
+            consistent read. This is slower, but guarantees that the latest
+            saved version of the job is returned.
         """
-        item = cls._get_sdb_job_state_domain().get_item(unique_id)
+        item = cls._get_sdb_job_state_domain().get_item(
+                                    unique_id, consistent_read=consistent_read)
         if item is None:
             msg = 'JobStateBackend.get_job_object_from_id(): ' \
                   'No unique ID match for: % s' % unique_id
@@ -354,7 +880,10 @@ class JobStateBackend(object):
         """
         try:
             cls._get_sdb_connection().delete_domain(settings.SIMPLEDB_JOB_STATE_DOMAIN)
-            cls._get_sqs_new_job_queue().clear()
+            # The fingerprints point at the jobs we just deleted.
+            cls._get_sdb_connection().delete_domain(settings.SIMPLEDB_FINGERPRINT_DOMAIN)
+            for priority in cls.get_priority_lanes():
+                cls._get_sqs_new_job_queue(priority).clear()
         except boto.exception.SDBResponseError:
             # Tried to delete a domain that doesn't exist. We probably haven't
             # ran feederd before, or are doing testing.
@@ -362,8 +891,9 @@ class JobStateBackend(object):
 
         # Reset our local cache of the boto SDB domain object.
         cls.__aws_sdb_job_state_domain = None
-        # Reset our local cache of the boto SQS queue object.
-        cls.__aws_sqs_new_job_queue = None
+        cls.__aws_sdb_fingerprint_domain = None
+        # Reset our local cache of the boto SQS queue objects.
+        cls.__aws_sqs_new_job_queues.clear()
 
     @classmethod
     def get_unfinished_jobs(cls):
@@ -404,6 +934,162 @@ class JobStateBackend(object):
 
         return jobs
 
+    @classmethod
+    def get_child_jobs(cls, parent_id):
+        """
+        Queries SimpleDB for the jobs that a job has been split into.
+
+        :param str parent_id: The unique ID of the parent job.
+        :rtype: list
+        :returns: A list of :py:class:`EncodingJob` objects.
+        """
+        query_str = "SELECT * FROM %s WHERE parent_id = '%s'" % (
+              settings.SIMPLEDB_JOB_STATE_DOMAIN,
+              parent_id,
+        )
+        results = cls._get_sdb_job_state_domain().select(query_str,
+                                                         consistent_read=True)
+        return [cls._get_job_object_from_item(item) for item in results]
+
+    @classmethod
+    def get_jobs_by_id(cls, unique_ids):
+        """
+        Loads a bunch of jobs by unique ID, :py:data:`SDB_SELECT_IN_SIZE` per
+        query.
+
+        :param list unique_ids: The unique IDs of the jobs to load.
+        :rtype: dict
+        :returns: Keys are unique IDs, values are :py:class:`EncodingJob`
+            objects. IDs that don't match a job are left out.
+        """
+        unique_ids = list(unique_ids)
+        jobs = {}
+        for start in range(0, len(unique_ids), cls.SDB_SELECT_IN_SIZE):
+            batch = unique_ids[start:start + cls.SDB_SELECT_IN_SIZE]
+            query_str = "SELECT * FROM %s WHERE itemName() IN (%s)" % (
+                  settings.SIMPLEDB_JOB_STATE_DOMAIN,
+                  ', '.join(["'%s'" % unique_id.replace("'", "''")
+                             for unique_id in batch]),
+            )
+            results = cls._get_sdb_job_state_domain().select(query_str,
+                                                        consistent_read=True)
+            for item in results:
+                job = cls._get_job_object_from_item(item)
+                jobs[job.unique_id] = job
+        return jobs
+
+    @classmethod
+    def get_jobs_with_state(cls, job_state, limit, next_token=None):
+        """
+        Loads one page of the jobs in a given state, oldest first.
+
+        :param str job_state: One of :py:attr:`JOB_STATES`.
+        :param int limit: The most jobs to return.
+        :keyword str next_token: Where to pick up from, as returned with
+            the previous page.
+        :rtype: tuple
+        :returns: A ``(jobs, next_token)`` tuple. ``next_token`` is ``None``
+            on the last page.
+        """
+        if job_state not in cls.JOB_STATES:
+            raise Exception('Invalid job state: %s' % job_state)
+
+        # SimpleDB only sorts on attributes in the WHERE clause.
+        query_str = "SELECT * FROM %s WHERE job_state = '%s' " \
+                    "AND creation_dtime IS NOT NULL " \
+                    "ORDER BY creation_dtime LIMIT %d" % (
+              settings.SIMPLEDB_JOB_STATE_DOMAIN,
+              job_state,
+              limit,
+        )
+        results = cls._get_sdb_connection().select(
+                                    cls._get_sdb_job_state_domain(), query_str,
+                                    next_token=next_token)
+        jobs = [cls._get_job_object_from_item(item) for item in results]
+        return jobs, results.next_token
+
+    @classmethod
+    def get_job_creation_history(cls, since_dtime):
+        """
+        Queries SimpleDB for a few details about every job created since
+        ``since_dtime``. This is cheaper than loading full job objects.
+        
+        :param datetime.datetime since_dtime: Only return jobs created after
+            this time.
+        :rtype: list
+        :returns: A list of ``(creation_dtime, source_size, preset)`` tuples.
+            ``source_size`` and ``preset`` may be ``None``.
+        """
+        # Datetimes are stored in a format that sorts lexicographically.
+        query_str = "SELECT creation_dtime, source_size, preset FROM %s " \
+                    "WHERE creation_dtime > '%s'" % (
+              settings.SIMPLEDB_JOB_STATE_DOMAIN,
+              since_dtime,
+        )
+        results = cls._get_sdb_job_state_domain().select(query_str)
+
+        history = []
+        for item in results:
+            source_size = item.get('source_size')
+            if source_size in (None, 'None'):
+                source_size = None
+            else:
+                source_size = int(source_size)
+            preset = item.get('preset')
+            if preset == 'None':
+                preset = None
+            creation_dtime = datetime.datetime.strptime(item['creation_dtime'],
+                                                        '%Y-%m-%d %H:%M:%S.%f')
+            history.append((creation_dtime, source_size, preset))
+        return history
+
+    @classmethod
+    def _get_job_messages_from_queue(cls, queue, num_to_pop,
+                                     visibility_timeout=30):
+        """
+        Receives messages from a queue whose entries have bodies that just
+        contain job ID strings, and loads the job that each one refers to.
+        Messages are *not* deleted.
+        
+        :param boto.sqs.queue.Queue queue: The queue to receive messages from.
+        :param int num_to_pop: The maximum number of messages to receive.
+            This can not be more than 10, as per SQS_ limitations.
+        :param int visibility_timeout: The time (in seconds) that a message
+            will re-appear on the queue if ``delete()`` is not called on it.
+        :rtype: list
+        :returns: A list of ``(message, job)`` tuples, one per message
+            received. Messages that refer to the same job share the same
+            :py:class:`EncodingJob` object.
+        """
+        if num_to_pop > 10:
+            msg = 'SQS only allows up to 10 messages to be popped at a time.'
+            raise Exception(msg)
+
+        messages = queue.get_messages(num_to_pop,
+                                      visibility_timeout=visibility_timeout)
+        # Keys are unique id, values are EncodingJob objects.
+        jobs = {}
+        job_messages = []
+
+        for message in messages:
+            # These message bodies only contain a unique id string.
+            unique_id = message.get_body()
+
+            if not jobs.has_key(unique_id):
+                # Avoid querying for a job we already have. This mostly comes
+                # up with the state change queue, where you can have more
+                # than one state change for the same object. In that case,
+                # there could be more than one queue entry with the same
+                # job id in their bodies. The read is consistent so that
+                # a notification never hands us an older copy of the job
+                # than the save that triggered it.
+                jobs[unique_id] = cls.get_job_object_from_id(unique_id,
+                                                         consistent_read=True)
+
+            job_messages.append((message, jobs[unique_id]))
+
+        return job_messages
+
     @classmethod
     def _pop_jobs_from_queue(cls, queue, num_to_pop, visibility_timeout=30,
                              delete_msg_on_pop=True):
@@ -426,26 +1112,13 @@ class JobStateBackend(object):
         :rtype: list
         :returns: A list of :py:class:`EncodingJob` objects.
         """
-        if num_to_pop > 10:
-            msg = 'SQS only allows up to 10 messages to be popped at a time.'
-            raise Exception(msg)
-
-        messages = queue.get_messages(num_to_pop,
-                                      visibility_timeout=visibility_timeout)
+        job_messages = cls._get_job_messages_from_queue(queue, num_to_pop,
+                                         visibility_timeout=visibility_timeout)
         # Store these in a dict to avoid duplicates. Keys are unique id.
         jobs = {}
 
-        for message in messages:
-            # These message bodies only contain a unique id string.
-            unique_id = message.get_body()
-
-            if not jobs.has_key(unique_id):
-                # Avoid querying for a job we already have. This mostly comes
-                # up with the state change queue, where you can have more
-                # than one state change for the same object. In that case,
-                # there could be more than one queue entry with the same
-                # job id in their bodies.
-                jobs[unique_id] = cls.get_job_object_from_id(unique_id)
+        for message, job in job_messages:
+            jobs[job.unique_id] = job
 
             if delete_msg_on_pop:
                 # Deleting a message makes it gone for good from SQS, instead
@@ -456,9 +1129,9 @@ class JobStateBackend(object):
         return jobs.values()
 
     @classmethod
-    def pop_new_jobs_from_queue(cls, num_to_pop):
+    def pop_new_jobs_from_queue(cls, num_to_pop, priority=None):
         """
-        Pops any new jobs from the job queue.
+        Pops any new jobs from a priority lane's job queue.
         
         .. warning:: 
             Once jobs are popped from a queue and ``delete()`` is ran on the
@@ -467,13 +1140,56 @@ class JobStateBackend(object):
         
         :param int num_to_pop: Pop up to this many jobs from the queue at once.
             This can be up to 10, as per SimpleDB_ limitations.
+        :keyword str priority: The priority lane to pop from. Defaults to 
+            :py:data:`DEFAULT_JOB_PRIORITY <media_nommer.conf.settings.DEFAULT_JOB_PRIORITY>`.
         :rtype: list
         :returns: A list of :py:class:`EncodingJob` objects.
         """
-        return cls._pop_jobs_from_queue(cls._get_sqs_new_job_queue(),
+        return cls._pop_jobs_from_queue(cls._get_sqs_new_job_queue(priority),
                                          num_to_pop,
                                          visibility_timeout=3600)
 
+    @classmethod
+    def get_new_job_messages_from_queue(cls, num_to_pop, visibility_timeout,
+                                        priority=None):
+        """
+        Receives new jobs from the job queue *without* deleting their 
+        messages. The caller is responsible for keeping the messages
+        invisible for as long as the job is being worked on, and for
+        deleting them once the job is finished.
+        
+        :param int num_to_pop: Receive up to this many messages at once.
+            This can be up to 10, as per SQS_ limitations.
+        :param int visibility_timeout: The time (in seconds) that the
+            messages stay hidden from other consumers.
+        :keyword str priority: The priority lane to receive from. Defaults to 
+            :py:data:`DEFAULT_JOB_PRIORITY <media_nommer.conf.settings.DEFAULT_JOB_PRIORITY>`.
+        :rtype: list
+        :returns: A list of ``(message, job)`` tuples.
+        """
+        return cls._get_job_messages_from_queue(cls._get_sqs_new_job_queue(priority),
+                                          num_to_pop,
+                                          visibility_timeout=visibility_timeout)
+
+    @classmethod
+    def get_node_job_messages_from_queue(cls, instance_id, num_to_pop,
+                                         visibility_timeout):
+        """
+        Receives jobs routed to a node, *without* deleting their messages.
+        See :py:meth:`get_new_job_messages_from_queue`.
+
+        :param str instance_id: The node's EC2 instance ID.
+        :param int num_to_pop: Receive up to this many messages at once.
+            This can be up to 10, as per SQS_ limitations.
+        :param int visibility_timeout: The time (in seconds) that the
+            messages stay hidden from other consumers.
+        :rtype: list
+        :returns: A list of ``(message, job)`` tuples.
+        """
+        return cls._get_job_messages_from_queue(cls._get_sqs_node_job_queue(instance_id),
+                                          num_to_pop,
+                                          visibility_timeout=visibility_timeout)
+
     @classmethod
     def pop_state_changes_from_queue(cls, num_to_pop):
         """
@@ -492,3 +1208,55 @@ class JobStateBackend(object):
         return cls._pop_jobs_from_queue(cls._get_sqs_state_change_queue(),
                                          num_to_pop,
                                          visibility_timeout=3600)
+
+    @classmethod
+    def pop_state_change_messages_from_queue(cls, num_to_pop):
+        """
+        Pops any recent state changes from the queue, returning one entry
+        per message received. Unlike :py:meth:`pop_state_changes_from_queue`,
+        duplicates are not collapsed. This lets callers tell whether a full
+        batch came back, and thus whether there is likely more waiting.
+        
+        .. warning:: 
+            The messages are deleted before this returns. Be careful to handle
+            errors in the methods higher on the call stack that use this 
+            method.
+        
+        :param int num_to_pop: Pop up to this many messages from the queue at
+            once. This can be up to 10, as per SQS_ limitations.
+        :rtype: list
+        :returns: A list of ``(message, job)`` tuples.
+        """
+        job_messages = cls._get_job_messages_from_queue(
+                                            cls._get_sqs_state_change_queue(),
+                                            num_to_pop,
+                                            visibility_timeout=3600)
+        for message, job in job_messages:
+            message.delete()
+        return job_messages
+
+    @classmethod
+    def get_state_change_queue_depth(cls):
+        """
+        Asks SQS_ for the approximate number of messages waiting in the state
+        change queue.
+        
+        :rtype: int
+        :returns: The approximate number of pending state change messages.
+        """
+        return int(cls._get_sqs_state_change_queue().count())
+
+    @classmethod
+    def get_new_job_queue_depths(cls):
+        """
+        Asks SQS_ for the approximate number of jobs waiting in each
+        priority lane.
+        
+        :rtype: dict
+        :returns: A dict whose keys are priority lane names, and whose values
+            are the approximate number of jobs waiting in that lane.
+        """
+        depths = {}
+        for priority in cls.get_priority_lanes():
+            depths[priority] = int(cls._get_sqs_new_job_queue(priority).count())
+        return depths
@@ -61,6 +61,33 @@ class S3Backend(object):
                      "Download of %s completed." % uri)
         return fobj
 
+    @classmethod
+    def get_file_info(cls, uri):
+        """
+        Given a URI, look up some details about the file without downloading 
+        it. This is a HEAD request, and is cheap.
+        
+        :param str uri: The URI of a file to look up.
+        :rtype: dict
+        :returns: A dict with ``size`` (in bytes) and ``etag`` keys.
+        """
+        # Breaks the URI into usable componenents.
+        values = get_values_from_media_uri(uri)
+
+        conn = cls._get_aws_s3_connection(values['username'],
+                                          values['password'])
+        bucket = conn.get_bucket(values['host'])
+        key = bucket.get_key(values['path'])
+        if key is None:
+            message = "The specified input file cannot be found."
+            raise InfileNotFoundException(message)
+
+        return {
+            'size': int(key.size),
+            # S3 wraps these in double quotes.
+            'etag': key.etag.strip('"'),
+        }
+
     @classmethod
     def upload_file(cls, uri, fobj):
         """
@@ -87,3 +114,28 @@ class S3Backend(object):
 
         logger.debug("S3Backend.upload_file(): Upload complete.")
         return key
+
+    @classmethod
+    def copy_file(cls, source_uri, dest_uri):
+        """
+        Copies one S3 key to another without the data leaving S3. The
+        destination's credentials are used for both keys.
+        
+        :param str source_uri: The URI of the file to copy.
+        :param str dest_uri: The URI to copy the file to.
+        :rtype: :py:class:`boto.s3.key.Key`
+        :returns: The newly copied boto key.
+        """
+        source_values = get_values_from_media_uri(source_uri)
+        dest_values = get_values_from_media_uri(dest_uri)
+
+        conn = cls._get_aws_s3_connection(dest_values['username'],
+                                          dest_values['password'])
+        bucket = conn.create_bucket(dest_values['host'])
+
+        logger.debug("S3Backend.copy_file(): " \
+                     "Copying %s to %s" % (source_uri, dest_uri))
+        key = bucket.copy_key(dest_values['path'], source_values['host'],
+                              source_values['path'])
+        logger.debug("S3Backend.copy_file(): Copy complete.")
+        return key
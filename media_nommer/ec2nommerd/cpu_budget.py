@@ -0,0 +1,99 @@
+"""
+Contains the :py:class:`CPUBudget` class, which divides this node's cores up
+between the encoders running on it.
+"""
+import os
+import threading
+from media_nommer.conf import settings
+from media_nommer.ec2nommerd.instance_metadata import InstanceMetadata
+from media_nommer.ec2nommerd.resource_monitor import ResourceMonitor
+from media_nommer.ec2nommerd.job_buffer import JobBuffer
+
+class CPUBudget(object):
+    """
+    Hands each encoder a share of the node's cores, so that concurrent
+    encoders don't all spin up a thread per core and fight over every one
+    of them. Each encoder gets the core count divided by the number of
+    encoding slots, as a thread count, along with (optionally) a set of
+    cores to pin itself to. See
+    :py:data:`NOMMERD_PARTITION_CPUS <media_nommer.conf.settings.NOMMERD_PARTITION_CPUS>`
+    and
+    :py:data:`NOMMERD_PIN_ENCODERS <media_nommer.conf.settings.NOMMERD_PIN_ENCODERS>`.
+    """
+    # Keys are job unique IDs, values are lists of the cores assigned.
+    ASSIGNED = {}
+    # Guards ASSIGNED.
+    LOCK = threading.Lock()
+
+    @classmethod
+    def get_threads_per_encoder(cls):
+        """
+        :rtype: int
+        :returns: The number of threads each encoder should use.
+        """
+        num_cpus = max(InstanceMetadata.get('num_cpus') or 1, 1)
+        num_slots = ResourceMonitor.get_capacity(JobBuffer.get_num_in_flight())
+        return max(num_cpus // max(num_slots, 1), 1)
+
+    @classmethod
+    def acquire(cls, unique_id):
+        """
+        Reserves a share of the cores for a job's encoder. The least used
+        cores are handed out first.
+
+        :param str unique_id: The job's unique ID.
+        :rtype: tuple
+        :returns: A ``(num_threads, cpus)`` tuple, where ``cpus`` is a list
+            of core numbers to pin the encoder to.
+        """
+        num_cpus = max(InstanceMetadata.get('num_cpus') or 1, 1)
+        num_threads = cls.get_threads_per_encoder()
+
+        with cls.LOCK:
+            usage = dict([(cpu, 0) for cpu in range(num_cpus)])
+            for cpus in cls.ASSIGNED.values():
+                for cpu in cpus:
+                    if usage.has_key(cpu):
+                        usage[cpu] += 1
+            by_usage = sorted(usage.keys(), key=lambda cpu: (usage[cpu], cpu))
+            cpus = sorted(by_usage[:num_threads])
+            cls.ASSIGNED[unique_id] = cpus
+
+        return num_threads, cpus
+
+    @classmethod
+    def release(cls, unique_id):
+        """
+        Gives a job's cores back.
+
+        :param str unique_id: The job's unique ID.
+        """
+        with cls.LOCK:
+            cls.ASSIGNED.pop(unique_id, None)
+
+    @classmethod
+    def pin_command(cls, cmd_list, cpus):
+        """
+        Arranges for a command to be pinned to a set of cores. Uses
+        ``os.sched_setaffinity()`` in the child process where available.
+        Python 2 doesn't have it, so :command:`taskset` is put in front of
+        the command instead, if it's around. If neither is, the command is
+        left alone.
+
+        :param list cmd_list: The command to be passed to ``Popen()``.
+        :param list cpus: The cores to pin to.
+        :rtype: tuple
+        :returns: A ``(cmd_list, popen_kwargs)`` tuple to hand to
+            ``Popen()``.
+        """
+        if hasattr(os, 'sched_setaffinity'):
+            return cmd_list, {
+                'preexec_fn': lambda: os.sched_setaffinity(0, cpus),
+            }
+
+        for path in os.environ.get('PATH', '').split(os.pathsep):
+            taskset = os.path.join(path, 'taskset')
+            if os.access(taskset, os.X_OK):
+                cpu_list = ','.join([str(cpu) for cpu in cpus])
+                return [taskset, '-c', cpu_list] + cmd_list, {}
+        return cmd_list, {}
@@ -0,0 +1,191 @@
+"""
+Contains the :py:class:`InstanceMetadata` class, which looks up details about
+the machine :doc:`../ec2nommerd` is running on.
+"""
+import os
+import socket
+import urllib2
+import multiprocessing
+from media_nommer.conf import settings
+from media_nommer.utils import logger
+
+# The instance ID used when we're not running on EC2.
+LOCAL_INSTANCE_ID = 'local-dev'
+
+class InstanceMetadata(object):
+    """
+    Fetches this node's instance ID, instance type, and availability zone
+    from EC2_'s instance metadata service, along with its CPU count and
+    memory. Everything is looked up once by :py:meth:`load` at startup,
+    and cached from then on.
+
+    The metadata service is asked with a short timeout, as per
+    :py:data:`NOMMERD_METADATA_TIMEOUT <media_nommer.conf.settings.NOMMERD_METADATA_TIMEOUT>`.
+    If it can't be reached, we assume we're not on EC2_. Any of the values
+    may be overridden with the
+    :py:data:`NOMMERD_INSTANCE_METADATA <media_nommer.conf.settings.NOMMERD_INSTANCE_METADATA>`
+    setting, or with environment variables (``NOMMERD_INSTANCE_ID``,
+    ``NOMMERD_INSTANCE_TYPE``, ``NOMMERD_AVAILABILITY_ZONE``,
+    ``NOMMERD_NUM_CPUS``, ``NOMMERD_MEMORY_MB``), which is handy for
+    local runs.
+    """
+    # The cached metadata. Empty until load() is called.
+    METADATA = {}
+
+    # Keys are our metadata keys, values are paths relative to
+    # settings.NOMMERD_METADATA_URL.
+    METADATA_PATHS = {
+        'instance_id': 'instance-id',
+        'instance_type': 'instance-type',
+        'availability_zone': 'placement/availability-zone',
+    }
+    # Keys are our metadata keys, values are environment variable names.
+    ENV_OVERRIDES = {
+        'instance_id': 'NOMMERD_INSTANCE_ID',
+        'instance_type': 'NOMMERD_INSTANCE_TYPE',
+        'availability_zone': 'NOMMERD_AVAILABILITY_ZONE',
+        'num_cpus': 'NOMMERD_NUM_CPUS',
+        'memory_mb': 'NOMMERD_MEMORY_MB',
+    }
+
+    @classmethod
+    def _fetch(cls, path):
+        """
+        Fetches a single value from the metadata service.
+
+        :param str path: The path to fetch, relative to
+            :py:data:`NOMMERD_METADATA_URL <media_nommer.conf.settings.NOMMERD_METADATA_URL>`.
+        :rtype: str
+        :returns: The value.
+        :raises: ``urllib2.URLError`` or ``socket.timeout`` if the service
+            can't be reached.
+        """
+        url = settings.NOMMERD_METADATA_URL.rstrip('/') + '/' + path
+        response = urllib2.urlopen(url,
+                                   timeout=settings.NOMMERD_METADATA_TIMEOUT)
+        return response.read().strip()
+
+    @classmethod
+    def _get_overrides(cls):
+        """
+        Gathers overrides from the settings and the environment. The
+        environment wins out.
+
+        :rtype: dict
+        :returns: The overridden metadata values.
+        """
+        overrides = dict(settings.NOMMERD_INSTANCE_METADATA or {})
+        for key, env_name in cls.ENV_OVERRIDES.items():
+            if os.environ.has_key(env_name):
+                overrides[key] = os.environ[env_name]
+        return overrides
+
+    @classmethod
+    def _get_local_memory_mb(cls):
+        """
+        :rtype: int
+        :returns: This machine's total memory in megabytes, or ``None`` if
+            it can't be determined.
+        """
+        try:
+            for line in open('/proc/meminfo'):
+                if line.startswith('MemTotal:'):
+                    # Reported in kB.
+                    return int(line.split()[1]) // 1024
+        except (IOError, ValueError, IndexError):
+            pass
+        return None
+
+    @classmethod
+    def load(cls, is_local=False):
+        """
+        Looks everything up and caches it. Called when :doc:`../ec2nommerd`
+        starts.
+
+        :keyword bool is_local: When ``True``, don't try to hit EC2's
+            metadata service at all.
+        :rtype: dict
+        :returns: The metadata.
+        """
+        overrides = cls._get_overrides()
+        metadata = {
+            'instance_id': LOCAL_INSTANCE_ID,
+            'instance_type': None,
+            'availability_zone': None,
+        }
+
+        if not is_local and not overrides.has_key('instance_id'):
+            try:
+                for key, path in cls.METADATA_PATHS.items():
+                    metadata[key] = cls._fetch(path)
+            except (urllib2.URLError, socket.error, socket.timeout):
+                logger.warning("InstanceMetadata.load(): Unable to reach " \
+                               "the metadata service at %s, assuming we're " \
+                               "not on EC2." % settings.NOMMERD_METADATA_URL)
+                metadata['instance_id'] = LOCAL_INSTANCE_ID
+
+        metadata['num_cpus'] = multiprocessing.cpu_count()
+        metadata['memory_mb'] = cls._get_local_memory_mb()
+        metadata.update(overrides)
+        for key in ['num_cpus', 'memory_mb']:
+            if metadata[key] is not None:
+                metadata[key] = int(metadata[key])
+
+        cls.METADATA = metadata
+        logger.info("InstanceMetadata.load(): %s" % metadata)
+        return metadata
+
+    @classmethod
+    def get(cls, key):
+        """
+        Returns a single metadata value, loading the metadata if that
+        hasn't happened yet.
+
+        :param str key: One of ``instance_id``, ``instance_type``,
+            ``availability_zone``, ``num_cpus``, or ``memory_mb``.
+        :returns: The value, or ``None`` if it isn't known.
+        """
+        if not cls.METADATA:
+            cls.load()
+        return cls.METADATA.get(key)
+
+    @classmethod
+    def get_instance_id(cls):
+        """
+        :rtype: str
+        :returns: The EC2 instance's ID, or ``local-dev`` if this isn't an
+            EC2 instance.
+        """
+        return cls.get('instance_id')
+
+    @classmethod
+    def is_ec2_instance(cls):
+        """
+        :rtype: bool
+        :returns: ``True`` if this is an EC2 instance, ``False`` if otherwise.
+        """
+        return cls.get_instance_id() != LOCAL_INSTANCE_ID
+
+    @classmethod
+    def get_max_encoding_jobs(cls):
+        """
+        Figures out how many jobs this node should encode at once. If
+        :py:data:`MAX_ENCODING_JOBS_PER_EC2_INSTANCE <media_nommer.conf.settings.MAX_ENCODING_JOBS_PER_EC2_INSTANCE>`
+        is set, that's the answer. Otherwise, it's worked out from the CPU
+        count and memory, as per
+        :py:data:`NOMMERD_CPUS_PER_JOB <media_nommer.conf.settings.NOMMERD_CPUS_PER_JOB>`
+        and
+        :py:data:`NOMMERD_MEMORY_MB_PER_JOB <media_nommer.conf.settings.NOMMERD_MEMORY_MB_PER_JOB>`.
+
+        :rtype: int
+        :returns: The maximum number of concurrent encoding jobs.
+        """
+        if settings.MAX_ENCODING_JOBS_PER_EC2_INSTANCE:
+            return settings.MAX_ENCODING_JOBS_PER_EC2_INSTANCE
+
+        max_jobs = cls.get('num_cpus') // settings.NOMMERD_CPUS_PER_JOB
+        memory_mb = cls.get('memory_mb')
+        if memory_mb:
+            max_jobs = min(max_jobs,
+                           memory_mb // settings.NOMMERD_MEMORY_MB_PER_JOB)
+        return max(int(max_jobs), 1)
@@ -7,53 +7,129 @@ All functions prefixed with ``task_`` are task functions that are registered
 with the Twisted_ reactor. All functions prefixed with ``threaded_`` are
 the interesting bits that actually do things.
 """
-from twisted.internet import task, reactor
+import random
+from twisted.internet import task, reactor, threads
 from media_nommer.conf import settings
 from media_nommer.utils import logger
-from media_nommer.core.job_state_backend import JobStateBackend
 from media_nommer.ec2nommerd.node_state import NodeStateManager
+from media_nommer.ec2nommerd.job_buffer import JobBuffer
+from media_nommer.ec2nommerd.resource_monitor import ResourceMonitor
+
+# The current delay (in seconds) between heartbeats, before jitter. This
+# backs off while nothing is changing, and snaps back down when it is.
+HEARTBEAT_DELAY = None
 
 def threaded_encode_job(job):
     """
     Given a job, run it through its encoding workflow in a non-blocking manner.
+    Once the job is done, its queue message is released, and the next
+    buffered job (if any) is started.
     """
     # Update the timestamp for when the node last did something so it
     # won't terminate itself.
     NodeStateManager.i_did_something()
-    job.nommer.onomnom()
+    try:
+        job.nommer.onomnom()
+    except:
+        # The nommer couldn't even record an ERROR state. Don't delete the
+        # message, let the job re-appear on the queue.
+        logger.error(message_or_obj="threaded_encode_job(): " \
+                     "Unhandled error while encoding %s" % job.unique_id)
+        logger.error()
+        JobBuffer.finish_job(job, delete_message=False)
+    else:
+        JobBuffer.finish_job(job)
+
+    # A slot just freed up. Put it to work right away, and top the buffer
+    # back up.
+    reactor.callFromThread(start_buffered_jobs)
+    reactor.callFromThread(task_check_for_new_jobs)
+
+def get_num_free_slots():
+    """
+    Figures out how many more jobs this node can be encoding right now,
+    going by the
+    :py:class:`ResourceMonitor <media_nommer.ec2nommerd.resource_monitor.ResourceMonitor>`.
+    If we're already encoding and the machine is overloaded, no new jobs
+    are admitted.
+    
+    :rtype: int
+    :returns: The number of free encoding slots.
+    """
+    num_jobs = JobBuffer.get_num_in_flight()
+    if num_jobs and not ResourceMonitor.has_headroom():
+        return 0
+    return max(0, ResourceMonitor.get_capacity(num_jobs) - num_jobs)
+
+def start_buffered_jobs():
+    """
+    Starts encoder threads for buffered jobs until the buffer is empty, or
+    we're out of free encoding slots. Must be called from the reactor thread.
+    
+    Calls :py:func:`threaded_encode_job` for any jobs to encode.
+    """
+    while get_num_free_slots() > 0:
+        job = JobBuffer.pop_next()
+        if not job:
+            break
+        logger.debug("* Starting encoder thread for job: %s" % job.unique_id)
+        reactor.callInThread(threaded_encode_job, job)
+
+def threaded_check_for_new_jobs():
+    """
+    Tops up the job buffer from the new job queue, then starts any jobs
+    that there are free slots for.
+    """
+    num_added = JobBuffer.fill(get_num_free_slots())
+    if num_added:
+        logger.debug("* Buffered %d jobs from the queue." % num_added)
+    reactor.callFromThread(start_buffered_jobs)
 
 def task_check_for_new_jobs():
     """
-    Looks at the number of currently active threads and compares it against the 
-    :py:data:`MAX_ENCODING_JOBS_PER_EC2_INSTANCE <media_nommer.conf.settings.MAX_ENCODING_JOBS_PER_EC2_INSTANCE>` 
-    setting. If we are under the max, fire up another thread for encoding 
-    additional job(s). 
+    Looks at the number of jobs currently encoding and compares it against
+    the number of jobs this node can handle at once (see
+    :py:func:`get_num_free_slots`).
+    Any free slots are filled from the job buffer, and the buffer
+    is topped back up from the queue, with up to
+    :py:data:`NOMMERD_JOB_PREFETCH_DEPTH <media_nommer.conf.settings.NOMMERD_JOB_PREFETCH_DEPTH>`
+    extra jobs held in reserve.
     
     The interval at which :doc:`../ec2nommerd` checks for new jobs is 
     determined by the 
     :py:data:`NOMMERD_NEW_JOB_CHECK_INTERVAL <media_nommer.conf.settings.NOMMERD_NEW_JOB_CHECK_INTERVAL>`
+    setting. Jobs finishing also trigger a check.
+    
+    Calls :py:func:`threaded_check_for_new_jobs`.
+    """
+    start_buffered_jobs()
+    reactor.callInThread(threaded_check_for_new_jobs)
+
+def task_extend_job_visibility():
+    """
+    Keeps the queue messages for buffered and in-flight jobs hidden from
+    other nodes.
+    
+    The interval at which this happens is determined by the
+    :py:data:`NOMMERD_JOB_VISIBILITY_HEARTBEAT_INTERVAL <media_nommer.conf.settings.NOMMERD_JOB_VISIBILITY_HEARTBEAT_INTERVAL>`
     setting.
     
-    Calls :py:func:`threaded_encode_job` for any jobs to encode.
+    Calls :py:meth:`JobBuffer.extend_visibility <media_nommer.ec2nommerd.job_buffer.JobBuffer.extend_visibility>`.
     """
-    num_active_threads = NodeStateManager.get_num_active_threads()
-    max_threads = settings.MAX_ENCODING_JOBS_PER_EC2_INSTANCE
-    num_jobs_to_pop = max(0, max_threads - num_active_threads)
-
-    if num_jobs_to_pop > 0:
-        # We have more room for encoding threads, determine how many.
-        logger.debug("task_check_for_new_jobs: " \
-                     "Popping up to %d new jobs." % num_jobs_to_pop)
-        # This is an iterable of BaseEncodingJob sub-classed instances for
-        # each job returned from the queue.
-        jobs = JobStateBackend.pop_new_jobs_from_queue(num_jobs_to_pop)
-        if jobs:
-            logger.debug("* Popped %d jobs from the queue." % len(jobs))
-
-        for job in jobs:
-            # For each job returned, render in another thread.
-            logger.debug("* Starting encoder thread for job: %s" % job.unique_id)
-            reactor.callInThread(threaded_encode_job, job)
+    reactor.callInThread(JobBuffer.extend_visibility)
+
+def task_sample_resources():
+    """
+    Takes a fresh set of CPU and memory readings for sizing our encoder
+    slots.
+
+    The interval at which this happens is determined by the
+    :py:data:`NOMMERD_RESOURCE_CHECK_INTERVAL <media_nommer.conf.settings.NOMMERD_RESOURCE_CHECK_INTERVAL>`
+    setting.
+
+    Calls :py:meth:`ResourceMonitor.sample <media_nommer.ec2nommerd.resource_monitor.ResourceMonitor.sample>`.
+    """
+    reactor.callInThread(ResourceMonitor.sample)
 
 def threaded_heartbeat():
     """
@@ -61,9 +137,11 @@ def threaded_heartbeat():
     is a domain that contains all of the running EC2_ instances and their
     unique IDs, along with some state data.
     
-    The interval at which heartbeats occur is determined by the
-    :py:data:`NOMMERD_HEARTBEAT_INTERVAL <media_nommer.conf.settings.NOMMERD_HEARTBEAT_INTERVAL` 
-    setting.
+    The interval at which heartbeats occur adapts to how much is going on,
+    see :py:func:`_schedule_next_heartbeat`.
+
+    :rtype: bool
+    :returns: ``True`` if this node's reported state changed.
     """
     if settings.NOMMERD_TERMINATE_WHEN_IDLE:
         # thread_count_mod factors out this thread when counting active threads.
@@ -71,24 +149,75 @@ def threaded_heartbeat():
     else:
         is_terminated = False
 
-    if not is_terminated:
-        NodeStateManager.send_instance_state_update()
+    if is_terminated:
+        return False
+    return NodeStateManager.send_instance_state_update()
+
+def _get_jittered_delay(delay):
+    """
+    Randomly nudges a delay by up to
+    :py:data:`NOMMERD_HEARTBEAT_JITTER <media_nommer.conf.settings.NOMMERD_HEARTBEAT_JITTER>`
+    in either direction. Keeps nodes that were launched together from
+    hitting SimpleDB_ in lockstep.
+
+    :param float delay: The delay to nudge.
+    :rtype: float
+    :returns: The nudged delay.
+    """
+    jitter = settings.NOMMERD_HEARTBEAT_JITTER
+    return delay * random.uniform(1 - jitter, 1 + jitter)
+
+def _schedule_next_heartbeat(changed):
+    """
+    Figures out how long to wait until the next heartbeat, and schedules it.
+    If our state just changed, heartbeat again after
+    :py:data:`NOMMERD_HEARTBEAT_MIN_INTERVAL <media_nommer.conf.settings.NOMMERD_HEARTBEAT_MIN_INTERVAL>`.
+    If not, back off exponentially up to
+    :py:data:`NOMMERD_HEARTBEAT_INTERVAL <media_nommer.conf.settings.NOMMERD_HEARTBEAT_INTERVAL>`.
+
+    :param bool changed: Whether the last heartbeat reported a change. This
+        is a Twisted Failure if the last heartbeat blew up.
+    """
+    global HEARTBEAT_DELAY
+
+    if changed is True:
+        HEARTBEAT_DELAY = settings.NOMMERD_HEARTBEAT_MIN_INTERVAL
+    else:
+        if not isinstance(changed, bool):
+            # This is a Failure, log it and carry on.
+            logger.error(message_or_obj=changed)
+        HEARTBEAT_DELAY = min(HEARTBEAT_DELAY * 2,
+                              settings.NOMMERD_HEARTBEAT_INTERVAL)
+
+    reactor.callLater(_get_jittered_delay(HEARTBEAT_DELAY), task_heartbeat)
 
 def task_heartbeat():
     """
     Checks in with feederd in a non-blocking manner via 
-    :py:meth:`threaded_heartbeat`.
+    :py:meth:`threaded_heartbeat`, then schedules the next heartbeat.
     
     Calls :py:func:`threaded_heartbeat`.
     """
-    reactor.callInThread(threaded_heartbeat)
+    d = threads.deferToThread(threaded_heartbeat)
+    d.addBoth(_schedule_next_heartbeat)
 
 def register_tasks():
     """
     Registers all tasks. Called by the :doc:`../ec2nommerd` Twisted_ plugin.
     """
+    global HEARTBEAT_DELAY
+
     task.LoopingCall(task_check_for_new_jobs).start(
                                         settings.NOMMERD_NEW_JOB_CHECK_INTERVAL,
                                         now=True)
-    task.LoopingCall(task_heartbeat).start(settings.NOMMERD_HEARTBEAT_INTERVAL,
-                                           now=False)
+    HEARTBEAT_DELAY = settings.NOMMERD_HEARTBEAT_INTERVAL
+    # Spread the first heartbeat out over a whole interval, in case a bunch
+    # of us were launched at once.
+    reactor.callLater(random.uniform(0, settings.NOMMERD_HEARTBEAT_INTERVAL),
+                      task_heartbeat)
+    task.LoopingCall(task_sample_resources).start(
+                        settings.NOMMERD_RESOURCE_CHECK_INTERVAL,
+                        now=True)
+    task.LoopingCall(task_extend_job_visibility).start(
+                        settings.NOMMERD_JOB_VISIBILITY_HEARTBEAT_INTERVAL,
+                        now=False)
@@ -0,0 +1,337 @@
+"""
+Contains the :py:class:`JobBuffer` class, which holds on to jobs that this
+node has taken from the new job queue, both those that are encoding and those
+that are waiting for a free encoding slot.
+"""
+import threading
+from media_nommer.conf import settings
+from media_nommer.utils import logger
+from media_nommer.core.job_state_backend import JobStateBackend
+from media_nommer.ec2nommerd.instance_metadata import InstanceMetadata
+
+class PriorityLaneScheduler(object):
+    """
+    Picks which priority lane to pull the next job from, using smooth 
+    weighted round-robin over the
+    :py:data:`JOB_PRIORITY_LANES <media_nommer.conf.settings.JOB_PRIORITY_LANES>`
+    setting. With weights of 6, 3, and 1, every ten picks go six, three, and
+    one to the lanes, interleaved rather than in runs. Lower priority lanes
+    are thus never starved, only slowed.
+    """
+    # Keys are lane names, values are the lane's running weight.
+    CURRENT_WEIGHTS = {}
+
+    @classmethod
+    def next_lane(cls, exclude=()):
+        """
+        Picks the next lane to pull from.
+
+        :keyword exclude: Lane names to skip. For example, lanes that have
+            already come up empty.
+        :rtype: str
+        :returns: The name of the lane to pull from, or ``None`` if every
+            lane has been excluded.
+        """
+        lanes = [(lane, weight) for lane, weight in settings.JOB_PRIORITY_LANES
+                 if lane not in exclude]
+        if not lanes:
+            return None
+
+        total_weight = 0
+        best_lane = None
+        for lane, weight in lanes:
+            total_weight += weight
+            cls.CURRENT_WEIGHTS[lane] = cls.CURRENT_WEIGHTS.get(lane, 0) + weight
+            if best_lane is None or \
+               cls.CURRENT_WEIGHTS[lane] > cls.CURRENT_WEIGHTS[best_lane]:
+                best_lane = lane
+
+        cls.CURRENT_WEIGHTS[best_lane] -= total_weight
+        return best_lane
+
+class JobBuffer(object):
+    """
+    Tracks the jobs this node has received from SQS_, along with the SQS_
+    message for each. Messages are kept invisible on the queue for as long as
+    we hold them (see :py:meth:`extend_visibility`), and are only deleted
+    once their job reaches a finished state. If the node dies, the messages
+    re-appear on the queue and another node picks the jobs up.
+
+    A small number of jobs are prefetched beyond the number of free encoding
+    slots, as per the
+    :py:data:`NOMMERD_JOB_PREFETCH_DEPTH <media_nommer.conf.settings.NOMMERD_JOB_PREFETCH_DEPTH>`
+    setting. This lets a slot that frees up start its next job right away.
+    """
+    # Jobs waiting for a free encoding slot. A list of (message, job) tuples.
+    BUFFERED = []
+    # Jobs that are currently encoding. Keys are unique IDs, values are
+    # (message, job) tuples.
+    IN_FLIGHT = {}
+    # Guards BUFFERED and IN_FLIGHT.
+    LOCK = threading.RLock()
+    # Held while filling the buffer, so we don't have concurrent fills.
+    FILL_LOCK = threading.Lock()
+    # A lane is given up on for the rest of a fill once it has come up empty
+    # this many times in a row. SQS only samples some of its servers on each
+    # receive, so a single empty reply doesn't mean the lane is empty.
+    MAX_EMPTY_RECEIVES = 3
+
+    @classmethod
+    def get_num_buffered(cls):
+        """
+        :rtype: int
+        :returns: The number of jobs waiting for a free encoding slot.
+        """
+        return len(cls.BUFFERED)
+
+    @classmethod
+    def get_num_in_flight(cls):
+        """
+        :rtype: int
+        :returns: The number of jobs currently being encoded.
+        """
+        return len(cls.IN_FLIGHT)
+
+    @classmethod
+    def _find_message(cls, unique_id):
+        """
+        Finds the message we are holding for a job, if any.
+
+        :param str unique_id: The job's unique ID.
+        :returns: The boto SQS message, or ``None`` if we're not holding
+            this job.
+        """
+        if cls.IN_FLIGHT.has_key(unique_id):
+            return cls.IN_FLIGHT[unique_id][0]
+        for message, job in cls.BUFFERED:
+            if job.unique_id == unique_id:
+                return message
+        return None
+
+    @classmethod
+    def _replace_message(cls, unique_id, new_message):
+        """
+        Swaps out the message we're holding for a job. Used when SQS
+        re-delivers a message we already have, which gives us a new receipt
+        handle.
+        """
+        if cls.IN_FLIGHT.has_key(unique_id):
+            job = cls.IN_FLIGHT[unique_id][1]
+            cls.IN_FLIGHT[unique_id] = (new_message, job)
+            return
+        for index, (message, job) in enumerate(cls.BUFFERED):
+            if job.unique_id == unique_id:
+                cls.BUFFERED[index] = (new_message, job)
+                return
+
+    @classmethod
+    def _add(cls, message, job):
+        """
+        Adds a freshly received job to the buffer, unless it's a duplicate
+        or has already been finished.
+
+        :param message: The boto SQS message the job came from.
+        :param EncodingJob job: The job referred to by the message.
+        """
+        with cls.LOCK:
+            held_message = cls._find_message(job.unique_id)
+            if held_message:
+                if held_message.id == message.id:
+                    # Same message delivered again. Our old receipt handle
+                    # may no longer be good, hang on to the new one.
+                    cls._replace_message(job.unique_id, message)
+                else:
+                    # A separate message for a job we already have.
+                    logger.debug("JobBuffer._add(): Discarding duplicate " \
+                                 "message for %s" % job.unique_id)
+                    message.delete()
+                return
+
+        if job.is_finished() or job.job_state == 'WAITING':
+            # Somebody already finished (or split up) this one, but the
+            # message lingered.
+            logger.debug("JobBuffer._add(): Discarding message for " \
+                         "finished job %s" % job.unique_id)
+            message.delete()
+            return
+
+        with cls.LOCK:
+            cls.BUFFERED.append((message, job))
+
+    @classmethod
+    def _fill_from_node_queue(cls, target):
+        """
+        Receives the jobs that :doc:`../feederd` has routed to this node
+        because we have their source cached. These go ahead of the priority
+        lanes. See
+        :py:data:`JOB_CACHE_AFFINITY <media_nommer.conf.settings.JOB_CACHE_AFFINITY>`.
+
+        :param int target: How many jobs the buffer should hold.
+        :rtype: int
+        :returns: The number of jobs added to the buffer.
+        """
+        if not settings.JOB_CACHE_AFFINITY or \
+           not InstanceMetadata.is_ec2_instance():
+            return 0
+
+        num_to_pop = min(target - cls.get_num_buffered(), 10)
+        if num_to_pop <= 0:
+            return 0
+        job_messages = JobStateBackend.get_node_job_messages_from_queue(
+                        InstanceMetadata.get_instance_id(), num_to_pop,
+                        visibility_timeout=settings.NOMMERD_JOB_VISIBILITY_TIMEOUT)
+
+        num_before = cls.get_num_buffered()
+        for message, job in job_messages:
+            cls._add(message, job)
+        return cls.get_num_buffered() - num_before
+
+    @classmethod
+    def _receive_from_lanes(cls, picks, empty_receives, dry_lanes):
+        """
+        Receives jobs for a round of lane picks, one receive per lane.
+
+        :param list picks: Lane names, in the order the scheduler picked
+            them. A lane picked three times gets asked for three messages.
+        :param dict empty_receives: Keys are lane names, values are how many
+            times in a row they've come up empty. Updated in place.
+        :param list dry_lanes: Lanes that have come up empty too many times.
+            Added to in place.
+        :rtype: list
+        :returns: ``(message, job)`` tuples, in the order they were picked.
+        """
+        received = {}
+        for lane in picks:
+            if received.has_key(lane):
+                continue
+            job_messages = JobStateBackend.get_new_job_messages_from_queue(
+                            min(picks.count(lane), 10),
+                            visibility_timeout=settings.NOMMERD_JOB_VISIBILITY_TIMEOUT,
+                            priority=lane)
+            received[lane] = list(job_messages)
+            if job_messages:
+                empty_receives[lane] = 0
+                continue
+            empty_receives[lane] = empty_receives.get(lane, 0) + 1
+            if empty_receives[lane] >= cls.MAX_EMPTY_RECEIVES:
+                dry_lanes.append(lane)
+
+        # Hand them out in pick order, so the buffer is interleaved by lane
+        # weight, rather than in runs.
+        job_messages = []
+        for lane in picks:
+            if received[lane]:
+                job_messages.append(received[lane].pop(0))
+        return job_messages
+
+    @classmethod
+    def fill(cls, num_free_slots):
+        """
+        Receives jobs routed to this node, then jobs from the priority lanes,
+        until the buffer holds enough to fill ``num_free_slots``, plus
+        :py:data:`NOMMERD_JOB_PREFETCH_DEPTH <media_nommer.conf.settings.NOMMERD_JOB_PREFETCH_DEPTH>`
+        extras. Lanes are picked by :py:class:`PriorityLaneScheduler`, one
+        pick per job needed, and each lane picked is received from once per
+        round, in a batch. If another fill is in progress, this returns
+        immediately.
+
+        :param int num_free_slots: The number of encoding slots that are
+            currently free.
+        :rtype: int
+        :returns: The number of jobs added to the buffer.
+        """
+        if not cls.FILL_LOCK.acquire(False):
+            # Someone else is already on it.
+            return 0
+
+        num_added = 0
+        # Keys are lane names, values are how many times in a row they've
+        # come up empty during this fill.
+        empty_receives = {}
+        # Lanes that have come up empty too many times during this fill.
+        dry_lanes = []
+        try:
+            target = num_free_slots + settings.NOMMERD_JOB_PREFETCH_DEPTH
+            num_added += cls._fill_from_node_queue(target)
+            while cls.get_num_buffered() < target:
+                picks = []
+                for i in range(target - cls.get_num_buffered()):
+                    lane = PriorityLaneScheduler.next_lane(exclude=dry_lanes)
+                    if not lane:
+                        break
+                    picks.append(lane)
+                if not picks:
+                    # Every lane is dry.
+                    break
+
+                job_messages = cls._receive_from_lanes(picks, empty_receives,
+                                                       dry_lanes)
+                for message, job in job_messages:
+                    num_before = cls.get_num_buffered()
+                    cls._add(message, job)
+                    num_added += cls.get_num_buffered() - num_before
+        finally:
+            cls.FILL_LOCK.release()
+
+        if num_added:
+            logger.debug("JobBuffer.fill(): Buffered %d new jobs." % num_added)
+        return num_added
+
+    @classmethod
+    def pop_next(cls):
+        """
+        Takes the next job out of the buffer and marks it as in-flight.
+
+        :rtype: :py:class:`EncodingJob <media_nommer.core.job_state_backend.EncodingJob>`
+        :returns: The next job to encode, or ``None`` if the buffer is empty.
+        """
+        with cls.LOCK:
+            if not cls.BUFFERED:
+                return None
+            message, job = cls.BUFFERED.pop(0)
+            cls.IN_FLIGHT[job.unique_id] = (message, job)
+            return job
+
+    @classmethod
+    def finish_job(cls, job, delete_message=True):
+        """
+        Called when we're done with an in-flight job. The job's message is
+        deleted from the queue if the job has reached a finished state. If
+        not, the message is left alone and will re-appear on the queue for
+        another try once its visibility timeout runs out.
+
+        :param EncodingJob job: The job that we're done with.
+        :keyword bool delete_message: If ``False``, never delete the message.
+            Use this when the job's final state may not have been saved.
+        """
+        with cls.LOCK:
+            message, job = cls.IN_FLIGHT.pop(job.unique_id, (None, job))
+
+        if not message:
+            return
+
+        # WAITING jobs have been handed off to their child jobs.
+        if delete_message and (job.is_finished() or job.job_state == 'WAITING'):
+            message.delete()
+        else:
+            logger.info("JobBuffer.finish_job(): Job %s did not finish, " \
+                        "leaving it to re-appear on the queue." % job.unique_id)
+
+    @classmethod
+    def extend_visibility(cls):
+        """
+        Pushes out the visibility timeout on every message we're holding,
+        buffered and in-flight alike. This keeps long-running jobs from
+        re-appearing on the queue and being encoded twice.
+        """
+        with cls.LOCK:
+            messages = [message for message, job in cls.BUFFERED]
+            messages += [message for message, job in cls.IN_FLIGHT.values()]
+
+        for message in messages:
+            try:
+                message.change_visibility(settings.NOMMERD_JOB_VISIBILITY_TIMEOUT)
+            except:
+                logger.error(message_or_obj="JobBuffer.extend_visibility(): " \
+                             "Unable to extend visibility of %s" % message.id)
+                logger.error()
@@ -2,13 +2,16 @@
 Contains the :py:class:`NodeStateManager` class, which is an abstraction layer
 for storing and communicating the status of EC2_ nodes.
 """
-import urllib2
 import datetime
 import boto
 from twisted.internet import reactor
 from media_nommer.conf import settings
 from media_nommer.utils import logger
 from media_nommer.utils.compat import total_seconds
+from media_nommer.ec2nommerd.job_buffer import JobBuffer
+from media_nommer.ec2nommerd.instance_metadata import InstanceMetadata
+from media_nommer.ec2nommerd.resource_monitor import ResourceMonitor
+from media_nommer.ec2nommerd.source_cache import SourceCache
 
 class NodeStateManager(object):
     """
@@ -16,6 +19,8 @@ class NodeStateManager(object):
     itself if certain conditions of inactivity are met.
     """
     last_dtime_i_did_something = datetime.datetime.now()
+    # The attributes sent with the last heartbeat, so we only send changes.
+    LAST_REPORTED_ATTRIBUTES = {}
 
     # Used for lazy-loading the SDB connection. Do not refer to directly.
     __aws_sdb_connection = None
@@ -23,8 +28,6 @@ class NodeStateManager(object):
     __aws_sdb_nommer_state_domain = None
     # Used for lazy-loading the EC2 connection. Do not refer to directly.
     __aws_ec2_connection = None
-    # Store the instance ID for this EC2 node (if not local).
-    __instance_id = None
 
     @classmethod
     def _aws_ec2_connection(cls):
@@ -68,26 +71,16 @@ class NodeStateManager(object):
         return cls.__aws_sdb_nommer_state_domain
 
     @classmethod
-    def get_instance_id(cls, is_local=False):
+    def get_instance_id(cls):
         """
-        Determine this EC2 instance's unique instance ID. Lazy load this, and
-        avoid further re-queries after the first one.
-               
-        :param bool is_local: When True, don't try to hit EC2's meta data server,
-            When False, just make up a unique ID.
+        Determine this EC2 instance's unique instance ID. This is looked up
+        once at startup, see
+        :py:class:`InstanceMetadata <media_nommer.ec2nommerd.instance_metadata.InstanceMetadata>`.
             
         :rtype: str
         :returns: The EC2 instance's ID.
         """
-        if not cls.__instance_id:
-            if is_local:
-                cls.__instance_id = 'local-dev'
-            else:
-                aws_meta_url = 'http://169.254.169.254/latest/meta-data/instance-id'
-                response = urllib2.urlopen(aws_meta_url)
-                cls.__instance_id = response.read()
-
-        return cls.__instance_id
+        return InstanceMetadata.get_instance_id()
 
     @classmethod
     def is_ec2_instance(cls):
@@ -97,33 +90,74 @@ class NodeStateManager(object):
         :rtype: bool
         :returns: ``True`` if this is an EC2 instance, ``False`` if otherwise.
         """
-        return cls.get_instance_id() != 'local-dev'
+        return InstanceMetadata.is_ec2_instance()
+
+    @classmethod
+    def _get_changed_attributes(cls, attributes):
+        """
+        Picks out the attributes whose values differ from what we last
+        reported.
+
+        :param dict attributes: The attributes we'd like feederd to see.
+        :rtype: dict
+        :returns: The subset of ``attributes`` that have changed.
+        """
+        changed = {}
+        for key, value in attributes.items():
+            if cls.LAST_REPORTED_ATTRIBUTES.get(key) != value:
+                changed[key] = value
+        return changed
 
     @classmethod
     def send_instance_state_update(cls, state='ACTIVE'):
         """
         Sends a status update to feederd through SimpleDB. Lets the daemon
-        know how many jobs this instance is crunching right now. Also updates
-        a timestamp field to let feederd know how long it has been since the
-        instance's last check-in.
+        know how many jobs this instance is crunching right now, and how many
+        it can currently take on at once (see
+        :py:class:`ResourceMonitor <media_nommer.ec2nommerd.resource_monitor.ResourceMonitor>`),
+        and which sources it has cached (see
+        :py:meth:`SourceCache.get_summary <media_nommer.ec2nommerd.source_cache.SourceCache.get_summary>`). Also updates a timestamp field to let feederd
+        know how long it has been since the instance's last check-in.
+
+        Only the fields that have changed since the last update are written,
+        along with the timestamp, in a single ``put_attributes`` call.
         
         :keyword str state: If this EC2_ instance is anything but ``ACTIVE``,
             pass the state here. This is useful during node termination.
+        :rtype: bool
+        :returns: ``True`` if anything other than the timestamp changed since
+            the last update, ``False`` if not.
         """
-        if cls.is_ec2_instance():
-            instance_id = cls.get_instance_id()
-            item = cls._aws_sdb_nommer_state_domain().new_item(instance_id)
-            item['id'] = instance_id
-            item['active_jobs'] = cls.get_num_active_threads() - 1
-            item['last_report_dtime'] = datetime.datetime.now()
-            item['state'] = state
-            item.save()
+        if not cls.is_ec2_instance():
+            return False
+
+        instance_id = cls.get_instance_id()
+        num_jobs = JobBuffer.get_num_in_flight()
+        changed = cls._get_changed_attributes({
+            'id': instance_id,
+            'active_jobs': num_jobs,
+            'max_jobs': ResourceMonitor.get_capacity(num_jobs),
+            'source_cache': SourceCache.get_summary(),
+            'state': state,
+        })
+
+        attributes = changed.copy()
+        attributes['last_report_dtime'] = datetime.datetime.now()
+        cls._aws_sdb_nommer_state_domain().put_attributes(instance_id,
+                                                          attributes,
+                                                          replace=True)
+        # Only remember these once they've made it to SimpleDB.
+        cls.LAST_REPORTED_ATTRIBUTES.update(changed)
+        return len(changed) > 0
 
     @classmethod
     def contemplate_termination(cls, thread_count_mod=0):
         """
-        Looks at how long it's been since this worker has done something, and
-        decides whether to self-terminate.
+        Decides whether to self-terminate. Busy nodes never terminate. Idle
+        nodes follow :doc:`../feederd`'s directive if there is one (see
+        :py:meth:`get_fleet_directive`), and otherwise terminate after
+        :py:data:`NOMMERD_MAX_INACTIVITY <media_nommer.conf.settings.NOMMERD_MAX_INACTIVITY>`
+        seconds of inactivity.
         
         :param int thread_count_mod: Add this to the amount returned by the call
             to :py:meth:`get_num_active_threads`. This is useful when calling
@@ -145,29 +179,75 @@ class NodeStateManager(object):
             # Encoding right now, don't terminate.
             return False
 
+        if JobBuffer.get_num_in_flight() or JobBuffer.get_num_buffered():
+            # We're holding on to jobs, don't take them down with us.
+            return False
+
+        directive = cls.get_fleet_directive()
+        if directive == 'KEEP':
+            # feederd wants us around, probably as a warm spare.
+            return False
+        elif directive == 'RETIRE':
+            logger.info("feederd has asked us to retire.")
+            cls._terminate_self()
+            return True
+
+        # No word from feederd, fall back to deciding on our own.
         tdelt = datetime.datetime.now() - cls.last_dtime_i_did_something
         # Total seconds of inactivity.
         inactive_secs = total_seconds(tdelt)
 
         # If we're over the inactivity threshold...
         if inactive_secs > settings.NOMMERD_MAX_INACTIVITY:
-            instance_id = cls.get_instance_id()
-            conn = cls._aws_ec2_connection()
-            # Find this particular EC2 instance via boto.
-            reservations = conn.get_all_instances(instance_ids=[instance_id])
-            # This should only be one match, but in the interest of
-            # playing along...
-            for reservation in reservations:
-                for instance in reservation.instances:
-                    # Here's the instance, terminate it.
-                    logger.info("Goodbye, cruel world.")
-                    cls.send_instance_state_update(state='TERMINATED')
-                    instance.terminate()
+            cls._terminate_self()
             # Seeya later!
             return True
         # Continue existence, no termination.
         return False
 
+    @classmethod
+    def _terminate_self(cls):
+        """
+        Reports this node as ``TERMINATED`` and terminates its EC2_ instance.
+        """
+        instance_id = cls.get_instance_id()
+        conn = cls._aws_ec2_connection()
+        # Find this particular EC2 instance via boto.
+        reservations = conn.get_all_instances(instance_ids=[instance_id])
+        # This should only be one match, but in the interest of
+        # playing along...
+        for reservation in reservations:
+            for instance in reservation.instances:
+                # Here's the instance, terminate it.
+                logger.info("Goodbye, cruel world.")
+                cls.send_instance_state_update(state='TERMINATED')
+                instance.terminate()
+
+    @classmethod
+    def get_fleet_directive(cls):
+        """
+        Checks for a directive from :doc:`../feederd`'s
+        :py:class:`FleetController <media_nommer.feederd.fleet_controller.FleetController>`
+        on whether this node should stay up or retire. Directives older than
+        :py:data:`NOMMERD_MAX_INACTIVITY <media_nommer.conf.settings.NOMMERD_MAX_INACTIVITY>`
+        are ignored, in case feederd has gone away.
+        
+        :rtype: str
+        :returns: ``KEEP``, ``RETIRE``, or ``None`` if there is no current
+            directive.
+        """
+        item = cls._aws_sdb_nommer_state_domain().get_item(cls.get_instance_id())
+        if not item or not item.get('fleet_directive'):
+            return None
+
+        # Microseconds are left off when they're zero, so ignore them.
+        directive_dtime = datetime.datetime.strptime(
+                        item['fleet_directive_dtime'][:19], '%Y-%m-%d %H:%M:%S')
+        directive_age = total_seconds(datetime.datetime.now() - directive_dtime)
+        if directive_age > settings.NOMMERD_MAX_INACTIVITY:
+            return None
+        return item['fleet_directive']
+
     @classmethod
     def get_num_active_threads(cls):
         """
@@ -8,8 +8,10 @@ import traceback
 import tempfile
 import shutil
 from media_nommer.utils import logger
+from media_nommer.core.exceptions import JobStateConflictException
 from media_nommer.ec2nommerd.node_state import NodeStateManager
 from media_nommer.core.storage_backends import get_backend_for_uri
+from media_nommer.ec2nommerd.source_cache import SourceCache
 
 class BaseNommer(object):
     """
@@ -32,11 +34,20 @@ class BaseNommer(object):
 
         try:
             self._start_encoding()
+        except JobStateConflictException:
+            # Someone else finished the job (feederd may have abandoned it),
+            # so there's nothing left for us to do.
+            logger.info("BaseNommer.onomnom(): Job %s was finished " \
+                        "elsewhere, giving up on it." % self.job.unique_id)
         except:
             # If we run into any un-handled exceptions, error out the job
             # and set as its state details.
-            self.wrapped_set_job_state('ERROR', details=traceback.format_exc())
             traceback.print_exc()
+            try:
+                self.wrapped_set_job_state('ERROR',
+                                           details=traceback.format_exc())
+            except JobStateConflictException:
+                pass
 
         # Clean up the temporary CWD used during nomming.
         shutil.rmtree(self.temp_cwd, ignore_errors=True)
@@ -60,11 +71,35 @@ class BaseNommer(object):
         # Tracks the fact that we did something, prevents the node from
         # terminating itself.
         NodeStateManager.i_did_something()
+        if args and args[0] == 'FINISHED' and self.job.fingerprint:
+            # feederd may hand this output out again to identical jobs, and
+            # checks it against what we record here before doing so.
+            self.__record_dest_info()
         self.job.set_job_state(*args, **kwargs)
 
+    def __record_dest_info(self):
+        """
+        Records the size and ETag of the uploaded output on the job. If they
+        can't be determined, the job is still finished, and feederd only
+        checks that the output exists before re-using it.
+        """
+        file_uri = self.job.dest_path
+        try:
+            dest_info = get_backend_for_uri(file_uri).get_file_info(file_uri)
+        except:
+            logger.error(message_or_obj="BaseNommer.__record_dest_info(): " \
+                         "Unable to look up %s" % file_uri)
+            logger.error()
+            return
+        self.job.dest_size = dest_info.get('size')
+        self.job.dest_etag = dest_info.get('etag')
+
     def download_source_file(self):
         """
-        Download the source file to a temporary file.
+        Download the source file into our temporary directory. Sources
+        recently used on this node come out of the
+        :py:class:`SourceCache <media_nommer.ec2nommerd.source_cache.SourceCache>`
+        instead.
         """
         self.wrapped_set_job_state('DOWNLOADING')
 
@@ -72,24 +107,16 @@ class BaseNommer(object):
         file_uri = self.job.source_path
         logger.debug("BaseNommer.download_source_file(): " \
                      "Attempting to download %s" % file_uri)
-        # Figure out which backend to use for the protocol in the URI.
-        storage = get_backend_for_uri(file_uri)
-        # Create a temporary file which will be auto deleted when
-        # garbage collected.
-        fobj = tempfile.NamedTemporaryFile(mode='w+b', delete=True)
-        # Using the correct backend, download the file to the given
-        # file-like object.
-        storage.download_file(file_uri, fobj)
-        # flush and fsync to force writing to the file object. Doesn't always
-        # happen otherwise.
-        fobj.flush()
-        os.fsync(fobj.fileno())
+        # This is removed along with the temporary directory once we're done.
+        source_path = os.path.join(self.temp_cwd, 'source')
+        from_cache = SourceCache.fetch(file_uri, source_path,
+                                       etag=self.job.source_etag,
+                                       size=self.job.source_size)
+        fobj = open(source_path, 'rb')
 
         logger.debug("BaseNommer.download_source_file(): " \
-                     "Downloaded %s to %s" % (file_uri, fobj.name))
-
-        # As soon as this fobj is garbage collected, it is closed(). Be
-        # careful to continue its existence if you need it.
+                     "Downloaded %s to %s (cached: %s)" % (file_uri, fobj.name,
+                                                          from_cache))
         return fobj
 
     def upload_to_destination(self, fobj):
@@ -0,0 +1,60 @@
+"""
+Contains a Nommer that copies media that has already been encoded to
+another destination, rather than encoding it again.
+"""
+from media_nommer.utils import logger
+from media_nommer.core.storage_backends import get_backend_for_uri
+from media_nommer.ec2nommerd.nommers.base_nommer import BaseNommer
+
+class CopyNommer(BaseNommer):
+    """
+    This :ref:`Nommer <nommers>` copies the output of an earlier job (this
+    job's source) to this job's destination. :doc:`../feederd` queues these
+    up on its own when a job comes in that would produce the same output as
+    an earlier one, but somewhere else. See
+    :py:data:`FEEDERD_DEDUPLICATE_JOBS <media_nommer.conf.settings.FEEDERD_DEDUPLICATE_JOBS>`.
+
+    When both ends are on a backend that can copy within itself (like S3_),
+    the data never comes down to the node. Otherwise, or if that copy fails,
+    it's downloaded and uploaded again.
+    """
+    def _start_encoding(self):
+        """
+        Copies the source over to the destination.
+        """
+        logger.info("Starting to copy %s for job %s" % (self.job.source_path,
+                                                        self.job.unique_id))
+        if not self.__copy_within_backend():
+            fobj = self.download_source_file()
+            self.upload_to_destination(fobj)
+            fobj.close()
+
+        self.wrapped_set_job_state('FINISHED')
+        logger.info("CopyNommer: Job %s has been copied." % self.job.unique_id)
+        return True
+
+    def __copy_within_backend(self):
+        """
+        Tries to have the storage backend copy the file itself.
+
+        :rtype: bool
+        :returns: ``True`` if the file was copied, ``False`` if it needs to
+            go through this node.
+        """
+        source_backend = get_backend_for_uri(self.job.source_path)
+        dest_backend = get_backend_for_uri(self.job.dest_path)
+        if source_backend is not dest_backend or \
+           not hasattr(dest_backend, 'copy_file'):
+            return False
+
+        self.wrapped_set_job_state('UPLOADING')
+        try:
+            dest_backend.copy_file(self.job.source_path, self.job.dest_path)
+        except:
+            # Too big to copy in one go, or the credentials don't reach.
+            logger.error(message_or_obj="CopyNommer.__copy_within_backend(): " \
+                         "Unable to copy %s within its backend, falling " \
+                         "back to downloading it." % self.job.source_path)
+            logger.error()
+            return False
+        return True
@@ -3,10 +3,17 @@ Contains a class used for nomming media on EC2 via FFmpeg_. This is used in
 conjunction with the ec2nommerd Twisted_ plugin.
 """
 import os
+import time
 import tempfile
+import threading
 import subprocess
+import simplejson
+from media_nommer.conf import settings
 from media_nommer.utils import logger
+from media_nommer.core.storage_backends import get_backend_for_uri
 from media_nommer.ec2nommerd.nommers.base_nommer import BaseNommer
+from media_nommer.ec2nommerd.cpu_budget import CPUBudget
+from media_nommer.ec2nommerd.nommers.ffmpeg_progress import FFmpegProgress
 
 class FFmpegNommer(BaseNommer):
     """
@@ -57,6 +64,43 @@ class FFmpegNommer(BaseNommer):
         'minimal_preset': {
             'nommer': 'media_nommer.ec2nommerd.nommers.ffmpeg.FFmpegNommer'
         }
+
+    **Threading**
+
+    When :py:data:`NOMMERD_PARTITION_CPUS <media_nommer.conf.settings.NOMMERD_PARTITION_CPUS>`
+    is ``True``, ffmpeg is passed a ``-threads`` value that gives it its share
+    of the node's cores (see
+    :py:class:`CPUBudget <media_nommer.ec2nommerd.cpu_budget.CPUBudget>`).
+    A ``threads`` option in a pass's ``infile_options`` or 
+    ``outfile_options`` takes precedence, and also leaves the encoder 
+    un-pinned.
+
+    **Progress**
+
+    When :py:data:`NOMMERD_FFMPEG_PROGRESS <media_nommer.conf.settings.NOMMERD_FFMPEG_PROGRESS>`
+    is ``True``, ffmpeg's progress is followed as it encodes, and published
+    to the job's state details as JSON every
+    :py:data:`NOMMERD_PROGRESS_UPDATE_INTERVAL <media_nommer.conf.settings.NOMMERD_PROGRESS_UPDATE_INTERVAL>`
+    seconds. See
+    :py:meth:`EncodingJob.get_progress <media_nommer.core.job_state_backend.EncodingJob.get_progress>`.
+
+    **Multiple outputs**
+
+    Jobs submitted with ``outputs`` (see :doc:`../jsonapi`) have job options
+    like this, rather than a list of passes::
+
+        {
+            'outputs': [
+                {'preset': 'hd', 'dest_path': 's3://bucket/out_hd.mp4'},
+                {'preset': 'sd', 'dest_path': 's3://bucket/out_sd.mp4'},
+            ]
+        }
+
+    The source is downloaded once, and every output is encoded by a single
+    ffmpeg process, which decodes the source once for all of them. Each
+    output gets its preset's ``outfile_options``. The outputs are then
+    uploaded concurrently. Each output's state is tracked in the job's
+    :py:attr:`output_states <media_nommer.core.job_state_backend.EncodingJob.output_states>`.
     """
     def _start_encoding(self):
         """
@@ -66,6 +110,10 @@ class FFmpegNommer(BaseNommer):
         logger.info("Starting to encode job %s" % self.job.unique_id)
         fobj = self.download_source_file()
 
+        outputs = self.__get_outputs()
+        if outputs:
+            return self.__encode_outputs(fobj, outputs)
+
         # Encode the file. The return value is a tempfile with the output.
         self.wrapped_set_job_state('ENCODING')
         out_fobj = self.__run_ffmpeg(fobj)
@@ -102,20 +150,40 @@ class FFmpegNommer(BaseNommer):
                 # None values are not used.
                 cmd_list.append(str(val))
 
+    def __has_threads_option(self, encoding_pass_options):
+        """
+        Checks whether the preset sets ffmpeg's thread count itself.
+
+        :param dict encoding_pass_options: The options for this pass.
+        :rtype: bool
+        :returns: ``True`` if a ``threads`` option is present.
+        """
+        for opt_key in ['infile_options', 'outfile_options']:
+            for key, val in encoding_pass_options.get(opt_key, []):
+                if key == 'threads':
+                    return True
+        return False
+
     def __assemble_ffmpeg_cmd_list(self, encoding_pass_options, infile_obj,
                                    outfile_obj, is_two_pass=False,
-                                   is_second_pass=False):
+                                   is_second_pass=False, num_threads=None):
         """
         Assembles a command list that subprocess.Popen() will use within
         self.__run_ffmpeg().
         
         :param file infile_obj: A file-like object for input.
         :param file outfile_obj: A file-like object to store the output.
+        :keyword int num_threads: If specified, the number of threads ffmpeg
+            should use. Ignored if the preset sets ``threads`` itself.
         :rtype: list
         :returns: A list to be passed to subprocess.Popen().
         """
         #ffmpeg [[infile options][-i infile]]... {[outfile options] outfile}...
         ffmpeg_cmd = ['ffmpeg', '-y']
+        if settings.NOMMERD_FFMPEG_PROGRESS:
+            # Machine-readable progress on stdout, instead of the stats line
+            # on stderr.
+            ffmpeg_cmd += ['-progress', 'pipe:1', '-nostats']
 
         # Form the ffmpeg infile and outfile options from the options
         # stored in the SimpleDB domain.
@@ -130,6 +198,9 @@ class FFmpegNommer(BaseNommer):
             outfile_opts = encoding_pass_options['outfile_options']
             self.__append_inout_opts_to_cmd_list(outfile_opts, ffmpeg_cmd)
 
+        if num_threads and not self.__has_threads_option(encoding_pass_options):
+            ffmpeg_cmd += ['-threads', str(num_threads)]
+
         if is_two_pass and not is_second_pass:
             # First pass of a 2-pass encoding.
             ffmpeg_cmd.append('/dev/null')
@@ -141,6 +212,82 @@ class FFmpegNommer(BaseNommer):
 
         return ffmpeg_cmd
 
+    def __follow_ffmpeg(self, process, progress):
+        """
+        Reads ffmpeg's output as it comes, publishing progress to the job's
+        state details along the way, until ffmpeg exits.
+
+        :param subprocess.Popen process: The running ffmpeg process.
+        :param FFmpegProgress progress: Follows the output.
+        """
+        readers = [
+            threading.Thread(target=progress.read_progress,
+                             args=(process.stdout,)),
+            threading.Thread(target=progress.read_stderr,
+                             args=(process.stderr,)),
+        ]
+        for reader in readers:
+            reader.daemon = True
+            reader.start()
+
+        interval = settings.NOMMERD_PROGRESS_UPDATE_INTERVAL
+        last_published = time.time()
+        published_snapshot = None
+        # The readers finish when ffmpeg closes its output.
+        alive_readers = readers
+        try:
+            while alive_readers:
+                alive_readers[0].join(1)
+                alive_readers = [reader for reader in readers
+                                 if reader.is_alive()]
+                snapshot = progress.get_snapshot()
+                if snapshot and snapshot != published_snapshot and \
+                   time.time() - last_published >= interval:
+                    try:
+                        self.wrapped_set_job_state('ENCODING',
+                                            details=simplejson.dumps(snapshot))
+                    except:
+                        # Progress is best-effort, the encode carries on.
+                        logger.error(message_or_obj="FFmpegNommer.__follow_ffmpeg(): " \
+                                     "Unable to publish progress for %s" % (
+                                        self.job.unique_id))
+                        logger.error()
+                    published_snapshot = snapshot
+                    last_published = time.time()
+        finally:
+            if alive_readers and process.poll() is None:
+                # We're bailing out early. Don't leave ffmpeg running with
+                # nobody to answer to.
+                try:
+                    process.kill()
+                except OSError:
+                    # It beat us to it.
+                    pass
+            process.wait()
+
+    def __popen_ffmpeg(self, ffmpeg_cmd, popen_kwargs, progress):
+        """
+        Runs ffmpeg, following its output until it exits.
+
+        :param list ffmpeg_cmd: The command to be passed to ``Popen()``.
+        :param dict popen_kwargs: Any extra keyword arguments for ``Popen()``.
+        :param FFmpegProgress progress: Follows the output.
+        :rtype: subprocess.Popen
+        :returns: The finished ffmpeg process.
+        """
+        # Do this for ffmpeg's sake. Allows more than one concurrent
+        # encoding job per EC2 instance.
+        os.chdir(self.temp_cwd)
+        # Fire up ffmpeg.
+        process = subprocess.Popen(ffmpeg_cmd,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE,
+                                   **popen_kwargs)
+        # Get back to home dir. Not sure this is necessary, but meh.
+        os.chdir(os.path.expanduser('~'))
+        self.__follow_ffmpeg(process, progress)
+        return process
+
     def __run_ffmpeg(self, fobj):
         """
         Fire up ffmpeg and toss the results into a temporary file.
@@ -152,29 +299,36 @@ class FFmpegNommer(BaseNommer):
         """
         is_two_pass = len(self.job.job_options) > 1
         out_fobj = tempfile.NamedTemporaryFile(mode='w+b', delete=True)
+        progress = FFmpegProgress(num_passes=len(self.job.job_options))
 
         pass_counter = 1
         for encoding_pass_options in self.job.job_options:
             is_second_pass = pass_counter == 2
+            num_threads = None
+            popen_kwargs = {}
+            use_budget = settings.NOMMERD_PARTITION_CPUS and \
+                         not self.__has_threads_option(encoding_pass_options)
+            if use_budget:
+                num_threads, cpus = CPUBudget.acquire(self.job.unique_id)
             # Based on the given options, assemble the command list to
             # pass on to Popen.
             ffmpeg_cmd = self.__assemble_ffmpeg_cmd_list(
                              encoding_pass_options,
                              fobj, out_fobj,
                              is_two_pass=is_two_pass,
-                             is_second_pass=is_second_pass)
-
-            # Do this for ffmpeg's sake. Allows more than one concurrent
-            # encoding job per EC2 instance.
-            os.chdir(self.temp_cwd)
-            # Fire up ffmpeg.
-            process = subprocess.Popen(ffmpeg_cmd,
-                                       stdout=subprocess.PIPE,
-                                       stderr=subprocess.PIPE)
-            # Get back to home dir. Not sure this is necessary, but meh.
-            os.chdir(os.path.expanduser('~'))
-            # Block here while waiting for output
-            cmd_output = process.communicate()
+                             is_second_pass=is_second_pass,
+                             num_threads=num_threads)
+            if use_budget and settings.NOMMERD_PIN_ENCODERS:
+                ffmpeg_cmd, popen_kwargs = CPUBudget.pin_command(ffmpeg_cmd,
+                                                                 cpus)
+
+            progress.start_pass(pass_counter)
+            try:
+                process = self.__popen_ffmpeg(ffmpeg_cmd, popen_kwargs,
+                                              progress)
+            finally:
+                if use_budget:
+                    CPUBudget.release(self.job.unique_id)
 
             # 0 is success, so anything but that is bad.
             error_happened = process.returncode != 0
@@ -185,10 +339,170 @@ class FFmpegNommer(BaseNommer):
                 return out_fobj
             elif error_happened:
                 # Error found, return nothing so the nommer can die.
+                stderr_tail = progress.get_stderr_tail()
                 logger.error(message_or_obj="Error encountered while running ffmpeg.")
-                logger.error(message_or_obj=cmd_output[0])
-                logger.error(message_or_obj=cmd_output[1])
-                self.wrapped_set_job_state('ERROR', details=cmd_output[1])
+                logger.error(message_or_obj=stderr_tail)
+                self.wrapped_set_job_state('ERROR', details=stderr_tail)
                 return None
 
             pass_counter += 1
+
+    def __get_outputs(self):
+        """
+        :rtype: list
+        :returns: The outputs of a multi-output job, as dicts with
+            ``preset`` and ``dest_path`` keys. ``None`` for regular jobs.
+        """
+        if isinstance(self.job.job_options, dict):
+            return self.job.job_options.get('outputs')
+        return None
+
+    def __set_output_state(self, output_index, output_state):
+        """
+        Sets the state of one of a multi-output job's outputs. Safe to call
+        from the upload threads. This isn't saved on its own, the output
+        states go out with the job's next state change (the final
+        ``FINISHED`` or ``ERROR``), so the uploads don't wait on each
+        other's saves.
+
+        :param int output_index: Which output, from 0.
+        :param str output_state: The output's new state.
+        """
+        with self.__output_lock:
+            self.job.output_states[output_index] = output_state
+
+    def __encode_outputs(self, fobj, outputs):
+        """
+        Encodes every output of a multi-output job with a single ffmpeg
+        process, then uploads the outputs concurrently. The job is
+        ``FINISHED`` only if every output made it.
+
+        :param file fobj: The downloaded source.
+        :param list outputs: The job's outputs. See :py:meth:`__get_outputs`.
+        :rtype: bool
+        :returns: ``True`` if every output was encoded and uploaded.
+        """
+        self.__output_lock = threading.Lock()
+        self.job.output_states = ['ENCODING'] * len(outputs)
+        self.wrapped_set_job_state('ENCODING')
+        out_fobjs = self.__run_ffmpeg_outputs(fobj, outputs)
+        fobj.close()
+
+        if not out_fobjs:
+            # Failure! We're going nowhere.
+            return False
+
+        self.job.output_states = ['UPLOADING'] * len(outputs)
+        self.wrapped_set_job_state('UPLOADING')
+        uploaders = [threading.Thread(target=self.__upload_output,
+                                      args=(index, output, out_fobjs[index]))
+                     for index, output in enumerate(outputs)]
+        for uploader in uploaders:
+            uploader.start()
+        for uploader in uploaders:
+            uploader.join()
+
+        for out_fobj in out_fobjs:
+            out_fobj.close()
+
+        failed = ['%d (%s)' % (index, output['preset'])
+                  for index, output in enumerate(outputs)
+                  if self.job.output_states[index] != 'FINISHED']
+        if failed:
+            self.wrapped_set_job_state('ERROR',
+                details='Outputs failed to upload: %s' % ', '.join(failed))
+            return False
+
+        self.wrapped_set_job_state('FINISHED')
+        logger.info("FFmpegNommer: Job %s has been successfully encoded " \
+                    "to %d outputs." % (self.job.unique_id, len(outputs)))
+        return True
+
+    def __upload_output(self, output_index, output, out_fobj):
+        """
+        Uploads one output of a multi-output job. Meant to be run in its own
+        thread.
+
+        :param int output_index: Which output, from 0.
+        :param dict output: The output. See :py:meth:`__get_outputs`.
+        :param file out_fobj: The encoded output.
+        """
+        self.__set_output_state(output_index, 'UPLOADING')
+        try:
+            storage = get_backend_for_uri(output['dest_path'])
+            storage.upload_file(output['dest_path'], out_fobj)
+        except:
+            logger.error(message_or_obj="FFmpegNommer.__upload_output(): " \
+                         "Unable to upload output %d of %s" % (
+                            output_index, self.job.unique_id))
+            logger.error()
+            self.__set_output_state(output_index, 'ERROR')
+            return
+        self.__set_output_state(output_index, 'FINISHED')
+
+    def __run_ffmpeg_outputs(self, fobj, outputs):
+        """
+        Encodes every output of a multi-output job in one ffmpeg process.
+        ffmpeg decodes the source once and feeds each output's encoder from
+        that, so the source is only read and decoded once however many
+        outputs there are. Each output's options come from its preset.
+
+        :param file fobj: The downloaded source.
+        :param list outputs: The job's outputs. See :py:meth:`__get_outputs`.
+        :rtype: list or ``None``
+        :returns: A file-like object per output, in order. If an error
+            happens, ``None`` is returned, and the ERROR job state is set.
+        """
+        # Submission made sure these are all one-pass, and that they all
+        # share their infile options.
+        output_options = [(settings.PRESETS[output['preset']].get('options') or [{}])[0]
+                          for output in outputs]
+        out_fobjs = [tempfile.NamedTemporaryFile(
+                         mode='w+b', delete=True,
+                         suffix=os.path.splitext(output['dest_path'])[1])
+                     for output in outputs]
+        progress = FFmpegProgress()
+
+        ffmpeg_cmd = ['ffmpeg', '-y']
+        if settings.NOMMERD_FFMPEG_PROGRESS:
+            ffmpeg_cmd += ['-progress', 'pipe:1', '-nostats']
+        self.__append_inout_opts_to_cmd_list(
+            output_options[0].get('infile_options', []), ffmpeg_cmd)
+        ffmpeg_cmd += ['-i', fobj.name]
+
+        num_threads = None
+        popen_kwargs = {}
+        use_budget = settings.NOMMERD_PARTITION_CPUS
+        if use_budget:
+            num_threads, cpus = CPUBudget.acquire(self.job.unique_id)
+            # One process, but an encoder per output sharing our cores.
+            num_threads = max(num_threads // len(outputs), 1)
+        for options, out_fobj in zip(output_options, out_fobjs):
+            self.__append_inout_opts_to_cmd_list(
+                options.get('outfile_options', []), ffmpeg_cmd)
+            if num_threads and not self.__has_threads_option(options):
+                ffmpeg_cmd += ['-threads', str(num_threads)]
+            ffmpeg_cmd.append(out_fobj.name)
+        logger.debug("FFmpegNommer.__run_ffmpeg_outputs(): Command to run: %s" % ' '.join(ffmpeg_cmd))
+        if use_budget and settings.NOMMERD_PIN_ENCODERS:
+            ffmpeg_cmd, popen_kwargs = CPUBudget.pin_command(ffmpeg_cmd, cpus)
+
+        try:
+            process = self.__popen_ffmpeg(ffmpeg_cmd, popen_kwargs, progress)
+        finally:
+            if use_budget:
+                CPUBudget.release(self.job.unique_id)
+
+        if process.returncode != 0:
+            stderr_tail = progress.get_stderr_tail()
+            logger.error(message_or_obj="Error encountered while running ffmpeg.")
+            logger.error(message_or_obj=stderr_tail)
+            self.job.output_states = ['ERROR'] * len(outputs)
+            self.wrapped_set_job_state('ERROR', details=stderr_tail)
+            for out_fobj in out_fobjs:
+                out_fobj.close()
+            return None
+
+        for out_fobj in out_fobjs:
+            out_fobj.seek(0)
+        return out_fobjs
@@ -0,0 +1,171 @@
+"""
+Contains the :py:class:`FFmpegProgress` class, which follows a running
+FFmpeg_ process's output for :py:class:`FFmpegNommer <media_nommer.ec2nommerd.nommers.ffmpeg.FFmpegNommer>`.
+"""
+import re
+import threading
+from collections import deque
+from media_nommer.conf import settings
+
+# Matches the source duration that ffmpeg prints to stderr.
+DURATION_RE = re.compile(r'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)')
+
+def parse_duration(line):
+    """
+    Picks the source duration out of a line of ffmpeg's stderr.
+
+    :param str line: A line of ffmpeg's stderr.
+    :rtype: float
+    :returns: The duration in seconds, or ``None`` if the line doesn't
+        have one.
+    """
+    match = DURATION_RE.search(line)
+    if not match:
+        return None
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+class FFmpegProgress(object):
+    """
+    Reads ffmpeg's ``-progress`` output and stderr as they're written,
+    rather than buffering everything until ffmpeg exits. Only the last
+    :py:data:`NOMMERD_FFMPEG_STDERR_LINES <media_nommer.conf.settings.NOMMERD_FFMPEG_STDERR_LINES>`
+    lines of stderr are kept around, for error reporting.
+
+    One of these follows every pass of an encoding, so that progress can be
+    reported for the encoding as a whole.
+    """
+    def __init__(self, num_passes=1):
+        """
+        :keyword int num_passes: The number of passes in the encoding.
+        """
+        self.num_passes = num_passes
+        self.pass_number = 1
+        # The source duration in seconds, once ffmpeg tells us.
+        self.duration = None
+        # The key/value pairs from the progress block being read.
+        self.current = {}
+        # The latest complete progress snapshot. See get_snapshot().
+        self.snapshot = None
+        self.stderr_lines = deque(maxlen=settings.NOMMERD_FFMPEG_STDERR_LINES)
+        self.lock = threading.Lock()
+
+    def start_pass(self, pass_number):
+        """
+        Called before each pass is started.
+
+        :param int pass_number: The pass that is starting, from 1.
+        """
+        with self.lock:
+            self.pass_number = pass_number
+            self.current = {}
+
+    def read_progress(self, stream):
+        """
+        Reads ``-progress`` output until ffmpeg closes the stream. Meant to
+        be run in its own thread.
+
+        :param file stream: ffmpeg's progress output.
+        """
+        for line in iter(stream.readline, ''):
+            self.feed_progress_line(line)
+
+    def read_stderr(self, stream):
+        """
+        Reads stderr until ffmpeg closes the stream. Meant to be run in its
+        own thread.
+
+        :param file stream: ffmpeg's stderr.
+        """
+        for line in iter(stream.readline, ''):
+            self.feed_stderr_line(line)
+
+    def feed_stderr_line(self, line):
+        """
+        Keeps a line of stderr, and picks out the source duration.
+
+        :param str line: A line of ffmpeg's stderr.
+        """
+        with self.lock:
+            self.stderr_lines.append(line.rstrip())
+            if self.duration is None:
+                self.duration = parse_duration(line)
+
+    def feed_progress_line(self, line):
+        """
+        Takes in a ``key=value`` line of ffmpeg's progress output. ffmpeg
+        ends each block of these with a ``progress`` key.
+
+        :param str line: A line of ffmpeg's progress output.
+        """
+        if '=' not in line:
+            return
+        key, value = line.strip().split('=', 1)
+        with self.lock:
+            self.current[key] = value
+            if key == 'progress':
+                self.snapshot = self._build_snapshot(self.current)
+                self.current = {}
+
+    def _build_snapshot(self, block):
+        """
+        Turns a complete block of progress output into a snapshot.
+
+        :param dict block: The key/value pairs from one progress block.
+        :rtype: dict
+        :returns: A progress snapshot. See :py:meth:`get_snapshot`.
+        """
+        snapshot = {
+            'pass': self.pass_number,
+            'passes': self.num_passes,
+        }
+        try:
+            snapshot['fps'] = float(block.get('fps', 0))
+        except ValueError:
+            snapshot['fps'] = 0.0
+        try:
+            # Looks like '1.92x', or 'N/A' early on.
+            speed = float(block.get('speed', '').rstrip('x'))
+        except ValueError:
+            speed = None
+        snapshot['speed'] = speed
+
+        # Despite the name, out_time_ms is in microseconds. Newer builds
+        # have out_time_us as well.
+        out_time_us = block.get('out_time_us', block.get('out_time_ms'))
+        try:
+            out_time = int(out_time_us) / 1000000.0
+        except (TypeError, ValueError):
+            out_time = None
+
+        if self.duration and out_time is not None:
+            pass_fraction = min(out_time / self.duration, 1.0)
+            if block.get('progress') == 'end':
+                pass_fraction = 1.0
+            done = (self.pass_number - 1 + pass_fraction) / self.num_passes
+            snapshot['percent'] = round(done * 100, 1)
+            if speed:
+                # What's left of this pass, plus any passes after it.
+                remaining = (1 - pass_fraction) * self.duration + \
+                            (self.num_passes - self.pass_number) * self.duration
+                snapshot['eta_seconds'] = int(remaining / speed)
+        return snapshot
+
+    def get_snapshot(self):
+        """
+        :rtype: dict
+        :returns: The latest progress, or ``None`` if ffmpeg hasn't reported
+            any yet. Keys are ``pass``, ``passes``, ``fps``, ``speed``, and,
+            once the source duration is known, ``percent`` and
+            ``eta_seconds``.
+        """
+        with self.lock:
+            return self.snapshot
+
+    def get_stderr_tail(self):
+        """
+        :rtype: str
+        :returns: The last few lines of ffmpeg's stderr.
+        """
+        with self.lock:
+            return '\n'.join(self.stderr_lines)
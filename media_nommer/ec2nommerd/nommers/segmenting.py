@@ -0,0 +1,292 @@
+"""
+Contains Nommers that split long sources up so that their segments can be
+encoded in parallel, across every free slot in the fleet, then joined back
+together with FFmpeg_.
+"""
+import os
+import glob
+import tempfile
+import subprocess
+from media_nommer.conf import settings
+from media_nommer.utils import logger
+from media_nommer.core.job_state_backend import EncodingJob
+from media_nommer.core.storage_backends import get_backend_for_uri
+from media_nommer.ec2nommerd.nommers.base_nommer import BaseNommer
+
+# Segments are encoded by a plain FFmpegNommer, then joined by this.
+SEGMENT_NOMMER = 'media_nommer.ec2nommerd.nommers.ffmpeg.FFmpegNommer'
+JOIN_NOMMER = 'media_nommer.ec2nommerd.nommers.segmenting.SegmentJoinNommer'
+
+def get_segment_uri(parent_id, segment_index, kind, extension):
+    """
+    Figures out where a segment lives under
+    :py:data:`SEGMENT_SCRATCH_URI <media_nommer.conf.settings.SEGMENT_SCRATCH_URI>`.
+
+    :param str parent_id: The unique ID of the job that was split.
+    :param int segment_index: Which segment, from 0.
+    :param str kind: ``src`` for the segment as cut from the source, ``out``
+        for the encoded segment.
+    :param str extension: The file extension, with the leading dot.
+    :rtype: str
+    :returns: The segment's URI.
+    """
+    return '%s/%s/%s_%04d%s' % (settings.SEGMENT_SCRATCH_URI.rstrip('/'),
+                                parent_id, kind, segment_index, extension)
+
+def get_output_extension(job):
+    """
+    :param EncodingJob job: The job that was split.
+    :rtype: str
+    :returns: The file extension of the job's destination, used for its
+        encoded segments.
+    """
+    return os.path.splitext(job.dest_path)[1]
+
+def run_ffmpeg(nommer, ffmpeg_cmd):
+    """
+    Runs a quick (stream copying) ffmpeg command to completion.
+
+    :param BaseNommer nommer: The nommer running the command. Its job is set
+        to ERROR if ffmpeg fails.
+    :param list ffmpeg_cmd: The command to be passed to ``Popen()``.
+    :rtype: bool
+    :returns: ``True`` if ffmpeg succeeded.
+    """
+    process = subprocess.Popen(ffmpeg_cmd, cwd=nommer.temp_cwd,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    stdout, stderr = process.communicate()
+    if process.returncode == 0:
+        return True
+
+    logger.error(message_or_obj="Error encountered while running ffmpeg.")
+    logger.error(message_or_obj=stderr)
+    nommer.wrapped_set_job_state('ERROR', details=stderr)
+    return False
+
+class SegmentingNommer(BaseNommer):
+    """
+    This :ref:`Nommer <nommers>` splits a source into segments of around
+    :py:data:`NOMMERD_SEGMENT_SECONDS <media_nommer.conf.settings.NOMMERD_SEGMENT_SECONDS>`
+    each, cutting at keyframes. Each segment becomes a job of its own,
+    encoded by
+    :py:class:`FFmpegNommer <media_nommer.ec2nommerd.nommers.ffmpeg.FFmpegNommer>`
+    with this job's options, so any node with a free slot can pick it up.
+    This job then goes into the ``WAITING`` state.
+
+    :doc:`../feederd` keeps an eye on the segment jobs, reflecting their
+    combined progress in this job's state details. Once every segment is
+    encoded, it queues up a :py:class:`SegmentJoinNommer` job that stitches
+    them together and uploads the result to this job's destination, at which
+    point this job is ``FINISHED``.
+
+    Presets are the same as for FFmpegNommer, but with this nommer::
+
+        'long_form_preset': {
+            'nommer': 'media_nommer.ec2nommerd.nommers.segmenting.SegmentingNommer',
+            'options': [
+                {
+                    'outfile_options': [
+                        ('f', 'mp4'),
+                        ('vcodec', 'libx264'),
+                    ],
+                },
+            ],
+        }
+
+    The encoded segments are joined without re-encoding, so the options must
+    produce output that can be concatenated (no per-segment fades, and the
+    same codec settings throughout). The
+    :py:data:`SEGMENT_SCRATCH_URI <media_nommer.conf.settings.SEGMENT_SCRATCH_URI>`
+    setting must be set.
+    """
+    def _start_encoding(self):
+        """
+        Splits the source, queues up a job per segment, and hands the rest
+        off to :doc:`../feederd`.
+        """
+        if not settings.SEGMENT_SCRATCH_URI:
+            self.wrapped_set_job_state('ERROR',
+                                       details='SEGMENT_SCRATCH_URI is not set.')
+            return False
+
+        logger.info("Starting to split job %s" % self.job.unique_id)
+        fobj = self.download_source_file()
+
+        self.wrapped_set_job_state('ENCODING')
+        segment_paths = self.__split_source(fobj)
+        fobj.close()
+        if not segment_paths:
+            return False
+
+        self.wrapped_set_job_state('UPLOADING')
+        for segment_index, segment_path in enumerate(segment_paths):
+            self.__queue_segment(segment_index, segment_path)
+
+        self.job.num_segments = len(segment_paths)
+        self.wrapped_set_job_state('WAITING')
+        logger.info("SegmentingNommer: Job %s has been split into %d " \
+                    "segments." % (self.job.unique_id, len(segment_paths)))
+        return True
+
+    def __split_source(self, fobj):
+        """
+        Cuts the source into segments with ffmpeg's segment muxer. The
+        segments are stream copies, so this is quick.
+
+        :param file fobj: The downloaded source.
+        :rtype: list
+        :returns: Paths to the segments, in order. If ffmpeg fails, ``None``
+            is returned, and the ERROR job state is set.
+        """
+        segment_dir = os.path.join(self.temp_cwd, 'segments')
+        os.mkdir(segment_dir)
+        # Matroska can hold just about anything we'd get as a source.
+        ffmpeg_cmd = ['ffmpeg', '-y', '-v', 'error',
+                      '-i', fobj.name,
+                      '-map', '0', '-c', 'copy',
+                      '-f', 'segment',
+                      '-segment_time', str(settings.NOMMERD_SEGMENT_SECONDS),
+                      '-reset_timestamps', '1',
+                      os.path.join(segment_dir, 'src_%04d.mkv')]
+        logger.debug("SegmentingNommer.__split_source(): Command to run: %s" % ' '.join(ffmpeg_cmd))
+
+        if not run_ffmpeg(self, ffmpeg_cmd):
+            return None
+        return sorted(glob.glob(os.path.join(segment_dir, 'src_*.mkv')))
+
+    def __queue_segment(self, segment_index, segment_path):
+        """
+        Uploads a segment to the scratch area, and queues up a job to
+        encode it.
+
+        :param int segment_index: Which segment, from 0.
+        :param str segment_path: The segment's local path.
+        """
+        source_uri = get_segment_uri(self.job.unique_id, segment_index,
+                                     'src', '.mkv')
+        dest_uri = get_segment_uri(self.job.unique_id, segment_index, 'out',
+                                   get_output_extension(self.job))
+
+        segment_fobj = open(segment_path, 'rb')
+        try:
+            get_backend_for_uri(source_uri).upload_file(source_uri,
+                                                        segment_fobj)
+        finally:
+            segment_fobj.close()
+
+        segment_job = EncodingJob(source_uri, dest_uri, SEGMENT_NOMMER,
+                                  self.job.job_options,
+                                  priority=self.job.priority,
+                                  preset=self.job.preset,
+                                  source_size=os.path.getsize(segment_path),
+                                  parent_id=self.job.unique_id,
+                                  segment_index=segment_index)
+        segment_job.save()
+        logger.debug("SegmentingNommer.__queue_segment(): Queued segment " \
+                     "%d of %s as %s" % (segment_index, self.job.unique_id,
+                                         segment_job.unique_id))
+
+class SegmentJoinNommer(BaseNommer):
+    """
+    This :ref:`Nommer <nommers>` downloads the encoded segments of a job
+    that :py:class:`SegmentingNommer` split up, joins them with ffmpeg's
+    concat demuxer, and uploads the result to the split job's destination.
+    :doc:`../feederd` queues these up on its own, there's no need to submit
+    them.
+    """
+    def _start_encoding(self):
+        """
+        Downloads the segments, joins them, and uploads the result.
+        """
+        logger.info("Starting to join segments for job %s" % self.job.parent_id)
+        self.wrapped_set_job_state('DOWNLOADING')
+        segment_paths = self.__download_segments()
+
+        self.wrapped_set_job_state('ENCODING')
+        out_fobj = self.__join_segments(segment_paths)
+        if not out_fobj:
+            return False
+
+        self.upload_to_destination(out_fobj)
+        self.wrapped_set_job_state('FINISHED')
+        logger.info("SegmentJoinNommer: Segments for job %s have been " \
+                    "joined." % self.job.parent_id)
+
+        out_fobj.close()
+        return True
+
+    def __download_segments(self):
+        """
+        Downloads every encoded segment into our temporary directory.
+
+        :rtype: list
+        :returns: Paths to the segments, in order.
+        """
+        extension = get_output_extension(self.job)
+        segment_paths = []
+        for segment_index in range(self.job.num_segments):
+            segment_uri = get_segment_uri(self.job.parent_id, segment_index,
+                                          'out', extension)
+            segment_path = os.path.join(self.temp_cwd,
+                                        'out_%04d%s' % (segment_index,
+                                                        extension))
+            segment_fobj = open(segment_path, 'w+b')
+            try:
+                get_backend_for_uri(segment_uri).download_file(segment_uri,
+                                                               segment_fobj)
+                segment_fobj.flush()
+                os.fsync(segment_fobj.fileno())
+            finally:
+                segment_fobj.close()
+            segment_paths.append(segment_path)
+        return segment_paths
+
+    def __get_output_format(self):
+        """
+        Looks for an ``f`` option in the last pass of the split job's
+        options, since the segments were encoded with it.
+
+        :rtype: str
+        :returns: The output format, or ``None`` to let ffmpeg guess from
+            the destination's file extension.
+        """
+        if not self.job.job_options:
+            return None
+        for key, val in self.job.job_options[-1].get('outfile_options', []):
+            if key == 'f':
+                return val
+        return None
+
+    def __join_segments(self, segment_paths):
+        """
+        Runs the segments through ffmpeg's concat demuxer, without
+        re-encoding.
+
+        :param list segment_paths: Paths to the segments, in order.
+        :rtype: file-like object or ``None``
+        :returns: The joined output. If ffmpeg fails, ``None`` is returned,
+            and the ERROR job state is set.
+        """
+        list_path = os.path.join(self.temp_cwd, 'segments.txt')
+        list_fobj = open(list_path, 'w')
+        for segment_path in segment_paths:
+            list_fobj.write("file '%s'\n" % segment_path)
+        list_fobj.close()
+
+        out_fobj = tempfile.NamedTemporaryFile(
+            mode='w+b', delete=True, suffix=get_output_extension(self.job))
+        ffmpeg_cmd = ['ffmpeg', '-y', '-v', 'error',
+                      '-f', 'concat', '-safe', '0', '-i', list_path,
+                      '-map', '0', '-c', 'copy']
+        output_format = self.__get_output_format()
+        if output_format:
+            ffmpeg_cmd += ['-f', output_format]
+        ffmpeg_cmd.append(out_fobj.name)
+        logger.debug("SegmentJoinNommer.__join_segments(): Command to run: %s" % ' '.join(ffmpeg_cmd))
+
+        if not run_ffmpeg(self, ffmpeg_cmd):
+            out_fobj.close()
+            return None
+        out_fobj.seek(0)
+        return out_fobj
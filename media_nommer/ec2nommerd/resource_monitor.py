@@ -0,0 +1,236 @@
+"""
+Contains the :py:class:`ResourceMonitor` class, which watches this node's
+CPU and memory to decide how many jobs it can encode at once.
+"""
+import os
+import threading
+from media_nommer.conf import settings
+from media_nommer.utils import logger
+from media_nommer.ec2nommerd.instance_metadata import InstanceMetadata
+
+class ResourceMonitor(object):
+    """
+    Sizes this node's encoder slots from what it's actually seeing, rather
+    than from a fixed number. Readings are taken from ``/proc`` every
+    :py:data:`NOMMERD_RESOURCE_CHECK_INTERVAL <media_nommer.conf.settings.NOMMERD_RESOURCE_CHECK_INTERVAL>`
+    seconds:
+
+    * CPU utilization and steal time, from ``/proc/stat``.
+    * The one minute load average, from ``/proc/loadavg``.
+    * Available memory, from ``/proc/meminfo``.
+    * The resident memory of our encoder processes (any child processes of
+      :doc:`../ec2nommerd`).
+
+    Until the first reading is in, or on systems without ``/proc``, the
+    starting point from
+    :py:meth:`InstanceMetadata.get_max_encoding_jobs <media_nommer.ec2nommerd.instance_metadata.InstanceMetadata.get_max_encoding_jobs>`
+    is used.
+    """
+    # The latest smoothed readings. Empty until the first sample.
+    READINGS = {}
+    # The last raw (busy, steal, total) CPU jiffies, for working out deltas.
+    LAST_CPU_TIMES = None
+    # Guards READINGS and LAST_CPU_TIMES.
+    LOCK = threading.Lock()
+
+    @classmethod
+    def _read_cpu_times(cls):
+        """
+        :rtype: tuple
+        :returns: A ``(busy, steal, total)`` tuple of CPU jiffies since boot.
+        """
+        for line in open('/proc/stat'):
+            if line.startswith('cpu '):
+                fields = [int(field) for field in line.split()[1:]]
+                # user nice system idle iowait irq softirq steal ...
+                idle = fields[3] + fields[4]
+                steal = len(fields) > 7 and fields[7] or 0
+                # Guest time is already counted in user time.
+                total = sum(fields[:8])
+                return total - idle - steal, steal, total
+        raise IOError("No cpu line in /proc/stat")
+
+    @classmethod
+    def _read_load_average(cls):
+        """
+        :rtype: float
+        :returns: The one minute load average.
+        """
+        return float(open('/proc/loadavg').read().split()[0])
+
+    @classmethod
+    def _read_available_memory_mb(cls):
+        """
+        :rtype: int
+        :returns: The megabytes of memory available for new processes.
+        """
+        meminfo = {}
+        for line in open('/proc/meminfo'):
+            key, value = line.split(':', 1)
+            # Values are in kB.
+            meminfo[key] = int(value.split()[0])
+        if meminfo.has_key('MemAvailable'):
+            return meminfo['MemAvailable'] // 1024
+        # Older kernels don't work this out for us.
+        return (meminfo['MemFree'] + meminfo.get('Buffers', 0) + \
+                meminfo.get('Cached', 0)) // 1024
+
+    @classmethod
+    def _read_encoder_rss_mb(cls):
+        """
+        Adds up the resident memory of our child processes, which are the
+        encoders.
+
+        :rtype: tuple
+        :returns: A ``(num_processes, rss_mb)`` tuple.
+        """
+        my_pid = os.getpid()
+        num_processes = 0
+        rss_kb = 0
+        for pid in os.listdir('/proc'):
+            if not pid.isdigit():
+                continue
+            try:
+                status = open('/proc/%s/status' % pid).read()
+            except IOError:
+                # Went away while we were looking.
+                continue
+            fields = {}
+            for line in status.splitlines():
+                if ':' in line:
+                    key, value = line.split(':', 1)
+                    fields[key] = value.split()
+            if fields.get('PPid') != [str(my_pid)]:
+                continue
+            num_processes += 1
+            if fields.has_key('VmRSS'):
+                rss_kb += int(fields['VmRSS'][0])
+        return num_processes, rss_kb // 1024
+
+    @classmethod
+    def _smooth(cls, key, value):
+        """
+        Folds a new reading into its moving average.
+        """
+        smoothing = settings.NOMMERD_RESOURCE_SMOOTHING
+        if cls.READINGS.has_key(key):
+            value = (smoothing * value) + ((1 - smoothing) * cls.READINGS[key])
+        cls.READINGS[key] = value
+
+    @classmethod
+    def sample(cls):
+        """
+        Takes a fresh set of readings from ``/proc``. Called every
+        :py:data:`NOMMERD_RESOURCE_CHECK_INTERVAL <media_nommer.conf.settings.NOMMERD_RESOURCE_CHECK_INTERVAL>`
+        seconds.
+        """
+        try:
+            cpu_times = cls._read_cpu_times()
+            load_average = cls._read_load_average()
+            available_mb = cls._read_available_memory_mb()
+            num_encoders, encoder_rss_mb = cls._read_encoder_rss_mb()
+        except (IOError, OSError, ValueError, KeyError):
+            # No /proc here, stick with the static estimate.
+            return
+
+        with cls.LOCK:
+            if cls.LAST_CPU_TIMES:
+                busy, steal, total = [now - last for now, last in
+                                      zip(cpu_times, cls.LAST_CPU_TIMES)]
+                if total > 0:
+                    cls._smooth('cpu_busy', float(busy) / total)
+                    cls._smooth('cpu_steal', float(steal) / total)
+            cls.LAST_CPU_TIMES = cpu_times
+            cls.READINGS['load_average'] = load_average
+            cls.READINGS['available_mb'] = available_mb
+            cls.READINGS['num_encoders'] = num_encoders
+            cls.READINGS['encoder_rss_mb'] = encoder_rss_mb
+
+        logger.debug("ResourceMonitor.sample(): %s" % cls.READINGS)
+
+    @classmethod
+    def get_max_capacity(cls):
+        """
+        :rtype: int
+        :returns: The most jobs we'll ever run at once, however idle the
+            machine looks.
+        """
+        return settings.MAX_ENCODING_JOBS_PER_EC2_INSTANCE or \
+               max(InstanceMetadata.get('num_cpus'), 1)
+
+    @classmethod
+    def compute_capacity(cls, num_jobs, readings):
+        """
+        Works out how many jobs this node can handle at once, given a set of
+        readings.
+
+        :param int num_jobs: The number of jobs currently encoding.
+        :param dict readings: Readings, as gathered by :py:meth:`sample`.
+        :rtype: int
+        :returns: The number of jobs this node can handle at once.
+        """
+        max_capacity = cls.get_max_capacity()
+        static_capacity = min(InstanceMetadata.get_max_encoding_jobs(),
+                              max_capacity)
+        if not readings.has_key('cpu_busy'):
+            return static_capacity
+
+        # Jobs spend a while downloading before they get CPU hungry, so
+        # only feel our way past the static estimate one job at a time.
+        capacity = min(max_capacity, max(static_capacity, num_jobs + 1))
+
+        cpu_busy = readings['cpu_busy']
+        # Stolen time is CPU we were promised but aren't getting.
+        usable_cpu = settings.NOMMERD_TARGET_CPU_UTILIZATION - \
+                     readings.get('cpu_steal', 0.0)
+        if num_jobs and cpu_busy > 0:
+            # Assume each job costs as much CPU as the current ones do.
+            capacity = min(capacity, int(num_jobs * usable_cpu / cpu_busy))
+
+        # Memory left over for jobs, counting what the current ones use.
+        num_encoders = readings.get('num_encoders', 0)
+        encoder_rss_mb = readings.get('encoder_rss_mb', 0)
+        if num_encoders and encoder_rss_mb:
+            mb_per_job = float(encoder_rss_mb) / num_encoders
+        else:
+            mb_per_job = settings.NOMMERD_MEMORY_MB_PER_JOB
+        job_mb = readings.get('available_mb', 0) + encoder_rss_mb
+        capacity = min(capacity, int(job_mb / max(mb_per_job, 1)))
+
+        # Never report less than what we're already running, and always
+        # allow at least one job.
+        return max(capacity, num_jobs, 1)
+
+    @classmethod
+    def get_capacity(cls, num_jobs):
+        """
+        :param int num_jobs: The number of jobs currently encoding.
+        :rtype: int
+        :returns: The number of jobs this node can handle at once right now.
+            This is what gets reported to :doc:`../feederd`.
+        """
+        if not settings.NOMMERD_ADAPTIVE_CONCURRENCY:
+            return InstanceMetadata.get_max_encoding_jobs()
+
+        with cls.LOCK:
+            readings = cls.READINGS.copy()
+        return cls.compute_capacity(num_jobs, readings)
+
+    @classmethod
+    def has_headroom(cls):
+        """
+        Checks whether the machine is too busy for another job right now,
+        regardless of capacity. This catches load spikes that the smoothed
+        readings haven't caught up with yet.
+
+        :rtype: bool
+        :returns: ``True`` if there's room for another job.
+        """
+        if not settings.NOMMERD_ADAPTIVE_CONCURRENCY:
+            return True
+
+        load_average = cls.READINGS.get('load_average')
+        if load_average is None:
+            return True
+        num_cpus = max(InstanceMetadata.get('num_cpus'), 1)
+        return load_average / num_cpus < settings.NOMMERD_MAX_LOAD_PER_CPU
@@ -0,0 +1,305 @@
+"""
+Contains the :py:class:`SourceCache` class, which keeps recently used source
+media around on this node's disk.
+"""
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+from media_nommer.conf import settings
+from media_nommer.utils import logger, metrics
+from media_nommer.utils.bloom_filter import BloomFilter
+from media_nommer.core.storage_backends import get_backend_for_uri
+
+class SourceCache(object):
+    """
+    An on-disk, least recently used cache of source media. Re-encodes,
+    retries, and several presets' worth of jobs for the same master only
+    download it once per node.
+
+    Sources are keyed by their URI, along with the ETag and size recorded
+    when the job was submitted, so a changed source is never mistaken for
+    the old one. Jobs without either aren't cached. The cache holds no more
+    than
+    :py:data:`NOMMERD_SOURCE_CACHE_BYTES <media_nommer.conf.settings.NOMMERD_SOURCE_CACHE_BYTES>`,
+    evicting the least recently used sources to make room.
+
+    Nommers get a hard link to the cached file, so an eviction while they're
+    still encoding doesn't pull the file out from under them. If the cache
+    is on a different filesystem from the nommer's working directory, the
+    file is copied instead.
+    """
+    # Keys are cache keys, values are dicts with size and last_used keys.
+    # None until the cache directory has been scanned.
+    ENTRIES = None
+    # Keys are cache keys, values are how many nommers are linking to them
+    # right now. These aren't evicted.
+    IN_USE = {}
+    # Keys are cache keys, values are threading.Event objects set once the
+    # source has finished downloading.
+    DOWNLOADING = {}
+    # Guards ENTRIES, IN_USE, and DOWNLOADING.
+    LOCK = threading.Lock()
+
+    @classmethod
+    def get_cache_dir(cls):
+        """
+        :rtype: str
+        :returns: The directory that cached sources are kept in.
+        """
+        return settings.NOMMERD_SOURCE_CACHE_DIR or \
+               os.path.join(tempfile.gettempdir(), 'nommerd-source-cache')
+
+    @classmethod
+    def get_key(cls, uri, etag=None, size=None):
+        """
+        :param str uri: The source's URI.
+        :keyword str etag: The source's ETag, if known.
+        :keyword int size: The source's size in bytes, if known.
+        :rtype: str
+        :returns: The source's cache key, or ``None`` if it can't be cached.
+        """
+        if not etag and size is None:
+            return None
+        return hashlib.sha1('%s\n%s\n%s' % (uri, etag, size)).hexdigest()
+
+    @classmethod
+    def get_summary(cls):
+        """
+        Sums up what's in the cache compactly enough to go out with every
+        heartbeat, so :doc:`../feederd` can send jobs our way when we already
+        have their source. See
+        :py:data:`JOB_CACHE_AFFINITY <media_nommer.conf.settings.JOB_CACHE_AFFINITY>`.
+
+        :rtype: str
+        :returns: A serialized
+            :py:class:`BloomFilter <media_nommer.utils.bloom_filter.BloomFilter>`
+            of the cached keys, or ``None`` if the cache is off.
+        """
+        if not settings.NOMMERD_SOURCE_CACHE_BYTES:
+            return None
+
+        summary = BloomFilter(settings.NOMMERD_SOURCE_CACHE_SUMMARY_BITS,
+                              settings.NOMMERD_SOURCE_CACHE_SUMMARY_HASHES)
+        with cls.LOCK:
+            cls._load_entries()
+            for key in cls.ENTRIES.keys():
+                summary.add(key)
+        return summary.to_string()
+
+    @classmethod
+    def _get_path(cls, key):
+        """
+        :param str key: A cache key.
+        :rtype: str
+        :returns: Where the source for the key is kept.
+        """
+        return os.path.join(cls.get_cache_dir(), key)
+
+    @classmethod
+    def _load_entries(cls):
+        """
+        Scans the cache directory, picking up whatever an earlier run left
+        behind, and clearing out half-finished downloads. Must be called
+        with :py:attr:`LOCK` held.
+        """
+        if cls.ENTRIES is not None:
+            return
+
+        cls.ENTRIES = {}
+        cache_dir = cls.get_cache_dir()
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        for filename in os.listdir(cache_dir):
+            path = os.path.join(cache_dir, filename)
+            if filename.endswith('.partial'):
+                os.remove(path)
+                continue
+            stat = os.stat(path)
+            cls.ENTRIES[filename] = {'size': stat.st_size,
+                                     'last_used': stat.st_mtime}
+        cls._set_size_gauge()
+
+    @classmethod
+    def _set_size_gauge(cls):
+        """
+        Records how many bytes are cached. Must be called with
+        :py:attr:`LOCK` held.
+        """
+        metrics.set_gauge('nommerd.source_cache.bytes',
+                          sum([entry['size'] for entry in cls.ENTRIES.values()]))
+
+    @classmethod
+    def _evict(cls, num_bytes):
+        """
+        Evicts the least recently used sources until there's room for
+        ``num_bytes`` more. Sources being linked to or downloaded are left
+        alone. Must be called with :py:attr:`LOCK` held.
+
+        :param int num_bytes: How much room is needed.
+        :rtype: bool
+        :returns: ``True`` if there's now enough room.
+        """
+        budget = settings.NOMMERD_SOURCE_CACHE_BYTES
+        cached_bytes = sum([entry['size'] for entry in cls.ENTRIES.values()])
+        by_last_used = sorted(cls.ENTRIES.items(),
+                              key=lambda item: item[1]['last_used'])
+        for key, entry in by_last_used:
+            if cached_bytes + num_bytes <= budget:
+                break
+            if cls.IN_USE.get(key) or cls.DOWNLOADING.has_key(key):
+                continue
+            logger.debug("SourceCache._evict(): Evicting %s" % key)
+            try:
+                os.remove(cls._get_path(key))
+            except OSError:
+                pass
+            del cls.ENTRIES[key]
+            cached_bytes -= entry['size']
+            metrics.incr('nommerd.source_cache.evictions')
+        return cached_bytes + num_bytes <= budget
+
+    @classmethod
+    def _link(cls, source_path, dest_path):
+        """
+        Hard links a cached source to where a nommer wants it, falling back
+        to a copy across filesystems.
+        """
+        try:
+            os.link(source_path, dest_path)
+        except OSError:
+            shutil.copyfile(source_path, dest_path)
+
+    @classmethod
+    def _release(cls, key):
+        """
+        Marks a cached source as no longer in use by one more nommer.
+
+        :param str key: A cache key.
+        :rtype: int
+        :returns: The source's size in bytes.
+        """
+        with cls.LOCK:
+            cls.IN_USE[key] -= 1
+            if not cls.IN_USE[key]:
+                del cls.IN_USE[key]
+            return cls.ENTRIES.get(key, {}).get('size', 0)
+
+    @classmethod
+    def _download(cls, uri, path):
+        """
+        Downloads a source from its storage backend.
+
+        :param str uri: The source's URI.
+        :param str path: Where to download it to.
+        """
+        fobj = open(path, 'w+b')
+        try:
+            get_backend_for_uri(uri).download_file(uri, fobj)
+            # flush and fsync to force writing to the file object. Doesn't
+            # always happen otherwise.
+            fobj.flush()
+            os.fsync(fobj.fileno())
+        finally:
+            fobj.close()
+
+    @classmethod
+    def fetch(cls, uri, dest_path, etag=None, size=None):
+        """
+        Puts a source at ``dest_path``, from the cache if it's there, or by
+        downloading it (and caching it) if not. If another job is already
+        downloading the same source, this waits for it rather than
+        downloading it twice.
+
+        :param str uri: The source's URI.
+        :param str dest_path: Where to put the source.
+        :keyword str etag: The source's ETag, if known.
+        :keyword int size: The source's size in bytes, if known.
+        :rtype: bool
+        :returns: ``True`` if the source came from the cache.
+        """
+        key = cls.get_key(uri, etag=etag, size=size)
+        if not settings.NOMMERD_SOURCE_CACHE_BYTES or not key:
+            cls._download(uri, dest_path)
+            return False
+
+        while True:
+            with cls.LOCK:
+                cls._load_entries()
+                if cls.ENTRIES.has_key(key):
+                    cls.IN_USE[key] = cls.IN_USE.get(key, 0) + 1
+                    cls.ENTRIES[key]['last_used'] = time.time()
+                    is_hit = True
+                    break
+                download_done = cls.DOWNLOADING.get(key)
+                if not download_done:
+                    # It's up to us.
+                    cls.DOWNLOADING[key] = threading.Event()
+                    is_hit = False
+                    break
+            download_done.wait()
+
+        if is_hit:
+            return cls.__use_cached(key, dest_path)
+        return cls.__download_and_cache(key, uri, dest_path)
+
+    @classmethod
+    def __use_cached(cls, key, dest_path):
+        """
+        Links a cached source into place. The caller has marked it in use.
+
+        :rtype: bool
+        :returns: ``True``, since this is a cache hit.
+        """
+        path = cls._get_path(key)
+        try:
+            cls._link(path, dest_path)
+            # Carries our idea of recently used across restarts.
+            os.utime(path, None)
+        finally:
+            num_bytes = cls._release(key)
+
+        metrics.incr('nommerd.source_cache.hits')
+        metrics.incr('nommerd.source_cache.bytes_saved', num_bytes)
+        logger.debug("SourceCache.fetch(): Cache hit for %s" % key)
+        return True
+
+    @classmethod
+    def __download_and_cache(cls, key, uri, dest_path):
+        """
+        Downloads a source into the cache, then links it into place. The
+        caller has marked it as downloading.
+
+        :rtype: bool
+        :returns: ``False``, since this is a cache miss.
+        """
+        metrics.incr('nommerd.source_cache.misses')
+        path = cls._get_path(key)
+        partial_path = path + '.partial'
+        try:
+            cls._download(uri, partial_path)
+            num_bytes = os.path.getsize(partial_path)
+            with cls.LOCK:
+                is_cached = cls._evict(num_bytes)
+                if is_cached:
+                    os.rename(partial_path, path)
+                    cls.ENTRIES[key] = {'size': num_bytes,
+                                        'last_used': time.time()}
+                    cls.IN_USE[key] = cls.IN_USE.get(key, 0) + 1
+                    cls._set_size_gauge()
+            if is_cached:
+                try:
+                    cls._link(path, dest_path)
+                finally:
+                    cls._release(key)
+            else:
+                # Too big to cache. Hand it over as-is.
+                shutil.move(partial_path, dest_path)
+        finally:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            with cls.LOCK:
+                cls.DOWNLOADING.pop(key).set()
+        return False
@@ -0,0 +1,719 @@
+"""
+Tests for ec2nommerd's job scheduling and node management.
+"""
+import os
+import sys
+import time
+import shutil
+import socket
+import subprocess
+import tempfile
+import unittest
+import datetime
+import threading
+import BaseHTTPServer
+from media_nommer.conf import settings
+from media_nommer.core.job_state_backend import EncodingJob, JobStateBackend
+from media_nommer.ec2nommerd.job_buffer import JobBuffer, PriorityLaneScheduler
+from media_nommer.ec2nommerd.node_state import NodeStateManager
+from media_nommer.ec2nommerd.instance_metadata import InstanceMetadata
+from media_nommer.ec2nommerd.resource_monitor import ResourceMonitor
+from media_nommer.ec2nommerd.cpu_budget import CPUBudget
+from media_nommer.ec2nommerd.source_cache import SourceCache
+from media_nommer.ec2nommerd.nommers import ffmpeg
+from media_nommer.ec2nommerd.nommers.ffmpeg_progress import FFmpegProgress
+
+BASE_NOMMER = 'media_nommer.ec2nommerd.nommers.base_nommer.BaseNommer'
+FFMPEG_NOMMER = 'media_nommer.ec2nommerd.nommers.ffmpeg.FFmpegNommer'
+
+class PriorityLaneSchedulerTests(unittest.TestCase):
+    """
+    Tests for PriorityLaneScheduler.
+    """
+    def setUp(self):
+        self.orig_lanes = settings.JOB_PRIORITY_LANES
+        settings.JOB_PRIORITY_LANES = (('high', 6), ('normal', 3), ('low', 1))
+        PriorityLaneScheduler.CURRENT_WEIGHTS = {}
+
+    def tearDown(self):
+        settings.JOB_PRIORITY_LANES = self.orig_lanes
+
+    def test_picks_follow_weights(self):
+        """
+        Every ten picks are split between the lanes by weight.
+        """
+        picks = [PriorityLaneScheduler.next_lane() for i in range(10)]
+        self.assertEqual(picks.count('high'), 6)
+        self.assertEqual(picks.count('normal'), 3)
+        self.assertEqual(picks.count('low'), 1)
+        # High priority shouldn't hog the first six picks.
+        self.assertNotEqual(picks[:6], ['high'] * 6)
+
+    def test_excluded_lanes_skipped(self):
+        """
+        Excluded lanes are never picked, and excluding everything gives None.
+        """
+        for i in range(10):
+            self.assertEqual(PriorityLaneScheduler.next_lane(
+                                        exclude=['high', 'normal']), 'low')
+        self.assertEqual(PriorityLaneScheduler.next_lane(
+                                exclude=['high', 'normal', 'low']), None)
+
+class FakeMessage(object):
+    """
+    Stands in for a boto SQS message.
+    """
+    def __init__(self, id):
+        self.id = id
+        self.is_deleted = False
+
+    def delete(self):
+        self.is_deleted = True
+
+class JobBufferFillTests(unittest.TestCase):
+    """
+    Tests for filling the job buffer from the priority lanes.
+    """
+    def setUp(self):
+        self.orig_settings = {}
+        new_settings = {
+            'JOB_PRIORITY_LANES': (('high', 6), ('normal', 3), ('low', 1)),
+            'JOB_CACHE_AFFINITY': False,
+            'NOMMERD_JOB_PREFETCH_DEPTH': 0,
+        }
+        for name, value in new_settings.items():
+            self.orig_settings[name] = getattr(settings, name)
+            setattr(settings, name, value)
+        PriorityLaneScheduler.CURRENT_WEIGHTS = {}
+        JobBuffer.BUFFERED = []
+        # Keys are lane names, values are lists of replies, each a number
+        # of messages to hand back.
+        self.replies = {}
+        # (lane, num_to_pop) tuples.
+        self.receives = []
+        def get_new_job_messages_from_queue(num_to_pop, visibility_timeout,
+                                            priority=None):
+            self.receives.append((priority, num_to_pop))
+            replies = self.replies.get(priority)
+            num_messages = min(replies and replies.pop(0) or 0, num_to_pop)
+            job_messages = []
+            for i in range(num_messages):
+                unique_id = '%s%d' % (priority, len(self.receives) * 10 + i)
+                job = EncodingJob('s3://bucket/in.mp4', 's3://bucket/out.mp4',
+                                  BASE_NOMMER, [], unique_id=unique_id,
+                                  job_state='PENDING')
+                job_messages.append((FakeMessage(unique_id), job))
+            return job_messages
+        self.orig_get_messages = \
+                JobStateBackend.__dict__['get_new_job_messages_from_queue']
+        JobStateBackend.get_new_job_messages_from_queue = \
+                staticmethod(get_new_job_messages_from_queue)
+
+    def tearDown(self):
+        for name, value in self.orig_settings.items():
+            setattr(settings, name, value)
+        JobStateBackend.get_new_job_messages_from_queue = self.orig_get_messages
+        PriorityLaneScheduler.CURRENT_WEIGHTS = {}
+        JobBuffer.BUFFERED = []
+
+    def get_buffered_lanes(self):
+        return [job.unique_id.rstrip('0123456789')
+                for message, job in JobBuffer.BUFFERED]
+
+    def test_one_receive_per_lane(self):
+        """
+        Ten slots take one batched receive per lane, and the jobs are
+        buffered in the order the scheduler picked their lanes.
+        """
+        self.replies = {'high': [10], 'normal': [10], 'low': [10]}
+        self.assertEqual(JobBuffer.fill(10), 10)
+        self.assertEqual(sorted(self.receives),
+                         [('high', 6), ('low', 1), ('normal', 3)])
+
+        PriorityLaneScheduler.CURRENT_WEIGHTS = {}
+        picks = [PriorityLaneScheduler.next_lane() for i in range(10)]
+        self.assertEqual(self.get_buffered_lanes(), picks)
+
+    def test_empty_reply_not_dry(self):
+        """
+        A lane that comes up empty once is asked again, and its jobs still
+        get buffered.
+        """
+        settings.JOB_PRIORITY_LANES = (('high', 1), ('low', 1))
+        self.replies = {'high': [0, 10], 'low': [0, 10]}
+        self.assertEqual(JobBuffer.fill(4), 4)
+        self.assertEqual(sorted(self.get_buffered_lanes()),
+                         ['high', 'high', 'low', 'low'])
+        self.assertEqual(len(self.receives), 4)
+
+    def test_empty_lanes_given_up_on(self):
+        """
+        Once every lane has come up empty enough times in a row, the fill
+        stops.
+        """
+        self.replies = {'high': [1]}
+        self.assertEqual(JobBuffer.fill(10), 1)
+        self.assertEqual(self.get_buffered_lanes(), ['high'])
+        self.assertEqual(len(self.receives),
+                         JobBuffer.MAX_EMPTY_RECEIVES * 3 + 1)
+
+class HeartbeatTests(unittest.TestCase):
+    """
+    Tests for NodeStateManager's heartbeat diffing.
+    """
+    def setUp(self):
+        NodeStateManager.LAST_REPORTED_ATTRIBUTES = {
+            'id': 'i-12345',
+            'active_jobs': 1,
+            'state': 'ACTIVE',
+        }
+
+    def tearDown(self):
+        NodeStateManager.LAST_REPORTED_ATTRIBUTES = {}
+
+    def test_only_changes_sent(self):
+        """
+        Unchanged attributes are left out, new and changed ones are kept.
+        """
+        changed = NodeStateManager._get_changed_attributes({
+            'id': 'i-12345',
+            'active_jobs': 2,
+            'max_jobs': 2,
+            'state': 'ACTIVE',
+        })
+        self.assertEqual(changed, {'active_jobs': 2, 'max_jobs': 2})
+
+class FakeNodeStateDomain(object):
+    """
+    Stands in for the SimpleDB node state domain, holding one item.
+    """
+    def __init__(self, item):
+        self.item = item
+
+    def get_item(self, item_name):
+        return self.item
+
+class FleetDirectiveTests(unittest.TestCase):
+    """
+    Tests for picking up feederd's fleet directives.
+    """
+    def setUp(self):
+        self.domain = FakeNodeStateDomain(None)
+        self.orig_get_domain = \
+                NodeStateManager.__dict__['_aws_sdb_nommer_state_domain']
+        NodeStateManager._aws_sdb_nommer_state_domain = \
+                staticmethod(lambda: self.domain)
+        self.orig_get_instance_id = NodeStateManager.__dict__['get_instance_id']
+        NodeStateManager.get_instance_id = staticmethod(lambda: 'i-12345')
+
+    def tearDown(self):
+        NodeStateManager._aws_sdb_nommer_state_domain = self.orig_get_domain
+        NodeStateManager.get_instance_id = self.orig_get_instance_id
+
+    def set_directive(self, directive_dtime):
+        self.domain.item = {'fleet_directive': 'RETIRE',
+                            'fleet_directive_dtime': str(directive_dtime)}
+
+    def test_current_directive(self):
+        """
+        A recent directive is followed, whether or not its time has
+        microseconds.
+        """
+        now_dtime = datetime.datetime.now()
+        self.set_directive(now_dtime.replace(microsecond=0))
+        self.assertEqual(NodeStateManager.get_fleet_directive(), 'RETIRE')
+        self.set_directive(now_dtime.replace(microsecond=5))
+        self.assertEqual(NodeStateManager.get_fleet_directive(), 'RETIRE')
+
+    def test_stale_directive(self):
+        """
+        Directives from a feederd that has gone away are ignored.
+        """
+        self.set_directive(datetime.datetime.now() - datetime.timedelta(
+                        seconds=settings.NOMMERD_MAX_INACTIVITY + 60))
+        self.assertEqual(NodeStateManager.get_fleet_directive(), None)
+
+class FakeMetadataHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Stands in for EC2's instance metadata service.
+    """
+    VALUES = {
+        '/latest/meta-data/instance-id': 'i-12345',
+        '/latest/meta-data/instance-type': 'c1.xlarge',
+        '/latest/meta-data/placement/availability-zone': 'us-east-1a',
+    }
+
+    def do_GET(self):
+        if not self.VALUES.has_key(self.path):
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(self.VALUES[self.path])
+
+    def log_message(self, *args):
+        pass
+
+class InstanceMetadataTests(unittest.TestCase):
+    """
+    Tests for InstanceMetadata.
+    """
+    def setUp(self):
+        self.orig_settings = {}
+        for name in ['NOMMERD_METADATA_URL', 'NOMMERD_INSTANCE_METADATA',
+                     'MAX_ENCODING_JOBS_PER_EC2_INSTANCE']:
+            self.orig_settings[name] = getattr(settings, name)
+        settings.NOMMERD_INSTANCE_METADATA = None
+        InstanceMetadata.METADATA = {}
+
+    def tearDown(self):
+        for name, value in self.orig_settings.items():
+            setattr(settings, name, value)
+        InstanceMetadata.METADATA = {}
+
+    def test_fetched_from_metadata_service(self):
+        """
+        Values come from the metadata service when it's around.
+        """
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0),
+                                           FakeMetadataHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            settings.NOMMERD_METADATA_URL = \
+                'http://127.0.0.1:%d/latest/meta-data/' % server.server_port
+            InstanceMetadata.load()
+        finally:
+            server.shutdown()
+
+        self.assertEqual(InstanceMetadata.get_instance_id(), 'i-12345')
+        self.assertEqual(InstanceMetadata.get('instance_type'), 'c1.xlarge')
+        self.assertEqual(InstanceMetadata.is_ec2_instance(), True)
+
+    def test_unreachable_service_means_local(self):
+        """
+        If nothing answers, we're not on EC2.
+        """
+        # Grab a port that nobody is listening on.
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        settings.NOMMERD_METADATA_URL = 'http://127.0.0.1:%d/' % port
+
+        InstanceMetadata.load()
+        self.assertEqual(InstanceMetadata.is_ec2_instance(), False)
+
+    def test_overrides_size_slots(self):
+        """
+        Overridden CPU and memory figures drive the number of slots.
+        """
+        settings.MAX_ENCODING_JOBS_PER_EC2_INSTANCE = None
+        settings.NOMMERD_INSTANCE_METADATA = {
+            'instance_id': 'i-local',
+            'num_cpus': 16,
+            'memory_mb': 4096,
+        }
+        InstanceMetadata.load()
+        self.assertEqual(InstanceMetadata.get_instance_id(), 'i-local')
+        # CPUs allow 8, but memory only allows 2.
+        self.assertEqual(InstanceMetadata.get_max_encoding_jobs(), 2)
+
+class ResourceMonitorTests(unittest.TestCase):
+    """
+    Tests for ResourceMonitor's capacity sizing.
+    """
+    def setUp(self):
+        self.orig_settings = {}
+        new_settings = {
+            'MAX_ENCODING_JOBS_PER_EC2_INSTANCE': None,
+            'NOMMERD_CPUS_PER_JOB': 2,
+            'NOMMERD_MEMORY_MB_PER_JOB': 1536,
+            'NOMMERD_TARGET_CPU_UTILIZATION': 0.9,
+        }
+        for name, value in new_settings.items():
+            self.orig_settings[name] = getattr(settings, name)
+            setattr(settings, name, value)
+        InstanceMetadata.METADATA = {
+            'instance_id': 'i-12345',
+            'num_cpus': 8,
+            'memory_mb': 16384,
+        }
+
+    def tearDown(self):
+        for name, value in self.orig_settings.items():
+            setattr(settings, name, value)
+        InstanceMetadata.METADATA = {}
+
+    def test_no_readings_uses_static_estimate(self):
+        """
+        Before any readings, capacity comes from the CPU count.
+        """
+        self.assertEqual(ResourceMonitor.compute_capacity(0, {}), 4)
+
+    def test_grows_one_job_at_a_time(self):
+        """
+        With CPU to spare, capacity creeps past the static estimate.
+        """
+        readings = {'cpu_busy': 0.45, 'cpu_steal': 0.0,
+                    'available_mb': 10000, 'num_encoders': 4,
+                    'encoder_rss_mb': 2000}
+        self.assertEqual(ResourceMonitor.compute_capacity(4, readings), 5)
+
+    def test_steal_blocks_new_jobs(self):
+        """
+        Stolen CPU time counts against us, but we never report less than
+        we're running.
+        """
+        readings = {'cpu_busy': 0.9, 'cpu_steal': 0.3,
+                    'available_mb': 10000, 'num_encoders': 4,
+                    'encoder_rss_mb': 2000}
+        self.assertEqual(ResourceMonitor.compute_capacity(4, readings), 4)
+
+    def test_memory_limits_capacity(self):
+        """
+        Without memory to spare, only one job fits.
+        """
+        readings = {'cpu_busy': 0.05, 'available_mb': 2000}
+        self.assertEqual(ResourceMonitor.compute_capacity(0, readings), 1)
+
+class CPUBudgetTests(unittest.TestCase):
+    """
+    Tests for CPUBudget's core partitioning.
+    """
+    def setUp(self):
+        self.orig_settings = {}
+        new_settings = {
+            'MAX_ENCODING_JOBS_PER_EC2_INSTANCE': 2,
+            'NOMMERD_ADAPTIVE_CONCURRENCY': False,
+        }
+        for name, value in new_settings.items():
+            self.orig_settings[name] = getattr(settings, name)
+            setattr(settings, name, value)
+        InstanceMetadata.METADATA = {'instance_id': 'i-12345', 'num_cpus': 8}
+        CPUBudget.ASSIGNED = {}
+
+    def tearDown(self):
+        for name, value in self.orig_settings.items():
+            setattr(settings, name, value)
+        InstanceMetadata.METADATA = {}
+        CPUBudget.ASSIGNED = {}
+
+    def test_cores_split_between_slots(self):
+        """
+        Two slots on eight cores get four cores each, without overlap.
+        Released cores are handed out again.
+        """
+        self.assertEqual(CPUBudget.acquire('job1'), (4, [0, 1, 2, 3]))
+        self.assertEqual(CPUBudget.acquire('job2'), (4, [4, 5, 6, 7]))
+        CPUBudget.release('job1')
+        self.assertEqual(CPUBudget.acquire('job3'), (4, [0, 1, 2, 3]))
+
+class FFmpegProgressTests(unittest.TestCase):
+    """
+    Tests for following ffmpeg's progress output.
+    """
+    def test_two_pass_progress(self):
+        """
+        Progress and ETA cover both passes.
+        """
+        progress = FFmpegProgress(num_passes=2)
+        progress.feed_stderr_line('  Duration: 00:01:40.00, start: 0.000000\n')
+        progress.start_pass(2)
+        for line in ['frame=1500\n', 'fps=50.0\n', 'out_time_ms=50000000\n',
+                     'speed=2.0x\n', 'progress=continue\n']:
+            progress.feed_progress_line(line)
+
+        snapshot = progress.get_snapshot()
+        self.assertEqual(snapshot['percent'], 75.0)
+        self.assertEqual(snapshot['fps'], 50.0)
+        self.assertEqual(snapshot['eta_seconds'], 25)
+
+    def test_stderr_is_bounded(self):
+        """
+        Only the last few lines of stderr are kept.
+        """
+        progress = FFmpegProgress()
+        num_lines = settings.NOMMERD_FFMPEG_STDERR_LINES + 10
+        for i in range(num_lines):
+            progress.feed_stderr_line('line %d\n' % i)
+        tail = progress.get_stderr_tail().splitlines()
+        self.assertEqual(len(tail), settings.NOMMERD_FFMPEG_STDERR_LINES)
+        self.assertEqual(tail[-1], 'line %d' % (num_lines - 1))
+
+class FakeProgress(object):
+    """
+    Stands in for FFmpegProgress. Each snapshot is different, so each one
+    gets published.
+    """
+    def __init__(self, fail_snapshots=False):
+        self.fail_snapshots = fail_snapshots
+        self.num_snapshots = 0
+
+    def read_progress(self, stream):
+        stream.read()
+
+    def read_stderr(self, stream):
+        stream.read()
+
+    def get_snapshot(self):
+        if self.fail_snapshots:
+            raise RuntimeError('Snapshot failed.')
+        self.num_snapshots += 1
+        return {'percent': self.num_snapshots}
+
+class FFmpegFollowTests(unittest.TestCase):
+    """
+    Tests for following a running ffmpeg process.
+    """
+    def setUp(self):
+        self.orig_interval = settings.NOMMERD_PROGRESS_UPDATE_INTERVAL
+        settings.NOMMERD_PROGRESS_UPDATE_INTERVAL = 0
+        job = EncodingJob('s3://bucket/in.mp4', 's3://bucket/out.mp4',
+                          FFMPEG_NOMMER, [], unique_id='somejob')
+        self.nommer = job.nommer
+        self.num_publishes = 0
+        def set_job_state(job_state, details=None):
+            self.num_publishes += 1
+            raise IOError('SimpleDB is throttling us.')
+        self.nommer.wrapped_set_job_state = set_job_state
+
+    def tearDown(self):
+        settings.NOMMERD_PROGRESS_UPDATE_INTERVAL = self.orig_interval
+
+    def start_process(self, seconds):
+        """
+        Starts a stand-in for ffmpeg, which runs for ``seconds``.
+        """
+        return subprocess.Popen([sys.executable, '-c',
+                                 'import time; time.sleep(%s)' % seconds],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+
+    def test_failed_publish_ignored(self):
+        """
+        Progress that can't be published doesn't stop the encode.
+        """
+        process = self.start_process(1.5)
+        self.nommer._FFmpegNommer__follow_ffmpeg(process, FakeProgress())
+        self.assertEqual(process.returncode, 0)
+        self.assertTrue(self.num_publishes >= 1)
+
+    def test_killed_on_early_exit(self):
+        """
+        If following blows up, ffmpeg isn't left running.
+        """
+        process = self.start_process(60)
+        start_time = time.time()
+        self.assertRaises(RuntimeError,
+                          self.nommer._FFmpegNommer__follow_ffmpeg, process,
+                          FakeProgress(fail_snapshots=True))
+        self.assertNotEqual(process.returncode, 0)
+        self.assertTrue(time.time() - start_time < 30)
+
+class FakeProcess(object):
+    """
+    Stands in for a finished ffmpeg process.
+    """
+    def __init__(self, returncode):
+        self.returncode = returncode
+
+class FakeStorage(object):
+    """
+    Stands in for a storage backend. Uploads to a path with ``fail`` in it
+    blow up.
+    """
+    def __init__(self, uploads):
+        self.uploads = uploads
+
+    def upload_file(self, uri, fobj):
+        if 'fail' in uri:
+            raise IOError('Upload failed.')
+        self.uploads.append(uri)
+
+class FFmpegMultiOutputTests(unittest.TestCase):
+    """
+    Tests for encoding several outputs with one ffmpeg process.
+    """
+    def setUp(self):
+        self.orig_settings = {}
+        new_settings = {
+            'PRESETS': {
+                'hd': {
+                    'nommer': FFMPEG_NOMMER,
+                    'options': [{
+                        'infile_options': [('ss', '5')],
+                        'outfile_options': [('s', '1280x720')],
+                    }],
+                },
+                'sd': {
+                    'nommer': FFMPEG_NOMMER,
+                    'options': [{
+                        'infile_options': [('ss', '5')],
+                        'outfile_options': [('s', '640x360'), ('threads', 1)],
+                    }],
+                },
+            },
+            'MAX_ENCODING_JOBS_PER_EC2_INSTANCE': 2,
+            'NOMMERD_ADAPTIVE_CONCURRENCY': False,
+            'NOMMERD_PARTITION_CPUS': True,
+            'NOMMERD_PIN_ENCODERS': False,
+            'NOMMERD_FFMPEG_PROGRESS': False,
+        }
+        for name, value in new_settings.items():
+            self.orig_settings[name] = getattr(settings, name)
+            setattr(settings, name, value)
+        InstanceMetadata.METADATA = {'instance_id': 'i-12345', 'num_cpus': 8}
+        CPUBudget.ASSIGNED = {}
+
+        self.uploads = []
+        self.orig_get_backend_for_uri = ffmpeg.get_backend_for_uri
+        ffmpeg.get_backend_for_uri = lambda uri: FakeStorage(self.uploads)
+
+        self.outputs = [{'preset': 'hd', 'dest_path': 's3://bucket/hd.mp4'},
+                        {'preset': 'sd', 'dest_path': 's3://bucket/sd.mp4'}]
+        self.job = EncodingJob('s3://bucket/in.mp4', 's3://bucket/hd.mp4',
+                               FFMPEG_NOMMER, {'outputs': self.outputs},
+                               unique_id='somejob')
+        self.nommer = self.job.nommer
+        # (job_state, output_states) tuples, one per save.
+        self.saved_states = []
+        def set_job_state(job_state, details=None):
+            self.job.job_state = job_state
+            self.job.job_state_details = details
+            self.saved_states.append((job_state, list(self.job.output_states)))
+        self.nommer.wrapped_set_job_state = set_job_state
+        # Commands ffmpeg was run with.
+        self.commands = []
+        self.returncode = 0
+        def popen_ffmpeg(ffmpeg_cmd, popen_kwargs, progress):
+            self.commands.append(ffmpeg_cmd)
+            return FakeProcess(self.returncode)
+        self.nommer._FFmpegNommer__popen_ffmpeg = popen_ffmpeg
+        self.source = tempfile.NamedTemporaryFile()
+
+    def tearDown(self):
+        for name, value in self.orig_settings.items():
+            setattr(settings, name, value)
+        ffmpeg.get_backend_for_uri = self.orig_get_backend_for_uri
+        InstanceMetadata.METADATA = {}
+        CPUBudget.ASSIGNED = {}
+        self.source.close()
+
+    def test_command(self):
+        """
+        The source is read once, with the shared infile options, and each
+        output gets its own outfile options and a share of the threads.
+        """
+        out_fobjs = self.nommer._FFmpegNommer__run_ffmpeg_outputs(
+                                                self.source, self.outputs)
+        self.assertEqual(self.commands, [[
+            'ffmpeg', '-y', '-ss', '5', '-i', self.source.name,
+            # Four cores, split between two outputs.
+            '-s', '1280x720', '-threads', '2', out_fobjs[0].name,
+            # The preset's own thread count wins.
+            '-s', '640x360', '-threads', '1', out_fobjs[1].name,
+        ]])
+        self.assertEqual(CPUBudget.ASSIGNED, {})
+        for out_fobj in out_fobjs:
+            out_fobj.close()
+
+    def test_upload_failure(self):
+        """
+        One output failing to upload leaves the others alone, but fails
+        the job.
+        """
+        self.outputs[1]['dest_path'] = 's3://bucket/fail.mp4'
+        self.assertEqual(self.nommer._FFmpegNommer__encode_outputs(
+                                        self.source, self.outputs), False)
+        self.assertEqual(self.uploads, ['s3://bucket/hd.mp4'])
+        self.assertEqual(self.job.output_states, ['FINISHED', 'ERROR'])
+        self.assertEqual(self.job.job_state, 'ERROR')
+        self.assertEqual(self.job.job_state_details,
+                         'Outputs failed to upload: 1 (sd)')
+        self.assertEqual(self.saved_states[0], ('ENCODING',
+                                                ['ENCODING', 'ENCODING']))
+
+    def test_encoding_failure(self):
+        """
+        If ffmpeg fails, every output has failed, and nothing is uploaded.
+        """
+        self.returncode = 1
+        self.assertEqual(self.nommer._FFmpegNommer__encode_outputs(
+                                        self.source, self.outputs), False)
+        self.assertEqual(self.uploads, [])
+        self.assertEqual(self.job.output_states, ['ERROR', 'ERROR'])
+        self.assertEqual(self.job.job_state, 'ERROR')
+
+    def test_success(self):
+        """
+        The job is only finished once every output is uploaded.
+        """
+        self.assertEqual(self.nommer._FFmpegNommer__encode_outputs(
+                                        self.source, self.outputs), True)
+        self.assertEqual(sorted(self.uploads),
+                         ['s3://bucket/hd.mp4', 's3://bucket/sd.mp4'])
+        self.assertEqual(self.job.output_states, ['FINISHED', 'FINISHED'])
+        self.assertEqual(self.job.job_state, 'FINISHED')
+        # The outputs' states go out with the job's own, not one by one.
+        self.assertEqual(self.saved_states, [
+            ('ENCODING', ['ENCODING', 'ENCODING']),
+            ('UPLOADING', ['UPLOADING', 'UPLOADING']),
+            ('FINISHED', ['FINISHED', 'FINISHED']),
+        ])
+
+class SourceCacheTests(unittest.TestCase):
+    """
+    Tests for the on-disk source cache.
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.orig_settings = {}
+        new_settings = {
+            'NOMMERD_SOURCE_CACHE_DIR': os.path.join(self.temp_dir, 'cache'),
+            'NOMMERD_SOURCE_CACHE_BYTES': 10,
+        }
+        for name, value in new_settings.items():
+            self.orig_settings[name] = getattr(settings, name)
+            setattr(settings, name, value)
+        SourceCache.ENTRIES = None
+        # Stand in for the storage backends. Sources are 4 bytes each.
+        self.downloads = []
+        def download(uri, path):
+            self.downloads.append(uri)
+            open(path, 'wb').write(uri[-4:])
+        self.orig_download = SourceCache.__dict__['_download']
+        SourceCache._download = staticmethod(download)
+
+    def tearDown(self):
+        for name, value in self.orig_settings.items():
+            setattr(settings, name, value)
+        SourceCache._download = self.orig_download
+        SourceCache.ENTRIES = None
+        shutil.rmtree(self.temp_dir)
+
+    def fetch(self, uri, name):
+        path = os.path.join(self.temp_dir, name)
+        from_cache = SourceCache.fetch(uri, path, etag='abc')
+        self.assertEqual(open(path).read(), uri[-4:])
+        return from_cache
+
+    def test_second_fetch_is_a_hit(self):
+        """
+        A source is only downloaded once, and later fetches are linked to.
+        """
+        self.assertEqual(self.fetch('s3://b/aaaa', 'first'), False)
+        self.assertEqual(self.fetch('s3://b/aaaa', 'second'), True)
+        self.assertEqual(self.downloads, ['s3://b/aaaa'])
+
+    def test_least_recently_used_evicted(self):
+        """
+        Only two sources fit, so the least recently used one goes.
+        """
+        self.fetch('s3://b/aaaa', 'a1')
+        self.fetch('s3://b/bbbb', 'b1')
+        self.fetch('s3://b/aaaa', 'a2')
+        self.fetch('s3://b/cccc', 'c1')
+        self.assertEqual(self.fetch('s3://b/aaaa', 'a3'), True)
+        self.assertEqual(self.fetch('s3://b/bbbb', 'b2'), False)
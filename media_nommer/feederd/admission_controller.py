@@ -0,0 +1,229 @@
+"""
+Contains the :py:class:`AdmissionController` class, which turns job
+submissions away when a client is sending too many, or when there's already
+more work queued up than the fleet can get through.
+"""
+import math
+import time
+import threading
+from media_nommer.conf import settings
+from media_nommer.utils import logger, metrics
+from media_nommer.feederd.exceptions import InvalidJobException, \
+                                           JobRejectedException
+from media_nommer.feederd.job_cache import JobCache
+from media_nommer.feederd.submission_log import SubmissionLog
+from media_nommer.feederd.work_estimator import WorkEstimator
+
+class TokenBucket(object):
+    """
+    A token bucket rate limiter. Holds up to ``burst`` tokens, and gains
+    ``rate`` tokens a second. Each job submitted takes a token.
+    """
+    def __init__(self, rate, burst):
+        """
+        :param float rate: Tokens gained per second.
+        :param int burst: The most tokens the bucket holds.
+        """
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.last_time = time.time()
+
+    def _refill(self, now):
+        """
+        Adds the tokens gained since we last looked.
+        """
+        elapsed = max(now - self.last_time, 0)
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.last_time = max(now, self.last_time)
+
+    def get_wait(self, amount, now):
+        """
+        :param int amount: How many tokens are needed.
+        :param float now: The current time.
+        :rtype: float
+        :returns: How many seconds until there are enough tokens. ``0`` if
+            there are enough now.
+        """
+        self._refill(now)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount):
+        """
+        Takes tokens. Check :py:meth:`get_wait` first.
+
+        :param int amount: How many tokens to take.
+        """
+        self.tokens -= amount
+
+    def is_full(self, now):
+        """
+        :rtype: bool
+        :returns: ``True`` if the bucket is full, and so no different from
+            a new one.
+        """
+        self._refill(now)
+        return self.tokens >= self.burst
+
+class AdmissionController(object):
+    """
+    Decides whether job submissions are let in. Submissions are turned away
+    with a :py:exc:`JobRejectedException <media_nommer.feederd.exceptions.JobRejectedException>`
+    when:
+
+    * The client has used up its
+      :py:data:`FEEDERD_CLIENT_SUBMIT_RATE <media_nommer.conf.settings.FEEDERD_CLIENT_SUBMIT_RATE>`.
+    * The preset has used up its ``submit_rate``
+      (see :py:data:`PRESETS <media_nommer.conf.settings.PRESETS>`).
+    * The queued up work, in estimated encoder-seconds, is past
+      :py:data:`FEEDERD_MAX_BACKLOG_SECONDS <media_nommer.conf.settings.FEEDERD_MAX_BACKLOG_SECONDS>`.
+    """
+    # Keys are ('client', name) or ('preset', name) tuples, values are
+    # TokenBucket objects.
+    BUCKETS = {}
+    # Guards BUCKETS.
+    LOCK = threading.Lock()
+    # Idle buckets are cleared out once there are this many.
+    MAX_BUCKETS = 10000
+    # The last queue depth, as a (time, depth) tuple. Estimating it means
+    # going over every cached job, so it's only done every so often.
+    QUEUE_DEPTH = None
+    # How long (in seconds) a queue depth is good for.
+    QUEUE_DEPTH_TTL = 5
+
+    @classmethod
+    def get_client_name(cls, request):
+        """
+        Figures out who sent a request, for rate limiting purposes. This is
+        the
+        :py:data:`FEEDERD_CLIENT_HEADER <media_nommer.conf.settings.FEEDERD_CLIENT_HEADER>`
+        header if it's set, and the client's IP otherwise.
+
+        :param request: The Twisted request.
+        :rtype: str
+        :returns: The client's name.
+        """
+        if settings.FEEDERD_CLIENT_HEADER:
+            client_name = request.getHeader(settings.FEEDERD_CLIENT_HEADER)
+            if client_name:
+                return client_name
+        return request.getClientIP()
+
+    @classmethod
+    def get_queue_depth(cls):
+        """
+        Sums up how much work is waiting, so clients can spread out their
+        load.
+
+        :rtype: dict
+        :returns: A dict with ``pending_jobs`` (jobs that haven't been
+            picked up yet) and ``backlog_seconds`` (estimated encoder-seconds
+            of un-finished work) keys.
+        """
+        now = time.time()
+        cached = cls.QUEUE_DEPTH
+        if cached and now - cached[0] < cls.QUEUE_DEPTH_TTL:
+            return cached[1]
+
+        # Jobs still in the submission log haven't made it to the cache.
+        jobs = JobCache.get_cached_jobs().values() + \
+               SubmissionLog.get_jobs()
+        depth = {
+            'pending_jobs': len([job for job in jobs
+                                 if job.job_state == 'PENDING']),
+            'backlog_seconds': int(WorkEstimator.estimate_backlog_seconds(jobs)),
+        }
+        cls.QUEUE_DEPTH = (now, depth)
+        return depth
+
+    @classmethod
+    def _get_bucket_settings(cls, key):
+        """
+        :param tuple key: A ``('client', name)`` or ``('preset', name)``
+            tuple.
+        :rtype: tuple
+        :returns: A ``(rate, burst)`` tuple, or ``None`` if it isn't rate
+            limited.
+        """
+        kind, name = key
+        if kind == 'client':
+            rate = settings.FEEDERD_CLIENT_SUBMIT_RATE
+            burst = settings.FEEDERD_CLIENT_SUBMIT_BURST
+        else:
+            try:
+                preset_dict = settings.PRESETS[name]
+            except (KeyError, TypeError):
+                # Unknown presets are turned away later on.
+                preset_dict = {}
+            rate = preset_dict.get('submit_rate')
+            burst = preset_dict.get('submit_burst', rate)
+        if not rate:
+            return None
+        return rate, max(burst or 0, 1)
+
+    @classmethod
+    def _prune_buckets(cls, now):
+        """
+        Forgets about full buckets. They're no different from new ones.
+        """
+        for key, bucket in cls.BUCKETS.items():
+            if bucket.is_full(now):
+                del cls.BUCKETS[key]
+
+    @classmethod
+    def admit(cls, client_name, presets):
+        """
+        Lets a submission in, or turns it away. A batch is let in or turned
+        away as a whole.
+
+        :param str client_name: Who's submitting. See
+            :py:meth:`get_client_name`.
+        :param list presets: The preset name of each job being submitted.
+        :raises: :py:exc:`JobRejectedException <media_nommer.feederd.exceptions.JobRejectedException>`
+            if the submission should be tried again later.
+            :py:exc:`InvalidJobException <media_nommer.feederd.exceptions.InvalidJobException>`
+            if it never will get in.
+        """
+        max_backlog = settings.FEEDERD_MAX_BACKLOG_SECONDS
+        if max_backlog and \
+           cls.get_queue_depth()['backlog_seconds'] >= max_backlog:
+            metrics.incr('feederd.admission.rejected.backlog')
+            raise JobRejectedException('The queue is full.',
+                                       settings.FEEDERD_BACKLOG_RETRY_AFTER)
+
+        amounts = {('client', client_name): len(presets)}
+        for preset in presets:
+            key = ('preset', preset)
+            amounts[key] = amounts.get(key, 0) + 1
+
+        now = time.time()
+        with cls.LOCK:
+            buckets = []
+            wait = 0.0
+            for key, amount in amounts.items():
+                bucket_settings = cls._get_bucket_settings(key)
+                if not bucket_settings:
+                    continue
+                if amount > bucket_settings[1]:
+                    raise InvalidJobException('No more than %d jobs at once ' \
+                                    'for this %s.' % (bucket_settings[1], key[0]))
+                if not cls.BUCKETS.has_key(key):
+                    if len(cls.BUCKETS) >= cls.MAX_BUCKETS:
+                        cls._prune_buckets(now)
+                    cls.BUCKETS[key] = TokenBucket(*bucket_settings)
+                bucket = cls.BUCKETS[key]
+                wait = max(wait, bucket.get_wait(amount, now))
+                buckets.append((bucket, amount))
+
+            if wait:
+                metrics.incr('feederd.admission.rejected.rate')
+                logger.debug("AdmissionController.admit(): Turned away %d " \
+                             "jobs from %s for %.1fs." % (len(presets),
+                                                          client_name, wait))
+                raise JobRejectedException('Too many jobs submitted.',
+                                           int(math.ceil(wait)))
+            # Only take from the buckets once they all have room.
+            for bucket, amount in buckets:
+                bucket.take(amount)
@@ -2,11 +2,15 @@
 Contains the :py:class:`EC2InstanceManager` class, which helps manage the
 currently active instances.
 """
+import datetime
 import boto
 from boto.exception import EC2ResponseError
 from media_nommer.conf import settings
-from media_nommer.utils import logger
+from media_nommer.utils import logger, metrics
+from media_nommer.utils.compat import total_seconds
 from media_nommer.core.job_state_backend import JobStateBackend
+from media_nommer.feederd.work_estimator import WorkEstimator
+from media_nommer.feederd.fleet_table import FleetTable
 
 class EC2InstanceManager(object):
     """
@@ -16,6 +20,10 @@ class EC2InstanceManager(object):
     """
     # Used for lazy-loading the EC2 connection. Do not refer to directly.
     __aws_ec2_connection = None
+    # The last known list of media-nommer instances. See get_instances().
+    INSTANCES = []
+    # When INSTANCES was last fetched from EC2.
+    LAST_RECONCILE_DTIME = None
 
     @classmethod
     def _aws_ec2_connection(cls):
@@ -32,37 +40,160 @@ class EC2InstanceManager(object):
         return cls.__aws_ec2_connection
 
     @classmethod
-    def get_instances(cls):
+    def _reconcile_instances(cls):
+        """
+        Asks EC2_ for the instances running the media-nommer AMI, as per
+        :py:data:`media_nommer.conf.settings.EC2_AMI_ID`. Only running and
+        pending instances are returned. The filtering is done on Amazon's
+        end, rather than listing every instance on the account.
+        """
+        # Instances must be in these states to make it through the filter.
+        counted_states = ['running', 'pending']
+        reservations = cls._aws_ec2_connection().get_all_instances(filters={
+            'image-id': settings.EC2_AMI_ID,
+            'instance-state-name': counted_states,
+        })
+        instances = []
+        for r in reservations:
+            instances.extend(r.instances)
+
+        cls.INSTANCES = instances
+        cls.LAST_RECONCILE_DTIME = datetime.datetime.now()
+        # Anything EC2 no longer knows about is gone for good.
+        FleetTable.forget_nodes_except([i.id for i in instances])
+
+    @classmethod
+    def get_instances(cls, force_reconcile=False):
         """
         Returns a list of boto 
         :py:class:`Instance <boto.ec2.instance.Instance>` objects matching the
         media-nommer AMI, as per 
         :py:data:`media_nommer.conf.settings.EC2_AMI_ID`. Also filters only
         running instances.
+
+        The list is only fetched from EC2_ every
+        :py:data:`FEEDERD_EC2_RECONCILE_INTERVAL <media_nommer.conf.settings.FEEDERD_EC2_RECONCILE_INTERVAL>`
+        seconds. In between, instances we've spawned are added to it, and
+        instances that have reported themselves as terminated through the
+        :py:class:`FleetTable <media_nommer.feederd.fleet_table.FleetTable>`
+        are left out.
         
+        :keyword bool force_reconcile: If ``True``, ask EC2 for a fresh list
+            regardless of when we last did.
         :rtype: list
         :returns: A list of :py:class:`boto.ec2.instance.Instance` objects 
             representing currently active media-nommer 
             :doc:`../ec2nommerd` instances.
         """
-        # Instances must be in these states to make it through the filter.
-        counted_states = ['running', 'pending']
-        # Get a list of reservations for all running instances.
-        reservations = cls._aws_ec2_connection().get_all_instances()
-        # Hold a list of Instance objects to return.
-        instances = []
-        for r in reservations:
-            for i in r.instances:
-                if i.image_id == settings.EC2_AMI_ID and i.state in counted_states:
-                    # Passed filters, this is a media-nommer instance.
-                    instances.append(i)
+        if cls.LAST_RECONCILE_DTIME:
+            since_reconcile = total_seconds(datetime.datetime.now() - \
+                                            cls.LAST_RECONCILE_DTIME)
+        else:
+            since_reconcile = None
+
+        if force_reconcile or since_reconcile is None or \
+           since_reconcile > settings.FEEDERD_EC2_RECONCILE_INTERVAL:
+            cls._reconcile_instances()
 
-        return instances
+        return [i for i in cls.INSTANCES
+                if not FleetTable.is_node_terminated(i.id)]
+
+    @classmethod
+    def get_instance_uptime(cls, instance):
+        """
+        :param boto.ec2.instance.Instance instance: The instance to check.
+        :rtype: float
+        :returns: The number of seconds since the instance was launched.
+        """
+        launch_dtime = datetime.datetime.strptime(instance.launch_time,
+                                                  '%Y-%m-%dT%H:%M:%S.000Z')
+        return total_seconds(datetime.datetime.utcnow() - launch_dtime)
+
+    @classmethod
+    def get_num_slots(cls, instances):
+        """
+        Counts the encoding slots the fleet can actually put to use, going by
+        each node's last heartbeat in the
+        :py:class:`FleetTable <media_nommer.feederd.fleet_table.FleetTable>`.
+        Nodes that have stopped reporting are dead capacity and count for
+        nothing. Instances that haven't reported yet are assumed to be
+        booting, and count for 
+        :py:meth:`FleetTable.get_slots_per_instance <media_nommer.feederd.fleet_table.FleetTable.get_slots_per_instance>`
+        slots, unless they've been at it for longer than it should take.
+
+        :param list instances: The currently running instances.
+        :rtype: int
+        :returns: The number of usable encoding slots.
+        """
+        max_boot_time = settings.AUTOSCALE_INSTANCE_BOOT_TIME + \
+                        settings.FEEDERD_NODE_STALE_THRESH
+        num_slots = 0
+        for instance in instances:
+            node = FleetTable.get_node(instance.id)
+            if node:
+                if FleetTable.is_node_alive(node):
+                    num_slots += node['max_jobs']
+            elif cls.get_instance_uptime(instance) <= max_boot_time:
+                num_slots += FleetTable.get_slots_per_instance()
+        return num_slots
+
+    @classmethod
+    def get_num_instances_needed(cls, backlog_seconds, num_slots,
+                                 num_top_lane_jobs=0):
+        """
+        Figures out how many new instances it would take to get through
+        ``backlog_seconds`` of encoding work within 
+        :py:data:`AUTOSCALE_TARGET_DRAIN_TIME <media_nommer.conf.settings.AUTOSCALE_TARGET_DRAIN_TIME>`.
+        New instances take
+        :py:data:`AUTOSCALE_INSTANCE_BOOT_TIME <media_nommer.conf.settings.AUTOSCALE_INSTANCE_BOOT_TIME>`
+        to start contributing. Since instances are billed by the hour, an
+        extra instance isn't spawned for less than 
+        :py:data:`AUTOSCALE_MIN_WORK_PER_NEW_INSTANCE <media_nommer.conf.settings.AUTOSCALE_MIN_WORK_PER_NEW_INSTANCE>`
+        encoder-seconds of left-over work.
+        
+        :param float backlog_seconds: The estimated encoder-seconds of work
+            for all un-finished jobs.
+        :param int num_slots: The number of usable encoding slots on the
+            current fleet, as per :py:meth:`get_num_slots`.
+        :keyword int num_top_lane_jobs: The number of jobs waiting in the
+            highest priority lane. If there are any and no slots are usable,
+            at least one instance is always asked for.
+        :rtype: int
+        :returns: The number of instances to spawn, not taking
+            :py:data:`MAX_NUM_EC2_INSTANCES <media_nommer.conf.settings.MAX_NUM_EC2_INSTANCES>`
+            into account.
+        """
+        slots = FleetTable.get_slots_per_instance()
+        target = settings.AUTOSCALE_TARGET_DRAIN_TIME
+        # How much work the current fleet gets through in the target time.
+        current_capacity = num_slots * target
+        shortfall = backlog_seconds - current_capacity
+        # How much work a new instance gets through once it's booted.
+        new_instance_capacity = slots * max(target - settings.AUTOSCALE_INSTANCE_BOOT_TIME,
+                                            1)
+
+        if shortfall <= 0:
+            num_new_instances = 0
+        else:
+            num_new_instances = int(shortfall // new_instance_capacity)
+            leftover = shortfall - (num_new_instances * new_instance_capacity)
+            if leftover >= settings.AUTOSCALE_MIN_WORK_PER_NEW_INSTANCE:
+                num_new_instances += 1
+
+        if num_slots == 0 and (backlog_seconds > 0 or num_top_lane_jobs):
+            # Somebody has to do the work, however little there is.
+            num_new_instances = max(num_new_instances, 1)
+
+        return num_new_instances
 
     @classmethod
     def spawn_if_needed(cls):
         """
-        Spawns additional EC2 instances if needed.
+        Spawns additional EC2 instances if needed. The decision is based on
+        the estimated encoder-seconds of queued work (see
+        :py:class:`WorkEstimator <media_nommer.feederd.work_estimator.WorkEstimator>`)
+        rather than the raw job count, as per
+        :py:meth:`get_num_instances_needed`.
         
         :rtype: :py:class:`boto.ec2.instance.Reservation` or ``None``
         :returns: If instances are spawned, return a boto Reservation
@@ -86,43 +217,35 @@ class EC2InstanceManager(object):
             # No unfinished jobs, no need to go any further.
             return
 
-        job_capacity = num_instances * settings.MAX_ENCODING_JOBS_PER_EC2_INSTANCE
-
-        if job_capacity == 0:
-            # Don't factor in overflow thresh or anything if we have no
-            # instances or capacity.
-            cap_plus_thresh = 0
-        else:
-            cap_plus_thresh = job_capacity + settings.JOB_OVERFLOW_THRESH
+        lane_depths = JobStateBackend.get_new_job_queue_depths()
+        for lane, depth in lane_depths.items():
+            metrics.set_gauge('feederd.new_job_queue_depth.%s' % lane, depth)
+        logger.debug("EC2InstanceManager.spawn_if_needed(): " \
+                     "Queued jobs per priority lane: %s" % lane_depths)
+        top_lane = JobStateBackend.get_priority_lanes()[0]
 
+        backlog_seconds = WorkEstimator.estimate_backlog_seconds(unfinished_jobs)
+        metrics.set_gauge('feederd.backlog_seconds', backlog_seconds)
         logger.debug("EC2InstanceManager.spawn_if_needed(): " \
-                     "Job capacity (%d w/ thresh): %d" % (job_capacity,
-                                                         cap_plus_thresh))
-
-        is_over_capacity = num_unfinished_jobs >= cap_plus_thresh
-        # Disgregard the overflow thresh if there are jobs but no instances.
-        if is_over_capacity or num_instances == 0:
-            overage = num_unfinished_jobs - job_capacity
-            if job_capacity > 0:
-                # Only factor overhold threshold in when we have capacity
-                # available in some form.
-                overage -= settings.JOB_OVERFLOW_THRESH
-            logger.info("EC2InstanceManager.spawn_if_needed(): " \
-                         "Observed labor shortage of: %d" % overage)
+                     "Estimated backlog: %.0f encoder-seconds" % backlog_seconds)
 
-            # Raw # of instances needing to be spawned.
-            num_new_instances = overage / settings.MAX_ENCODING_JOBS_PER_EC2_INSTANCE
-            # At this point, we know there's an overage, even with the overflow
-            # thresh factored in (if there is at least one EC2 instance
-            # already running).
-            num_new_instances = max(num_new_instances, 1)
-            # Also don't spawn more than the max configured instances.
-            num_new_instances = min(num_new_instances, settings.MAX_NUM_EC2_INSTANCES)
+        num_slots = cls.get_num_slots(instances)
+        metrics.set_gauge('feederd.fleet.usable_slots', num_slots)
+        num_new_instances = cls.get_num_instances_needed(backlog_seconds,
+                                num_slots,
+                                num_top_lane_jobs=lane_depths.get(top_lane, 0))
+        # Also don't spawn more than the max configured instances.
+        num_new_instances = min(num_new_instances,
+                                settings.MAX_NUM_EC2_INSTANCES - num_instances)
 
+        if num_new_instances > 0:
+            logger.info("EC2InstanceManager.spawn_if_needed(): " \
+                        "Observed labor shortage, %.0f encoder-seconds " \
+                        "queued for %d usable slots." % (backlog_seconds,
+                                                         num_slots))
             # The boto Reservation object. Its 'instances' attribute is the
             # important bit.
-            if num_new_instances > 0:
-                return cls.spawn_instances(num_new_instances)
+            return cls.spawn_instances(num_new_instances)
         # No new instances.
         return None
 
@@ -155,11 +278,16 @@ class EC2InstanceManager(object):
 
         # The boto Reservation object. Its 'instances' attribute is the
         # important bit.
-        return image.run(min_count=num_instances, max_count=num_instances,
-                         instance_type=settings.EC2_INSTANCE_TYPE,
-                         security_groups=settings.EC2_SECURITY_GROUPS,
-                         key_name=settings.EC2_KEY_NAME,
-                         user_data=cls._gen_ec2_user_data())
+        reservation = image.run(min_count=num_instances,
+                                max_count=num_instances,
+                                instance_type=settings.EC2_INSTANCE_TYPE,
+                                security_groups=settings.EC2_SECURITY_GROUPS,
+                                key_name=settings.EC2_KEY_NAME,
+                                user_data=cls._gen_ec2_user_data())
+        # Count these right away, rather than waiting for the next
+        # reconciliation with EC2.
+        cls.INSTANCES.extend(reservation.instances)
+        return reservation
 
     @classmethod
     def _gen_ec2_user_data(cls):
@@ -176,11 +304,13 @@ class EC2InstanceManager(object):
                     "runcmd:\n" \
                     " - chmod 777 /tmp\n" \
                     " - echo \"s3://%s:%s@%s/nomconf.py\" > /home/nom/.nommerd_s3.cfg\n" \
-                    " - chown nom:nom /home/nom/.nommerd_s3.cfg\n" \
-                    " - sudo -u nom -i /home/nom/.virtualenvs/media_nommer/bin/pip install --upgrade git+http://github.com/duointeractive/media-nommer.git#egg=media_nommer > /tmp/media_nom_upgrade.log\n" \
-                    " - supervisorctl start ec2nommerd > /tmp/superv_start.log" % (
+                    " - chown nom:nom /home/nom/.nommerd_s3.cfg\n" % (
                         settings.AWS_ACCESS_KEY_ID,
                         settings.AWS_SECRET_ACCESS_KEY,
                         settings.CONFIG_S3_BUCKET,
                     )
+        if settings.EC2_UPGRADE_ON_BOOT:
+            # This is slow, so it's optional.
+            user_data += " - sudo -u nom -i /home/nom/.virtualenvs/media_nommer/bin/pip install --upgrade git+http://github.com/duointeractive/media-nommer.git#egg=media_nommer > /tmp/media_nom_upgrade.log\n"
+        user_data += " - supervisorctl start ec2nommerd > /tmp/superv_start.log"
         return user_data
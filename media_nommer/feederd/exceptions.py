@@ -0,0 +1,31 @@
+"""
+feederd exceptions
+"""
+class FeederdException(Exception):
+    """
+    A generic feederd-related exception. Try to be more specific in your code,
+    just use this as a parent class.
+    """
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return repr(self.message)
+
+class InvalidJobException(FeederdException):
+    """
+    Raised when a job submission doesn't make sense: a missing field, an
+    unknown preset or priority, a source that can't be found, and so on.
+    The message is fit to hand back to whoever submitted it.
+    """
+    pass
+
+class JobRejectedException(FeederdException):
+    """
+    Raised when a job submission is turned away for now, because the client
+    is sending too many, or feederd is too far behind. It may be tried again
+    after ``retry_after`` seconds.
+    """
+    def __init__(self, message, retry_after):
+        self.message = message
+        self.retry_after = retry_after
@@ -0,0 +1,271 @@
+"""
+Contains the :py:class:`FleetController` class, which looks ahead at expected
+demand to pre-warm EC2_ instances, and decides which idle instances should
+be retired.
+"""
+import math
+import datetime
+import threading
+from media_nommer.conf import settings
+from media_nommer.utils import logger, metrics
+from media_nommer.utils.compat import total_seconds
+from media_nommer.core.job_state_backend import JobStateBackend
+from media_nommer.feederd.ec2_instance_manager import EC2InstanceManager
+from media_nommer.feederd.fleet_table import FleetTable
+from media_nommer.feederd.work_estimator import WorkEstimator
+
+class FleetController(object):
+    """
+    Coordinates the size of the EC2_ fleet. On top of the reactive scaling
+    done by
+    :py:meth:`EC2InstanceManager.spawn_if_needed <media_nommer.feederd.ec2_instance_manager.EC2InstanceManager.spawn_if_needed>`,
+    this:
+
+    * Forecasts demand for the coming hour from a moving average of the
+      work submitted at the same time of day over the last
+      :py:data:`FEEDERD_FORECAST_HISTORY_DAYS <media_nommer.conf.settings.FEEDERD_FORECAST_HISTORY_DAYS>`
+      days, and spawns instances ahead of it.
+    * Keeps
+      :py:data:`FEEDERD_FLEET_WARM_SPARES <media_nommer.conf.settings.FEEDERD_FLEET_WARM_SPARES>`
+      instances around beyond the forecast.
+    * Picks which idle instances to retire, favoring those closest to the
+      end of their billing hour.
+
+    Instances are told whether to stay or go through a ``fleet_directive``
+    attribute on their item in the
+    :py:data:`SIMPLEDB_EC2_NOMMER_STATE_DOMAIN <media_nommer.conf.settings.SIMPLEDB_EC2_NOMMER_STATE_DOMAIN>`
+    domain. See
+    :py:meth:`NodeStateManager.contemplate_termination <media_nommer.ec2nommerd.node_state.NodeStateManager.contemplate_termination>`.
+    """
+    # Keys are (date, hour) tuples, values are the estimated encoder-seconds
+    # of work submitted during that hour.
+    SUBMISSION_HISTORY = {}
+    # Guards SUBMISSION_HISTORY.
+    LOCK = threading.Lock()
+    # Keys are instance IDs, values are (directive, datetime) tuples for the
+    # last directive we sent to each instance.
+    SENT_DIRECTIVES = {}
+
+    @classmethod
+    def _add_to_history(cls, creation_dtime, encoder_seconds):
+        """
+        Adds a submission to the hourly history.
+
+        :param datetime.datetime creation_dtime: When the job was submitted.
+        :param float encoder_seconds: The job's estimated encoder-seconds.
+        """
+        key = (creation_dtime.date(), creation_dtime.hour)
+        with cls.LOCK:
+            cls.SUBMISSION_HISTORY[key] = cls.SUBMISSION_HISTORY.get(key, 0.0) + \
+                                          encoder_seconds
+
+    @classmethod
+    def _prune_history(cls):
+        """
+        Forgets about submissions older than
+        :py:data:`FEEDERD_FORECAST_HISTORY_DAYS <media_nommer.conf.settings.FEEDERD_FORECAST_HISTORY_DAYS>`.
+        """
+        cutoff = datetime.date.today() - \
+                 datetime.timedelta(days=settings.FEEDERD_FORECAST_HISTORY_DAYS)
+        with cls.LOCK:
+            for key in cls.SUBMISSION_HISTORY.keys():
+                if key[0] < cutoff:
+                    del cls.SUBMISSION_HISTORY[key]
+
+    @classmethod
+    def load_submission_history(cls):
+        """
+        Populates the submission history from the jobs in SimpleDB_. This
+        is performed when :doc:`../feederd` starts.
+        """
+        since = datetime.datetime.now() - \
+                datetime.timedelta(days=settings.FEEDERD_FORECAST_HISTORY_DAYS)
+        history = JobStateBackend.get_job_creation_history(since)
+        for creation_dtime, source_size, preset in history:
+            if source_size:
+                encoder_seconds = source_size / WorkEstimator.get_throughput(preset)
+            else:
+                encoder_seconds = float(settings.AUTOSCALE_DEFAULT_JOB_SECONDS)
+            cls._add_to_history(creation_dtime, encoder_seconds)
+
+    @classmethod
+    def record_submission(cls, job):
+        """
+        Records a newly submitted job in the submission history.
+
+        :param EncodingJob job: The newly submitted job.
+        """
+        cls._add_to_history(job.creation_dtime,
+                            WorkEstimator.estimate_job_seconds(job))
+
+    @classmethod
+    def forecast_encoder_seconds(cls, dtime):
+        """
+        Forecasts how much work will be submitted during the hour of the day
+        that ``dtime`` falls in. This is the average of the work submitted
+        during the same hour on each of the last
+        :py:data:`FEEDERD_FORECAST_HISTORY_DAYS <media_nommer.conf.settings.FEEDERD_FORECAST_HISTORY_DAYS>`
+        days.
+
+        :param datetime.datetime dtime: A time within the hour to forecast.
+        :rtype: float
+        :returns: The forecasted encoder-seconds of work.
+        """
+        num_days = settings.FEEDERD_FORECAST_HISTORY_DAYS
+        today = datetime.date.today()
+        total = 0.0
+        with cls.LOCK:
+            for days_ago in range(1, num_days + 1):
+                date = today - datetime.timedelta(days=days_ago)
+                total += cls.SUBMISSION_HISTORY.get((date, dtime.hour), 0.0)
+        return total / max(num_days, 1)
+
+    @classmethod
+    def get_desired_num_instances(cls):
+        """
+        Figures out how many instances we want to have warm by the time a
+        newly spawned instance would be ready.
+
+        :rtype: int
+        :returns: The desired number of instances, not counting any needed
+            for work that is already queued.
+        """
+        ready_dtime = datetime.datetime.now() + \
+                      datetime.timedelta(seconds=settings.AUTOSCALE_INSTANCE_BOOT_TIME)
+        forecast = cls.forecast_encoder_seconds(ready_dtime)
+        metrics.set_gauge('feederd.fleet.forecast_seconds', forecast)
+
+        # One instance gets through this much in an hour.
+        instance_hour = FleetTable.get_slots_per_instance() * 3600.0
+        num_instances = int(math.ceil(forecast / instance_hour))
+        num_instances += settings.FEEDERD_FLEET_WARM_SPARES
+        return min(num_instances, settings.MAX_NUM_EC2_INSTANCES)
+
+    @classmethod
+    def _get_seconds_left_in_billing_hour(cls, instance):
+        """
+        Figures out how long until an instance starts another billing hour.
+
+        :param boto.ec2.instance.Instance instance: The instance to check.
+        :rtype: float
+        :returns: The number of seconds left in the instance's current
+            billing hour.
+        """
+        uptime = EC2InstanceManager.get_instance_uptime(instance)
+        return 3600 - (uptime % 3600)
+
+    @classmethod
+    def _send_directive(cls, instance_id, directive):
+        """
+        Tells an instance whether it should stay up (``KEEP``) or terminate
+        itself once it's idle (``RETIRE``). Directives are only re-sent when
+        they change, or when they are at risk of going stale.
+
+        :param str instance_id: The instance to send the directive to.
+        :param str directive: Either ``KEEP`` or ``RETIRE``.
+        """
+        now_dtime = datetime.datetime.now()
+        last_directive, last_dtime = cls.SENT_DIRECTIVES.get(instance_id,
+                                                             (None, None))
+        if last_directive == directive and \
+           total_seconds(now_dtime - last_dtime) < settings.NOMMERD_MAX_INACTIVITY / 2:
+            return
+
+        FleetTable.put_node_attributes(instance_id, {
+            'fleet_directive': directive,
+            # str() leaves the microseconds off when they're zero.
+            'fleet_directive_dtime': now_dtime.strftime('%Y-%m-%d %H:%M:%S.%f'),
+        })
+        cls.SENT_DIRECTIVES[instance_id] = (directive, now_dtime)
+
+    @classmethod
+    def prewarm(cls, instances, num_desired):
+        """
+        Spawns instances ahead of forecasted demand.
+
+        :param list instances: The currently running instances.
+        :param int num_desired: The number of instances we'd like to have.
+        :rtype: :py:class:`boto.ec2.instance.Reservation` or ``None``
+        :returns: If instances are spawned, return a boto Reservation
+            object. If no instances are spawned, ``None`` is returned.
+        """
+        num_new_instances = min(num_desired,
+                                settings.MAX_NUM_EC2_INSTANCES) - len(instances)
+        if num_new_instances <= 0:
+            return None
+
+        logger.info("FleetController.prewarm(): Pre-warming %d instances " \
+                    "for forecasted demand." % num_new_instances)
+        return EC2InstanceManager.spawn_instances(num_new_instances)
+
+    @classmethod
+    def retire_idle_instances(cls, instances, num_desired):
+        """
+        Picks idle instances beyond ``num_desired`` to retire. Only instances
+        within
+        :py:data:`FEEDERD_RETIRE_BEFORE_BILLING_HOUR <media_nommer.conf.settings.FEEDERD_RETIRE_BEFORE_BILLING_HOUR>`
+        seconds of the end of their billing hour are retired, since we've
+        already paid for the rest of their hour. Nothing is retired while
+        jobs are waiting in the queue.
+
+        Idleness is judged from each node's last heartbeat in the
+        :py:class:`FleetTable <media_nommer.feederd.fleet_table.FleetTable>`.
+        Nodes that have stopped reporting aren't considered, since we can't
+        tell what they're up to.
+
+        :param list instances: The currently running instances.
+        :param int num_desired: The number of instances we'd like to keep.
+        :rtype: list
+        :returns: The IDs of the instances that were told to retire.
+        """
+        num_queued = sum(JobStateBackend.get_new_job_queue_depths().values())
+        num_excess = len(instances) - num_desired
+        if num_queued:
+            num_excess = 0
+
+        idle_instances = []
+        for instance in instances:
+            node = FleetTable.get_node(instance.id)
+            if node and FleetTable.is_node_alive(node) and \
+               node['state'] == 'ACTIVE' and node['active_jobs'] == 0:
+                seconds_left = cls._get_seconds_left_in_billing_hour(instance)
+                idle_instances.append((seconds_left, instance.id))
+        # Closest to the end of their billing hour first.
+        idle_instances.sort()
+
+        retired = []
+        for seconds_left, instance_id in idle_instances:
+            if len(retired) >= num_excess:
+                break
+            if seconds_left <= settings.FEEDERD_RETIRE_BEFORE_BILLING_HOUR:
+                retired.append(instance_id)
+
+        for instance in instances:
+            if instance.id in retired:
+                cls._send_directive(instance.id, 'RETIRE')
+            else:
+                cls._send_directive(instance.id, 'KEEP')
+
+        if retired:
+            logger.info("FleetController.retire_idle_instances(): " \
+                        "Retiring: %s" % retired)
+            metrics.incr('feederd.fleet.retired', len(retired))
+        return retired
+
+    @classmethod
+    def manage_fleet(cls):
+        """
+        Runs a round of fleet management. Instances are spawned for queued
+        work first, then for forecasted demand, then any excess idle
+        instances are retired.
+        """
+        cls._prune_history()
+        EC2InstanceManager.spawn_if_needed()
+
+        instances = EC2InstanceManager.get_instances()
+        num_desired = cls.get_desired_num_instances()
+        metrics.set_gauge('feederd.fleet.desired_instances', num_desired)
+        metrics.set_gauge('feederd.fleet.instances', len(instances))
+
+        cls.prewarm(instances, num_desired)
+        cls.retire_idle_instances(instances, num_desired)
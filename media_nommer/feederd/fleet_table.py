@@ -0,0 +1,255 @@
+"""
+Contains the :py:class:`FleetTable` class, :doc:`../feederd`'s in-memory view
+of the heartbeats sent by the :doc:`../ec2nommerd` instances.
+"""
+import datetime
+import threading
+import boto
+from media_nommer.conf import settings
+from media_nommer.utils import logger, metrics
+from media_nommer.utils.compat import total_seconds
+from media_nommer.utils.bloom_filter import BloomFilter
+
+class FleetTable(object):
+    """
+    Keeps track of the last reported state of each EC2_ instance, as written
+    to the
+    :py:data:`SIMPLEDB_EC2_NOMMER_STATE_DOMAIN <media_nommer.conf.settings.SIMPLEDB_EC2_NOMMER_STATE_DOMAIN>`
+    domain by
+    :py:meth:`NodeStateManager.send_instance_state_update <media_nommer.ec2nommerd.node_state.NodeStateManager.send_instance_state_update>`.
+
+    The table is refreshed incrementally, only selecting heartbeats newer
+    than the newest one we've already seen. Nodes that haven't reported in
+    :py:data:`FEEDERD_NODE_STALE_THRESH <media_nommer.conf.settings.FEEDERD_NODE_STALE_THRESH>`
+    seconds are considered dead capacity.
+    """
+    # Keys are instance IDs, values are dicts of the node's last reported
+    # state. See _parse_item() for the keys.
+    NODES = {}
+    # Guards NODES.
+    LOCK = threading.RLock()
+    # The newest last_report_dtime string seen so far.
+    NEWEST_REPORT_DTIME = None
+
+    # Used for lazy-loading the SDB connection. Do not refer to directly.
+    __aws_sdb_connection = None
+    # Used for lazy-loading the SDB domain. Do not refer to directly.
+    __aws_sdb_nommer_state_domain = None
+
+    @classmethod
+    def _aws_sdb_connection(cls):
+        """
+        Lazy-loading of the SimpleDB boto connection. Refer to this instead of
+        referencing cls.__aws_sdb_connection directly.
+
+        :returns: A boto connection to Amazon's SimpleDB interface.
+        """
+        if not cls.__aws_sdb_connection:
+            cls.__aws_sdb_connection = boto.connect_sdb(
+                settings.AWS_ACCESS_KEY_ID,
+                settings.AWS_SECRET_ACCESS_KEY)
+        return cls.__aws_sdb_connection
+
+    @classmethod
+    def _aws_sdb_nommer_state_domain(cls):
+        """
+        Lazy-loading of the SimpleDB boto domain. Refer to this instead of
+        referencing cls.__aws_sdb_nommer_state_domain directly.
+
+        :returns: A boto SimpleDB domain for the EC2 node heartbeats.
+        """
+        if not cls.__aws_sdb_nommer_state_domain:
+            cls.__aws_sdb_nommer_state_domain = cls._aws_sdb_connection().create_domain(
+                                    settings.SIMPLEDB_EC2_NOMMER_STATE_DOMAIN)
+        return cls.__aws_sdb_nommer_state_domain
+
+    @classmethod
+    def put_node_attributes(cls, instance_id, attributes):
+        """
+        Writes attributes to a node's item in the heartbeat domain, leaving
+        the rest of the item alone.
+
+        :param str instance_id: The node's instance ID.
+        :param dict attributes: The attributes to set.
+        """
+        cls._aws_sdb_nommer_state_domain().put_attributes(instance_id,
+                                                          attributes,
+                                                          replace=True)
+
+    @classmethod
+    def _parse_item(cls, item, seen_dtime):
+        """
+        Turns a heartbeat item into a node state dict.
+
+        :param item: A boto SimpleDB item from the heartbeat domain.
+        :param datetime.datetime seen_dtime: When (by our clock) we first
+            saw this heartbeat.
+        :rtype: dict
+        :returns: The node's state.
+        """
+        max_jobs = item.get('max_jobs')
+        if max_jobs:
+            max_jobs = int(max_jobs)
+        else:
+            # Older nodes don't report this.
+            max_jobs = cls.get_slots_per_instance()
+
+        source_cache = item.get('source_cache')
+        if source_cache and source_cache != 'None':
+            source_cache = BloomFilter.from_string(source_cache)
+        else:
+            # Older nodes don't report this, or their cache is off.
+            source_cache = None
+
+        return {
+            'id': item.name,
+            'state': item.get('state'),
+            'active_jobs': int(item.get('active_jobs', 0)),
+            'max_jobs': max_jobs,
+            'source_cache': source_cache,
+            'last_report_dtime': item.get('last_report_dtime'),
+            'seen_dtime': seen_dtime,
+        }
+
+    @classmethod
+    def refresh(cls):
+        """
+        Selects any heartbeats newer than the newest one we've seen, and
+        updates the table with them. Heartbeat times come from the nodes'
+        clocks, so we look back a little further than strictly needed, in
+        case a node's clock lags behind the others.
+        """
+        query_str = "SELECT * FROM %s" % settings.SIMPLEDB_EC2_NOMMER_STATE_DOMAIN
+        if cls.NEWEST_REPORT_DTIME:
+            # Microseconds are left off when they're zero, so ignore them.
+            newest = datetime.datetime.strptime(cls.NEWEST_REPORT_DTIME[:19],
+                                                '%Y-%m-%d %H:%M:%S')
+            since = newest - datetime.timedelta(
+                                    seconds=settings.FEEDERD_NODE_STALE_THRESH)
+            query_str += " WHERE last_report_dtime > '%s'" % since
+
+        now_dtime = datetime.datetime.now()
+        num_updated = 0
+        with cls.LOCK:
+            for item in cls._aws_sdb_nommer_state_domain().select(query_str):
+                report_dtime = item.get('last_report_dtime')
+                if not report_dtime:
+                    continue
+                if report_dtime > cls.NEWEST_REPORT_DTIME:
+                    cls.NEWEST_REPORT_DTIME = report_dtime
+
+                node = cls.NODES.get(item.name)
+                if node and node['last_report_dtime'] == report_dtime:
+                    # Nothing new from this one.
+                    continue
+
+                cls.NODES[item.name] = cls._parse_item(item, now_dtime)
+                num_updated += 1
+
+        dead_nodes = cls.get_dead_nodes()
+        metrics.set_gauge('feederd.fleet.dead_nodes', len(dead_nodes))
+        metrics.set_gauge('feederd.fleet.free_slots', cls.get_num_free_slots())
+        if dead_nodes:
+            logger.warning("FleetTable.refresh(): No recent heartbeat from: %s" % (
+                [node['id'] for node in dead_nodes]))
+        logger.debug("FleetTable.refresh(): %d node updates." % num_updated)
+
+    @classmethod
+    def forget_nodes_except(cls, instance_ids):
+        """
+        Drops any nodes that aren't in ``instance_ids``. Called after
+        reconciling with EC2_, so that instances that are gone for good
+        don't linger in the table.
+
+        :param list instance_ids: The IDs of the instances that still exist.
+        """
+        with cls.LOCK:
+            for instance_id in cls.NODES.keys():
+                if instance_id not in instance_ids:
+                    del cls.NODES[instance_id]
+
+    @classmethod
+    def get_node(cls, instance_id):
+        """
+        :param str instance_id: The node's instance ID.
+        :rtype: dict
+        :returns: The node's last reported state, or ``None`` if it hasn't
+            reported in yet.
+        """
+        return cls.NODES.get(instance_id)
+
+    @classmethod
+    def is_node_terminated(cls, instance_id):
+        """
+        :param str instance_id: The node's instance ID.
+        :rtype: bool
+        :returns: ``True`` if the node has reported that it terminated.
+        """
+        node = cls.NODES.get(instance_id)
+        return node is not None and node['state'] == 'TERMINATED'
+
+    @classmethod
+    def is_node_alive(cls, node):
+        """
+        :param dict node: A node state dict.
+        :rtype: bool
+        :returns: ``True`` if the node has reported in recently, and hasn't
+            terminated.
+        """
+        if node['state'] == 'TERMINATED':
+            return False
+        age = total_seconds(datetime.datetime.now() - node['seen_dtime'])
+        return age <= settings.FEEDERD_NODE_STALE_THRESH
+
+    @classmethod
+    def get_alive_nodes(cls):
+        """
+        :rtype: list
+        :returns: A list of node state dicts for nodes that have reported in
+            recently.
+        """
+        with cls.LOCK:
+            return [node for node in cls.NODES.values()
+                    if cls.is_node_alive(node)]
+
+    @classmethod
+    def get_dead_nodes(cls):
+        """
+        :rtype: list
+        :returns: A list of node state dicts for nodes that haven't reported
+            in for a while. These may be hung, or may have vanished without
+            saying goodbye.
+        """
+        with cls.LOCK:
+            return [node for node in cls.NODES.values()
+                    if node['state'] != 'TERMINATED' and \
+                       not cls.is_node_alive(node)]
+
+    @classmethod
+    def get_num_free_slots(cls):
+        """
+        :rtype: int
+        :returns: The number of free encoding slots across all live nodes.
+        """
+        return sum([max(0, node['max_jobs'] - node['active_jobs'])
+                    for node in cls.get_alive_nodes()])
+
+    @classmethod
+    def get_slots_per_instance(cls):
+        """
+        Figures out how many encoding slots a typical instance has. If
+        :py:data:`MAX_ENCODING_JOBS_PER_EC2_INSTANCE <media_nommer.conf.settings.MAX_ENCODING_JOBS_PER_EC2_INSTANCE>`
+        is set, that's the answer. Otherwise, nodes size themselves, so go
+        by what the live nodes have reported. If none have, fall back to
+        :py:data:`AUTOSCALE_DEFAULT_SLOTS_PER_INSTANCE <media_nommer.conf.settings.AUTOSCALE_DEFAULT_SLOTS_PER_INSTANCE>`.
+
+        :rtype: int
+        :returns: The expected number of encoding slots per instance.
+        """
+        if settings.MAX_ENCODING_JOBS_PER_EC2_INSTANCE:
+            return settings.MAX_ENCODING_JOBS_PER_EC2_INSTANCE
+
+        reported = [node['max_jobs'] for node in cls.get_alive_nodes()]
+        if not reported:
+            return settings.AUTOSCALE_DEFAULT_SLOTS_PER_INSTANCE
+        return max(sum(reported) // len(reported), 1)
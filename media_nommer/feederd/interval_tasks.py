@@ -7,11 +7,21 @@ All functions prefixed with ``task_`` are task functions that are registered
 with the Twisted_ reactor. All functions prefixed with ``threaded_`` are
 the interesting bits that actually do things.
 """
-from twisted.internet import task, reactor
+from twisted.internet import task, reactor, threads
 from media_nommer.conf import settings
 from media_nommer.utils import logger
 from media_nommer.feederd.job_cache import JobCache
 from media_nommer.feederd.ec2_instance_manager import EC2InstanceManager
+from media_nommer.feederd.fleet_controller import FleetController
+from media_nommer.feederd.fleet_table import FleetTable
+from media_nommer.feederd.job_router import JobRouter
+from media_nommer.feederd.job_notifier import JobNotifier
+from media_nommer.feederd.job_submitter import JobSubmitter
+from media_nommer.feederd.submission_log import SubmissionLog
+
+# The current delay (in seconds) between state change checks. This backs off
+# while the queue is empty, and snaps back down when there's work.
+STATE_CHANGE_CHECK_DELAY = None
 
 def threaded_check_for_job_state_changes():
     """
@@ -22,18 +32,53 @@ def threaded_check_for_job_state_changes():
     updated job details from the SimpleDB_ domain defined in the
     :py:data:`SIMPLEDB_JOB_STATE_DOMAIN <media_nommer.conf.settings.SIMPLEDB_JOB_STATE_DOMAIN>`
     setting.
+    
+    :rtype: int
+    :returns: The number of jobs that had state changes.
     """
-    JobCache.refresh_jobs_with_state_changes()
+    changed_jobs = JobCache.refresh_jobs_with_state_changes()
+    # Split jobs move along with their children.
+    JobCache.update_split_jobs(changed_jobs)
+    # As do jobs that are copying another's output.
+    JobCache.release_dependent_jobs()
     # If jobs have completed, remove them from the job cache.
     JobCache.uncache_finished_jobs()
+    return len(changed_jobs)
+
+def _schedule_next_state_change_check(num_changed):
+    """
+    Figures out how long to wait until the next state change check, and
+    schedules it. If the last check found changes, check again soon. If not,
+    back off exponentially up to
+    :py:data:`FEEDERD_JOB_STATE_CHANGE_CHECK_INTERVAL <media_nommer.conf.settings.FEEDERD_JOB_STATE_CHANGE_CHECK_INTERVAL>`.
+    
+    :param int num_changed: The number of changed jobs found by the last
+        check. This is a Twisted Failure if the last check blew up.
+    """
+    global STATE_CHANGE_CHECK_DELAY
+
+    if isinstance(num_changed, int) and num_changed > 0:
+        STATE_CHANGE_CHECK_DELAY = settings.FEEDERD_JOB_STATE_CHANGE_MIN_CHECK_INTERVAL
+    else:
+        if not isinstance(num_changed, int):
+            # This is a Failure, log it and treat it like an empty queue.
+            logger.error(message_or_obj=num_changed)
+        STATE_CHANGE_CHECK_DELAY = min(STATE_CHANGE_CHECK_DELAY * 2,
+                            settings.FEEDERD_JOB_STATE_CHANGE_CHECK_INTERVAL)
+
+    reactor.callLater(STATE_CHANGE_CHECK_DELAY,
+                      task_check_for_job_state_changes)
 
 def task_check_for_job_state_changes():
     """
-    Checks for job state changes in a non-blocking manner.
+    Checks for job state changes in a non-blocking manner, then schedules
+    the next check. The delay between checks adapts to how busy the state
+    change queue is.
     
     Calls :py:func:`threaded_check_for_job_state_changes`.
     """
-    reactor.callInThread(threaded_check_for_job_state_changes)
+    d = threads.deferToThread(threaded_check_for_job_state_changes)
+    d.addBoth(_schedule_next_state_change_check)
 
 def threaded_prune_jobs():
     """
@@ -65,13 +110,25 @@ def threaded_manage_ec2_instances():
     """
     Looks at the current number of jobs needing encoding and compares them
     to the pool of currently running EC2_ instances. Spawns more instances
-    as needed.
+    as needed. If the
+    :py:data:`FEEDERD_FLEET_CONTROLLER <media_nommer.conf.settings.FEEDERD_FLEET_CONTROLLER>`
+    setting is ``True``, also pre-warms instances for forecasted demand and
+    retires excess idle instances.
     
     See source of 
     :py:meth:`media_nommer.feederd.ec2_instance_manager.EC2InstanceManager.spawn_if_needed` 
-    for the logic behind this.
+    and
+    :py:meth:`media_nommer.feederd.fleet_controller.FleetController.manage_fleet`
+    for the logic behind this. Both work from the latest node heartbeats,
+    which are pulled into the
+    :py:class:`FleetTable <media_nommer.feederd.fleet_table.FleetTable>`
+    first.
     """
-    EC2InstanceManager.spawn_if_needed()
+    FleetTable.refresh()
+    if settings.FEEDERD_FLEET_CONTROLLER:
+        FleetController.manage_fleet()
+    else:
+        EC2InstanceManager.spawn_if_needed()
 
 def task_manage_ec2_instances():
     """
@@ -81,18 +138,68 @@ def task_manage_ec2_instances():
     """
     reactor.callInThread(threaded_manage_ec2_instances)
 
+def threaded_requeue_routed_jobs():
+    """
+    Jobs routed to a node that has their source cached wait a little while
+    for that node, then go to the shared queues. See
+    :py:class:`JobRouter <media_nommer.feederd.job_router.JobRouter>`. The
+    :py:class:`FleetTable <media_nommer.feederd.fleet_table.FleetTable>` is
+    refreshed first, so that routing decisions use recent heartbeats.
+    """
+    FleetTable.refresh()
+    JobRouter.requeue_stale_jobs()
+
+def task_requeue_routed_jobs():
+    """
+    Calls :py:func:`threaded_requeue_routed_jobs` in a non-blocking manner.
+    """
+    reactor.callInThread(threaded_requeue_routed_jobs)
+
+def threaded_flush_submission_log():
+    """
+    Saves newly submitted jobs to SimpleDB_ and queues them up, in batches.
+    See
+    :py:meth:`JobSubmitter.flush_submission_log <media_nommer.feederd.job_submitter.JobSubmitter.flush_submission_log>`.
+    """
+    JobSubmitter.flush_submission_log()
+
+def task_flush_submission_log():
+    """
+    Calls :py:func:`threaded_flush_submission_log` in a non-blocking manner.
+    The next flush waits for this one to finish.
+    """
+    d = threads.deferToThread(threaded_flush_submission_log)
+    # Keep the LoopingCall going, whatever happened.
+    d.addErrback(lambda failure: logger.error(message_or_obj=failure))
+    return d
+
 def register_tasks():
     """
     Registers all tasks. Called by the :doc:`../feederd` Twisted_ plugin.
     """
-    task.LoopingCall(task_check_for_job_state_changes).start(
-                            settings.FEEDERD_JOB_STATE_CHANGE_CHECK_INTERVAL,
-                            now=False)
+    global STATE_CHANGE_CHECK_DELAY
+    # This task re-schedules itself, see _schedule_next_state_change_check().
+    STATE_CHANGE_CHECK_DELAY = settings.FEEDERD_JOB_STATE_CHANGE_MIN_CHECK_INTERVAL
+    reactor.callLater(settings.FEEDERD_JOB_STATE_CHANGE_CHECK_INTERVAL,
+                      task_check_for_job_state_changes)
+
+    # Picks up where the last run left off, and retries failed deliveries.
+    JobNotifier.start()
+    if settings.FEEDERD_SUBMISSION_LOG:
+        # Jobs submitted before the last run went down are saved first.
+        SubmissionLog.load()
+        task.LoopingCall(task_flush_submission_log).start(
+                            settings.FEEDERD_SUBMISSION_LOG_FLUSH_INTERVAL)
 
     task.LoopingCall(task_prune_jobs).start(
                             settings.FEEDERD_PRUNE_JOBS_INTERVAL,
                             now=False)
 
+    if settings.JOB_CACHE_AFFINITY:
+        task.LoopingCall(task_requeue_routed_jobs).start(
+                            settings.FEEDERD_AFFINITY_CHECK_INTERVAL,
+                            now=False)
+
     # Only register the instance auto-spawning if enabled.
     if settings.FEEDERD_ALLOW_EC2_LAUNCHES:
         logger.debug("feederd will automatically scale EC2 instances.")
@@ -1,11 +1,22 @@
 """
 Basic job caching module.
 """
+import time
 import datetime
+import collections
+import threading
+import simplejson
 from media_nommer.conf import settings
-from media_nommer.utils import logger
-from media_nommer.core.job_state_backend import JobStateBackend
+from media_nommer.utils import logger, metrics
+from media_nommer.core.job_state_backend import EncodingJob, JobStateBackend
+from media_nommer.core.exceptions import JobStateConflictException
+from media_nommer.feederd.work_estimator import WorkEstimator
 from media_nommer.utils.compat import total_seconds
+from media_nommer.feederd.job_router import JobRouter
+from media_nommer.feederd.job_notifier import JobNotifier
+from media_nommer.feederd.job_events import JobEventBroker
+from media_nommer.feederd.submission_log import SubmissionLog
+from media_nommer.ec2nommerd.nommers.segmenting import JOIN_NOMMER
 
 class JobCache(dict):
     """
@@ -15,6 +26,14 @@ class JobCache(dict):
     :py:attr:`media_nommer.core.job_state_backend.JobStateBackend.FINISHED_STATES`.
     """
     CACHE = {}
+    # Recently finished jobs, kept around for the status API. Keys are
+    # unique IDs, values are jobs. Finished jobs don't change.
+    FINISHED = {}
+    # The keys of FINISHED, oldest first.
+    FINISHED_ORDER = collections.deque()
+    # Guards CACHE and FINISHED when state changes are applied from more
+    # than one thread.
+    LOCK = threading.RLock()
 
     @classmethod
     def update_job(cls, job):
@@ -101,7 +120,39 @@ class JobCache(dict):
         :rtype: ``list`` of :py:class:`EncodingJob <media_nommer.core.job_state_backend.EncodingJob>`
         :returns: A list of jobs matching the given state.
         """
-        return [job for id, job in cls.get_cached_jobs.items() if job.job_state == state]
+        return [job for id, job in cls.get_cached_jobs().items() if job.job_state == state]
+
+    @classmethod
+    def remember_finished_job(cls, job):
+        """
+        Holds on to a finished job for the status API, so that clients
+        polling on it don't have to go to SimpleDB_. No more than
+        :py:data:`FEEDERD_FINISHED_JOB_CACHE_SIZE <media_nommer.conf.settings.FEEDERD_FINISHED_JOB_CACHE_SIZE>`
+        are kept, the oldest are forgotten first.
+
+        :type job: :py:class:`EncodingJob <media_nommer.core.job_state_backend.EncodingJob>`
+        :param job: A finished job.
+        """
+        with cls.LOCK:
+            if not cls.FINISHED.has_key(job.unique_id):
+                cls.FINISHED_ORDER.append(job.unique_id)
+            cls.FINISHED[job.unique_id] = job
+            while len(cls.FINISHED_ORDER) > settings.FEEDERD_FINISHED_JOB_CACHE_SIZE:
+                del cls.FINISHED[cls.FINISHED_ORDER.popleft()]
+
+    @classmethod
+    def get_known_job(cls, unique_id):
+        """
+        Looks for a job among the cached jobs, then the recently finished
+        ones, then those in the submission log that haven't been saved yet.
+
+        :param str unique_id: A job's unique ID.
+        :rtype: :py:class:`EncodingJob <media_nommer.core.job_state_backend.EncodingJob>`
+        :returns: The job, or ``None`` if we don't have it on hand.
+        """
+        with cls.LOCK:
+            job = cls.CACHE.get(unique_id) or cls.FINISHED.get(unique_id)
+        return job or SubmissionLog.get_job(unique_id)
 
     @classmethod
     def load_recent_jobs_at_startup(cls):
@@ -122,39 +173,354 @@ class JobCache(dict):
                 job.is_finished())
             )
 
+    @classmethod
+    def apply_job_state_change(cls, job):
+        """
+        Updates the cached copy of a job with a freshly loaded one, but only
+        if the fresh copy is actually newer. SQS delivers state change
+        notifications at least once and in no particular order, so stale or
+        duplicate copies are discarded here rather than regressing the cache.
+        
+        This is safe to call from multiple threads at once.
+        
+        :type job: :py:class:`EncodingJob <media_nommer.core.job_state_backend.EncodingJob>`
+        :param job: A freshly loaded copy of a job.
+        :rtype: bool
+        :returns: ``True`` if the cache was updated, ``False`` if the
+            change was discarded.
+        """
+        with cls.LOCK:
+            if not cls.is_job_cached(job):
+                if job.parent_id and cls.is_job_cached(job.parent_id):
+                    # A piece of a split job we're tracking. Nodes create
+                    # these, so this is the first we've heard of it.
+                    logger.debug("JobCache.apply_job_state_change(): " \
+                                 "Tracking %s, a child of %s" % (
+                                    job.unique_id, job.parent_id))
+                    cls.update_job(job)
+                    JobEventBroker.publish(job)
+                    return True
+                # Not a job we're tracking.
+                return False
+
+            cached_job = cls.get_job(job)
+            if not job.is_newer_than(cached_job):
+                logger.debug("JobCache.apply_job_state_change(): " \
+                             "Discarding stale change for %s (v%d <= v%d)" % (
+                                job.unique_id,
+                                job.job_state_version,
+                                cached_job.job_state_version))
+                return False
+
+            if cached_job.job_state != job.job_state:
+                logger.info("* Job state changed %s: %s -> %s" % (
+                    job.unique_id,
+                    # Current job state in cache
+                    cached_job.job_state,
+                    # New incoming job state
+                    job.job_state,
+                ))
+            WorkEstimator.observe_state_change(cached_job, job)
+            cls.update_job(job)
+            JobEventBroker.publish(job)
+            return True
+
+    @classmethod
+    def _receive_state_change_batches(cls, num_receivers):
+        """
+        Pops a batch of state changes with each of ``num_receivers`` 
+        concurrent receivers, and applies them to the cache.
+        
+        :param int num_receivers: How many batches to receive at once.
+        :rtype: list
+        :returns: A list with an entry per receiver. Each entry is a
+            ``(num_messages, jobs)`` tuple, where ``num_messages`` is how
+            many messages that receiver popped, and ``jobs`` is the
+            :py:class:`EncodingJob <media_nommer.core.job_state_backend.EncodingJob>`
+            objects among them that were applied to the cache. Stale and
+            duplicate copies are left out.
+        """
+        # Receivers fill in their own entry.
+        batches = [(0, []) for i in range(num_receivers)]
+
+        def receive(index):
+            try:
+                job_messages = JobStateBackend.pop_state_change_messages_from_queue(10)
+            except:
+                logger.error(message_or_obj="JobCache._receive_state_change_batches(): " \
+                             "Error while receiving state changes.")
+                logger.error()
+                return
+
+            applied_jobs = []
+            batches[index] = (len(job_messages), applied_jobs)
+            for message, job in job_messages:
+                # The messages are already deleted, so one bad change can't
+                # be allowed to take the rest of the batch down with it.
+                try:
+                    is_applied = cls.apply_job_state_change(job)
+                except:
+                    logger.error(message_or_obj="JobCache._receive_state_change_batches(): " \
+                                 "Error while applying a state change to %s" % (
+                                    job.unique_id))
+                    logger.error()
+                    metrics.incr('feederd.state_changes.errors')
+                    continue
+                if is_applied:
+                    applied_jobs.append(job)
+                else:
+                    metrics.incr('feederd.state_changes.discarded')
+
+        if num_receivers == 1:
+            # No sense in spinning up a thread for this.
+            receive(0)
+        else:
+            threads = [threading.Thread(target=receive, args=(index,))
+                       for index in range(num_receivers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        return batches
+
     @classmethod
     def refresh_jobs_with_state_changes(cls):
         """
-        Looks at the state SQS queue specified by the
+        Drains the state SQS queue specified by the
         :py:data:`SQS_JOB_STATE_CHANGE_QUEUE_NAME <media_nommer.conf.settings.SQS_JOB_STATE_CHANGE_QUEUE_NAME>`
         setting and refreshes any jobs that have changed. This simply reloads
         the job's details from SimpleDB_.
         
+        Batches keep being received for as long as they come back full. Each
+        round of full batches doubles the number of concurrent receivers, up
+        to the
+        :py:data:`FEEDERD_JOB_STATE_CHANGE_MAX_RECEIVERS <media_nommer.conf.settings.FEEDERD_JOB_STATE_CHANGE_MAX_RECEIVERS>`
+        setting. No more than
+        :py:data:`FEEDERD_JOB_STATE_CHANGE_MAX_DRAIN <media_nommer.conf.settings.FEEDERD_JOB_STATE_CHANGE_MAX_DRAIN>`
+        messages are drained per call.
+        
         :rtype: ``list`` of :py:class:`EncodingJob <media_nommer.core.job_state_backend.EncodingJob>`
-        :returns: A list of changed :py:class:`EncodingJob` objects.
+        :returns: A list of changed :py:class:`EncodingJob` objects. Only
+            changes that were applied to the cache count, not stale or
+            duplicate ones.
         """
         logger.debug("JobCache.refresh_jobs_with_state_changes(): " \
                      "Checking state change queue.")
-        changed_jobs = JobStateBackend.pop_state_changes_from_queue(10)
+        start_time = time.time()
+        # Keys are unique IDs, values are the newest copy of each job seen.
+        changed_jobs = {}
+        num_messages = 0
+        num_receivers = 1
+
+        while num_messages < settings.FEEDERD_JOB_STATE_CHANGE_MAX_DRAIN:
+            batches = cls._receive_state_change_batches(num_receivers)
 
+            for num_batch_messages, applied_jobs in batches:
+                num_messages += num_batch_messages
+                for job in applied_jobs:
+                    seen_job = changed_jobs.get(job.unique_id)
+                    if not seen_job or job.is_newer_than(seen_job):
+                        changed_jobs[job.unique_id] = job
+
+            if [num for num, jobs in batches if num < 10]:
+                # At least one receiver came back short. The queue is
+                # drained, or close enough to it.
+                break
+            # Everyone came back full, there's more where that came from.
+            num_receivers = min(num_receivers * 2,
+                                settings.FEEDERD_JOB_STATE_CHANGE_MAX_RECEIVERS)
+
+        elapsed = time.time() - start_time
+        metrics.incr('feederd.state_changes.drained', num_messages)
+        metrics.set_gauge('feederd.state_changes.drain_rate',
+                          num_messages / max(elapsed, 0.001))
+        try:
+            metrics.set_gauge('feederd.state_changes.queue_depth',
+                              JobStateBackend.get_state_change_queue_depth())
+        except:
+            logger.error(message_or_obj="JobCache.refresh_jobs_with_state_changes(): " \
+                         "Unable to determine state change queue depth.")
+            logger.error()
+
+        changed_jobs = changed_jobs.values()
         if changed_jobs:
-            logger.info("Job state changes found: %s" % changed_jobs)
-            for job in changed_jobs:
-                if cls.is_job_cached(job):
-                    current_state = cls.get_job(job).job_state
-                    new_state = job.job_state
-
-                    if current_state != new_state:
-                        logger.info("* Job state changed %s: %s -> %s" % (
-                            job.unique_id,
-                            # Current job state in cache
-                            current_state,
-                            # New incoming job state
-                            new_state,
-                        ))
-                        cls.update_job(job)
+            logger.info("Job state changes found (%d messages): %s" % (
+                num_messages, changed_jobs))
         return changed_jobs
 
+    @classmethod
+    def summarize_child_jobs(cls, children):
+        """
+        Sums up where the child jobs of a split job are at.
+
+        :param list children: The split job's child
+            :py:class:`EncodingJob <media_nommer.core.job_state_backend.EncodingJob>`
+            objects.
+        :rtype: dict
+        :returns: A dict with the keys ``num_finished`` (segments encoded),
+            ``done`` (the sum of each segment's progress, from 0 to 1),
+            ``failed`` (a failed segment job, or ``None``), and ``join_job``
+            (the job joining the segments, or ``None``).
+        """
+        # Keys are segment indices, values are how far along (0 to 1) the
+        # best job for that segment is. Redelivered splits can produce more
+        # than one job per segment.
+        segments = {}
+        failures = []
+        join_job = None
+        for child in children:
+            if child.segment_index is None:
+                join_job = child
+                continue
+
+            if child.job_state == 'FINISHED':
+                done = 1.0
+            elif child.is_finished():
+                failures.append(child)
+                continue
+            else:
+                progress = child.get_progress() or {}
+                done = min(progress.get('percent', 0.0) / 100.0, 0.99)
+            segments[child.segment_index] = max(done,
+                                        segments.get(child.segment_index, 0.0))
+
+        # A failure doesn't count if another job encoded the same segment.
+        failures = [child for child in failures
+                    if segments.get(child.segment_index) != 1.0]
+
+        return {
+            'num_finished': len([done for done in segments.values() if done == 1.0]),
+            'done': sum(segments.values()),
+            'failed': failures and failures[0] or None,
+            'join_job': join_job,
+        }
+
+    @classmethod
+    def _update_split_job(cls, parent):
+        """
+        Reflects the state of a split job's children in the split job. Fails
+        it if a segment fails, queues up a
+        :py:class:`SegmentJoinNommer <media_nommer.ec2nommerd.nommers.segmenting.SegmentJoinNommer>`
+        job when every segment is encoded, and finishes it once that's done.
+
+        :param EncodingJob parent: The split job, in the ``WAITING`` state.
+        """
+        children = JobStateBackend.get_child_jobs(parent.unique_id)
+        summary = cls.summarize_child_jobs(children)
+        join_job = summary['join_job']
+
+        if join_job:
+            if join_job.job_state == 'FINISHED':
+                parent.set_job_state('FINISHED')
+            elif join_job.is_finished():
+                parent.set_job_state('ERROR',
+                    details='Joining segments failed: %s' % join_job.job_state_details)
+            return
+
+        failed = summary['failed']
+        if failed:
+            parent.set_job_state('ERROR',
+                details='Segment %d failed: %s' % (failed.segment_index,
+                                                   failed.job_state_details))
+            return
+
+        num_segments = parent.num_segments or len(children)
+        details = {
+            'segments': num_segments,
+            'segments_finished': summary['num_finished'],
+            'percent': round(summary['done'] * 100 / max(num_segments, 1)),
+        }
+        if summary['num_finished'] >= num_segments:
+            join_job = EncodingJob(parent.source_path, parent.dest_path,
+                                   JOIN_NOMMER, parent.job_options,
+                                   priority=parent.priority,
+                                   preset=parent.preset,
+                                   parent_id=parent.unique_id,
+                                   num_segments=num_segments)
+            join_job.save()
+            cls.update_job(join_job)
+            details['joining'] = True
+            logger.info("JobCache._update_split_job(): Joining %d segments " \
+                        "of %s as %s" % (num_segments, parent.unique_id,
+                                         join_job.unique_id))
+
+        if parent.get_progress() != details:
+            # Each of these comes back to us as a state change, so only
+            # bother when there's news.
+            parent.set_job_state('WAITING', details=simplejson.dumps(details))
+
+    @classmethod
+    def update_split_jobs(cls, changed_jobs):
+        """
+        Brings split jobs up to date with any changes to their children. See
+        :py:class:`SegmentingNommer <media_nommer.ec2nommerd.nommers.segmenting.SegmentingNommer>`.
+
+        :param list changed_jobs: The jobs that have just had state changes.
+        """
+        parent_ids = set()
+        for job in changed_jobs:
+            if job.parent_id:
+                parent_ids.add(job.parent_id)
+            elif job.job_state == 'WAITING':
+                # Segments can finish before their parent is done splitting.
+                parent_ids.add(job.unique_id)
+
+        for parent_id in parent_ids:
+            with cls.LOCK:
+                if not cls.is_job_cached(parent_id):
+                    continue
+                parent = cls.get_job(parent_id)
+            if parent.job_state != 'WAITING':
+                continue
+            try:
+                cls._update_split_job(parent)
+            except:
+                logger.error(message_or_obj="JobCache.update_split_jobs(): " \
+                             "Unable to update split job %s" % parent_id)
+                logger.error()
+
+    @classmethod
+    def release_dependent_jobs(cls):
+        """
+        Queues up jobs that were waiting on another job, now that it's
+        finished. If it failed, so do they. See
+        :py:data:`FEEDERD_DEDUPLICATE_JOBS <media_nommer.conf.settings.FEEDERD_DEDUPLICATE_JOBS>`.
+        """
+        with cls.LOCK:
+            waiting_jobs = [job for job in cls.CACHE.values()
+                            if job.depends_on and job.job_state == 'PENDING']
+
+        for job in waiting_jobs:
+            try:
+                with cls.LOCK:
+                    if cls.is_job_cached(job.depends_on):
+                        original_job = cls.get_job(job.depends_on)
+                    else:
+                        original_job = None
+                if not original_job or original_job.is_finished():
+                    # Finished jobs don't stay cached, get the final word.
+                    original_job = JobStateBackend.get_job_object_from_id(
+                                        job.depends_on, consistent_read=True)
+                if not original_job.is_finished():
+                    continue
+
+                if original_job.job_state == 'FINISHED':
+                    logger.info("JobCache.release_dependent_jobs(): %s is " \
+                                "finished, queueing up %s" % (
+                                    original_job.unique_id, job.unique_id))
+                    job.depends_on = None
+                    job.save()
+                    JobRouter.route(job)
+                else:
+                    job.set_job_state('ERROR',
+                        details='The job this depends on failed: %s' % (
+                                    original_job.job_state_details))
+            except:
+                logger.error(message_or_obj="JobCache.release_dependent_jobs(): " \
+                             "Unable to release job %s" % job.unique_id)
+                logger.error()
+
     @classmethod
     def abandon_stale_jobs(cls):
         """
@@ -169,8 +535,15 @@ class JobCache(dict):
         :py:data:`FEEDERD_ABANDON_INACTIVE_JOBS_THRESH <media_nommer.conf.settings.FEEDERD_ABANDON_INACTIVE_JOBS_THRESH>`
         setting.
         """
-        for id, job in cls.get_cached_jobs().items():
-            if not job.is_finished():
+        with cls.LOCK:
+            cached_jobs = cls.CACHE.items()
+
+        for id, job in cached_jobs:
+            # WAITING jobs sit still while their children do the work, and
+            # jobs that depend on another sit still until it's done (they're
+            # released or errored out along with it).
+            if not job.is_finished() and job.job_state != 'WAITING' and \
+               not job.depends_on:
                 now_dtime = datetime.datetime.now()
                 last_mod = job.last_modified_dtime
 
@@ -178,18 +551,40 @@ class JobCache(dict):
                 inactive_seconds = total_seconds(tdelta)
 
                 if inactive_seconds >= settings.FEEDERD_ABANDON_INACTIVE_JOBS_THRESH:
-                    cls.remove_job(job)
-                    job.set_job_state('ABANDONED', job.job_state_details)
+                    with cls.LOCK:
+                        if cls.CACHE.get(id) is not job:
+                            # A state change came in since we looked.
+                            continue
+                        cls.remove_job(job)
+                    try:
+                        job.set_job_state('ABANDONED', job.job_state_details)
+                    except JobStateConflictException:
+                        # The node finished it after all. Put the final
+                        # word back in the cache to be seen off as usual.
+                        finished_job = JobStateBackend.get_job_object_from_id(
+                                                id, consistent_read=True)
+                        with cls.LOCK:
+                            if not cls.is_job_cached(id):
+                                cls.update_job(finished_job)
+                        continue
+                    JobNotifier.notify(job)
 
     @classmethod
     def uncache_finished_jobs(cls):
         """
-        Clears jobs from the cache after they have been finished.
+        Clears jobs from the cache after they have been finished, and lets
+        the :py:class:`JobNotifier <media_nommer.feederd.job_notifier.JobNotifier>`
+        know about them.
         
         TODO: We'll eventually want to clear jobs from the cache that haven't
         been accessed by the web API recently.
         """
-        for id, job in cls.CACHE.items():
-            if job.is_finished():
-                logger.info("Removing job %s from job cache." % id)
-                cls.remove_job(id)
+        with cls.LOCK:
+            for id, job in cls.CACHE.items():
+                if job.is_finished():
+                    logger.info("Removing job %s from job cache." % id)
+                    cls.remove_job(id)
+                    cls.remember_finished_job(job)
+                    # Each job only leaves the cache once, so this is
+                    # where clients hear about it.
+                    JobNotifier.notify(job)
@@ -0,0 +1,229 @@
+"""
+Contains the :py:class:`JobEventBroker` class, which streams job state
+changes to clients as they happen, rather than having them poll for them.
+"""
+import collections
+import simplejson
+from zope.interface import implements
+from twisted.internet import reactor, task
+from twisted.internet.interfaces import IPushProducer
+from media_nommer.conf import settings
+from media_nommer.utils import logger, metrics
+
+def get_job_status(job):
+    """
+    Sums up a job for the status API. Source and destination URIs are left
+    out, since they may carry credentials.
+
+    :param EncodingJob job: The job.
+    :rtype: dict
+    :returns: The job's status, ready to be serialized.
+    """
+    return {
+        'job_id': job.unique_id,
+        'job_state': job.job_state,
+        'job_state_details': job.job_state_details,
+        'job_state_version': job.job_state_version,
+        'progress': job.get_progress(),
+        'output_states': job.output_states,
+        'preset': job.preset,
+        'priority': job.priority,
+        'creation_dtime': str(job.creation_dtime),
+        'last_modified_dtime': str(job.last_modified_dtime),
+    }
+
+class JobEventSubscriber(object):
+    """
+    A client listening to the event stream. This is the Twisted_ producer
+    for its connection, so it hears about it when the client can't keep up.
+    Events are held in a buffer until then, and if the buffer fills up, the
+    client is dropped.
+    """
+    implements(IPushProducer)
+
+    def __init__(self, request, job_ids=None, job_states=None):
+        """
+        :param request: The client's streaming request.
+        :param set job_ids: If given, only changes to these jobs are sent.
+        :param set job_states: If given, only changes to these states are
+            sent.
+        """
+        self.request = request
+        self.job_ids = job_ids
+        self.job_states = job_states
+        # Events waiting for the client to catch up.
+        self.buffer = collections.deque()
+        self.is_paused = False
+        self.is_closed = False
+
+    def wants(self, job):
+        """
+        :param EncodingJob job: A job that has changed.
+        :rtype: bool
+        :returns: ``True`` if this job passes the subscriber's filters.
+        """
+        if self.job_ids is not None and job.unique_id not in self.job_ids:
+            return False
+        if self.job_states is not None and job.job_state not in self.job_states:
+            return False
+        return True
+
+    def send(self, event):
+        """
+        Writes an event to the client, or buffers it if the client is
+        behind. Clients that fall too far behind are dropped.
+
+        :param str event: The encoded event.
+        """
+        if self.is_closed:
+            return
+        if not self.is_paused:
+            self.request.write(event)
+            return
+
+        if len(self.buffer) >= settings.FEEDERD_EVENTS_MAX_BUFFER:
+            logger.info("JobEventSubscriber.send(): Dropping a subscriber " \
+                        "with %d events backed up." % len(self.buffer))
+            metrics.incr('feederd.events.dropped')
+            self.close()
+            return
+        self.buffer.append(event)
+
+    def close(self):
+        """
+        Stops streaming to the client, and hangs up on it.
+        """
+        if self.is_closed:
+            return
+        self.is_closed = True
+        self.buffer.clear()
+        JobEventBroker.unsubscribe(self)
+        self.request.unregisterProducer()
+        self.request.finish()
+
+    def pauseProducing(self):
+        """
+        Called by the connection when its own buffer is full.
+        """
+        self.is_paused = True
+
+    def resumeProducing(self):
+        """
+        Called by the connection once it has room again. Sends what has been
+        buffered in the meantime.
+        """
+        self.is_paused = False
+        while self.buffer and not self.is_paused and not self.is_closed:
+            self.request.write(self.buffer.popleft())
+
+    def stopProducing(self):
+        """
+        Called by the connection when the client goes away.
+        """
+        self.is_closed = True
+        self.buffer.clear()
+        JobEventBroker.unsubscribe(self)
+
+class JobEventBroker(object):
+    """
+    Streams job state changes to subscribers as
+    :py:meth:`JobCache.apply_job_state_change <media_nommer.feederd.job_cache.JobCache.apply_job_state_change>`
+    applies them. Events are in the
+    `Server-Sent Events <http://www.w3.org/TR/eventsource/>`_ format, one
+    ``job`` event per change, with the job's status as JSON data.
+
+    Everything but :py:meth:`publish` must be called from the reactor thread.
+    """
+    SUBSCRIBERS = set()
+    # Keeps idle connections from being closed by proxies. Runs while there
+    # are subscribers.
+    KEEPALIVE_TASK = None
+
+    @classmethod
+    def subscribe(cls, request, job_ids=None, job_states=None):
+        """
+        Starts streaming events to a client.
+
+        :param request: The client's request. It's kept open for streaming.
+        :param set job_ids: If given, only changes to these jobs are sent.
+        :param set job_states: If given, only changes to these states are
+            sent.
+        :rtype: JobEventSubscriber
+        :returns: The new subscriber.
+        """
+        subscriber = JobEventSubscriber(request, job_ids, job_states)
+        request.setHeader('Content-Type', 'text/event-stream')
+        request.setHeader('Cache-Control', 'no-cache')
+        request.registerProducer(subscriber, True)
+        request.notifyFinish().addBoth(lambda ignored: subscriber.stopProducing())
+
+        cls.SUBSCRIBERS.add(subscriber)
+        metrics.set_gauge('feederd.events.subscribers', len(cls.SUBSCRIBERS))
+        if not cls.KEEPALIVE_TASK:
+            cls.KEEPALIVE_TASK = task.LoopingCall(cls._send_keepalive)
+            cls.KEEPALIVE_TASK.start(settings.FEEDERD_EVENTS_KEEPALIVE_INTERVAL,
+                                     now=False)
+
+        # Gets the headers out, so the client knows it's connected.
+        subscriber.send(': connected\n\n')
+        return subscriber
+
+    @classmethod
+    def unsubscribe(cls, subscriber):
+        """
+        Stops sending events to a subscriber.
+
+        :param JobEventSubscriber subscriber: The subscriber to forget.
+        """
+        cls.SUBSCRIBERS.discard(subscriber)
+        metrics.set_gauge('feederd.events.subscribers', len(cls.SUBSCRIBERS))
+        if not cls.SUBSCRIBERS and cls.KEEPALIVE_TASK:
+            cls.KEEPALIVE_TASK.stop()
+            cls.KEEPALIVE_TASK = None
+
+    @classmethod
+    def publish(cls, job):
+        """
+        Sends a job's new state to everyone who's interested. This is safe
+        to call from any thread.
+
+        :param EncodingJob job: The job that has changed.
+        """
+        if not cls.SUBSCRIBERS:
+            return
+        reactor.callFromThread(cls._publish, job)
+
+    @classmethod
+    def _publish(cls, job):
+        """
+        Sends a job's new state to everyone who's interested.
+        """
+        event = None
+        for subscriber in list(cls.SUBSCRIBERS):
+            if not subscriber.wants(job):
+                continue
+            if event is None:
+                event = cls.encode_event(job)
+            subscriber.send(event)
+            metrics.incr('feederd.events.sent')
+
+    @classmethod
+    def encode_event(cls, job):
+        """
+        :param EncodingJob job: The job that has changed.
+        :rtype: str
+        :returns: The job's status as an SSE event. The event ID is the job's
+            ID and state version, so repeats can be told apart.
+        """
+        return 'id: %s:%d\nevent: job\ndata: %s\n\n' % (
+                    job.unique_id, job.job_state_version,
+                    simplejson.dumps(get_job_status(job)))
+
+    @classmethod
+    def _send_keepalive(cls):
+        """
+        Sends a comment to every subscriber, so that idle connections stay
+        open.
+        """
+        for subscriber in list(cls.SUBSCRIBERS):
+            subscriber.send(': keepalive\n\n')
@@ -0,0 +1,265 @@
+"""
+Contains the :py:class:`JobNotifier` class, which lets clients know when
+their jobs are done by hitting their ``notify_url``.
+"""
+import os
+import time
+import urllib
+import tempfile
+import simplejson
+from twisted.internet import reactor, task
+from twisted.web.client import Agent, HTTPConnectionPool, readBody
+from media_nommer.conf import settings
+from media_nommer.utils import logger, metrics
+
+class JobNotifier(object):
+    """
+    Sends a GET request to a job's ``notify_url`` once it reaches a finished
+    state, with ``job_id`` and ``job_state`` added to the query string. Any
+    ``2xx`` response counts as delivered.
+
+    Requests go out through a Twisted_ ``Agent`` with a persistent connection
+    pool, no more than
+    :py:data:`FEEDERD_NOTIFY_CONCURRENCY <media_nommer.conf.settings.FEEDERD_NOTIFY_CONCURRENCY>`
+    at a time. Failed deliveries are retried with exponential back-off, up
+    to
+    :py:data:`FEEDERD_NOTIFY_MAX_ATTEMPTS <media_nommer.conf.settings.FEEDERD_NOTIFY_MAX_ATTEMPTS>`
+    times. Undelivered notifications are kept in
+    :py:data:`FEEDERD_NOTIFY_RETRY_FILE <media_nommer.conf.settings.FEEDERD_NOTIFY_RETRY_FILE>`,
+    so that they survive restarts. The file is re-written at most once every
+    :py:data:`FEEDERD_NOTIFY_CHECK_INTERVAL <media_nommer.conf.settings.FEEDERD_NOTIFY_CHECK_INTERVAL>`,
+    and on shutdown.
+
+    Everything but :py:meth:`notify` must be called from the reactor thread.
+    """
+    # Keys are job unique IDs, values are dicts with url, job_state,
+    # attempts, next_attempt, and finished_time keys.
+    PENDING = {}
+    # The unique IDs of notifications being delivered right now.
+    IN_FLIGHT = set()
+    # True when PENDING has changed since it was last written out.
+    DIRTY = False
+    # The lazy-loaded Agent. See _get_agent().
+    AGENT = None
+    # The retry LoopingCall, once started.
+    RETRY_TASK = None
+
+    @classmethod
+    def get_retry_file(cls):
+        """
+        :rtype: str
+        :returns: The path to the file undelivered notifications are kept in.
+        """
+        return settings.FEEDERD_NOTIFY_RETRY_FILE or \
+               os.path.join(tempfile.gettempdir(), 'feederd-notifications.json')
+
+    @classmethod
+    def _get_agent(cls):
+        """
+        Lazy-loading of the Agent, and its connection pool.
+
+        :rtype: :py:class:`twisted.web.client.Agent`
+        :returns: The Agent to send notifications with.
+        """
+        if not cls.AGENT:
+            pool = HTTPConnectionPool(reactor, persistent=True)
+            pool.maxPersistentPerHost = settings.FEEDERD_NOTIFY_CONCURRENCY
+            cls.AGENT = Agent(reactor, pool=pool,
+                              connectTimeout=settings.FEEDERD_NOTIFY_TIMEOUT)
+        return cls.AGENT
+
+    @classmethod
+    def start(cls):
+        """
+        Picks up any notifications left undelivered by the last run, and
+        starts retrying failed ones. Called when :doc:`../feederd` starts.
+        """
+        retry_file = cls.get_retry_file()
+        if os.path.exists(retry_file):
+            try:
+                cls.PENDING.update(simplejson.load(open(retry_file)))
+            except ValueError:
+                logger.error(message_or_obj="JobNotifier.start(): " \
+                             "Unable to read %s, discarding it." % retry_file)
+            logger.info("JobNotifier.start(): Loaded %d undelivered " \
+                        "notifications." % len(cls.PENDING))
+
+        cls.RETRY_TASK = task.LoopingCall(cls._check)
+        cls.RETRY_TASK.start(settings.FEEDERD_NOTIFY_CHECK_INTERVAL)
+        reactor.addSystemEventTrigger('before', 'shutdown', cls._save_if_dirty)
+
+    @classmethod
+    def notify(cls, job):
+        """
+        Queues up a notification for a job that has just finished. Jobs
+        without a ``notify_url`` are ignored. This is safe to call from any
+        thread.
+
+        :param EncodingJob job: The finished job.
+        """
+        if not job.notify_url:
+            return
+        reactor.callFromThread(cls._add, job.unique_id, job.notify_url,
+                               job.job_state)
+
+    @classmethod
+    def _add(cls, unique_id, notify_url, job_state):
+        """
+        Adds a notification, and sends it if there's room.
+        """
+        if cls.PENDING.has_key(unique_id):
+            # Already on its way.
+            return
+        cls.PENDING[unique_id] = {
+            'url': notify_url,
+            'job_state': job_state,
+            'attempts': 0,
+            'next_attempt': 0,
+            'finished_time': time.time(),
+        }
+        cls.DIRTY = True
+        cls._send_ready()
+
+    @classmethod
+    def _save(cls):
+        """
+        Writes the undelivered notifications to the retry file. The file is
+        replaced in one go, so a crash mid-write doesn't lose the old one.
+        """
+        cls.DIRTY = False
+        metrics.set_gauge('feederd.notify.pending', len(cls.PENDING))
+        retry_file = cls.get_retry_file()
+        temp_file = retry_file + '.tmp'
+        try:
+            fobj = open(temp_file, 'w')
+            try:
+                simplejson.dump(cls.PENDING, fobj)
+            finally:
+                fobj.close()
+            os.rename(temp_file, retry_file)
+        except (IOError, OSError):
+            logger.error(message_or_obj="JobNotifier._save(): " \
+                         "Unable to write %s" % retry_file)
+            logger.error()
+
+    @classmethod
+    def _save_if_dirty(cls):
+        """
+        Writes the undelivered notifications to the retry file, if they've
+        changed since the last time.
+        """
+        if cls.DIRTY:
+            cls._save()
+
+    @classmethod
+    def _check(cls):
+        """
+        Run every
+        :py:data:`FEEDERD_NOTIFY_CHECK_INTERVAL <media_nommer.conf.settings.FEEDERD_NOTIFY_CHECK_INTERVAL>`
+        seconds. Saves whatever has changed since the last run, and retries
+        failed notifications that are due.
+        """
+        cls._save_if_dirty()
+        cls._send_ready()
+
+    @classmethod
+    def _send_ready(cls):
+        """
+        Sends notifications that are due, as long as there's room.
+        """
+        now = time.time()
+        ready = sorted([(notification['next_attempt'], unique_id)
+                        for unique_id, notification in cls.PENDING.items()
+                        if notification['next_attempt'] <= now and
+                           unique_id not in cls.IN_FLIGHT])
+        room = settings.FEEDERD_NOTIFY_CONCURRENCY - len(cls.IN_FLIGHT)
+        for next_attempt, unique_id in ready[:max(room, 0)]:
+            cls._send(unique_id)
+
+    @classmethod
+    def _get_url(cls, unique_id, notification):
+        """
+        :rtype: str
+        :returns: The notify URL, with the job's ID and state added.
+        """
+        query = urllib.urlencode({'job_id': unique_id,
+                                  'job_state': notification['job_state']})
+        url = notification['url']
+        if '?' in url:
+            return '%s&%s' % (url, query)
+        return '%s?%s' % (url, query)
+
+    @classmethod
+    def _send(cls, unique_id):
+        """
+        Sends a notification.
+
+        :param str unique_id: The unique ID of the notification's job.
+        """
+        notification = cls.PENDING[unique_id]
+        cls.IN_FLIGHT.add(unique_id)
+        notification['attempts'] += 1
+        start_time = time.time()
+
+        d = cls._get_agent().request('GET',
+                            str(cls._get_url(unique_id, notification)))
+        # The connect timeout doesn't cover slow responses.
+        timeout = reactor.callLater(settings.FEEDERD_NOTIFY_TIMEOUT, d.cancel)
+
+        def got_response(response):
+            # Connections are only re-used once the body has been read.
+            d = readBody(response)
+            d.addCallback(lambda body: response.code)
+            return d
+
+        def done(result):
+            if timeout.active():
+                timeout.cancel()
+            cls.IN_FLIGHT.discard(unique_id)
+            metrics.observe('feederd.notify.request_time',
+                            time.time() - start_time)
+            if isinstance(result, int) and 200 <= result < 300:
+                cls._delivered(unique_id, notification)
+            else:
+                cls._failed(unique_id, notification, result)
+            cls._send_ready()
+
+        d.addCallback(got_response)
+        d.addBoth(done)
+
+    @classmethod
+    def _delivered(cls, unique_id, notification):
+        """
+        Forgets a delivered notification.
+        """
+        del cls.PENDING[unique_id]
+        cls.DIRTY = True
+        metrics.incr('feederd.notify.delivered')
+        metrics.observe('feederd.notify.latency',
+                        time.time() - notification['finished_time'])
+        logger.debug("JobNotifier._delivered(): Notified %s for %s" % (
+                        notification['url'], unique_id))
+
+    @classmethod
+    def _failed(cls, unique_id, notification, result):
+        """
+        Schedules a failed notification for another try, or gives up on it.
+
+        :param result: The HTTP status code, or a Twisted Failure.
+        """
+        metrics.incr('feederd.notify.failures')
+        if notification['attempts'] >= settings.FEEDERD_NOTIFY_MAX_ATTEMPTS:
+            del cls.PENDING[unique_id]
+            metrics.incr('feederd.notify.abandoned')
+            logger.error(message_or_obj="JobNotifier._failed(): Giving up " \
+                         "on notifying %s for %s: %s" % (notification['url'],
+                                                         unique_id, result))
+        else:
+            delay = min(settings.FEEDERD_NOTIFY_RETRY_DELAY * \
+                            2 ** (notification['attempts'] - 1),
+                        settings.FEEDERD_NOTIFY_MAX_RETRY_DELAY)
+            notification['next_attempt'] = time.time() + delay
+            logger.info("JobNotifier._failed(): Notifying %s for %s " \
+                        "failed (%s), retrying in %ds." % (
+                            notification['url'], unique_id, result, delay))
+        cls.DIRTY = True
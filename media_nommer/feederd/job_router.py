@@ -0,0 +1,201 @@
+"""
+Contains the :py:class:`JobRouter` class, which sends new jobs to nodes that
+already have their source cached.
+"""
+import time
+import threading
+from media_nommer.conf import settings
+from media_nommer.utils import logger, metrics
+from media_nommer.core.job_state_backend import JobStateBackend
+from media_nommer.feederd.fleet_table import FleetTable
+from media_nommer.ec2nommerd.source_cache import SourceCache
+
+class JobRouter(object):
+    """
+    Queues new jobs up, preferring nodes whose
+    :py:class:`SourceCache <media_nommer.ec2nommerd.source_cache.SourceCache>`
+    already holds the job's source. Nodes advertise their cache in their
+    heartbeats as a Bloom filter, which the
+    :py:class:`FleetTable <media_nommer.feederd.fleet_table.FleetTable>`
+    keeps. A job whose source a live node with free slots has cached goes
+    into that node's own queue. Anything else goes into its priority lane
+    as usual.
+
+    If a routed job isn't picked up within
+    :py:data:`FEEDERD_AFFINITY_TIMEOUT <media_nommer.conf.settings.FEEDERD_AFFINITY_TIMEOUT>`
+    seconds (the node got busy, or died), it is moved to its priority lane
+    for anyone to take.
+    """
+    # Keys are job unique IDs, values are (instance_id, routed_time) tuples
+    # for the jobs routed to a node's queue.
+    ROUTED = {}
+    # Guards ROUTED.
+    LOCK = threading.Lock()
+
+    @classmethod
+    def pick_node(cls, job):
+        """
+        Finds a node that has the job's source cached, and room for it.
+
+        :param EncodingJob job: The job to route.
+        :rtype: str
+        :returns: The instance ID of the node with the most free slots among
+            those with the source, or ``None`` if there isn't one.
+        """
+        key = SourceCache.get_key(job.source_path, etag=job.source_etag,
+                                  size=job.source_size)
+        if not key:
+            return None
+
+        with cls.LOCK:
+            num_routed = {}
+            for instance_id, routed_time in cls.ROUTED.values():
+                num_routed[instance_id] = num_routed.get(instance_id, 0) + 1
+
+        best_node = None
+        best_free_slots = 0
+        for node in FleetTable.get_alive_nodes():
+            if node['state'] != 'ACTIVE' or not node['source_cache'] or \
+               key not in node['source_cache']:
+                continue
+            # Jobs we've routed there may not have shown up in its
+            # heartbeats yet.
+            free_slots = node['max_jobs'] - node['active_jobs'] - \
+                         num_routed.get(node['id'], 0)
+            if free_slots > best_free_slots:
+                best_node = node['id']
+                best_free_slots = free_slots
+        return best_node
+
+    @classmethod
+    def route(cls, job):
+        """
+        Queues a newly saved job up, on a node that has its source if
+        :py:data:`JOB_CACHE_AFFINITY <media_nommer.conf.settings.JOB_CACHE_AFFINITY>`
+        is on and there is one.
+
+        :param EncodingJob job: The job to queue up. It must have been saved
+            with ``enqueue=False``.
+        """
+        instance_id = None
+        if settings.JOB_CACHE_AFFINITY:
+            instance_id = cls.pick_node(job)
+
+        JobStateBackend.enqueue_job(job, instance_id=instance_id)
+        if instance_id:
+            with cls.LOCK:
+                cls.ROUTED[job.unique_id] = (instance_id, time.time())
+            metrics.incr('feederd.routing.affinity')
+            logger.debug("JobRouter.route(): Routed %s to %s" % (
+                            job.unique_id, instance_id))
+        else:
+            metrics.incr('feederd.routing.shared')
+
+    @classmethod
+    def route_batch(cls, jobs):
+        """
+        Like :py:meth:`route`, but for many jobs at once. Jobs headed for the
+        same queue are sent together.
+
+        :param list jobs: The jobs to queue up. They must have been saved
+            with ``enqueue=False``, or by
+            :py:meth:`JobStateBackend.save_new_jobs <media_nommer.core.job_state_backend.JobStateBackend.save_new_jobs>`.
+        """
+        # Keys are instance IDs (None for the priority lanes), values are
+        # lists of jobs.
+        routes = {}
+        for job in jobs:
+            instance_id = None
+            if settings.JOB_CACHE_AFFINITY:
+                instance_id = cls.pick_node(job)
+            if instance_id:
+                # Counts against the node's free slots for the rest of
+                # the batch.
+                with cls.LOCK:
+                    cls.ROUTED[job.unique_id] = (instance_id, time.time())
+            routes.setdefault(instance_id, []).append(job)
+
+        for instance_id, routed_jobs in routes.items():
+            JobStateBackend.enqueue_jobs(routed_jobs, instance_id=instance_id)
+            if instance_id:
+                metrics.incr('feederd.routing.affinity', len(routed_jobs))
+            else:
+                metrics.incr('feederd.routing.shared', len(routed_jobs))
+
+    @classmethod
+    def _get_stale_nodes(cls):
+        """
+        :rtype: list
+        :returns: The instance IDs of nodes that have routed jobs that are
+            past :py:data:`FEEDERD_AFFINITY_TIMEOUT <media_nommer.conf.settings.FEEDERD_AFFINITY_TIMEOUT>`.
+        """
+        cutoff = time.time() - settings.FEEDERD_AFFINITY_TIMEOUT
+        with cls.LOCK:
+            return list(set([instance_id for instance_id, routed_time
+                             in cls.ROUTED.values() if routed_time <= cutoff]))
+
+    @classmethod
+    def _requeue_node_jobs(cls, instance_id):
+        """
+        Moves stale jobs out of a node's queue and into their priority
+        lanes. Jobs the node has already taken are invisible to us, and
+        are left alone.
+
+        :param str instance_id: The node's EC2 instance ID.
+        :rtype: int
+        :returns: The number of jobs moved.
+        """
+        node = FleetTable.get_node(instance_id)
+        is_alive = node and FleetTable.is_node_alive(node)
+        cutoff = time.time() - settings.FEEDERD_AFFINITY_TIMEOUT
+        num_moved = 0
+        seen_ids = set()
+
+        while True:
+            # Whatever we leave behind re-appears for the node shortly.
+            job_messages = JobStateBackend.get_node_job_messages_from_queue(
+                                instance_id, 10, visibility_timeout=10)
+            new_messages = [(message, job) for message, job in job_messages
+                            if job.unique_id not in seen_ids]
+            if not new_messages:
+                break
+
+            for message, job in new_messages:
+                seen_ids.add(job.unique_id)
+                with cls.LOCK:
+                    routed = cls.ROUTED.get(job.unique_id)
+                # If we've lost track of it (say, after a restart), it's
+                # been there a while.
+                if is_alive and routed and routed[1] > cutoff:
+                    continue
+                JobStateBackend.enqueue_job(job)
+                message.delete()
+                num_moved += 1
+
+        # Anything that's past due and wasn't in the queue was taken by the
+        # node.
+        with cls.LOCK:
+            for unique_id, (routed_id, routed_time) in cls.ROUTED.items():
+                if routed_id == instance_id and routed_time <= cutoff:
+                    del cls.ROUTED[unique_id]
+        return num_moved
+
+    @classmethod
+    def requeue_stale_jobs(cls):
+        """
+        Moves jobs that have waited too long for the node they were routed
+        to into their priority lanes.
+        """
+        for instance_id in cls._get_stale_nodes():
+            try:
+                num_moved = cls._requeue_node_jobs(instance_id)
+            except:
+                logger.error(message_or_obj="JobRouter.requeue_stale_jobs(): " \
+                             "Unable to requeue jobs routed to %s" % instance_id)
+                logger.error()
+                continue
+            if num_moved:
+                metrics.incr('feederd.routing.fallbacks', num_moved)
+                logger.info("JobRouter.requeue_stale_jobs(): Moved %d jobs " \
+                            "from %s to the shared queues." % (num_moved,
+                                                              instance_id))
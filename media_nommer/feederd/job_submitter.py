@@ -0,0 +1,527 @@
+"""
+Contains the :py:class:`JobSubmitter` class, which turns job submissions from
+the JSON API into saved and queued up jobs.
+"""
+import Queue
+import threading
+from media_nommer.conf import settings
+from media_nommer.utils import logger, metrics
+from media_nommer.core.job_state_backend import EncodingJob, JobStateBackend
+from media_nommer.core.storage_backends import get_backend_for_uri
+from media_nommer.core.storage_backends.exceptions import InfileNotFoundException
+from media_nommer.feederd.exceptions import InvalidJobException
+from media_nommer.feederd.job_cache import JobCache
+from media_nommer.feederd.fleet_controller import FleetController
+from media_nommer.feederd.job_router import JobRouter
+from media_nommer.feederd.submission_log import SubmissionLog
+
+# Multi-output jobs are always encoded by this.
+MULTI_OUTPUT_NOMMER = 'media_nommer.ec2nommerd.nommers.ffmpeg.FFmpegNommer'
+# Copies an earlier job's output instead of encoding the same thing again.
+COPY_NOMMER = 'media_nommer.ec2nommerd.nommers.copying.CopyNommer'
+# How many jobs in a batch have their sources looked up at once.
+BATCH_LOOKUP_THREADS = 10
+# The most jobs saved and queued up per flush of the submission log.
+SUBMISSION_FLUSH_SIZE = 1000
+
+class JobSubmitter(object):
+    """
+    Checks over job submissions, and saves and queues up the jobs. A
+    submission is a dict with these keys, as described in :doc:`../jsonapi`:
+
+    * ``source_path``
+    * ``dest_path`` and ``preset``, or ``outputs``
+    * ``notify_url`` (optional)
+    * ``priority`` (optional)
+    * ``job_options`` (optional)
+
+    Jobs that would produce the same output as an earlier one are
+    de-duplicated here. See
+    :py:data:`FEEDERD_DEDUPLICATE_JOBS <media_nommer.conf.settings.FEEDERD_DEDUPLICATE_JOBS>`.
+
+    With
+    :py:data:`FEEDERD_SUBMISSION_LOG <media_nommer.conf.settings.FEEDERD_SUBMISSION_LOG>`
+    on, new jobs are written to the
+    :py:class:`SubmissionLog <media_nommer.feederd.submission_log.SubmissionLog>`
+    rather than saved right away, and :py:meth:`flush_submission_log` saves
+    and queues them up in the background.
+    """
+    @classmethod
+    def build_job(cls, submission):
+        """
+        Checks over a submission, and looks up its source.
+
+        :param dict submission: The submission.
+        :rtype: EncodingJob
+        :returns: The job, un-saved.
+        :raises: :py:exc:`InvalidJobException <media_nommer.feederd.exceptions.InvalidJobException>`
+            if the submission doesn't make sense.
+        """
+        if not isinstance(submission, dict):
+            raise InvalidJobException('Each job must be a JSON object.')
+        for key in ['source_path', 'dest_path', 'preset', 'notify_url',
+                    'priority']:
+            if not isinstance(submission.get(key, ''), basestring):
+                raise InvalidJobException('%s must be a string.' % key)
+        source_path = submission.get('source_path')
+        if not source_path:
+            raise InvalidJobException('source_path is required.')
+        notify_url = submission.get('notify_url')
+
+        if submission.get('outputs') is not None:
+            # Several outputs from one download and decode.
+            multi_output_options = cls._get_multi_output_options(
+                                                    submission['outputs'])
+            outputs = multi_output_options['outputs']
+            dest_path = outputs[0]['dest_path']
+            preset = ','.join([output['preset'] for output in outputs])
+        else:
+            multi_output_options = None
+            dest_path = submission.get('dest_path')
+            preset = submission.get('preset')
+            if not dest_path or not preset:
+                raise InvalidJobException('dest_path and preset are required.')
+        user_job_options = submission.get('job_options') or {}
+
+        # Retrieve the given preset from nomconf. Multi-output jobs take
+        # their defaults from the first output's preset.
+        try:
+            preset_dict = settings.PRESETS[preset.split(',')[0]]
+        except KeyError:
+            raise InvalidJobException('No such preset.')
+
+        # A priority given with the request trumps the preset's.
+        priority = submission.get('priority') or preset_dict.get('priority')
+        if priority and priority not in JobStateBackend.get_priority_lanes():
+            raise InvalidJobException('No such priority.')
+
+        # Determine the nommer based on the preset.
+        nommer = preset_dict['nommer']
+        # Get the preset's job options dict.
+        if multi_output_options:
+            job_options = multi_output_options
+        else:
+            job_options = preset_dict['options']
+        # Override preset's options with user-specified values.
+        # TODO: Fix this for multi-pass!
+        #job_options.update(user_job_options)
+
+        # Look up the source's size so the autoscaler can estimate how much
+        # work this job is. Not all backends can do this.
+        source_info = {}
+        try:
+            source_info = get_backend_for_uri(source_path).get_file_info(source_path)
+        except InfileNotFoundException:
+            raise InvalidJobException('Source file not found.')
+        except:
+            logger.error(message_or_obj="JobSubmitter.build_job(): " \
+                         "Unable to look up source info for %s" % source_path)
+            logger.error()
+
+        job = EncodingJob(source_path, dest_path, nommer, job_options,
+                          notify_url=notify_url, priority=priority,
+                          preset=preset,
+                          source_size=source_info.get('size'),
+                          source_etag=source_info.get('etag'))
+        if settings.FEEDERD_DEDUPLICATE_JOBS:
+            job.fingerprint = job.get_fingerprint()
+        return job
+
+    @classmethod
+    def _get_multi_output_options(cls, outputs):
+        """
+        Checks over the ``outputs`` of a multi-output submission, and turns
+        them into job options for
+        :py:class:`FFmpegNommer <media_nommer.ec2nommerd.nommers.ffmpeg.FFmpegNommer>`.
+        Only preset names are stored, not their options, since SimpleDB
+        can't hold more than 1024 bytes of options.
+
+        :param list outputs: A list of ``[preset, dest_path]`` pairs.
+        :rtype: dict
+        :returns: The job options.
+        :raises: :py:exc:`InvalidJobException <media_nommer.feederd.exceptions.InvalidJobException>`
+            if the outputs aren't valid.
+        """
+        if not isinstance(outputs, list) or not outputs:
+            raise InvalidJobException('outputs must be a list of [preset, dest_path] pairs.')
+
+        job_outputs = []
+        infile_options = None
+        for output in outputs:
+            if not isinstance(output, list) or len(output) != 2:
+                raise InvalidJobException('outputs must be a list of [preset, dest_path] pairs.')
+            preset, dest_path = output
+            try:
+                preset_dict = settings.PRESETS[preset]
+            except KeyError:
+                raise InvalidJobException('No such preset: %s' % preset)
+
+            if preset_dict['nommer'] != MULTI_OUTPUT_NOMMER:
+                raise InvalidJobException('Preset %s does not use FFmpegNommer.' % preset)
+            passes = preset_dict.get('options') or [{}]
+            if len(passes) > 1:
+                raise InvalidJobException('Preset %s has more than one pass.' % preset)
+            # The source is only decoded once, so everyone has to read it
+            # the same way.
+            preset_infile_options = passes[0].get('infile_options', [])
+            if infile_options is not None and \
+               preset_infile_options != infile_options:
+                raise InvalidJobException('All outputs must share infile_options.')
+            infile_options = preset_infile_options
+
+            job_outputs.append({'preset': preset, 'dest_path': dest_path})
+
+        return {'outputs': job_outputs}
+
+    @classmethod
+    def _get_original_job(cls, job):
+        """
+        Finds the job that was last submitted to produce the same output as
+        ``job``, going by its fingerprint.
+
+        :param EncodingJob job: The job being submitted.
+        :rtype: EncodingJob
+        :returns: The earlier job, if it's finished or still underway.
+            ``None`` if there isn't one, or it failed.
+        """
+        if not job.fingerprint:
+            return None
+
+        # Jobs still in the submission log aren't in the fingerprint index.
+        unique_id = SubmissionLog.get_job_id_for_fingerprint(job.fingerprint)
+        if unique_id:
+            original_job = SubmissionLog.get_job(unique_id)
+            if original_job:
+                return original_job
+
+        try:
+            unique_id = JobStateBackend.get_job_id_for_fingerprint(job.fingerprint)
+            if not unique_id:
+                return None
+            if JobCache.is_job_cached(unique_id):
+                original_job = JobCache.get_job(unique_id)
+            else:
+                original_job = JobStateBackend.get_job_object_from_id(unique_id)
+        except:
+            # Encoding it again beats not encoding it at all.
+            logger.error(message_or_obj="JobSubmitter._get_original_job(): " \
+                         "Unable to look up fingerprint %s" % job.fingerprint)
+            logger.error()
+            return None
+
+        if original_job.is_finished() and original_job.job_state != 'FINISHED':
+            return None
+        if original_job.job_state == 'FINISHED' and \
+           not cls._is_output_intact(original_job):
+            # The fingerprint index points at it until this job replaces it.
+            metrics.incr('feederd.dedupe.stale_outputs')
+            return None
+        return original_job
+
+    @classmethod
+    def _is_output_intact(cls, original_job):
+        """
+        Checks that a finished job's output is still where it was uploaded,
+        and hasn't been overwritten since.
+
+        :param EncodingJob original_job: A FINISHED job.
+        :rtype: bool
+        :returns: ``True`` if the output can be handed out again, ``False``
+            if it has to be encoded again.
+        """
+        dest_path = original_job.dest_path
+        try:
+            dest_info = get_backend_for_uri(dest_path).get_file_info(dest_path)
+        except InfileNotFoundException:
+            logger.info("JobSubmitter._is_output_intact(): Output %s of " \
+                        "job %s is gone." % (dest_path, original_job.unique_id))
+            return False
+        except:
+            logger.error(message_or_obj="JobSubmitter._is_output_intact(): " \
+                         "Unable to look up %s" % dest_path)
+            logger.error()
+            return False
+
+        if original_job.dest_size is not None and \
+           dest_info.get('size') != original_job.dest_size:
+            return False
+        if original_job.dest_etag is not None and \
+           dest_info.get('etag') != original_job.dest_etag:
+            return False
+        return True
+
+    @classmethod
+    def _get_copy_job(cls, original_job, job):
+        """
+        :param EncodingJob original_job: A saved job producing the same
+            output as ``job``, somewhere else.
+        :param EncodingJob job: The job being submitted.
+        :rtype: EncodingJob
+        :returns: An un-saved job that copies the original job's output to
+            ``job``'s destination, once the original job is done.
+        """
+        metrics.incr('feederd.dedupe.copies')
+        copy_job = EncodingJob(original_job.dest_path, job.dest_path,
+                               COPY_NOMMER, {}, notify_url=job.notify_url,
+                               priority=job.priority, preset=job.preset)
+        if not original_job.is_finished():
+            copy_job.depends_on = original_job.unique_id
+        return copy_job
+
+    @classmethod
+    def _track_new_jobs(cls, jobs):
+        """
+        Indexes freshly saved jobs by fingerprint, queues them up (on nodes
+        that have their source cached if possible), and starts tracking
+        them. Jobs waiting on another are queued up by the
+        :py:class:`JobCache <media_nommer.feederd.job_cache.JobCache>` later.
+
+        :param list jobs: The saved jobs.
+        """
+        fingerprints = dict([(job.fingerprint, job.unique_id)
+                             for job in jobs if job.fingerprint])
+        if len(fingerprints) == 1:
+            JobStateBackend.set_job_id_for_fingerprint(*fingerprints.items()[0])
+        elif fingerprints:
+            JobStateBackend.set_job_ids_for_fingerprints(fingerprints)
+
+        ready_jobs = [job for job in jobs if not job.depends_on]
+        if len(ready_jobs) == 1:
+            JobRouter.route(ready_jobs[0])
+        elif ready_jobs:
+            JobRouter.route_batch(ready_jobs)
+
+        for job in jobs:
+            # Add the job to the local job cache.
+            JobCache.update_job(job)
+            # Feed the demand forecast.
+            FleetController.record_submission(job)
+
+    @classmethod
+    def _log_new_jobs(cls, jobs):
+        """
+        Writes new jobs to the submission log, if it's on. They're given
+        their unique IDs, and saved and queued up later by
+        :py:meth:`flush_submission_log`.
+
+        :param list jobs: The new jobs.
+        :rtype: bool
+        :returns: ``True`` if the jobs were logged. ``False`` if the log is
+            off or couldn't be written, in which case the caller saves and
+            queues them up itself.
+        """
+        if not settings.FEEDERD_SUBMISSION_LOG or not jobs:
+            return False
+        try:
+            SubmissionLog.append(jobs)
+        except (IOError, OSError):
+            logger.error(message_or_obj="JobSubmitter._log_new_jobs(): " \
+                         "Unable to write to the submission log, saving " \
+                         "%d jobs directly." % len(jobs))
+            logger.error()
+            return False
+        return True
+
+    @classmethod
+    def flush_submission_log(cls):
+        """
+        Saves and queues up the oldest jobs in the submission log. Jobs that
+        may have been saved already (by an earlier run, say) are looked up
+        rather than saved over. Those a node has picked up are just tracked,
+        and the rest are queued up again, so every job is queued up at least
+        once. Jobs that don't make it stay in the log for next time.
+
+        :rtype: int
+        :returns: The number of jobs flushed.
+        """
+        pending = SubmissionLog.get_pending_jobs(SUBMISSION_FLUSH_SIZE)
+        if not pending:
+            return 0
+
+        check_ids = [job.unique_id for job, needs_check in pending
+                     if needs_check]
+        saved_jobs = {}
+        if check_ids:
+            saved_jobs = JobStateBackend.get_jobs_by_id(check_ids)
+
+        new_jobs = [job for job, needs_check in pending
+                    if not saved_jobs.has_key(job.unique_id)]
+        failed_ids = set([job.unique_id for job in
+                          JobStateBackend.save_new_jobs(new_jobs)])
+        SubmissionLog.mark_saved([job.unique_id for job in new_jobs
+                                  if job.unique_id not in failed_ids])
+
+        ready_jobs = []
+        done_ids = []
+        for job, needs_check in pending:
+            if job.unique_id in failed_ids:
+                continue
+            job = saved_jobs.get(job.unique_id, job)
+            if job.job_state == 'PENDING':
+                ready_jobs.append(job)
+            elif not job.is_finished():
+                # Picked up before the last run went down.
+                JobCache.update_job(job)
+            done_ids.append(job.unique_id)
+
+        if ready_jobs:
+            cls._track_new_jobs(ready_jobs)
+        SubmissionLog.mark_done(done_ids)
+        metrics.incr('feederd.submission_log.flushed', len(done_ids))
+        return len(done_ids)
+
+    @classmethod
+    def submit(cls, job):
+        """
+        Saves and queues up a job, unless an earlier job has it covered.
+
+        :param EncodingJob job: A job from :py:meth:`build_job`.
+        :rtype: str
+        :returns: The unique ID of the job that will produce the output.
+            This is an earlier job's, if it's going to the same destination.
+        """
+        original_job = cls._get_original_job(job)
+        if original_job and original_job.dest_path == job.dest_path:
+            # This output is done, or on its way. Resubmissions after a
+            # timeout end up here.
+            metrics.incr('feederd.dedupe.coalesced')
+            return original_job.unique_id
+        if original_job:
+            # Same output, different destination. Copy it over.
+            job = cls._get_copy_job(original_job, job)
+
+        if not cls._log_new_jobs([job]):
+            if JobStateBackend.save_new_jobs([job]):
+                raise Exception('JobSubmitter.submit(): Unable to save job.')
+            cls._track_new_jobs([job])
+        return job.unique_id
+
+    @classmethod
+    def build_batch(cls, submissions):
+        """
+        Runs :py:meth:`build_job` and :py:meth:`_get_original_job` over a
+        batch of submissions. Each is a round trip or two, so several go at
+        once.
+
+        :param list submissions: The submissions.
+        :rtype: list
+        :returns: An entry per submission: a ``(job, original_job)`` tuple,
+            or an error message.
+        """
+        results = [None] * len(submissions)
+        indices = Queue.Queue()
+        for index in range(len(submissions)):
+            indices.put(index)
+
+        def build():
+            while True:
+                try:
+                    index = indices.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    job = cls.build_job(submissions[index])
+                    results[index] = (job, cls._get_original_job(job))
+                except InvalidJobException, e:
+                    results[index] = e.message
+                except:
+                    logger.error(message_or_obj="JobSubmitter.build_batch(): " \
+                                 "Unable to build job %d." % index)
+                    logger.error()
+                    results[index] = 'Unable to build job.'
+
+        threads = [threading.Thread(target=build) for i in
+                   range(min(BATCH_LOOKUP_THREADS, len(submissions)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    @classmethod
+    def _save_batch(cls, jobs, results):
+        """
+        Saves new jobs in as few requests as possible, and starts tracking
+        the ones that made it.
+
+        :param list jobs: ``(index, job)`` tuples, where ``index`` is the
+            job's submission's place in the batch.
+        :param list results: The batch's results, filled in for these jobs.
+        """
+        if cls._log_new_jobs([job for index, job in jobs]):
+            for index, job in jobs:
+                results[index] = {'job_id': job.unique_id}
+            return
+
+        JobStateBackend.save_new_jobs([job for index, job in jobs])
+        for index, job in jobs:
+            if job.unique_id:
+                results[index] = {'job_id': job.unique_id}
+            else:
+                results[index] = {'error': 'Unable to save job.'}
+
+        saved_jobs = [job for index, job in jobs if job.unique_id]
+        if saved_jobs:
+            cls._track_new_jobs(saved_jobs)
+
+    @classmethod
+    def submit_batch(cls, submissions, built_jobs=None):
+        """
+        Like :py:meth:`build_job` and :py:meth:`submit`, but for a batch of
+        submissions. Jobs are saved and queued up in as few requests as
+        possible. One bad submission doesn't sink the rest.
+
+        :param list submissions: The submissions.
+        :keyword list built_jobs: What :py:meth:`build_batch` made of the
+            submissions, if it has already been run over them.
+        :rtype: list
+        :returns: A dict per submission, in the same order. Each has a
+            ``job_id`` key if the job was submitted, or an ``error`` key
+            with a message if not.
+        """
+        results = [None] * len(submissions)
+        new_jobs = []
+        # Duplicates of jobs elsewhere in the batch, as (index, job,
+        # original_job) tuples. These wait until the originals are saved.
+        batch_duplicates = []
+        # Keys are fingerprints, values are new jobs in this batch.
+        batch_originals = {}
+
+        if built_jobs is None:
+            built_jobs = cls.build_batch(submissions)
+        for index, built in enumerate(built_jobs):
+            if isinstance(built, basestring):
+                results[index] = {'error': built}
+                continue
+
+            job, original_job = built
+            if not original_job and batch_originals.has_key(job.fingerprint):
+                batch_duplicates.append((index, job,
+                                         batch_originals[job.fingerprint]))
+                continue
+            if original_job and original_job.dest_path == job.dest_path:
+                metrics.incr('feederd.dedupe.coalesced')
+                results[index] = {'job_id': original_job.unique_id}
+                continue
+            if original_job:
+                new_jobs.append((index, cls._get_copy_job(original_job, job)))
+                continue
+
+            if job.fingerprint:
+                batch_originals[job.fingerprint] = job
+            new_jobs.append((index, job))
+
+        cls._save_batch(new_jobs, results)
+
+        copy_jobs = []
+        for index, job, original_job in batch_duplicates:
+            if not original_job.unique_id:
+                results[index] = {'error': 'Unable to save job.'}
+            elif original_job.dest_path == job.dest_path:
+                metrics.incr('feederd.dedupe.coalesced')
+                results[index] = {'job_id': original_job.unique_id}
+            else:
+                copy_jobs.append((index, cls._get_copy_job(original_job, job)))
+        cls._save_batch(copy_jobs, results)
+
+        return results
@@ -0,0 +1,343 @@
+"""
+Contains the :py:class:`SubmissionLog` class, an append-only log that new
+jobs are written to before they're saved to SimpleDB_ and queued up.
+"""
+import os
+import datetime
+import tempfile
+import threading
+import simplejson
+from media_nommer.conf import settings
+from media_nommer.utils import logger, metrics
+from media_nommer.core.job_state_backend import JobStateBackend
+
+class SubmissionLog(object):
+    """
+    Keeps newly submitted jobs on local disk until they've been saved to
+    SimpleDB_ and queued up in SQS_, so that the client can be answered
+    right away, whatever AWS_ is up to.
+    :py:meth:`JobSubmitter.flush_submission_log <media_nommer.feederd.job_submitter.JobSubmitter.flush_submission_log>`
+    does the saving and queueing, and picks up where the last run left off
+    after a restart.
+
+    The log lives in
+    :py:data:`FEEDERD_SUBMISSION_LOG_FILE <media_nommer.conf.settings.FEEDERD_SUBMISSION_LOG_FILE>`.
+    Each line is a JSON object, either ``{"add": <job attributes>}`` for a
+    new job, or ``{"done": [<unique IDs>]}`` for jobs that are safely saved
+    and queued. Appends from concurrent submissions share ``fsync()`` calls.
+
+    This is safe to call from multiple threads at once.
+    """
+    # Keys are unique IDs, values are dicts with job, seq, and needs_check
+    # keys. needs_check is set for jobs that may already be in SimpleDB,
+    # which are looked up rather than saved blindly.
+    PENDING = {}
+    # Keys are fingerprints, values are the unique IDs of the pending jobs
+    # they belong to. Resubmissions are matched up against these until the
+    # jobs make it into SimpleDB's fingerprint index.
+    FINGERPRINTS = {}
+    # The open log file.
+    FILE = None
+    # How many records are in the log file. See _compact().
+    NUM_RECORDS = 0
+    # Bumped with each job appended. Jobs are durable once SYNCED_SEQ has
+    # caught up with them.
+    WRITTEN_SEQ = 0
+    SYNCED_SEQ = 0
+    # Guards everything above but SYNCED_SEQ.
+    LOCK = threading.Lock()
+    # Held while syncing or replacing the log file. Taken before LOCK.
+    SYNC_LOCK = threading.Lock()
+    # Once there are this many records in the log, it's re-written with just
+    # the pending jobs.
+    COMPACT_RECORDS = 10000
+
+    @classmethod
+    def get_log_file(cls):
+        """
+        :rtype: str
+        :returns: The path to the log file.
+        """
+        return settings.FEEDERD_SUBMISSION_LOG_FILE or \
+               os.path.join(tempfile.gettempdir(), 'feederd-submissions.log')
+
+    @classmethod
+    def _encode_job(cls, job):
+        """
+        :param EncodingJob job: A job.
+        :rtype: dict
+        :returns: The job's attributes, stringified as SimpleDB_ would.
+        """
+        # Writing the job down isn't a save, so it doesn't get a new version.
+        version = job.job_state_version
+        item_attributes = job._get_item_attributes(job.last_modified_dtime)
+        item_attributes['job_state_version'] = job.job_state_version = version
+
+        attributes = {}
+        for key, value in item_attributes.items():
+            if isinstance(value, datetime.datetime):
+                value = value.strftime('%Y-%m-%d %H:%M:%S.%f')
+            elif not isinstance(value, basestring):
+                value = str(value)
+            attributes[key] = value
+        return attributes
+
+    @classmethod
+    def _get_file(cls):
+        """
+        Lazy-loading of the log file, opened for appending.
+        """
+        if not cls.FILE:
+            cls.FILE = open(cls.get_log_file(), 'a')
+        return cls.FILE
+
+    @classmethod
+    def _write(cls, record):
+        """
+        Appends a record to the log. Call with LOCK held.
+
+        :param dict record: The record to write.
+        """
+        cls._get_file().write(simplejson.dumps(record) + '\n')
+        cls.NUM_RECORDS += 1
+
+    @classmethod
+    def load(cls):
+        """
+        Reads the jobs left pending by the last run back in. Called when
+        :doc:`../feederd` starts.
+        """
+        log_file = cls.get_log_file()
+        if not os.path.exists(log_file):
+            return
+
+        jobs = {}
+        order = []
+        for line in open(log_file):
+            try:
+                record = simplejson.loads(line)
+            except ValueError:
+                # Most likely the tail end of a write cut short by a crash,
+                # which was never acknowledged.
+                logger.error(message_or_obj="SubmissionLog.load(): " \
+                             "Skipping an unreadable line in %s" % log_file)
+                continue
+            if record.has_key('add'):
+                job = JobStateBackend._get_job_object_from_item(record['add'])
+                jobs[job.unique_id] = job
+                order.append(job.unique_id)
+            else:
+                for unique_id in record['done']:
+                    jobs.pop(unique_id, None)
+
+        with cls.SYNC_LOCK:
+            with cls.LOCK:
+                for unique_id in order:
+                    if jobs.has_key(unique_id):
+                        cls.WRITTEN_SEQ += 1
+                        cls.PENDING[unique_id] = {'job': jobs[unique_id],
+                                                  'seq': cls.WRITTEN_SEQ,
+                                                  'needs_check': True}
+                        cls._add_fingerprint(jobs[unique_id])
+                cls._compact()
+        metrics.set_gauge('feederd.submission_log.pending', len(cls.PENDING))
+        logger.info("SubmissionLog.load(): Replaying %d submitted jobs." % (
+                        len(cls.PENDING)))
+
+    @classmethod
+    def append(cls, jobs):
+        """
+        Gives new jobs their unique IDs, and writes them to the log. Once
+        this returns, the jobs are on disk.
+
+        :param list jobs: The new :py:class:`EncodingJob <media_nommer.core.job_state_backend.EncodingJob>`
+            objects.
+        :raises: ``IOError`` or ``OSError`` if the log couldn't be written.
+            The jobs keep their unique IDs, and have to be saved some other
+            way. If some of them did make it into the log, they're checked
+            for in SimpleDB_ before being saved again after a restart.
+        """
+        now_dtime = datetime.datetime.now()
+        with cls.LOCK:
+            for job in jobs:
+                job.unique_id = job._generate_unique_job_id()
+                job.creation_dtime = now_dtime
+                job.last_modified_dtime = now_dtime
+                job.job_state = 'PENDING'
+            fobj = cls._get_file()
+            fobj.write(''.join([simplejson.dumps({'add': cls._encode_job(job)}) + '\n'
+                                for job in jobs]))
+            fobj.flush()
+            cls.NUM_RECORDS += len(jobs)
+            for job in jobs:
+                cls.WRITTEN_SEQ += 1
+                cls.PENDING[job.unique_id] = {'job': job,
+                                              'seq': cls.WRITTEN_SEQ,
+                                              'needs_check': False}
+                cls._add_fingerprint(job)
+            seq = cls.WRITTEN_SEQ
+
+        try:
+            cls._sync(seq)
+        except (IOError, OSError):
+            with cls.LOCK:
+                for job in jobs:
+                    cls._forget(job.unique_id)
+            raise
+        metrics.set_gauge('feederd.submission_log.pending', len(cls.PENDING))
+
+    @classmethod
+    def _add_fingerprint(cls, job):
+        """
+        Indexes a pending job by fingerprint. Call with LOCK held.
+
+        :param EncodingJob job: The job.
+        """
+        if job.fingerprint:
+            cls.FINGERPRINTS[job.fingerprint] = job.unique_id
+
+    @classmethod
+    def _forget(cls, unique_id):
+        """
+        Drops a job from the pending jobs, and the fingerprint index. Call
+        with LOCK held.
+
+        :param str unique_id: The job's unique ID.
+        """
+        entry = cls.PENDING.pop(unique_id, None)
+        if not entry:
+            return
+        fingerprint = entry['job'].fingerprint
+        # A later job with the same fingerprint may have taken its place.
+        if fingerprint and cls.FINGERPRINTS.get(fingerprint) == unique_id:
+            del cls.FINGERPRINTS[fingerprint]
+
+    @classmethod
+    def _sync(cls, seq):
+        """
+        Waits until the job numbered ``seq`` is on disk. Whoever gets to
+        sync first covers everyone who has appended by then, so a burst of
+        submissions gets by with a handful of ``fsync()`` calls.
+
+        :param int seq: The job to wait for.
+        """
+        with cls.SYNC_LOCK:
+            if cls.SYNCED_SEQ >= seq:
+                # Someone else's sync covered it.
+                return
+            with cls.LOCK:
+                target_seq = cls.WRITTEN_SEQ
+                fileno = cls._get_file().fileno()
+            os.fsync(fileno)
+            cls.SYNCED_SEQ = target_seq
+            metrics.incr('feederd.submission_log.syncs')
+
+    @classmethod
+    def get_pending_jobs(cls, limit):
+        """
+        :param int limit: The most jobs to return.
+        :rtype: list
+        :returns: ``(job, needs_check)`` tuples for the oldest pending
+            jobs. ``needs_check`` is ``True`` if the job may already have
+            been saved.
+        """
+        with cls.LOCK:
+            entries = sorted(cls.PENDING.values(),
+                             key=lambda entry: entry['seq'])[:limit]
+        return [(entry['job'], entry['needs_check']) for entry in entries]
+
+    @classmethod
+    def get_jobs(cls):
+        """
+        :rtype: list
+        :returns: All of the jobs in the log that aren't done yet, in no
+            particular order.
+        """
+        with cls.LOCK:
+            return [entry['job'] for entry in cls.PENDING.values()]
+
+    @classmethod
+    def get_job(cls, unique_id):
+        """
+        :param str unique_id: A job's unique ID.
+        :rtype: :py:class:`EncodingJob <media_nommer.core.job_state_backend.EncodingJob>`
+        :returns: The job, if it's in the log and not done yet. Otherwise
+            ``None``.
+        """
+        with cls.LOCK:
+            entry = cls.PENDING.get(unique_id)
+        return entry and entry['job']
+
+    @classmethod
+    def get_job_id_for_fingerprint(cls, fingerprint):
+        """
+        :param str fingerprint: A job fingerprint. See
+            :py:meth:`EncodingJob.get_fingerprint <media_nommer.core.job_state_backend.EncodingJob.get_fingerprint>`.
+        :rtype: str
+        :returns: The unique ID of the last pending job in the log with
+            this fingerprint, or ``None`` if there isn't one.
+        """
+        with cls.LOCK:
+            return cls.FINGERPRINTS.get(fingerprint)
+
+    @classmethod
+    def mark_saved(cls, unique_ids):
+        """
+        Notes that jobs have been saved, so they're not saved again over
+        any changes the nodes make to them.
+
+        :param list unique_ids: The unique IDs of the saved jobs.
+        """
+        with cls.LOCK:
+            for unique_id in unique_ids:
+                if cls.PENDING.has_key(unique_id):
+                    cls.PENDING[unique_id]['needs_check'] = True
+
+    @classmethod
+    def mark_done(cls, unique_ids):
+        """
+        Forgets about jobs that have been saved and queued up. This isn't
+        synced, since losing it only means the jobs get checked on again
+        after a restart.
+
+        :param list unique_ids: The unique IDs of the jobs.
+        """
+        if not unique_ids:
+            return
+        with cls.SYNC_LOCK:
+            with cls.LOCK:
+                for unique_id in unique_ids:
+                    cls._forget(unique_id)
+                cls._write({'done': list(unique_ids)})
+                cls._get_file().flush()
+                if not cls.PENDING or cls.NUM_RECORDS >= cls.COMPACT_RECORDS:
+                    cls._compact()
+                metrics.set_gauge('feederd.submission_log.pending',
+                                  len(cls.PENDING))
+
+    @classmethod
+    def _compact(cls):
+        """
+        Re-writes the log with just the pending jobs. The new log is synced
+        before it replaces the old one. Call with SYNC_LOCK and LOCK held.
+        """
+        log_file = cls.get_log_file()
+        temp_file = log_file + '.tmp'
+        entries = sorted(cls.PENDING.values(), key=lambda entry: entry['seq'])
+
+        fobj = open(temp_file, 'w')
+        try:
+            for entry in entries:
+                fobj.write(simplejson.dumps(
+                                {'add': cls._encode_job(entry['job'])}) + '\n')
+            fobj.flush()
+            os.fsync(fobj.fileno())
+        finally:
+            fobj.close()
+        os.rename(temp_file, log_file)
+
+        if cls.FILE:
+            cls.FILE.close()
+        cls.FILE = open(log_file, 'a')
+        cls.NUM_RECORDS = len(entries)
+        cls.SYNCED_SEQ = cls.WRITTEN_SEQ
@@ -0,0 +1,1276 @@
+"""
+Tests for feederd's job caching and scheduling logic.
+"""
+import os
+import StringIO
+import time
+import shutil
+import tempfile
+import unittest
+import datetime
+import threading
+import simplejson
+import boto
+from twisted.internet import defer
+from twisted.web.server import NOT_DONE_YET
+from media_nommer.conf import settings
+from media_nommer.core.job_state_backend import EncodingJob, JobStateBackend
+from media_nommer.core.exceptions import JobStateConflictException
+from media_nommer.feederd import interval_tasks, job_submitter
+from media_nommer.feederd.job_cache import JobCache
+from media_nommer.feederd.ec2_instance_manager import EC2InstanceManager
+from media_nommer.feederd.fleet_controller import FleetController
+from media_nommer.feederd.fleet_table import FleetTable
+from media_nommer.feederd.job_router import JobRouter
+from media_nommer.feederd.job_notifier import JobNotifier
+from media_nommer.feederd.job_events import JobEventBroker, JobEventSubscriber
+from media_nommer.feederd.job_submitter import JobSubmitter, COPY_NOMMER, \
+                                            MULTI_OUTPUT_NOMMER
+from media_nommer.feederd.admission_controller import AdmissionController
+from media_nommer.feederd.submission_log import SubmissionLog
+from media_nommer.feederd.exceptions import InvalidJobException, \
+                                           JobRejectedException
+from media_nommer.core.storage_backends.exceptions import InfileNotFoundException
+from media_nommer.feederd.web import views as web_views
+from media_nommer.ec2nommerd.source_cache import SourceCache
+from media_nommer.utils import views
+from media_nommer.utils.views import BaseView, JSONProducer
+from media_nommer.utils.bloom_filter import BloomFilter
+
+BASE_NOMMER = 'media_nommer.ec2nommerd.nommers.base_nommer.BaseNommer'
+
+def make_job(job_state='PENDING', job_state_version=1, unique_id='somejob'):
+    """
+    Creates an un-saved job for the cache to chew on.
+    """
+    return EncodingJob('s3://bucket/in.mp4', 's3://bucket/out.mp4',
+                       BASE_NOMMER, [], unique_id=unique_id,
+                       job_state=job_state,
+                       job_state_version=job_state_version)
+
+class JobCacheStateChangeTests(unittest.TestCase):
+    """
+    Tests for JobCache.apply_job_state_change().
+    """
+    def setUp(self):
+        JobCache.CACHE = {}
+        JobCache.update_job(make_job('DOWNLOADING', job_state_version=2))
+
+    def test_newer_change_applied(self):
+        """
+        A change with a higher version replaces the cached job.
+        """
+        applied = JobCache.apply_job_state_change(make_job('ENCODING', 3))
+        self.assertEqual(applied, True)
+        self.assertEqual(JobCache.get_job('somejob').job_state, 'ENCODING')
+
+    def test_stale_and_duplicate_changes_discarded(self):
+        """
+        Older or duplicate versions never overwrite the cached job.
+        """
+        self.assertEqual(JobCache.apply_job_state_change(make_job('PENDING', 1)),
+                         False)
+        self.assertEqual(JobCache.apply_job_state_change(make_job('ENCODING', 2)),
+                         False)
+        self.assertEqual(JobCache.get_job('somejob').job_state, 'DOWNLOADING')
+
+    def test_finished_never_regresses(self):
+        """
+        Once a job is finished, an un-finished state can't replace it.
+        """
+        JobCache.apply_job_state_change(make_job('FINISHED', 5))
+        JobCache.apply_job_state_change(make_job('ENCODING', 6))
+        self.assertEqual(JobCache.get_job('somejob').job_state, 'FINISHED')
+
+    def test_uncached_job_ignored(self):
+        """
+        Changes for jobs we aren't tracking are ignored.
+        """
+        job = make_job('ENCODING', 3, unique_id='otherjob')
+        self.assertEqual(JobCache.apply_job_state_change(job), False)
+        self.assertEqual(JobCache.is_job_cached('otherjob'), False)
+
+class FakeJobDomain(object):
+    """
+    Stands in for the SimpleDB job state domain, conditional puts included.
+    """
+    def __init__(self):
+        # Keys are unique IDs, values are dicts of string attributes.
+        self.items = {}
+
+    def put_job(self, job):
+        """
+        Stores a job as someone else would have saved it.
+        """
+        self.items[job.unique_id] = self.encode(job._get_item_attributes(
+                                                    job.last_modified_dtime))
+
+    def encode(self, attributes):
+        encoded = {}
+        for key, value in attributes.items():
+            if isinstance(value, datetime.datetime):
+                value = value.strftime('%Y-%m-%d %H:%M:%S.%f')
+            encoded[key] = str(value)
+        return encoded
+
+    def put_attributes(self, item_name, attributes, expected_value=None):
+        name, value = expected_value
+        if self.items[item_name].get(name, False) != value:
+            error = boto.exception.SDBResponseError(409, 'Conflict')
+            error.error_code = 'ConditionalCheckFailed'
+            raise error
+        self.items[item_name] = self.encode(attributes)
+
+    def get_item(self, item_name, consistent_read=False):
+        return dict(self.items[item_name])
+
+class JobSaveTests(unittest.TestCase):
+    """
+    Tests for saving jobs over someone else's changes.
+    """
+    def setUp(self):
+        self.domain = FakeJobDomain()
+        self.orig_get_domain = \
+                JobStateBackend.__dict__['_get_sdb_job_state_domain']
+        JobStateBackend._get_sdb_job_state_domain = \
+                staticmethod(lambda: self.domain)
+        self.orig_thresh = settings.FEEDERD_ABANDON_INACTIVE_JOBS_THRESH
+        JobCache.CACHE = {}
+
+    def tearDown(self):
+        JobStateBackend._get_sdb_job_state_domain = self.orig_get_domain
+        settings.FEEDERD_ABANDON_INACTIVE_JOBS_THRESH = self.orig_thresh
+        JobCache.CACHE = {}
+
+    def get_stored_job(self):
+        return JobStateBackend.get_job_object_from_id('somejob')
+
+    def test_saved_on_top(self):
+        """
+        If someone else saved the job first, our save gets the next version
+        rather than sharing theirs.
+        """
+        self.domain.put_job(make_job('ENCODING', 2))
+        job = make_job('DOWNLOADING', 1)
+        job.job_state = 'ERROR'
+        job.save()
+        self.assertEqual(job.job_state_version, 4)
+        stored_job = self.get_stored_job()
+        self.assertEqual((stored_job.job_state, stored_job.job_state_version),
+                         ('ERROR', 4))
+
+    def test_finished_jobs_left_alone(self):
+        """
+        A job someone else has finished isn't saved over.
+        """
+        self.domain.put_job(make_job('FINISHED', 2))
+        job = make_job('ENCODING', 1)
+        self.assertRaises(JobStateConflictException, job.save)
+        self.assertEqual(job.job_state_version, 1)
+        self.assertEqual(self.get_stored_job().job_state, 'FINISHED')
+
+    def test_abandon_loses_to_finish(self):
+        """
+        A job that finishes while being abandoned stays finished, and its
+        finished copy is cached to be seen off as usual.
+        """
+        settings.FEEDERD_ABANDON_INACTIVE_JOBS_THRESH = 0
+        self.domain.put_job(make_job('FINISHED', 2))
+        JobCache.update_job(make_job('ENCODING', 1))
+        JobCache.abandon_stale_jobs()
+        self.assertEqual(self.get_stored_job().job_state, 'FINISHED')
+        self.assertEqual(JobCache.get_job('somejob').job_state, 'FINISHED')
+
+    def test_dependent_jobs_not_abandoned(self):
+        """
+        A copy job waiting on its original isn't abandoned while the
+        original is still going.
+        """
+        settings.FEEDERD_ABANDON_INACTIVE_JOBS_THRESH = 0
+        job = make_job('PENDING', 1)
+        job.depends_on = 'originaljob'
+        JobCache.update_job(job)
+        JobCache.abandon_stale_jobs()
+        self.assertEqual(JobCache.get_job('somejob').job_state, 'PENDING')
+
+class FakeStorage(object):
+    """
+    Stands in for a storage backend, describing one file (or none).
+    """
+    def __init__(self, file_info=None):
+        self.file_info = file_info
+
+    def get_file_info(self, uri):
+        if self.file_info is None:
+            raise InfileNotFoundException("Can't find %s" % uri)
+        return self.file_info
+
+class DedupeOutputTests(unittest.TestCase):
+    """
+    Tests for checking a finished job's output before re-using it.
+    """
+    def setUp(self):
+        self.original_job = make_job('FINISHED', 3, unique_id='originaljob')
+        self.original_job.dest_size = 100
+        self.original_job.dest_etag = 'abc'
+        self.storage = FakeStorage({'size': 100, 'etag': 'abc'})
+        self.orig_get_id = \
+                JobStateBackend.__dict__['get_job_id_for_fingerprint']
+        JobStateBackend.get_job_id_for_fingerprint = \
+                staticmethod(lambda fingerprint: 'originaljob')
+        self.orig_get_backend = job_submitter.get_backend_for_uri
+        job_submitter.get_backend_for_uri = lambda uri: self.storage
+        JobCache.CACHE = {}
+        JobCache.update_job(self.original_job)
+
+    def tearDown(self):
+        JobStateBackend.get_job_id_for_fingerprint = self.orig_get_id
+        job_submitter.get_backend_for_uri = self.orig_get_backend
+        JobCache.CACHE = {}
+
+    def get_original_job(self):
+        job = make_job(unique_id=None)
+        job.fingerprint = 'somefingerprint'
+        return JobSubmitter._get_original_job(job)
+
+    def test_intact_output(self):
+        """
+        An output that's still as it was uploaded is re-used.
+        """
+        self.assertTrue(self.get_original_job() is self.original_job)
+
+    def test_missing_output(self):
+        """
+        An output that has been deleted is encoded again.
+        """
+        self.storage.file_info = None
+        self.assertEqual(self.get_original_job(), None)
+
+    def test_overwritten_output(self):
+        """
+        An output that has been overwritten is encoded again.
+        """
+        self.storage.file_info = {'size': 100, 'etag': 'def'}
+        self.assertEqual(self.get_original_job(), None)
+        self.storage.file_info = {'size': 50, 'etag': 'abc'}
+        self.assertEqual(self.get_original_job(), None)
+
+class FakeCallLaterReactor(object):
+    """
+    Stands in for the reactor, noting what gets scheduled.
+    """
+    def __init__(self):
+        self.delays = []
+
+    def callLater(self, delay, func, *args, **kwargs):
+        self.delays.append(delay)
+
+class StateChangeDrainTests(unittest.TestCase):
+    """
+    Tests for draining the state change queue, and backing off when it
+    has nothing new.
+    """
+    def setUp(self):
+        JobCache.CACHE = {}
+        JobCache.update_job(make_job('DOWNLOADING', job_state_version=2))
+        # Each receive pops the next list of jobs.
+        self.receives = []
+        def pop_state_change_messages_from_queue(num_to_pop):
+            if not self.receives:
+                return []
+            return [(None, job) for job in self.receives.pop(0)]
+        self.orig_pop_messages = \
+                JobStateBackend.__dict__['pop_state_change_messages_from_queue']
+        self.orig_get_queue_depth = \
+                JobStateBackend.__dict__['get_state_change_queue_depth']
+        JobStateBackend.pop_state_change_messages_from_queue = \
+                staticmethod(pop_state_change_messages_from_queue)
+        JobStateBackend.get_state_change_queue_depth = staticmethod(lambda: 0)
+        self.orig_reactor = interval_tasks.reactor
+        self.orig_delay = interval_tasks.STATE_CHANGE_CHECK_DELAY
+        interval_tasks.reactor = FakeCallLaterReactor()
+        interval_tasks.STATE_CHANGE_CHECK_DELAY = \
+                settings.FEEDERD_JOB_STATE_CHANGE_MIN_CHECK_INTERVAL
+
+    def tearDown(self):
+        JobStateBackend.pop_state_change_messages_from_queue = \
+                self.orig_pop_messages
+        JobStateBackend.get_state_change_queue_depth = self.orig_get_queue_depth
+        interval_tasks.reactor = self.orig_reactor
+        interval_tasks.STATE_CHANGE_CHECK_DELAY = self.orig_delay
+        JobCache.CACHE = {}
+
+    def check(self):
+        """
+        Runs a state change check, and schedules the next one.
+        """
+        interval_tasks._schedule_next_state_change_check(
+                interval_tasks.threaded_check_for_job_state_changes())
+        return interval_tasks.reactor.delays[-1]
+
+    def test_stale_changes_back_off(self):
+        """
+        Stale and duplicate copies, and jobs we aren't tracking, aren't
+        changes, so the checks keep backing off.
+        """
+        self.receives = [[make_job('PENDING', 1), make_job('DOWNLOADING', 2),
+                          make_job('ENCODING', 3, unique_id='otherjob')]]
+        self.assertEqual(JobCache.refresh_jobs_with_state_changes(), [])
+
+        self.receives = [[make_job('PENDING', 1), make_job('DOWNLOADING', 2)]]
+        min_delay = settings.FEEDERD_JOB_STATE_CHANGE_MIN_CHECK_INTERVAL
+        self.assertEqual(self.check(), min(min_delay * 2,
+                            settings.FEEDERD_JOB_STATE_CHANGE_CHECK_INTERVAL))
+
+    def test_newest_change_returned(self):
+        """
+        The newest applied copy of each job is returned, and the checks
+        speed back up.
+        """
+        interval_tasks.STATE_CHANGE_CHECK_DELAY = \
+                settings.FEEDERD_JOB_STATE_CHANGE_CHECK_INTERVAL
+        self.receives = [[make_job('ENCODING', 3), make_job('DOWNLOADING', 2),
+                          make_job('UPLOADING', 4)]]
+        changed_jobs = JobCache.refresh_jobs_with_state_changes()
+        self.assertEqual([(job.job_state, job.job_state_version)
+                          for job in changed_jobs], [('UPLOADING', 4)])
+
+        self.receives = [[make_job('FINISHED', 5)]]
+        self.assertEqual(self.check(),
+                         settings.FEEDERD_JOB_STATE_CHANGE_MIN_CHECK_INTERVAL)
+
+    def test_failed_change_skipped(self):
+        """
+        A change that blows up while being applied doesn't lose the rest of
+        its batch.
+        """
+        JobCache.update_job(make_job('DOWNLOADING', 2, unique_id='otherjob'))
+        orig_apply = JobCache.__dict__['apply_job_state_change']
+        def apply_job_state_change(job):
+            if job.unique_id == 'somejob':
+                raise RuntimeError('Boom.')
+            return orig_apply.__get__(None, JobCache)(job)
+        JobCache.apply_job_state_change = staticmethod(apply_job_state_change)
+        try:
+            self.receives = [[make_job('ENCODING', 3),
+                              make_job('ENCODING', 3, unique_id='otherjob')]]
+            self.assertEqual(JobCache._receive_state_change_batches(1),
+                             [(2, [JobCache.get_job('otherjob')])])
+        finally:
+            JobCache.apply_job_state_change = orig_apply
+        self.assertEqual(JobCache.get_job('otherjob').job_state, 'ENCODING')
+
+class SplitJobTests(unittest.TestCase):
+    """
+    Tests for JobCache's tracking of split jobs and their segments.
+    """
+    def make_segment(self, segment_index, job_state='PENDING', details=None,
+                     unique_id=None):
+        return EncodingJob('s3://bucket/seg.mkv', 's3://bucket/seg.mp4',
+                           BASE_NOMMER, [],
+                           unique_id=unique_id or 'seg%d' % segment_index,
+                           job_state=job_state, job_state_details=details,
+                           job_state_version=1, parent_id='somejob',
+                           segment_index=segment_index)
+
+    def test_children_of_cached_jobs_are_tracked(self):
+        """
+        Segment jobs are picked up once their parent is cached.
+        """
+        JobCache.CACHE = {}
+        segment = self.make_segment(0, 'DOWNLOADING')
+        self.assertEqual(JobCache.apply_job_state_change(segment), False)
+        JobCache.update_job(make_job('WAITING'))
+        self.assertEqual(JobCache.apply_job_state_change(segment), True)
+        self.assertEqual(JobCache.is_job_cached('seg0'), True)
+
+    def test_summary_averages_progress(self):
+        """
+        Finished segments count in full, encoding ones by their progress.
+        """
+        summary = JobCache.summarize_child_jobs([
+            self.make_segment(0, 'FINISHED'),
+            self.make_segment(1, 'ENCODING', details='{"percent": 50.0}'),
+            self.make_segment(2),
+        ])
+        self.assertEqual(summary['num_finished'], 1)
+        self.assertEqual(summary['done'], 1.5)
+        self.assertEqual(summary['failed'], None)
+        self.assertEqual(summary['join_job'], None)
+
+    def test_retried_segment_failure_ignored(self):
+        """
+        A failed segment doesn't fail the parent if another job encoded it.
+        """
+        summary = JobCache.summarize_child_jobs([
+            self.make_segment(0, 'ERROR', unique_id='first'),
+            self.make_segment(0, 'FINISHED', unique_id='second'),
+            self.make_segment(1, 'ABANDONED'),
+        ])
+        self.assertEqual(summary['num_finished'], 1)
+        self.assertEqual(summary['failed'].segment_index, 1)
+
+class AutoscaleTests(unittest.TestCase):
+    """
+    Tests for EC2InstanceManager.get_num_instances_needed().
+    """
+    def setUp(self):
+        self.orig_settings = {}
+        new_settings = {
+            'MAX_ENCODING_JOBS_PER_EC2_INSTANCE': 2,
+            'AUTOSCALE_TARGET_DRAIN_TIME': 3600,
+            'AUTOSCALE_INSTANCE_BOOT_TIME': 600,
+            'AUTOSCALE_MIN_WORK_PER_NEW_INSTANCE': 900,
+        }
+        for name, value in new_settings.items():
+            self.orig_settings[name] = getattr(settings, name)
+            setattr(settings, name, value)
+
+    def tearDown(self):
+        for name, value in self.orig_settings.items():
+            setattr(settings, name, value)
+
+    def test_short_clips_need_one_instance(self):
+        """
+        Fifty 10-second clips don't warrant more than one instance.
+        """
+        self.assertEqual(EC2InstanceManager.get_num_instances_needed(50 * 10, 0), 1)
+        self.assertEqual(EC2InstanceManager.get_num_instances_needed(50 * 10, 2), 0)
+
+    def test_long_masters_scale_up(self):
+        """
+        Fifty two-hour masters need lots of instances. Each new instance can
+        do (3600 - 600) * 2 = 6000 encoder-seconds in the target time.
+        """
+        backlog = 50 * 7200
+        self.assertEqual(EC2InstanceManager.get_num_instances_needed(backlog, 0), 60)
+
+    def test_small_leftover_not_worth_an_instance(self):
+        """
+        Left-over work below the minimum doesn't get an instance of its own.
+        """
+        # Two running slots do 7200, leaving 6000 + 500 of shortfall.
+        self.assertEqual(EC2InstanceManager.get_num_instances_needed(13700, 2), 1)
+        # 6000 + 1000 of shortfall is enough for a second one.
+        self.assertEqual(EC2InstanceManager.get_num_instances_needed(14200, 2), 2)
+
+class FleetForecastTests(unittest.TestCase):
+    """
+    Tests for FleetController's demand forecasting.
+    """
+    def setUp(self):
+        self.orig_days = settings.FEEDERD_FORECAST_HISTORY_DAYS
+        settings.FEEDERD_FORECAST_HISTORY_DAYS = 2
+        FleetController.SUBMISSION_HISTORY = {}
+
+    def tearDown(self):
+        settings.FEEDERD_FORECAST_HISTORY_DAYS = self.orig_days
+
+    def test_forecast_averages_same_hour(self):
+        """
+        The forecast for an hour is the average of that hour on past days.
+        Today's submissions and other hours don't count.
+        """
+        now = datetime.datetime.now().replace(hour=14)
+        yesterday = now - datetime.timedelta(days=1)
+        two_days_ago = now - datetime.timedelta(days=2)
+        FleetController._add_to_history(yesterday, 1000.0)
+        FleetController._add_to_history(two_days_ago, 3000.0)
+        FleetController._add_to_history(two_days_ago.replace(hour=3), 9999.0)
+        FleetController._add_to_history(now, 9999.0)
+
+        self.assertEqual(FleetController.forecast_encoder_seconds(now), 2000.0)
+
+class FleetTableTests(unittest.TestCase):
+    """
+    Tests for FleetTable's view of node capacity.
+    """
+    def setUp(self):
+        now = datetime.datetime.now()
+        stale = now - datetime.timedelta(
+                            seconds=settings.FEEDERD_NODE_STALE_THRESH + 1)
+        FleetTable.NODES = {}
+        for instance_id, state, active_jobs, seen_dtime in [
+                ('i-busy', 'ACTIVE', 2, now),
+                ('i-idle', 'ACTIVE', 0, now),
+                ('i-hung', 'ACTIVE', 0, stale),
+                ('i-gone', 'TERMINATED', 0, now)]:
+            FleetTable.NODES[instance_id] = {
+                'id': instance_id,
+                'state': state,
+                'active_jobs': active_jobs,
+                'max_jobs': 2,
+                'last_report_dtime': str(seen_dtime),
+                'seen_dtime': seen_dtime,
+            }
+
+    def tearDown(self):
+        FleetTable.NODES = {}
+
+    def test_stale_nodes_are_dead(self):
+        """
+        Nodes that stopped reporting are dead, terminated ones are neither
+        dead nor alive.
+        """
+        self.assertEqual([node['id'] for node in FleetTable.get_dead_nodes()],
+                         ['i-hung'])
+        self.assertEqual(sorted([node['id'] for node in FleetTable.get_alive_nodes()]),
+                         ['i-busy', 'i-idle'])
+
+    def test_free_slots_only_on_live_nodes(self):
+        """
+        The hung node's slots don't count.
+        """
+        self.assertEqual(FleetTable.get_num_free_slots(), 2)
+
+class JobRouterTests(unittest.TestCase):
+    """
+    Tests for routing jobs to nodes that have their source cached.
+    """
+    def setUp(self):
+        now = datetime.datetime.now()
+        job = make_job()
+        job.source_etag = 'abc'
+        self.job = job
+        FleetTable.NODES = {}
+        for instance_id, active_jobs, has_source in [
+                ('i-nocache', 0, False),
+                ('i-full', 2, True),
+                ('i-cached', 1, True)]:
+            source_cache = BloomFilter(1024, 4)
+            if has_source:
+                source_cache.add(SourceCache.get_key(job.source_path,
+                                                     etag='abc'))
+            FleetTable.NODES[instance_id] = {
+                'id': instance_id,
+                'state': 'ACTIVE',
+                'active_jobs': active_jobs,
+                'max_jobs': 2,
+                'source_cache': source_cache,
+                'last_report_dtime': str(now),
+                'seen_dtime': now,
+            }
+        JobRouter.ROUTED = {}
+
+    def tearDown(self):
+        FleetTable.NODES = {}
+        JobRouter.ROUTED = {}
+
+    def test_picks_node_with_source_and_room(self):
+        """
+        The full node has the source too, but no room for it.
+        """
+        self.assertEqual(JobRouter.pick_node(self.job), 'i-cached')
+
+    def test_routed_jobs_use_up_slots(self):
+        """
+        Jobs already routed to a node count against its free slots.
+        """
+        JobRouter.ROUTED['otherjob'] = ('i-cached', 0)
+        self.assertEqual(JobRouter.pick_node(self.job), None)
+
+class BloomFilterTests(unittest.TestCase):
+    """
+    Tests for the Bloom filters nodes report their cached sources in.
+    """
+    def test_membership_survives_serialization(self):
+        """
+        Added keys are found after a round trip through a string, and an
+        un-added key isn't (at this size, a false positive is unlikely).
+        """
+        bloom = BloomFilter(4096, 4)
+        for i in range(50):
+            bloom.add('key%d' % i)
+        bloom = BloomFilter.from_string(bloom.to_string())
+        for i in range(50):
+            self.assertEqual('key%d' % i in bloom, True)
+        self.assertEqual('some other key' in bloom, False)
+
+class FingerprintTests(unittest.TestCase):
+    """
+    Tests for the fingerprints jobs are de-duplicated by.
+    """
+    def make_fingerprinted_job(self, dest_path, job_options):
+        job = EncodingJob('s3://bucket/in.mp4', dest_path, BASE_NOMMER,
+                          job_options, source_etag='abc', source_size=100)
+        return job.get_fingerprint()
+
+    def test_destination_and_key_order_ignored(self):
+        """
+        The same output, going somewhere else, with the options in a
+        different order.
+        """
+        fingerprint = self.make_fingerprinted_job('s3://bucket/out.mp4',
+                                                  {'a': 1, 'b': [2, 3]})
+        self.assertEqual(fingerprint,
+                         self.make_fingerprinted_job('s3://other/out.mp4',
+                                                     {'b': [2, 3], 'a': 1}))
+        self.assertNotEqual(fingerprint,
+                            self.make_fingerprinted_job('s3://bucket/out.mp4',
+                                                        {'a': 2, 'b': [2, 3]}))
+
+    def test_no_etag(self):
+        """
+        Without an ETag, we can't tell whether the source has changed.
+        """
+        self.assertEqual(make_job().get_fingerprint(), None)
+
+class JobSubmitBatchTests(unittest.TestCase):
+    """
+    Tests for submitting batches of jobs.
+    """
+    def setUp(self):
+        self.saved = []
+        self.tracked = []
+        def save_new_jobs(jobs):
+            for job in jobs:
+                self.saved.append(job)
+                job.unique_id = 'job%d' % len(self.saved)
+            return []
+        def track_new_jobs(jobs):
+            self.tracked += jobs
+        self.orig_save_new_jobs = JobStateBackend.__dict__['save_new_jobs']
+        self.orig_build_batch = JobSubmitter.__dict__['build_batch']
+        self.orig_track_new_jobs = JobSubmitter.__dict__['_track_new_jobs']
+        JobStateBackend.save_new_jobs = staticmethod(save_new_jobs)
+        JobSubmitter._track_new_jobs = staticmethod(track_new_jobs)
+        self.orig_submission_log = settings.FEEDERD_SUBMISSION_LOG
+        settings.FEEDERD_SUBMISSION_LOG = False
+
+    def tearDown(self):
+        settings.FEEDERD_SUBMISSION_LOG = self.orig_submission_log
+        JobStateBackend.save_new_jobs = self.orig_save_new_jobs
+        JobSubmitter.build_batch = self.orig_build_batch
+        JobSubmitter._track_new_jobs = self.orig_track_new_jobs
+
+    def make_job(self, dest_path):
+        job = EncodingJob('s3://bucket/in.mp4', dest_path, BASE_NOMMER, [],
+                          source_etag='abc', source_size=100)
+        job.fingerprint = job.get_fingerprint()
+        return job
+
+    def test_errors_and_duplicates(self):
+        """
+        Bad jobs get errors, and duplicates within the batch are coalesced
+        or copied rather than encoded twice.
+        """
+        built = ['No such preset.',
+                 (self.make_job('s3://bucket/out.mp4'), None),
+                 (self.make_job('s3://bucket/out.mp4'), None),
+                 (self.make_job('s3://other/out.mp4'), None)]
+        JobSubmitter.build_batch = staticmethod(lambda submissions: built)
+
+        results = JobSubmitter.submit_batch([{}] * 4)
+        self.assertEqual(results, [{'error': 'No such preset.'},
+                                   {'job_id': 'job1'},
+                                   {'job_id': 'job1'},
+                                   {'job_id': 'job2'}])
+
+        copy_job = self.saved[1]
+        self.assertEqual(copy_job.nommer.__class__.__name__,
+                         COPY_NOMMER.split('.')[-1])
+        self.assertEqual(copy_job.source_path, 's3://bucket/out.mp4')
+        self.assertEqual(copy_job.dest_path, 's3://other/out.mp4')
+        self.assertEqual(copy_job.depends_on, 'job1')
+        self.assertEqual(self.tracked, self.saved)
+
+class MultiOutputTests(unittest.TestCase):
+    """
+    Tests for checking over multi-output submissions.
+    """
+    def setUp(self):
+        self.orig_presets = settings.PRESETS
+        one_pass = {'infile_options': [('ss', '5')],
+                    'outfile_options': [('s', '640x360')]}
+        settings.PRESETS = {
+            'hd': {'nommer': MULTI_OUTPUT_NOMMER, 'options': [one_pass]},
+            'sd': {'nommer': MULTI_OUTPUT_NOMMER, 'options': [one_pass]},
+            'two_pass': {'nommer': MULTI_OUTPUT_NOMMER,
+                         'options': [one_pass, one_pass]},
+            'no_seek': {'nommer': MULTI_OUTPUT_NOMMER,
+                        'options': [{'outfile_options': [('s', '640x360')]}]},
+            'base': {'nommer': BASE_NOMMER},
+        }
+
+    def tearDown(self):
+        settings.PRESETS = self.orig_presets
+
+    def test_valid_outputs(self):
+        """
+        Only the preset names and destinations are kept.
+        """
+        self.assertEqual(JobSubmitter._get_multi_output_options(
+                                [['hd', 's3://bucket/hd.mp4'],
+                                 ['sd', 's3://bucket/sd.mp4']]),
+                         {'outputs': [
+                             {'preset': 'hd', 'dest_path': 's3://bucket/hd.mp4'},
+                             {'preset': 'sd', 'dest_path': 's3://bucket/sd.mp4'},
+                         ]})
+
+    def test_invalid_outputs(self):
+        """
+        Multi-pass presets, other nommers, and outputs that would read the
+        source differently are turned away.
+        """
+        for outputs in [[['hd', 's3://bucket/hd.mp4'],
+                         ['two_pass', 's3://bucket/two_pass.mp4']],
+                        [['hd', 's3://bucket/hd.mp4'],
+                         ['no_seek', 's3://bucket/no_seek.mp4']],
+                        [['base', 's3://bucket/base.mp4']],
+                        [['hd', 's3://bucket/hd.mp4', 'extra']],
+                        []]:
+            self.assertRaises(InvalidJobException,
+                              JobSubmitter._get_multi_output_options, outputs)
+
+class FinishedJobCacheTests(unittest.TestCase):
+    """
+    Tests for the recently finished jobs kept for the status API.
+    """
+    def setUp(self):
+        self.orig_size = settings.FEEDERD_FINISHED_JOB_CACHE_SIZE
+        settings.FEEDERD_FINISHED_JOB_CACHE_SIZE = 2
+        JobCache.CACHE = {}
+        JobCache.FINISHED = {}
+        JobCache.FINISHED_ORDER.clear()
+
+    def tearDown(self):
+        settings.FEEDERD_FINISHED_JOB_CACHE_SIZE = self.orig_size
+        JobCache.CACHE = {}
+        JobCache.FINISHED = {}
+        JobCache.FINISHED_ORDER.clear()
+
+    def test_uncached_jobs_are_remembered(self):
+        """
+        Finished jobs leave the cache, but can still be looked up, up to
+        a point.
+        """
+        for unique_id in ['job1', 'job2', 'job3']:
+            JobCache.update_job(make_job(job_state='FINISHED',
+                                         unique_id=unique_id))
+            JobCache.uncache_finished_jobs()
+
+        self.assertEqual(JobCache.get_cached_jobs(), {})
+        self.assertEqual(JobCache.get_known_job('job1'), None)
+        self.assertEqual(JobCache.get_known_job('job3').unique_id, 'job3')
+        self.assertEqual(list(JobCache.FINISHED_ORDER), ['job2', 'job3'])
+
+class JobNotifierTests(unittest.TestCase):
+    """
+    Tests for retrying and persisting job completion notifications.
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.orig_retry_file = settings.FEEDERD_NOTIFY_RETRY_FILE
+        settings.FEEDERD_NOTIFY_RETRY_FILE = os.path.join(self.temp_dir,
+                                                          'retry.json')
+        JobNotifier.PENDING = {
+            'somejob': {
+                'url': 'http://example.com/done/',
+                'job_state': 'FINISHED',
+                'attempts': 1,
+                'next_attempt': 0,
+                'finished_time': time.time(),
+            },
+        }
+        JobNotifier.DIRTY = False
+
+    def tearDown(self):
+        settings.FEEDERD_NOTIFY_RETRY_FILE = self.orig_retry_file
+        JobNotifier.PENDING = {}
+        JobNotifier.DIRTY = False
+        shutil.rmtree(self.temp_dir)
+
+    def get_saved(self):
+        return simplejson.load(open(settings.FEEDERD_NOTIFY_RETRY_FILE))
+
+    def test_backoff_and_give_up(self):
+        """
+        Each failure doubles the wait, until we run out of attempts.
+        """
+        notification = JobNotifier.PENDING['somejob']
+        JobNotifier._failed('somejob', notification, 500)
+        first_delay = notification['next_attempt'] - time.time()
+        self.assertTrue(abs(first_delay - settings.FEEDERD_NOTIFY_RETRY_DELAY) < 1)
+        # Nothing is written until the next check.
+        self.assertFalse(os.path.exists(settings.FEEDERD_NOTIFY_RETRY_FILE))
+        JobNotifier._check()
+        self.assertEqual(self.get_saved().keys(), ['somejob'])
+
+        notification['attempts'] += 1
+        JobNotifier._failed('somejob', notification, 500)
+        second_delay = notification['next_attempt'] - time.time()
+        self.assertTrue(abs(second_delay - first_delay * 2) < 1)
+
+        notification['attempts'] = settings.FEEDERD_NOTIFY_MAX_ATTEMPTS
+        JobNotifier._failed('somejob', notification, 500)
+        self.assertEqual(JobNotifier.PENDING, {})
+        JobNotifier._check()
+        self.assertEqual(self.get_saved(), {})
+
+    def test_delivered(self):
+        """
+        Delivered notifications are forgotten, on disk too.
+        """
+        JobNotifier._save()
+        JobNotifier._delivered('somejob', JobNotifier.PENDING['somejob'])
+        self.assertEqual(self.get_saved().keys(), ['somejob'])
+        JobNotifier._check()
+        self.assertEqual(self.get_saved(), {})
+        self.assertFalse(JobNotifier.DIRTY)
+
+class FakeStreamRequest(object):
+    """
+    Stands in for a streaming Twisted request.
+    """
+    def __init__(self, headers=None, body='', args=None):
+        self.headers = headers or {}
+        self.content = StringIO.StringIO(body)
+        self.args = args or {}
+        self.written = []
+        self.is_finished = False
+        self.response_code = None
+        # Fires when the request is done, or errbacks if the client goes
+        # away first.
+        self.finished = defer.Deferred()
+
+    def getHeader(self, name):
+        return self.headers.get(name)
+
+    def setResponseCode(self, code):
+        self.response_code = code
+
+    def notifyFinish(self):
+        return self.finished
+
+    def write(self, data):
+        self.written.append(data)
+
+    def unregisterProducer(self):
+        pass
+
+    def finish(self):
+        self.is_finished = True
+
+class JobEventTests(unittest.TestCase):
+    """
+    Tests for filtering and buffering job state change events.
+    """
+    def setUp(self):
+        self.request = FakeStreamRequest()
+        JobEventBroker.SUBSCRIBERS = set()
+
+    def tearDown(self):
+        JobEventBroker.SUBSCRIBERS = set()
+
+    def test_filters(self):
+        """
+        Subscribers only hear about the jobs and states they asked for.
+        """
+        subscriber = JobEventSubscriber(self.request, job_ids=set(['somejob']),
+                                        job_states=set(['FINISHED']))
+        JobEventBroker.SUBSCRIBERS.add(subscriber)
+        JobEventBroker._publish(make_job('ENCODING', 2))
+        JobEventBroker._publish(make_job('FINISHED', 3, unique_id='otherjob'))
+        self.assertEqual(self.request.written, [])
+
+        JobEventBroker._publish(make_job('FINISHED', 3))
+        self.assertEqual(len(self.request.written), 1)
+        self.assertTrue(self.request.written[0].startswith('id: somejob:3\n'))
+
+    def test_slow_consumer_dropped(self):
+        """
+        Events are buffered while the connection is backed up, and the
+        subscriber is dropped once the buffer is full.
+        """
+        subscriber = JobEventSubscriber(self.request)
+        JobEventBroker.SUBSCRIBERS.add(subscriber)
+        subscriber.pauseProducing()
+        for version in range(settings.FEEDERD_EVENTS_MAX_BUFFER):
+            JobEventBroker._publish(make_job('ENCODING', version))
+        self.assertEqual(self.request.written, [])
+
+        subscriber.resumeProducing()
+        self.assertEqual(len(self.request.written),
+                         settings.FEEDERD_EVENTS_MAX_BUFFER)
+
+        subscriber.pauseProducing()
+        for version in range(settings.FEEDERD_EVENTS_MAX_BUFFER + 1):
+            JobEventBroker._publish(make_job('ENCODING', version))
+        self.assertEqual(self.request.is_finished, True)
+        self.assertEqual(JobEventBroker.SUBSCRIBERS, set())
+
+class ViewStreamingTests(unittest.TestCase):
+    """
+    Tests for request parsing and streamed responses in the view layer.
+    """
+    def setUp(self):
+        self.orig_chunk_size = views.JSON_CHUNK_SIZE
+        views.JSON_CHUNK_SIZE = 100
+
+    def tearDown(self):
+        views.JSON_CHUNK_SIZE = self.orig_chunk_size
+
+    def test_json_body(self):
+        """
+        JSON bodies are parsed as-is, without mangling special characters.
+        """
+        body = simplejson.dumps({'job_options': {'filter': 'a&b<c>'}})
+        request = FakeStreamRequest(
+                    headers={'Content-Type': 'application/json; charset=utf-8'},
+                    body=body, args={'ignored': ['1']})
+        arguments = BaseView.new(request).get_arguments()
+        self.assertEqual(arguments, {'job_options': {'filter': 'a&b<c>'}})
+
+        request = FakeStreamRequest(args={'preset': ['web', 'other']})
+        self.assertEqual(BaseView.new(request).get_arguments(),
+                         {'preset': 'web'})
+
+    def test_invalid_json_body(self):
+        """
+        JSON bodies have to be objects.
+        """
+        request = FakeStreamRequest(headers={'Content-Type': 'application/json'},
+                                    body='[1, 2]')
+        self.assertRaises(ValueError, BaseView.new(request).get_arguments)
+
+    def test_json_producer(self):
+        """
+        Responses are written a chunk at a time, each picking up where the
+        last left off, and add up to the whole thing.
+        """
+        obj = {'jobs': [{'job_id': '%040x' % i} for i in range(50)]}
+        expected = simplejson.dumps(obj)
+        request = FakeStreamRequest()
+        request.registerProducer = lambda producer, streaming: None
+        producer = JSONProducer(request, obj)
+        # Never loop forever, whatever the producer does.
+        for i in range(len(expected)):
+            if request.is_finished:
+                break
+            producer.resumeProducing()
+        self.assertEqual(request.is_finished, True)
+
+        # Each write but the last is at least a chunk, and just over it.
+        self.assertTrue(len(expected) > views.JSON_CHUNK_SIZE * 5)
+        num_writes = len(request.written)
+        self.assertTrue(len(expected) / (views.JSON_CHUNK_SIZE * 2) <=
+                        num_writes <=
+                        len(expected) / views.JSON_CHUNK_SIZE + 1)
+        for data in request.written[:-1]:
+            self.assertTrue(views.JSON_CHUNK_SIZE <= len(data) <
+                            views.JSON_CHUNK_SIZE * 2)
+        self.assertEqual(sum([len(data) for data in request.written]),
+                         len(expected))
+        self.assertEqual(simplejson.loads(''.join(request.written)), obj)
+
+class DeferredView(BaseView):
+    """
+    A view that waits on a Deferred it's handed, and answers with its
+    result.
+    """
+    def view(self):
+        return self.kwargs['deferred'].addCallback(self.set_answer)
+
+    def set_answer(self, answer):
+        self.context['answer'] = answer
+
+class FakeReactor(object):
+    """
+    Stands in for the reactor, which isn't running during the tests.
+    """
+    def callFromThread(self, func, *args, **kwargs):
+        func(*args, **kwargs)
+
+    def callWhenRunning(self, func, *args, **kwargs):
+        func(*args, **kwargs)
+
+    def addSystemEventTrigger(self, *args, **kwargs):
+        pass
+
+class DeferredViewTests(unittest.TestCase):
+    """
+    Tests for views that answer once a Deferred fires.
+    """
+    def setUp(self):
+        self.request = FakeStreamRequest()
+        self.deferred = defer.Deferred()
+
+    def test_success(self):
+        """
+        The response is written once the view's work is done.
+        """
+        self.assertEqual(DeferredView(self.request, deferred=self.deferred),
+                         NOT_DONE_YET)
+        self.assertEqual(self.request.written, [])
+
+        self.deferred.callback(42)
+        self.assertEqual(self.request.response_code, None)
+        self.assertEqual(simplejson.loads(''.join(self.request.written)),
+                         {'success': True, 'answer': 42})
+        self.assertEqual(self.request.is_finished, True)
+
+    def test_failure(self):
+        """
+        Views that blow up get a 500.
+        """
+        DeferredView(self.request, deferred=self.deferred)
+        self.deferred.errback(RuntimeError('Boom.'))
+        self.assertEqual(self.request.response_code, 500)
+        self.assertEqual(simplejson.loads(''.join(self.request.written)),
+                         {'success': False,
+                          'message': 'An internal error occurred.'})
+        self.assertEqual(self.request.is_finished, True)
+
+    def test_request_lost(self):
+        """
+        Nothing is written if the client goes away before the view is done.
+        """
+        DeferredView(self.request, deferred=self.deferred)
+        self.request.finished.errback(Exception('Connection lost.'))
+        self.deferred.callback(42)
+        self.assertEqual(self.request.written, [])
+        self.assertEqual(self.request.is_finished, False)
+
+    def test_defer_to_thread(self):
+        """
+        Blocking work is done off the reactor thread, and the result comes
+        back through the Deferred.
+        """
+        orig_reactor = web_views.reactor
+        orig_thread_pool = web_views.THREAD_POOL
+        web_views.reactor = FakeReactor()
+        web_views.THREAD_POOL = None
+        results = []
+        done = threading.Event()
+        def record(result):
+            results.append(result)
+            done.set()
+        try:
+            deferred = web_views.defer_to_thread(
+                            lambda name: (name, threading.currentThread()),
+                            'somejob')
+            deferred.addCallback(record)
+            done.wait(5)
+        finally:
+            if web_views.THREAD_POOL:
+                web_views.THREAD_POOL.stop()
+            web_views.reactor = orig_reactor
+            web_views.THREAD_POOL = orig_thread_pool
+
+        self.assertEqual(len(results), 1)
+        name, thread = results[0]
+        self.assertEqual(name, 'somejob')
+        self.assertNotEqual(thread, threading.currentThread())
+
+class AdmissionControllerTests(unittest.TestCase):
+    """
+    Tests for rate limiting and backlog limits on job submission.
+    """
+    def setUp(self):
+        self.orig_settings = (settings.FEEDERD_CLIENT_SUBMIT_RATE,
+                              settings.FEEDERD_CLIENT_SUBMIT_BURST,
+                              settings.FEEDERD_MAX_BACKLOG_SECONDS,
+                              settings.PRESETS)
+        settings.PRESETS = {}
+        settings.FEEDERD_CLIENT_SUBMIT_RATE = 1
+        settings.FEEDERD_CLIENT_SUBMIT_BURST = 5
+        settings.FEEDERD_MAX_BACKLOG_SECONDS = None
+        AdmissionController.BUCKETS = {}
+        AdmissionController.QUEUE_DEPTH = None
+        JobCache.CACHE = {}
+
+    def tearDown(self):
+        (settings.FEEDERD_CLIENT_SUBMIT_RATE,
+         settings.FEEDERD_CLIENT_SUBMIT_BURST,
+         settings.FEEDERD_MAX_BACKLOG_SECONDS,
+         settings.PRESETS) = self.orig_settings
+        AdmissionController.BUCKETS = {}
+        AdmissionController.QUEUE_DEPTH = None
+
+    def test_client_rate_limit(self):
+        """
+        Clients may burst, then get told how long to wait.
+        """
+        AdmissionController.admit('client1', ['web'] * 4)
+        AdmissionController.admit('client1', ['web'])
+        try:
+            AdmissionController.admit('client1', ['web'] * 2)
+            self.fail('The client went over its limit.')
+        except JobRejectedException, e:
+            self.assertEqual(e.retry_after, 2)
+        # A rejected batch takes nothing, and other clients are unaffected.
+        AdmissionController.admit('client2', ['web'] * 5)
+
+    def test_backlog_limit(self):
+        """
+        Submissions are turned away while the backlog is too big.
+        """
+        settings.FEEDERD_MAX_BACKLOG_SECONDS = 1
+        AdmissionController.admit('client1', ['web'])
+
+        AdmissionController.QUEUE_DEPTH = None
+        JobCache.update_job(make_job())
+        self.assertEqual(AdmissionController.get_queue_depth()['pending_jobs'],
+                         1)
+        self.assertRaises(JobRejectedException, AdmissionController.admit,
+                          'client1', ['web'])
+
+    def submit(self, view_class, request):
+        """
+        Runs a submission view's work, as its thread would.
+        """
+        view = view_class.new(request)
+        view.client_name = 'client1'
+        view._submit()
+        return view.context
+
+    def test_invalid_submissions_free(self):
+        """
+        Submissions that don't make it past being checked over don't use
+        up the client's rate limit, and still get the queue depth.
+        """
+        context = self.submit(web_views.JobSubmitView, FakeStreamRequest(
+                        args={'source_path': ['s3://bucket/in.mp4'],
+                              'dest_path': ['s3://bucket/out.mp4'],
+                              'preset': ['no_such_preset']}))
+        self.assertEqual(context['success'], False)
+        self.assertTrue(context.has_key('queue_depth'))
+
+        context = self.submit(web_views.JobSubmitBatchView, FakeStreamRequest(
+                        args={'jobs': ['[{"preset": "no_such_preset"}]']}))
+        self.assertTrue(context['jobs'][0].has_key('error'))
+        self.assertTrue(context.has_key('queue_depth'))
+        self.assertEqual(AdmissionController.BUCKETS, {})
+
+    def test_unparseable_submission(self):
+        """
+        Even a request that can't be parsed gets the queue depth.
+        """
+        context = self.submit(web_views.JobSubmitView, FakeStreamRequest(
+                        headers={'Content-Type': 'application/json'},
+                        body='{"source_path": '))
+        self.assertEqual(context['message'],
+                         'The request body is not a valid JSON object.')
+        self.assertTrue(context.has_key('queue_depth'))
+
+class SubmissionLogTests(unittest.TestCase):
+    """
+    Tests for logging new jobs, and replaying them after a restart.
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.orig_log_file = settings.FEEDERD_SUBMISSION_LOG_FILE
+        settings.FEEDERD_SUBMISSION_LOG_FILE = os.path.join(self.temp_dir,
+                                                            'submissions.log')
+        self.reset_log()
+
+        self.saved = []
+        self.tracked = []
+        self.existing = {}
+        def save_new_jobs(jobs):
+            self.saved += jobs
+            return []
+        def track_new_jobs(jobs):
+            self.tracked += jobs
+        self.orig_save_new_jobs = JobStateBackend.__dict__['save_new_jobs']
+        self.orig_get_jobs_by_id = JobStateBackend.__dict__['get_jobs_by_id']
+        self.orig_track_new_jobs = JobSubmitter.__dict__['_track_new_jobs']
+        JobStateBackend.save_new_jobs = staticmethod(save_new_jobs)
+        JobStateBackend.get_jobs_by_id = staticmethod(
+                lambda unique_ids: dict([(unique_id, self.existing[unique_id])
+                                         for unique_id in unique_ids
+                                         if self.existing.has_key(unique_id)]))
+        JobSubmitter._track_new_jobs = staticmethod(track_new_jobs)
+
+    def tearDown(self):
+        JobStateBackend.save_new_jobs = self.orig_save_new_jobs
+        JobStateBackend.get_jobs_by_id = self.orig_get_jobs_by_id
+        JobSubmitter._track_new_jobs = self.orig_track_new_jobs
+        settings.FEEDERD_SUBMISSION_LOG_FILE = self.orig_log_file
+        self.reset_log()
+        shutil.rmtree(self.temp_dir)
+
+    def reset_log(self):
+        """
+        Forgets everything, as if feederd had been restarted.
+        """
+        if SubmissionLog.FILE:
+            SubmissionLog.FILE.close()
+        SubmissionLog.FILE = None
+        SubmissionLog.PENDING = {}
+        SubmissionLog.FINGERPRINTS = {}
+        SubmissionLog.NUM_RECORDS = 0
+
+    def test_flush(self):
+        """
+        Logged jobs get IDs right away, and are saved and queued up when
+        the log is flushed.
+        """
+        jobs = [make_job(unique_id=None), make_job(unique_id=None)]
+        SubmissionLog.append(jobs)
+        self.assertTrue(jobs[0].unique_id)
+        self.assertEqual(SubmissionLog.get_job(jobs[0].unique_id), jobs[0])
+
+        self.assertEqual(JobSubmitter.flush_submission_log(), 2)
+        self.assertEqual(self.saved, jobs)
+        self.assertEqual(self.tracked, jobs)
+        self.assertEqual(SubmissionLog.get_jobs(), [])
+        self.assertEqual(JobSubmitter.flush_submission_log(), 0)
+
+    def test_replay(self):
+        """
+        After a restart, jobs that weren't done are read back in. Those
+        that were saved already aren't saved again, and only those that
+        are still waiting are queued up again.
+        """
+        jobs = [make_job(unique_id=None) for i in range(3)]
+        SubmissionLog.append(jobs)
+        SubmissionLog.mark_done([jobs[0].unique_id])
+        self.existing[jobs[2].unique_id] = make_job('ENCODING', 3,
+                                                    unique_id=jobs[2].unique_id)
+        self.reset_log()
+
+        SubmissionLog.load()
+        self.assertEqual(sorted([job.unique_id for job in SubmissionLog.get_jobs()]),
+                         sorted([jobs[1].unique_id, jobs[2].unique_id]))
+        JobCache.CACHE = {}
+        self.assertEqual(JobSubmitter.flush_submission_log(), 2)
+        self.assertEqual([job.unique_id for job in self.saved],
+                         [jobs[1].unique_id])
+        self.assertEqual([job.unique_id for job in self.tracked],
+                         [jobs[1].unique_id])
+        self.assertEqual(JobCache.get_job(jobs[2].unique_id).job_state,
+                         'ENCODING')
+
+    def test_resubmit_before_flush(self):
+        """
+        A job submitted again while the first one is still in the log is
+        coalesced with it, before and after a restart.
+        """
+        orig_get_job_id = JobStateBackend.__dict__['get_job_id_for_fingerprint']
+        orig_submission_log = settings.FEEDERD_SUBMISSION_LOG
+        JobStateBackend.get_job_id_for_fingerprint = staticmethod(
+                                                    lambda fingerprint: None)
+        settings.FEEDERD_SUBMISSION_LOG = True
+        def make_fingerprinted_job():
+            job = EncodingJob('s3://bucket/in.mp4', 's3://bucket/out.mp4',
+                              BASE_NOMMER, [], source_etag='abc',
+                              source_size=100)
+            job.fingerprint = job.get_fingerprint()
+            return job
+        try:
+            job_id = JobSubmitter.submit(make_fingerprinted_job())
+            self.assertEqual(JobSubmitter.submit(make_fingerprinted_job()),
+                             job_id)
+            self.reset_log()
+            SubmissionLog.load()
+            self.assertEqual(JobSubmitter.submit(make_fingerprinted_job()),
+                             job_id)
+            self.assertEqual(len(SubmissionLog.get_jobs()), 1)
+
+            JobCache.CACHE = {}
+            self.assertEqual(JobSubmitter.flush_submission_log(), 1)
+            self.assertEqual(SubmissionLog.FINGERPRINTS, {})
+        finally:
+            JobStateBackend.get_job_id_for_fingerprint = orig_get_job_id
+            settings.FEEDERD_SUBMISSION_LOG = orig_submission_log
@@ -4,11 +4,20 @@ the JSON API that external software can POST to for various things.
 """
 import cgi
 from txrestapi.resource import APIResource
-from media_nommer.feederd.web.views import JobSubmitView
+from media_nommer.feederd.web.views import JobSubmitView, JobSubmitBatchView, \
+                                         JobStatusView, JobListView, \
+                                         JobEventsView, MetricsView
 
 """
 URL assembly.
 """
 API = APIResource()
 
+API.register('POST', '^/job/submit_batch', JobSubmitBatchView)
 API.register('POST', '^/job/submit', JobSubmitView)
+API.register('GET', '^/job/status', JobStatusView)
+API.register('POST', '^/job/status', JobStatusView)
+API.register('GET', '^/job/list', JobListView)
+API.register('POST', '^/job/list', JobListView)
+API.register('GET', '^/job/events', JobEventsView)
+API.register('GET', '^/metrics', MetricsView)
@@ -1,50 +1,400 @@
-import cgi
+import re
+import base64
+import binascii
 import simplejson
+from twisted.internet import reactor, threads
+from twisted.python.threadpool import ThreadPool
+from twisted.web.server import NOT_DONE_YET
+from media_nommer.utils import metrics
 from media_nommer.utils.views import BaseView
 from media_nommer.conf import settings
-from media_nommer.core.job_state_backend import EncodingJob
+from media_nommer.core.job_state_backend import JobStateBackend
+from media_nommer.feederd.exceptions import InvalidJobException, \
+                                           JobRejectedException
+from media_nommer.feederd.admission_controller import AdmissionController
 from media_nommer.feederd.job_cache import JobCache
+from media_nommer.feederd.job_events import JobEventBroker, get_job_status
+from media_nommer.feederd.job_submitter import JobSubmitter
 
-class JobSubmitView(BaseView):
+# Job IDs are hex digests.
+JOB_ID_RE = re.compile(r'^[0-9a-f]+$')
+# The most jobs /job/status/ reports on at once.
+MAX_STATUS_JOBS = 100
+# How many jobs /job/list/ returns per page, unless asked for fewer.
+MAX_LIST_JOBS = 100
+
+# Views do their blocking AWS work in here, so that the reactor (and every
+# other request) isn't stuck waiting on it. See get_thread_pool().
+THREAD_POOL = None
+
+def get_thread_pool():
+    """
+    Lazy-loading of the views' thread pool, sized by the
+    :py:data:`FEEDERD_WEB_THREADS <media_nommer.conf.settings.FEEDERD_WEB_THREADS>`
+    setting. It's separate from the reactor's own pool, so that a flood of
+    submissions can't hold up the interval tasks.
+
+    :rtype: :py:class:`twisted.python.threadpool.ThreadPool`
+    :returns: The thread pool.
+    """
+    global THREAD_POOL
+
+    if not THREAD_POOL:
+        THREAD_POOL = ThreadPool(minthreads=1,
+                                 maxthreads=settings.FEEDERD_WEB_THREADS,
+                                 name='feederd-web')
+        reactor.callWhenRunning(THREAD_POOL.start)
+        reactor.addSystemEventTrigger('during', 'shutdown', THREAD_POOL.stop)
+    return THREAD_POOL
+
+def defer_to_thread(func, *args, **kwargs):
+    """
+    Calls a function in the views' thread pool.
+
+    :rtype: :py:class:`twisted.internet.defer.Deferred`
+    :returns: A Deferred that fires with the function's return value.
+    """
+    return threads.deferToThreadPool(reactor, get_thread_pool(), func,
+                                     *args, **kwargs)
+
+def get_list_arg(request, key):
+    """
+    Gathers up a query argument that may be repeated, comma-separated, or
+    both.
+
+    :param str key: The argument's name.
+    :rtype: list
+    :returns: The argument's values, in order.
+    """
+    values = []
+    for value in request.args.get(key, []):
+        values += [item.strip() for item in value.split(',') if item.strip()]
+    return values
+
+class BaseSubmitView(BaseView):
+    """
+    Common bits for the job submission views. Every response carries the
+    current ``queue_depth``, so that clients can spread out their load.
+    """
     def view(self):
-        print "REQ", self.request.args
-        print "KW", self.kwargs
-        print "CONT", self.context
-
-        source_path = cgi.escape(self.request.args['source_path'][0])
-        dest_path = cgi.escape(self.request.args['dest_path'][0])
-        notify_url = cgi.escape(self.request.args['notify_url'][0])
-        preset = cgi.escape(self.request.args['preset'][0])
-        user_job_options = cgi.escape(self.request.args['job_options'][0])
-        user_job_options = simplejson.loads(user_job_options)
-
-        print "SOURCE", source_path
-        print "DEST", dest_path
-        print "NOTIFY", notify_url
-        print "OPTIONS", user_job_options
-
-        # Retrieve the given preset from nomconf.
+        # Request headers are read here, in the reactor thread.
+        self.client_name = AdmissionController.get_client_name(self.request)
+        return defer_to_thread(self._submit)
+
+    def _submit(self):
+        """
+        Runs :py:meth:`submit`, and adds the queue depth to the response,
+        however it turned out.
+        """
+        self.submit()
+        self.set_queue_depth()
+
+    def submit(self):
+        """
+        Override this with the submission logic. This blocks, and runs in
+        the thread pool.
+        """
+        pass
+
+    def admit(self, jobs):
+        """
+        Checks with the
+        :py:class:`AdmissionController <media_nommer.feederd.admission_controller.AdmissionController>`
+        that the submissions may come in. If not, an error is set, with a
+        ``429`` status code and a ``Retry-After`` header if they may be
+        tried again later.
+
+        Only jobs that have been built (and so checked over) are let in or
+        turned away, so bad submissions don't use up anyone's rate limit.
+
+        :param list jobs: The jobs, from
+            :py:meth:`JobSubmitter.build_job <media_nommer.feederd.job_submitter.JobSubmitter.build_job>`.
+        :rtype: bool
+        :returns: ``True`` if the jobs were let in.
+        """
+        # Multi-output jobs go by their first output's preset.
+        presets = [job.preset.split(',')[0] for job in jobs]
+        try:
+            AdmissionController.admit(self.client_name, presets)
+        except JobRejectedException, e:
+            self.set_error(e.message, response_code=429)
+            self.response_headers['Retry-After'] = str(e.retry_after)
+            self.context['retry_after'] = e.retry_after
+        except InvalidJobException, e:
+            self.set_error(e.message)
+        else:
+            return True
+        return False
+
+    def set_queue_depth(self):
+        """
+        Adds the current queue depth to the response.
+        """
+        self.context['queue_depth'] = AdmissionController.get_queue_depth()
+
+class JobSubmitView(BaseSubmitView):
+    """
+    Submits a job. Arguments may be sent as a form, with ``outputs`` and
+    ``job_options`` JSON-serialized, or as an ``application/json`` body.
+    """
+    def submit(self):
+        """
+        Looks the job over, and saves and queues it up.
+        """
         try:
-            preset_dict = settings.PRESETS[preset]
-        except KeyError:
-            self.set_error('No such preset.')
-            return
-
-        # Determine the nommer based on the preset.
-        nommer = preset_dict['nommer']
-        # Get the preset's job options dict.
-        job_options = preset_dict['options']
-        # Override preset's options with user-specified values.
-        # TODO: Fix this for multi-pass!
-        #job_options.update(user_job_options)
-        print "NEW OPTS", job_options
-
-        # Create a new job and save it to the DB/queue.
-        job = EncodingJob(source_path, dest_path, nommer, job_options,
-                          notify_url=notify_url)
-        unique_job_id = job.save()
-        # Add the job to the local job cache.
-        JobCache.update_job(job)
+            arguments = self.get_arguments()
+        except ValueError:
+            self.set_error('The request body is not a valid JSON object.')
+            return
+
+        submission = {}
+        for key in ['source_path', 'dest_path', 'preset', 'notify_url',
+                    'priority']:
+            if arguments.has_key(key):
+                submission[key] = arguments[key]
+        for key in ['outputs', 'job_options']:
+            value = arguments.get(key)
+            if isinstance(value, basestring):
+                # Form arguments are JSON-serialized.
+                try:
+                    value = simplejson.loads(value)
+                except ValueError:
+                    self.set_error('%s is not valid JSON.' % key)
+                    return
+            if value is not None:
+                submission[key] = value
+
+        try:
+            job = JobSubmitter.build_job(submission)
+        except InvalidJobException, e:
+            self.set_error(e.message)
+            return
+        if not self.admit([job]):
+            return
+        unique_job_id = JobSubmitter.submit(job)
 
         # This is serialized and returned to the user.
         self.context.update({'job_id': unique_job_id})
+
+class JobSubmitBatchView(BaseSubmitView):
+    """
+    Submits a batch of jobs at once. Each job is checked over on its own,
+    so one bad job doesn't sink the rest. ``jobs`` may be sent as a
+    JSON-serialized form argument, or in an ``application/json`` body.
+    """
+    STREAM = True
+
+    def submit(self):
+        """
+        Submits the batch. Parsing the (possibly big) request is done here
+        too, out of the reactor thread.
+        """
+        try:
+            submissions = self.get_arguments().get('jobs')
+            if isinstance(submissions, basestring):
+                # Form arguments are JSON-serialized.
+                submissions = simplejson.loads(submissions)
+        except ValueError:
+            submissions = None
+        if not isinstance(submissions, list):
+            self.set_error('jobs must be a JSON list of jobs.')
+            return
+        if len(submissions) > settings.FEEDERD_MAX_BATCH_SIZE:
+            self.set_error('No more than %d jobs per batch.' % (
+                                        settings.FEEDERD_MAX_BATCH_SIZE))
+            return
+
+        built_jobs = JobSubmitter.build_batch(submissions)
+        jobs = [built[0] for built in built_jobs
+                if not isinstance(built, basestring)]
+        if jobs and not self.admit(jobs):
+            return
+
+        # This is serialized and returned to the user.
+        self.context.update({'jobs': JobSubmitter.submit_batch(
+                                        submissions, built_jobs=built_jobs)})
+
+class JobStatusView(BaseView):
+    """
+    Reports on one or more jobs, given as ``job_id`` (repeated, or
+    comma-separated). Jobs come out of the
+    :py:class:`JobCache <media_nommer.feederd.job_cache.JobCache>` where
+    possible, and SimpleDB_ otherwise.
+    """
+    ETAG = True
+
+    def view(self):
+        unique_ids = get_list_arg(self.request, 'job_id')
+        if not unique_ids:
+            self.set_error('job_id is required.')
+            return
+        if len(unique_ids) > MAX_STATUS_JOBS:
+            self.set_error('No more than %d jobs at once.' % MAX_STATUS_JOBS)
+            return
+        if [unique_id for unique_id in unique_ids
+            if not JOB_ID_RE.match(unique_id)]:
+            self.set_error('Invalid job_id.')
+            return
+
+        jobs = {}
+        for unique_id in unique_ids:
+            job = JobCache.get_known_job(unique_id)
+            if job:
+                jobs[unique_id] = job
+        missing_ids = set([unique_id for unique_id in unique_ids
+                           if not jobs.has_key(unique_id)])
+        if not missing_ids:
+            self._set_statuses(unique_ids, jobs)
+            return
+
+        d = defer_to_thread(JobStateBackend.get_jobs_by_id, missing_ids)
+        d.addCallback(self._read_through, unique_ids, jobs)
+        return d
+
+    def _read_through(self, loaded_jobs, unique_ids, jobs):
+        """
+        Adds the jobs we had to go to SimpleDB_ for to the response.
+        Finished ones are held on to for next time.
+        """
+        for job in loaded_jobs.values():
+            if job.is_finished():
+                JobCache.remember_finished_job(job)
+        jobs.update(loaded_jobs)
+        self._set_statuses(unique_ids, jobs)
+
+    def _set_statuses(self, unique_ids, jobs):
+        """
+        :param list unique_ids: The requested IDs, in order.
+        :param dict jobs: Keys are unique IDs, values are the jobs found.
+        """
+        self.context.update({
+            'jobs': [get_job_status(jobs[unique_id])
+                     for unique_id in unique_ids if jobs.has_key(unique_id)],
+            'not_found': [unique_id for unique_id in unique_ids
+                          if not jobs.has_key(unique_id)],
+        })
+
+class JobListView(BaseView):
+    """
+    Lists the jobs in a given ``state``, oldest first, a page at a time.
+    Un-finished jobs are listed from the
+    :py:class:`JobCache <media_nommer.feederd.job_cache.JobCache>`, which
+    has all of them. Finished jobs are listed from SimpleDB_.
+    """
+    ETAG = True
+
+    def view(self):
+        job_state = self.request.args.get('state', [None])[0]
+        if job_state not in JobStateBackend.JOB_STATES:
+            self.set_error('No such state.')
+            return
+        try:
+            limit = int(self.request.args.get('limit', [MAX_LIST_JOBS])[0])
+        except ValueError:
+            limit = 0
+        if not 0 < limit <= MAX_LIST_JOBS:
+            self.set_error('limit must be from 1 to %d.' % MAX_LIST_JOBS)
+            return
+        try:
+            cursor = self._decode_cursor(
+                                self.request.args.get('cursor', [None])[0])
+        except (TypeError, ValueError, binascii.Error):
+            self.set_error('Invalid cursor.')
+            return
+
+        if job_state in JobStateBackend.FINISHED_STATES:
+            d = defer_to_thread(JobStateBackend.get_jobs_with_state,
+                                job_state, limit, next_token=cursor)
+            d.addCallback(self._list_finished_jobs)
+            return d
+        self._list_cached_jobs(job_state, limit, cursor)
+
+    def _decode_cursor(self, cursor):
+        """
+        Cursors are opaque to clients. For un-finished jobs, they're the
+        sort key of the last job on the page. For finished jobs, they're
+        SimpleDB's NextToken.
+
+        :param str cursor: A cursor from the previous page, or ``None``.
+        :rtype: str
+        :returns: The decoded cursor, or ``None``.
+        """
+        if not cursor:
+            return None
+        return base64.urlsafe_b64decode(str(cursor))
+
+    def _encode_cursor(self, cursor):
+        """
+        :param str cursor: A decoded cursor, or ``None``.
+        :rtype: str
+        :returns: The cursor, ready to hand to the client.
+        """
+        if not cursor:
+            return None
+        return base64.urlsafe_b64encode(cursor)
+
+    def _list_cached_jobs(self, job_state, limit, cursor):
+        """
+        Lists a page of un-finished jobs from the job cache.
+        """
+        def get_sort_key(job):
+            return '%s|%s' % (job.creation_dtime.strftime('%Y-%m-%d %H:%M:%S.%f'),
+                              job.unique_id)
+
+        jobs = sorted(JobCache.get_jobs_with_state(job_state), key=get_sort_key)
+        if cursor:
+            jobs = [job for job in jobs if get_sort_key(job) > cursor]
+
+        next_cursor = None
+        if len(jobs) > limit:
+            jobs = jobs[:limit]
+            next_cursor = get_sort_key(jobs[-1])
+        self.context.update({
+            'jobs': [get_job_status(job) for job in jobs],
+            'cursor': self._encode_cursor(next_cursor),
+        })
+
+    def _list_finished_jobs(self, page):
+        """
+        Adds a page of finished jobs from SimpleDB_ to the response.
+
+        :param tuple page: A ``(jobs, next_token)`` tuple.
+        """
+        jobs, next_token = page
+        for job in jobs:
+            JobCache.remember_finished_job(job)
+        self.context.update({
+            'jobs': [get_job_status(job) for job in jobs],
+            'cursor': self._encode_cursor(next_token),
+        })
+
+class JobEventsView(BaseView):
+    """
+    Streams job state changes as Server-Sent Events, rather than having
+    clients poll :py:class:`JobStatusView`. The stream can be narrowed down
+    to certain jobs with ``job_id``, and to certain states with ``state``
+    (both repeated, or comma-separated).
+    """
+    def view(self):
+        unique_ids = get_list_arg(self.request, 'job_id')
+        if [unique_id for unique_id in unique_ids
+            if not JOB_ID_RE.match(unique_id)]:
+            self.set_error('Invalid job_id.')
+            return
+        job_states = get_list_arg(self.request, 'state')
+        if [job_state for job_state in job_states
+            if job_state not in JobStateBackend.JOB_STATES]:
+            self.set_error('No such state.')
+            return
+
+        JobEventBroker.subscribe(self.request,
+                                 job_ids=set(unique_ids) or None,
+                                 job_states=set(job_states) or None)
+        return NOT_DONE_YET
+
+class MetricsView(BaseView):
+    """
+    Dumps feederd's internal metrics (queue depths, drain rates, etc).
+    """
+    def view(self):
+        self.context.update({'metrics': metrics.get_metrics()})
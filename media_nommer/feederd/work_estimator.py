@@ -0,0 +1,145 @@
+"""
+Contains the :py:class:`WorkEstimator` class, which guesses how much encoder
+time the un-finished jobs will take. :doc:`../feederd` uses this to decide
+how many EC2_ instances it needs.
+"""
+import threading
+from media_nommer.conf import settings
+from media_nommer.utils import logger, metrics
+from media_nommer.utils.compat import total_seconds
+
+class WorkEstimator(object):
+    """
+    Estimates queued work in encoder-seconds (the number of seconds a single
+    encoding slot is kept busy). Estimates are based on the size of each
+    job's source media, and on how quickly jobs with the same preset have
+    gone through a slot in the past.
+
+    Historical throughput is learned from the state changes that
+    :py:class:`JobCache <media_nommer.feederd.job_cache.JobCache>` sees. Until
+    a preset has finished a job, the
+    :py:data:`AUTOSCALE_DEFAULT_BYTES_PER_SECOND <media_nommer.conf.settings.AUTOSCALE_DEFAULT_BYTES_PER_SECOND>`
+    setting is used.
+    """
+    # Keys are preset names, values are smoothed bytes per encoder-second.
+    THROUGHPUT = {}
+    # Keys are job unique IDs, values are the datetime the job started
+    # occupying an encoding slot.
+    SLOT_START_DTIMES = {}
+    # Guards THROUGHPUT and SLOT_START_DTIMES.
+    LOCK = threading.Lock()
+
+    @classmethod
+    def get_throughput(cls, preset):
+        """
+        Returns the expected throughput for a preset.
+
+        :param str preset: A preset name. May be ``None``.
+        :rtype: float
+        :returns: The expected number of source bytes an encoding slot
+            gets through per second for this preset.
+        """
+        return cls.THROUGHPUT.get(preset,
+                                  float(settings.AUTOSCALE_DEFAULT_BYTES_PER_SECOND))
+
+    @classmethod
+    def record_throughput(cls, preset, num_bytes, slot_seconds):
+        """
+        Folds a finished job's throughput into the preset's moving average.
+
+        :param str preset: The preset the job used.
+        :param int num_bytes: The size of the job's source media.
+        :param float slot_seconds: How long the job occupied its slot.
+        """
+        if slot_seconds <= 0 or not num_bytes:
+            return
+
+        observed = num_bytes / slot_seconds
+        smoothing = settings.AUTOSCALE_THROUGHPUT_SMOOTHING
+        with cls.LOCK:
+            if cls.THROUGHPUT.has_key(preset):
+                cls.THROUGHPUT[preset] = (smoothing * observed) + \
+                                         ((1 - smoothing) * cls.THROUGHPUT[preset])
+            else:
+                cls.THROUGHPUT[preset] = observed
+            throughput = cls.THROUGHPUT[preset]
+
+        metrics.set_gauge('feederd.throughput.%s' % preset, throughput)
+        logger.debug("WorkEstimator.record_throughput(): " \
+                     "%s now at %.0f bytes/sec" % (preset, throughput))
+
+    @classmethod
+    def observe_state_change(cls, old_job, new_job):
+        """
+        Called by :py:class:`JobCache <media_nommer.feederd.job_cache.JobCache>`
+        whenever it applies a state change. Tracks when jobs start occupying
+        a slot, and records their throughput when they finish.
+
+        :param EncodingJob old_job: The previously cached copy of the job.
+        :param EncodingJob new_job: The newly applied copy of the job.
+        """
+        unique_id = new_job.unique_id
+        if old_job.job_state == 'PENDING' and new_job.job_state != 'PENDING':
+            # The job has been picked up by a node. Both times come from
+            # the node's clock, so skew with our own doesn't matter.
+            with cls.LOCK:
+                cls.SLOT_START_DTIMES[unique_id] = new_job.last_modified_dtime
+
+        if not new_job.is_finished():
+            return
+
+        with cls.LOCK:
+            start_dtime = cls.SLOT_START_DTIMES.pop(unique_id, None)
+
+        # Split jobs' time is mostly spent waiting on their segments, which
+        # are recorded on their own.
+        if new_job.job_state == 'FINISHED' and start_dtime and \
+           not new_job.num_segments:
+            slot_seconds = total_seconds(new_job.last_modified_dtime - start_dtime)
+            cls.record_throughput(new_job.preset, new_job.source_size,
+                                  slot_seconds)
+
+    @classmethod
+    def estimate_job_seconds(cls, job):
+        """
+        Estimates how many more encoder-seconds a job needs. If the job's
+        nommer is publishing progress, its ETA is used.
+
+        :param EncodingJob job: The job to estimate.
+        :rtype: float
+        :returns: The estimated number of encoder-seconds remaining.
+        """
+        if job.is_finished() or job.job_state == 'WAITING':
+            # WAITING jobs' remaining work is in their child jobs.
+            return 0.0
+
+        progress = job.get_progress()
+        if progress and progress.get('eta_seconds') is not None:
+            # The node has told us how much is left.
+            return float(progress['eta_seconds'])
+
+        if job.source_size:
+            estimate = job.source_size / cls.get_throughput(job.preset)
+        else:
+            estimate = float(settings.AUTOSCALE_DEFAULT_JOB_SECONDS)
+
+        start_dtime = cls.SLOT_START_DTIMES.get(job.unique_id)
+        if start_dtime:
+            # Already working on it. Knock off the time spent so far, but
+            # assume there's always a little left, since we're evidently
+            # not done yet.
+            elapsed = total_seconds(job.last_modified_dtime - start_dtime)
+            estimate = max(estimate - elapsed, estimate * 0.1)
+
+        return estimate
+
+    @classmethod
+    def estimate_backlog_seconds(cls, jobs):
+        """
+        Estimates the total encoder-seconds needed to finish a list of jobs.
+
+        :param list jobs: A list of :py:class:`EncodingJob` objects.
+        :rtype: float
+        :returns: The estimated number of encoder-seconds.
+        """
+        return sum([cls.estimate_job_seconds(job) for job in jobs])
@@ -49,6 +49,7 @@ class WebApiServiceMaker(object):
         self.load_settings(options)
         self.upload_user_settings()
         self.load_job_cache()
+        self.load_submission_history()
         self.start_tasks()
         return internet.TCPServer(int(options['port']), Site(API))
 
@@ -88,6 +89,15 @@ class WebApiServiceMaker(object):
         """
         JobCache.load_recent_jobs_at_startup()
 
+    def load_submission_history(self):
+        """
+        Loads the recent submission history that the fleet controller uses
+        to forecast demand.
+        """
+        if conf.settings.FEEDERD_FLEET_CONTROLLER:
+            from media_nommer.feederd.fleet_controller import FleetController
+            FleetController.load_submission_history()
+
     def start_tasks(self):
         """
         Tasks are started by importing the interval_tasks module. Only do this
@@ -0,0 +1,71 @@
+"""
+A small Bloom filter, used by :doc:`../ec2nommerd` to tell :doc:`../feederd`
+which sources it has cached in a way that fits in a heartbeat.
+"""
+import base64
+import hashlib
+
+class BloomFilter(object):
+    """
+    A fixed-size Bloom filter over strings. Membership tests may give false
+    positives, but never false negatives.
+    """
+    def __init__(self, num_bits, num_hashes, bits=None):
+        """
+        :param int num_bits: The size of the filter, in bits. Rounded up to
+            a multiple of 8.
+        :param int num_hashes: How many bits each key sets.
+        :keyword bytearray bits: The filter's bits, if re-constituting one.
+        """
+        self.num_bits = ((num_bits + 7) // 8) * 8
+        self.num_hashes = num_hashes
+        if bits is None:
+            bits = bytearray(self.num_bits // 8)
+        self.bits = bits
+
+    def _get_positions(self, key):
+        """
+        Works out which bits a key sets, by double hashing.
+
+        :param str key: The key.
+        :rtype: list
+        :returns: A list of bit positions.
+        """
+        digest = hashlib.md5(key).hexdigest()
+        first = int(digest[:16], 16)
+        second = int(digest[16:], 16) | 1
+        return [(first + i * second) % self.num_bits
+                for i in range(self.num_hashes)]
+
+    def add(self, key):
+        """
+        :param str key: The key to add.
+        """
+        for position in self._get_positions(key):
+            self.bits[position // 8] |= 1 << (position % 8)
+
+    def __contains__(self, key):
+        for position in self._get_positions(key):
+            if not self.bits[position // 8] & (1 << (position % 8)):
+                return False
+        return True
+
+    def to_string(self):
+        """
+        :rtype: str
+        :returns: The filter, serialized for storage in SimpleDB_. See
+            :py:meth:`from_string`.
+        """
+        return '%d:%d:%s' % (self.num_bits, self.num_hashes,
+                             base64.b64encode(str(self.bits)))
+
+    @classmethod
+    def from_string(cls, value):
+        """
+        :param str value: A filter serialized by :py:meth:`to_string`.
+        :rtype: BloomFilter
+        :returns: The filter.
+        """
+        num_bits, num_hashes, bits = value.split(':', 2)
+        return cls(int(num_bits), int(num_hashes),
+                   bits=bytearray(base64.b64decode(bits)))
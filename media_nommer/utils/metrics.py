@@ -0,0 +1,80 @@
+"""
+A tiny, thread-safe, in-process metrics registry. Counters, gauges, and timing
+observations are recorded here by the daemons, and can be dumped as a dict
+for the JSON APIs to serve up.
+
+Metric names are dotted strings, prefixed with the daemon or component that
+records them. For example: ``feederd.state_changes.drained``.
+"""
+import threading
+
+# All values live in here, keyed by metric name. Guarded by _LOCK.
+_COUNTERS = {}
+_GAUGES = {}
+_TIMINGS = {}
+_LOCK = threading.Lock()
+
+def incr(name, amount=1):
+    """
+    Increments a counter.
+
+    :param str name: The counter's name.
+    :keyword int amount: How much to increment the counter by.
+    """
+    with _LOCK:
+        _COUNTERS[name] = _COUNTERS.get(name, 0) + amount
+
+def set_gauge(name, value):
+    """
+    Sets a gauge to the given value, replacing whatever was there.
+
+    :param str name: The gauge's name.
+    :param value: The gauge's new value. Typically an int or float.
+    """
+    with _LOCK:
+        _GAUGES[name] = value
+
+def observe(name, value):
+    """
+    Records a single observation of something like a duration. The count,
+    total, and maximum of all observations are kept.
+
+    :param str name: The timing's name.
+    :param float value: The observed value.
+    """
+    with _LOCK:
+        timing = _TIMINGS.setdefault(name, {'count': 0, 'total': 0.0,
+                                            'max': 0.0})
+        timing['count'] += 1
+        timing['total'] += value
+        timing['max'] = max(timing['max'], value)
+
+def get_metrics():
+    """
+    Returns a snapshot of all recorded metrics.
+
+    :rtype: dict
+    :returns: A dict with ``counters``, ``gauges``, and ``timings`` keys.
+        Timings also have an ``avg`` key computed.
+    """
+    with _LOCK:
+        timings = {}
+        for name, timing in _TIMINGS.items():
+            timing = dict(timing)
+            timing['avg'] = timing['total'] / timing['count']
+            timings[name] = timing
+
+        return {
+            'counters': dict(_COUNTERS),
+            'gauges': dict(_GAUGES),
+            'timings': timings,
+        }
+
+def reset():
+    """
+    Clears all recorded metrics. Mostly useful for testing.
+    """
+    with _LOCK:
+        _COUNTERS.clear()
+        _GAUGES.clear()
+        _TIMINGS.clear()
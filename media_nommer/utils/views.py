@@ -1,4 +1,66 @@
+import json
+import hashlib
 import simplejson
+from zope.interface import implements
+from twisted.internet import defer
+from twisted.internet.interfaces import IPullProducer
+from twisted.web.server import NOT_DONE_YET
+from media_nommer.utils import logger
+
+# Streamed responses are written in chunks of about this many bytes.
+JSON_CHUNK_SIZE = 64 * 1024
+
+class JSONProducer(object):
+    """
+    Encodes an object as JSON and writes it to a request a chunk at a time,
+    as the connection makes room for it. Big responses never sit in memory
+    all at once, and the reactor gets to serve other requests in between
+    chunks.
+    """
+    implements(IPullProducer)
+
+    def __init__(self, request, obj):
+        """
+        :param request: The request to write the response to.
+        :param obj: The object to encode.
+        """
+        self.request = request
+        # simplejson's C speedups encode everything in one go, and hand back
+        # a list. The standard library's pure Python encoder really does
+        # produce the chunks as it goes.
+        self.chunks = iter(json.JSONEncoder().iterencode(obj, _one_shot=False))
+
+    def start(self):
+        """
+        Starts writing. The request is finished once everything has been
+        written.
+        """
+        self.request.registerProducer(self, False)
+
+    def resumeProducing(self):
+        """
+        Called by the connection when it's ready for another chunk.
+        """
+        data = []
+        size = 0
+        for chunk in self.chunks:
+            data.append(chunk)
+            size += len(chunk)
+            if size >= JSON_CHUNK_SIZE:
+                self.request.write(''.join(data))
+                return
+
+        # That's the lot.
+        if data:
+            self.request.write(''.join(data))
+        self.request.unregisterProducer()
+        self.request.finish()
+
+    def stopProducing(self):
+        """
+        Called by the connection when the client goes away.
+        """
+        self.chunks = iter([])
 
 class BaseView(object):
     """
@@ -6,6 +68,17 @@ class BaseView(object):
     See __new__() for the order of execution of the rendering methods.
     """
 
+    ETAG = False
+    """If ``True``, responses get an ``ETag`` header, and requests with a
+    matching ``If-None-Match`` header get an empty ``304`` instead. Good for
+    views that clients poll."""
+
+    STREAM = False
+    """If ``True``, successful responses are encoded and written a chunk at
+    a time by a :py:class:`JSONProducer`, rather than built up in memory all
+    at once. Good for views with big responses. Doesn't mix with ``ETAG``,
+    which needs the whole response."""
+
     def __new__(cls, request, *args, **kwargs):
         """
         The top-level factory function for views when called by urls.py.
@@ -17,8 +90,19 @@ class BaseView(object):
         view = cls.new(request, *args, **kwargs)
 
         # Run all of the view's generation code.
-        view.view()
-        return view.render()
+        result = view.view()
+        if isinstance(result, defer.Deferred):
+            # The view has gone off to do something slow. Answer once it's
+            # done, rather than holding up the reactor until then.
+            request.notifyFinish().addErrback(view._request_lost)
+            result.addCallbacks(lambda ignored: view.respond(),
+                                view.render_failure)
+            result.addCallback(view._finish_request)
+            return NOT_DONE_YET
+        if result is NOT_DONE_YET:
+            # The view is streaming its own response.
+            return NOT_DONE_YET
+        return view.respond()
 
     @classmethod
     def new(cls, *args, **kwargs):
@@ -45,8 +129,42 @@ class BaseView(object):
         self.context = {
             'success': True
         }
+        # Set if the client goes away before a deferred view is done.
+        self.is_request_lost = False
+        # The HTTP status code to respond with, if not the usual 200.
+        self.response_code = None
+        # Extra HTTP headers to respond with.
+        self.response_headers = {}
+
+    def is_json_request(self):
+        """
+        :rtype: bool
+        :returns: ``True`` if the request has an ``application/json`` body.
+        """
+        content_type = self.request.getHeader('Content-Type') or ''
+        return content_type.split(';')[0].strip().lower() == 'application/json'
 
-    def set_error(self, message):
+    def get_arguments(self):
+        """
+        Gathers up the request's arguments. An ``application/json`` body is
+        parsed (once, and as-is) into them. Otherwise, the first value of
+        each query or form argument is used.
+
+        :rtype: dict
+        :returns: The request's arguments.
+        :raises: ``ValueError`` if a JSON body isn't a valid JSON object.
+        """
+        if not self.is_json_request():
+            return dict([(key, values[0])
+                         for key, values in self.request.args.items()])
+
+        self.request.content.seek(0)
+        arguments = simplejson.load(self.request.content)
+        if not isinstance(arguments, dict):
+            raise ValueError('The request body is not a JSON object.')
+        return arguments
+
+    def set_error(self, message, response_code=None):
         """
         Sets an error state and HTTP code. 
         
@@ -54,17 +172,79 @@ class BaseView(object):
             after calling this.
         
         :param str message: The error message to return in the response.
+        :keyword int response_code: The HTTP status code to respond with.
+            Leave this alone unless the client needs to tell this error
+            apart from the rest.
         """
         self.context = {
             'success': False,
             'message': message,
         }
+        self.response_code = response_code
 
     def render(self):
         """
         Handle construction of the response and return it.
         """
-        return simplejson.dumps(self.context)
+        response = simplejson.dumps(self.context)
+        if not self.ETAG or not self.context.get('success'):
+            return response
+
+        etag = '"%s"' % hashlib.sha1(response).hexdigest()
+        self.request.setHeader('ETag', etag)
+        if_none_match = self.request.getHeader('If-None-Match') or ''
+        if etag in [value.strip() for value in if_none_match.split(',')]:
+            # The client already has this.
+            self.request.setResponseCode(304)
+            return ''
+        return response
+
+    def respond(self):
+        """
+        Renders the response, or starts streaming it for ``STREAM`` views.
+
+        :returns: The response, or ``NOT_DONE_YET`` if it's being streamed.
+        """
+        if self.response_code:
+            self.request.setResponseCode(self.response_code)
+        for name, value in self.response_headers.items():
+            self.request.setHeader(name, value)
+
+        if self.STREAM and self.context.get('success') and \
+           not self.is_request_lost:
+            JSONProducer(self.request, self.context).start()
+            return NOT_DONE_YET
+        return self.render()
+
+    def render_failure(self, failure):
+        """
+        Renders an error response for a deferred view that blew up.
+
+        :param failure: The Twisted Failure.
+        :rtype: str
+        :returns: The response.
+        """
+        logger.error(message_or_obj=failure)
+        self.set_error('An internal error occurred.', response_code=500)
+        return self.respond()
+
+    def _request_lost(self, failure):
+        """
+        Notes that the client went away before a deferred view was done.
+        """
+        self.is_request_lost = True
+
+    def _finish_request(self, response):
+        """
+        Sends the response for a deferred view, if anyone's still listening.
+
+        :param str response: The rendered response, or ``NOT_DONE_YET`` if
+            it's being streamed.
+        """
+        if self.is_request_lost or response is NOT_DONE_YET:
+            return
+        self.request.write(response)
+        self.request.finish()
 
     def view(self, *args, **kwargs):
         """
@@ -74,6 +254,10 @@ class BaseView(object):
         want to do that in self.pre_view_checks(), which actually does something
         with return values (which view() doesn't).
         
-        Does not return anything.
+        Views that need to block (on AWS, say) shouldn't do so here, since
+        this runs in the reactor thread. Do the blocking work in a thread
+        instead, and return the Deferred for it. The response is rendered
+        once it fires. Views that write their own response to the request
+        return ``NOT_DONE_YET``. Otherwise, this does not return anything.
         """
         pass